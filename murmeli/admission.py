@@ -0,0 +1,103 @@
+'''Admission control for incoming traffic, limiting the number of messages
+   accepted from each sender and from senders we can't identify'''
+
+import collections
+import threading
+from murmeli.clock import get_default_clock
+from murmeli.message import Message
+from murmeli.tokenbucket import TokenBucket
+from murmeli import framing
+
+
+class AdmissionControl:
+    '''Token buckets for the messages received, one per sender (by tor id if the
+       signature belongs to a contact, otherwise by key id) and one shared by all
+       the unauthenticated traffic, which is the unencrypted frames and the messages
+       with an unknown signature or none at all.  Rates are in messages per second,
+       None for no limit.  Unencrypted frames can be checked as soon as they arrive,
+       but the others only once the signature has been checked.
+       Only the buckets of the most recent max_senders senders are kept.'''
+
+    KEY_ANONYMOUS = "anonymous"
+
+    def __init__(self, sender_rate=1.0, sender_burst=60, anonymous_rate=0.5,
+                 anonymous_burst=30, max_senders=1000, clock=None):
+        self.clock = clock or get_default_clock()
+        self.sender_rate = sender_rate
+        self.sender_burst = sender_burst
+        self.max_senders = max_senders
+        self._anonymous = TokenBucket(anonymous_rate, anonymous_burst,
+                                      clock=self.clock.monotonic) if anonymous_rate else None
+        self._senders = collections.OrderedDict()    # sender -> TokenBucket
+        self._dropped = collections.OrderedDict()    # sender -> number of messages dropped
+        self._lock = threading.Lock()
+        self._stats = {"admitted":0, "dropped":0, "anonymousdropped":0}
+
+    def admit_frame(self, frame):
+        '''Check a frame before it's decrypted, return False if it should be dropped.
+           Only unencrypted frames can be checked at this point.'''
+        if not frame or len(frame) < framing.HEADER_LENGTH \
+          or frame[framing.HEADER_LENGTH - 5] != Message.ENCTYPE_NONE:
+            return True
+        with self._lock:
+            return self._take(None)
+
+    def refund_frame(self, frame):
+        '''Give back the token taken by admit_frame, if the frame couldn't be queued'''
+        if not frame or len(frame) < framing.HEADER_LENGTH \
+          or frame[framing.HEADER_LENGTH - 5] != Message.ENCTYPE_NONE:
+            return
+        with self._lock:
+            if self._anonymous:
+                self._anonymous.give_back(1)
+            self._stats["admitted"] -= 1
+
+    def admit_message(self, msg, sender_id, key_id):
+        '''Check a message once the sender is known, return False if it should be dropped.
+           Unencrypted messages were already checked as frames.'''
+        if msg.enc_type == Message.ENCTYPE_NONE:
+            return True
+        with self._lock:
+            if not sender_id and not self._take(None):
+                return False
+            return self._take(sender_id or key_id)
+
+    def _take(self, sender):
+        '''Take a token for the given sender, or from the anonymous bucket if None'''
+        if sender:
+            bucket = self._get_bucket(sender)
+        else:
+            bucket = self._anonymous
+            sender = self.KEY_ANONYMOUS
+        if bucket is None or bucket.take(1):
+            self._stats["admitted"] += 1
+            return True
+        print("Dropping incoming message from '%s', over its limit" % sender)
+        self._stats["dropped"] += 1
+        if sender == self.KEY_ANONYMOUS:
+            self._stats["anonymousdropped"] += 1
+        self._dropped[sender] = self._dropped.pop(sender, 0) + 1
+        while len(self._dropped) > self.max_senders:
+            self._dropped.popitem(last=False)
+        return False
+
+    def _get_bucket(self, sender):
+        '''Get the bucket for the given sender, making a new one if necessary'''
+        if not self.sender_rate:
+            return None
+        bucket = self._senders.pop(sender, None)
+        if bucket is None:
+            bucket = TokenBucket(self.sender_rate, self.sender_burst,
+                                 clock=self.clock.monotonic)
+        self._senders[sender] = bucket
+        while len(self._senders) > self.max_senders:
+            self._senders.popitem(last=False)
+        return bucket
+
+    def get_stats(self):
+        '''Return a dictionary of counts, including the messages dropped for each sender'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats["senders"] = len(self._senders)
+            stats["throttled"] = dict(self._dropped)
+            return stats
@@ -0,0 +1,161 @@
+'''Asyncio-based listener, an alternative to the thread-per-connection SocketBroker'''
+
+import asyncio
+import threading
+from murmeli.system import System
+from murmeli.inbound import looks_like_http, make_http_reply
+from murmeli.framing import FrameReader, make_ack
+from murmeli import guinotification
+
+
+class AsyncSocketServer(threading.Thread):
+    '''This class listens on the Tor port using a single asyncio event loop in one thread.
+    Each connection is read until it is closed, and each frame is passed on to the
+    decrypt stage of the inbound pipeline as soon as it is complete.  The read timeout
+    starts again after each frame, so idle connections are closed.
+    It offers the same close() method as the SocketBroker so that the TorClient
+    can use either one.'''
+
+    def __init__(self, parent, pipeline, interface="localhost", port=11009, backlog=100,
+                 read_timeout=60, max_connections=500, shutdown_grace=5):
+        threading.Thread.__init__(self)
+        self.parent = parent
+        self.pipeline = pipeline
+        self.interface = interface
+        self.port = port
+        self.backlog = backlog
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self.shutdown_grace = shutdown_grace
+        self.loop = None
+        self.server = None
+        self.running = True
+        self.listening = threading.Event()
+        self._handlers = set()
+        self._stats = {"accepted":0, "rejected":0, "timedout":0, "submitted":0, "hellos":0}
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        '''Running in separate thread'''
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._start_server())
+            if self.server and self.running:
+                self.listening.set()
+                self.loop.run_forever()
+        finally:
+            self.listening.set()
+            self.loop.close()
+        print("Async server has finished accepting new connections, exiting thread")
+
+    async def _start_server(self):
+        '''Try a few times to open the socket, in case the port isn't free yet'''
+        for attempt in range(4):
+            if not self.running:
+                return
+            try:
+                self.server = await asyncio.start_server(self._handle_connection,
+                                                         self.interface, self.port,
+                                                         backlog=self.backlog,
+                                                         reuse_address=True)
+                if not self.port:
+                    self.port = self.server.sockets[0].getsockname()[1]
+                print("Async server listening on port", self.port)
+                return
+            except OSError as exc:
+                print("Attempt", attempt, "- failed to open socket for listening!", exc)
+                await asyncio.sleep(2)
+        print("Failed to start the async server")
+
+    async def _handle_connection(self, reader, writer):
+        '''Deal with a single incoming connection'''
+        if len(self._handlers) >= self.max_connections or not self.running:
+            self._stats["rejected"] += 1
+            writer.close()
+            return
+        self._stats["accepted"] += 1
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        self.parent.call_component(System.COMPNAME_GUI, "notify_gui",
+                                   notify_type=guinotification.NOTIFY_MSG_RECEIVING)
+        try:
+            await self._read_frames(reader, writer)
+        except asyncio.TimeoutError:
+            print("Timed out waiting for data on connection")
+            self._stats["timedout"] += 1
+        except (OSError, asyncio.IncompleteReadError) as exc:
+            print("Failed to receive data from connection:", exc)
+        finally:
+            writer.close()
+            self._handlers.discard(handler)
+            self.parent.call_component(System.COMPNAME_GUI, "notify_gui",
+                                       notify_type=guinotification.NOTIFY_MSG_RECEIVED)
+
+    async def _read_frames(self, reader, writer):
+        '''Read and submit the frames from the connection, and reply to http requests'''
+        frame_reader = FrameReader()
+        deadline = self.loop.time() + self.read_timeout
+        while not frame_reader.invalid:
+            received = await asyncio.wait_for(reader.read(4096),
+                                              max(0.0, deadline - self.loop.time()))
+            if not received:
+                remainder = frame_reader.get_remainder()
+                if remainder:
+                    # Unframed data from old senders is passed on as a whole
+                    await self._submit(remainder)
+                return
+            if not frame_reader.buffer and not frame_reader.num_frames \
+              and looks_like_http(received):
+                print("Got Http request: ", received)
+                writer.write(make_http_reply())
+                await writer.drain()
+                self.parent.call_component(System.COMPNAME_LOGGING, "log",
+                                           logstr="Received http request")
+                return
+            had_hello = frame_reader.hello_version is not None
+            frames = frame_reader.feed(received)
+            if frame_reader.hello_version is not None and not had_hello:
+                self._stats["hellos"] += 1
+                writer.write(make_ack())
+                await writer.drain()
+            for frame in frames:
+                await self._submit(frame)
+            if frames:
+                deadline = self.loop.time() + self.read_timeout
+
+    async def _submit(self, msg):
+        '''Pass the message to the pipeline, waiting without blocking the loop if it's full'''
+        while True:
+            if self.pipeline.submit_data(msg, timeout=0):
+                self._stats["submitted"] += 1
+                return
+            await asyncio.sleep(0.05)
+
+    async def _shutdown(self):
+        '''Stop accepting, give the open connections some time to finish, then cancel them'''
+        if self.server:
+            self.server.close()
+        if self._handlers:
+            _, pending = await asyncio.wait(list(self._handlers), timeout=self.shutdown_grace)
+            for handler in pending:
+                handler.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self.server:
+            await self.server.wait_closed()
+        self.loop.stop()
+
+    def get_stats(self):
+        '''Return a dictionary of connection counts'''
+        stats = dict(self._stats)
+        stats["open"] = len(self._handlers)
+        return stats
+
+    def close(self):
+        '''Call from outside to cleanly close the thread and its socket'''
+        self.running = False
+        if self.loop and self.loop.is_running():
+            print("AsyncSocketServer.close - shutting down")
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+            self.join(self.shutdown_grace + 2)
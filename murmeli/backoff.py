@@ -0,0 +1,104 @@
+'''Exponential backoff of delivery attempts to recipients who can't be reached'''
+
+import random
+import threading
+import time
+
+
+class DeliveryBackoff:
+    '''Keeps track of the consecutive delivery failures for each recipient, and the
+       time before which no further attempt should be made.  The delay doubles with
+       each failure up to a maximum, and is reduced by a random amount so that
+       retries to many recipients don't all happen at once.
+       States are dictionaries with torid, failures and nextAttempt (epoch seconds),
+       so that they can be stored in the database and survive a restart.'''
+
+    def __init__(self, base_delay=60, max_delay=4*3600, jitter=0.5, clock=None, rand=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.clock = clock or time.time
+        self.rand = rand or random.random
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._states = {}
+        self._num_deferred = 0
+
+    def load(self, states):
+        '''Load the given list of states, for example from the database'''
+        with self._lock:
+            self._states = {state['torid']:dict(state) for state in states or []
+                            if state and state.get('torid')}
+            self.loaded = True
+
+    def get_delay(self, failures):
+        '''Get the jittered delay in seconds after the given number of consecutive failures'''
+        if failures <= 0:
+            return 0
+        delay = min(self.max_delay, self.base_delay * 2 ** min(failures - 1, 30))
+        return delay * (1.0 - self.jitter * self.rand())
+
+    def is_due(self, recipient):
+        '''Return True if a delivery to this recipient may be attempted now'''
+        with self._lock:
+            state = self._states.get(recipient)
+            return not state or state.get('nextAttempt', 0) <= self.clock()
+
+    def get_deferred(self, recipients):
+        '''Get the set of the given recipients which are not due yet'''
+        deferred = {recpt for recpt in recipients if not self.is_due(recpt)}
+        with self._lock:
+            self._num_deferred += len(deferred)
+        return deferred
+
+    def get_next_attempt(self, recipients):
+        '''Get the earliest time in the future when one of the given recipients
+           may be tried again, or None if none of them are backing off'''
+        with self._lock:
+            now = self.clock()
+            times = [state.get('nextAttempt', 0) for state in
+                     [self._states.get(recpt) for recpt in recipients] if state]
+            times = [when for when in times if when > now]
+        return min(times) if times else None
+
+    def record_failure(self, recipient):
+        '''Record a failed delivery attempt, and return the new state'''
+        with self._lock:
+            state = self._states.setdefault(recipient, {'torid':recipient, 'failures':0})
+            state['failures'] = state.get('failures', 0) + 1
+            state['nextAttempt'] = self.clock() + self.get_delay(state['failures'])
+            return dict(state)
+
+    def get_state(self, recipient):
+        '''Get a copy of the state of the given recipient, or None'''
+        with self._lock:
+            state = self._states.get(recipient)
+            return dict(state) if state else None
+
+    def bring_forward(self, recipient, when):
+        '''Allow the next attempt at the given time if that's earlier than planned,
+           return the new state if it changed'''
+        with self._lock:
+            state = self._states.get(recipient)
+            if not state or state.get('nextAttempt', 0) <= when:
+                return None
+            state['nextAttempt'] = when
+            return dict(state)
+
+    def reset(self, recipient):
+        '''Forget the failures for this recipient, return the new state if it changed'''
+        with self._lock:
+            state = self._states.get(recipient)
+            if not state or not state.get('failures'):
+                return None
+            state['failures'] = 0
+            state['nextAttempt'] = 0
+            return dict(state)
+
+    def get_stats(self):
+        '''Return a dictionary of backoff counts'''
+        with self._lock:
+            now = self.clock()
+            return {"backingoff":len([state for state in self._states.values()
+                                      if state.get('nextAttempt', 0) > now]),
+                    "deferred":self._num_deferred}
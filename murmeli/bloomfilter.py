@@ -0,0 +1,128 @@
+'''Bloom filters for remembering which items have been seen, in a fixed amount of space'''
+
+import hashlib
+import math
+import threading
+import time
+
+
+class BloomFilter:
+    '''Set of strings which can't list its items, and which may wrongly claim to contain
+       an item (with a small probability depending on its size) but never wrongly
+       claims not to contain one.'''
+
+    def __init__(self, num_bits, num_hashes):
+        self.num_bits = max(8, int(num_bits))
+        self.num_hashes = max(1, int(num_hashes))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    @staticmethod
+    def get_size(capacity, error_rate):
+        '''Get the number of bits and hashes needed for the given number of items
+           with the given probability of false positives'''
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        num_hashes = round(num_bits / capacity * math.log(2))
+        return (num_bits, max(1, num_hashes))
+
+    def _get_positions(self, item):
+        '''Get the bit positions for the given item, using double hashing'''
+        digest = hashlib.sha256(item.encode("utf-8")).digest()
+        hash1 = int.from_bytes(digest[:8], "little")
+        hash2 = int.from_bytes(digest[8:16], "little") | 1
+        return [(hash1 + i * hash2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, item):
+        return all(self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._get_positions(item))
+
+    def add(self, item):
+        '''Add the given item, return False if it was (apparently) already there'''
+        added = False
+        for pos in self._get_positions(item):
+            mask = 1 << (pos % 8)
+            if not self.bits[pos // 8] & mask:
+                self.bits[pos // 8] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def to_string(self):
+        '''Get the bits as a hex string for storing'''
+        return self.bits.hex()
+
+    def load_string(self, bit_string):
+        '''Take the bits from the given hex string, if it's the right size'''
+        bits = bytearray.fromhex(bit_string or "")
+        if len(bits) != len(self.bits):
+            return False
+        self.bits = bits
+        return True
+
+
+class RotatingBloomFilter:
+    '''Seen-set with two generations of Bloom filter.  Items are added to the current
+       filter and looked for in both.  Once the current filter holds its capacity or is
+       older than max_age seconds, it replaces the previous one and a new empty filter
+       is started, so that old items are forgotten and false positives stay rare.
+       The state is a dictionary, so that it can be stored in the database.'''
+
+    def __init__(self, capacity=10000, error_rate=0.001, max_age=7 * 24 * 3600, clock=None):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.clock = clock or time.time
+        self.num_bits, self.num_hashes = BloomFilter.get_size(capacity, error_rate)
+        self._lock = threading.Lock()
+        self.current = BloomFilter(self.num_bits, self.num_hashes)
+        self.previous = None
+        self.started = self.clock()
+        self.num_rotations = 0
+
+    def check_and_add(self, item):
+        '''Add the given item, return True if it had already been seen'''
+        with self._lock:
+            self._rotate_if_due()
+            seen = item in self.current or (self.previous is not None and item in self.previous)
+            if not seen:
+                self.current.add(item)
+            return seen
+
+    def __contains__(self, item):
+        with self._lock:
+            return item in self.current or (self.previous is not None and item in self.previous)
+
+    def _rotate_if_due(self):
+        '''Start a new generation if the current one is full or too old'''
+        if self.current.count >= self.capacity or self.clock() - self.started > self.max_age:
+            self.previous = self.current
+            self.current = BloomFilter(self.num_bits, self.num_hashes)
+            self.started = self.clock()
+            self.num_rotations += 1
+
+    def get_state(self):
+        '''Get the state as a dictionary for storing'''
+        with self._lock:
+            return {"numBits":self.num_bits, "numHashes":self.num_hashes,
+                    "current":self.current.to_string(), "count":self.current.count,
+                    "previous":self.previous.to_string() if self.previous else "",
+                    "started":self.started}
+
+    def load(self, state):
+        '''Load the stored state, unless it was made with different sizes'''
+        if not state or state.get("numBits") != self.num_bits \
+          or state.get("numHashes") != self.num_hashes:
+            return False
+        with self._lock:
+            current = BloomFilter(self.num_bits, self.num_hashes)
+            if not current.load_string(state.get("current")):
+                return False
+            current.count = state.get("count", 0)
+            previous = None
+            if state.get("previous"):
+                previous = BloomFilter(self.num_bits, self.num_hashes)
+                if not previous.load_string(state.get("previous")):
+                    previous = None
+            self.current = current
+            self.previous = previous
+            self.started = state.get("started", self.clock())
+        return True
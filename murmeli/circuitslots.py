@@ -0,0 +1,92 @@
+'''Isolation credentials for the SOCKS connections to tor, so that sends to different
+   peers don't all share the same circuits'''
+
+import random
+import threading
+
+
+class CircuitSlots:
+    '''Spreads the destinations over a number of slots, each with its own SOCKS5
+       username and password.  Tor's SocksPort isolates streams by these credentials
+       (IsolateSOCKSAuth is on by default), so each slot gets its own circuits.
+       A destination keeps its slot while it's free, so that its circuits can be
+       reused, but moves to the least busy slot if others are sending on it.
+       With no slots, each destination gets credentials of its own.'''
+
+    def __init__(self, num_slots=8, rand=None):
+        self.num_slots = max(0, num_slots)
+        # Random per session, so that the credentials can't be linked across restarts
+        self.session = "%016x" % (rand or random.Random()).getrandbits(64)
+        self._lock = threading.Lock()
+        self._slots = {}     # destination -> slot
+        self._sending = {}   # destination -> number of sends in progress
+        self._loads = [0] * self.num_slots
+        self._new_num_slots = None    # requested while sends were in progress
+        self._stats = {"acquired":0, "moved":0, "shared":0}
+
+    def set_num_slots(self, num_slots):
+        '''Change the number of slots, forgetting the previous assignments.
+           If sends are in progress, the change is made when they've all finished.'''
+        with self._lock:
+            self._new_num_slots = max(0, num_slots)
+            if not self._sending:
+                self._resize()
+
+    def _resize(self):
+        '''Apply the requested number of slots, assuming we have the lock'''
+        num_slots = self._new_num_slots
+        self._new_num_slots = None
+        if num_slots is not None and num_slots != self.num_slots:
+            self.num_slots = num_slots
+            self._slots = {}
+            self._loads = [0] * num_slots
+
+    def acquire(self, whoto):
+        '''Choose the slot for a send to the given destination, and return it'''
+        with self._lock:
+            self._stats["acquired"] += 1
+            if not self.num_slots:
+                return None
+            slot = self._slots.get(whoto)
+            if not self._sending.get(whoto):
+                least_busy = self._loads.index(min(self._loads))
+                if slot is None or self._loads[slot] > self._loads[least_busy]:
+                    if slot is not None:
+                        self._stats["moved"] += 1
+                    slot = least_busy
+                    self._slots[whoto] = slot
+                if self._loads[slot]:
+                    self._stats["shared"] += 1
+                self._loads[slot] += 1
+            self._sending[whoto] = self._sending.get(whoto, 0) + 1
+            return slot
+
+    def release(self, whoto):
+        '''The send to the given destination has finished'''
+        with self._lock:
+            remaining = self._sending.get(whoto, 0) - 1
+            if remaining > 0:
+                self._sending[whoto] = remaining
+                return
+            self._sending.pop(whoto, None)
+            slot = self._slots.get(whoto)
+            if slot is not None and slot < len(self._loads):
+                self._loads[slot] -= 1
+            if not self._sending and self._new_num_slots is not None:
+                self._resize()
+
+    def get_credentials(self, whoto):
+        '''Get the username and password to use for connecting to the given destination'''
+        with self._lock:
+            slot = self._slots.get(whoto) if self.num_slots else None
+        if slot is None:
+            return ("murmeli-" + whoto, self.session)
+        return ("murmeli-slot%d" % slot, self.session)
+
+    def get_stats(self):
+        '''Return a dictionary of slot counts'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats["slots"] = self.num_slots
+            stats["busy"] = len([load for load in self._loads if load])
+        return stats
@@ -0,0 +1,78 @@
+'''Clock for getting the current time, which can be replaced for testing'''
+
+import threading
+import time
+
+
+class SystemClock:
+    '''Clock using the real system time'''
+
+    @staticmethod
+    def time():
+        '''Get the current wall-clock time in seconds since the epoch'''
+        return time.time()
+
+    @staticmethod
+    def monotonic():
+        '''Get the current time from a clock which never goes backwards'''
+        return time.monotonic()
+
+    @staticmethod
+    def sleep(secs):
+        '''Wait for the given number of seconds'''
+        time.sleep(secs)
+
+
+class VirtualClock:
+    '''Clock which only moves when told to, so that hours of activity can be
+       simulated in a moment.  Sleeping just moves the clock forward.'''
+
+    def __init__(self, start_time=1500000000.0):
+        self._lock = threading.Lock()
+        self._now = start_time
+        self._listeners = []
+
+    def time(self):
+        '''Get the current virtual time in seconds since the epoch'''
+        with self._lock:
+            return self._now
+
+    def monotonic(self):
+        '''The virtual time never goes backwards anyway'''
+        return self.time()
+
+    def sleep(self, secs):
+        '''Instead of waiting, move the clock forward'''
+        self.advance(secs)
+
+    def add_listener(self, listener):
+        '''Add a callable to be called with the new time whenever the clock moves'''
+        self._listeners.append(listener)
+
+    def advance(self, secs):
+        '''Move the clock forward by the given number of seconds'''
+        self.advance_to(self.time() + max(0.0, secs))
+
+    def advance_to(self, when):
+        '''Move the clock forward to the given time, if it's not there already'''
+        with self._lock:
+            if when <= self._now:
+                return
+            self._now = when
+        for listener in self._listeners:
+            listener(when)
+
+
+_DEFAULT_CLOCK = SystemClock()
+
+def get_default_clock():
+    '''Get the clock used by everything which hasn't been given its own'''
+    return _DEFAULT_CLOCK
+
+def set_default_clock(clock):
+    '''Replace the default clock, for example by a virtual one for a simulation.
+       Returns the previous one so that it can be restored afterwards.'''
+    global _DEFAULT_CLOCK
+    previous = _DEFAULT_CLOCK
+    _DEFAULT_CLOCK = clock or SystemClock()
+    return previous
@@ -16,6 +16,15 @@ class Config(Component):
     KEY_LET_FRIENDS_SEE_FRIENDS = "privacy.friendsseefriends"
     KEY_ALLOW_FRIEND_REQUESTS = "privacy.allowfriendrequests"
     KEY_SHOW_LOG_WINDOW = "gui.showlogwindow"
+    # upload limits in KiB per second, 0 for no limit
+    KEY_UPLOAD_LIMIT = "network.uploadlimit"
+    KEY_PEER_UPLOAD_LIMIT = "network.peeruploadlimit"
+    KEY_REUSE_CONNECTIONS = "network.reuseconnections"
+    # number of separately isolated tor circuits for sending, 0 for one per peer
+    KEY_CIRCUIT_SLOTS = "network.circuitslots"
+    # hops allowed for relayed messages, and number of relays to use (0 for all)
+    KEY_RELAY_HOPS = "network.relayhops"
+    KEY_RELAY_FANOUT = "network.relayfanout"
     # paths
     KEY_DATA_DIR = "path.data"
     KEY_TOR_EXE = "path.torexe"
@@ -45,6 +54,13 @@ class Config(Component):
         self.properties[Config.KEY_ALLOW_FRIEND_REQUESTS] = True
         # Default gui settings
         self.properties[Config.KEY_SHOW_LOG_WINDOW] = False
+        # Default network settings
+        self.properties[Config.KEY_UPLOAD_LIMIT] = 0
+        self.properties[Config.KEY_PEER_UPLOAD_LIMIT] = 0
+        self.properties[Config.KEY_REUSE_CONNECTIONS] = False
+        self.properties[Config.KEY_CIRCUIT_SLOTS] = 8
+        self.properties[Config.KEY_RELAY_HOPS] = 1
+        self.properties[Config.KEY_RELAY_FANOUT] = 0
 
         # Locate file in home directory, and load it if found
         self.from_file = False
@@ -61,6 +77,7 @@ class Config(Component):
         self._fix_boolean_property(Config.KEY_LET_FRIENDS_SEE_FRIENDS)
         self._fix_boolean_property(Config.KEY_ALLOW_FRIEND_REQUESTS)
         self._fix_boolean_property(Config.KEY_SHOW_LOG_WINDOW)
+        self._fix_boolean_property(Config.KEY_REUSE_CONNECTIONS)
 
     def _fix_boolean_property(self, prop_name):
         '''Helper method to fix the loading of string values representing booleans'''
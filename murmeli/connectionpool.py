@@ -0,0 +1,187 @@
+'''Pool of open outgoing connections, so that several messages can be sent to a peer
+   without a new connection (and Tor rendezvous) for each one'''
+
+import select
+import socket
+import threading
+from murmeli.clock import get_default_clock
+from murmeli import framing
+
+
+class PeerConnectionPool:
+    '''Keeps at most one idle connection to each peer, closing it after idle_timeout.
+       New connections start with a hello, and are only kept open if the peer
+       answers with an ack of a version which understands several frames per
+       connection.  Peers which don't answer within hello_timeout are remembered
+       as old versions and get a new connection per message, until legacy_recheck
+       seconds have passed and the hello is tried again.
+       The connect function takes a peer and returns a connected socket.'''
+
+    def __init__(self, connect, idle_timeout=20, hello_timeout=10,
+                 legacy_recheck=24 * 3600, clock=None):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.hello_timeout = hello_timeout
+        self.legacy_recheck = legacy_recheck
+        self.clock = clock or get_default_clock()
+        self._lock = threading.Lock()
+        self._idle = {}          # peer -> (socket, time when last used)
+        self._versions = {}      # peer -> (version, time when found out)
+        self._stats = {"connects":0, "reused":0, "legacy":0, "idleclosed":0, "failed":0}
+
+    def get_peer_version(self, peer):
+        '''Get the protocol version of the peer, or None if we don't know it yet'''
+        with self._lock:
+            found = self._versions.get(peer)
+        return found[0] if found else None
+
+    def send(self, peer, data):
+        '''Send the given bytes to the peer, reusing a connection if possible.
+           Return True if the bytes were sent.'''
+        conn = self._take_idle(peer)
+        if conn:
+            try:
+                conn.sendall(data)
+                self._put_back(peer, conn)
+                self._count("reused")
+                return True
+            except OSError as exc:
+                print("Failed to reuse connection, opening a new one:", exc)
+                self._close(conn)
+        try:
+            return self._send_on_new_connection(peer, data)
+        except OSError as exc:
+            print("Failed to send over new connection:", exc)
+            self._count("failed")
+            return False
+
+    def _send_on_new_connection(self, peer, data):
+        '''Open a connection, say hello if necessary, and send the bytes'''
+        version = self._get_known_version(peer)
+        conn = self._connect(peer)
+        if version is None:
+            version = self._say_hello(conn)
+            with self._lock:
+                self._versions[peer] = (version, self.clock.monotonic())
+            if version < framing.MULTI_FRAME_VERSION:
+                # The old peer will just drop the hello, so it needs a fresh connection
+                self._count("legacy")
+                self._close(conn)
+                conn = self._connect(peer)
+        try:
+            conn.sendall(data)
+        except OSError:
+            self._close(conn)
+            raise
+        if version >= framing.MULTI_FRAME_VERSION:
+            self._put_back(peer, conn)
+        else:
+            self._close(conn)
+        return True
+
+    def _connect(self, peer):
+        '''Open a new connection to the peer'''
+        conn = self.connect(peer)
+        self._count("connects")
+        return conn
+
+    def _say_hello(self, conn):
+        '''Send the hello and wait for the ack, returning the peer's version'''
+        conn.sendall(framing.make_hello())
+        reply = bytes()
+        expected_length = len(framing.ACK_TOKEN) + 1
+        try:
+            conn.settimeout(self.hello_timeout)
+            while len(reply) < expected_length:
+                received = conn.recv(expected_length - len(reply))
+                if not received:
+                    break
+                reply += received
+        except socket.timeout:
+            pass
+        finally:
+            conn.settimeout(None)
+        return framing.parse_ack(reply) or 1
+
+    def _get_known_version(self, peer):
+        '''Get the version of the peer unless we should ask again'''
+        with self._lock:
+            found = self._versions.get(peer)
+            if not found:
+                return None
+            version, when = found
+            if version < framing.MULTI_FRAME_VERSION and \
+              self.clock.monotonic() - when > self.legacy_recheck:
+                del self._versions[peer]
+                return None
+            return version
+
+    def _take_idle(self, peer):
+        '''Take the idle connection to this peer out of the pool, if it's still usable'''
+        self.close_idle()
+        with self._lock:
+            conn, _ = self._idle.pop(peer, (None, None))
+        if conn and not self._is_still_open(conn):
+            self._close(conn)
+            return None
+        return conn
+
+    def _put_back(self, peer, conn):
+        '''Put the connection back into the pool, unless there's already one'''
+        with self._lock:
+            if peer not in self._idle:
+                self._idle[peer] = (conn, self.clock.monotonic())
+                return
+        self._close(conn)
+
+    @staticmethod
+    def _is_still_open(conn):
+        '''Check that the peer hasn't closed the connection while it was idle'''
+        try:
+            readable, _, _ = select.select([conn], [], [], 0)
+            if readable:
+                return bool(conn.recv(1, socket.MSG_PEEK))
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def close_idle(self):
+        '''Close the connections which haven't been used for a while'''
+        now = self.clock.monotonic()
+        with self._lock:
+            expired = [peer for peer, (_, when) in self._idle.items()
+                       if now - when > self.idle_timeout]
+            conns = [self._idle.pop(peer)[0] for peer in expired]
+            self._stats["idleclosed"] += len(conns)
+        for conn in conns:
+            self._close(conn)
+
+    def close_all(self):
+        '''Close all the idle connections'''
+        with self._lock:
+            conns = [conn for conn, _ in self._idle.values()]
+            self._idle.clear()
+        for conn in conns:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        '''Close the given connection, ignoring errors'''
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+    def _count(self, key):
+        '''Increment the given counter'''
+        with self._lock:
+            self._stats[key] += 1
+
+    def get_stats(self):
+        '''Return a dictionary of connection counts'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats["open"] = len(self._idle)
+            stats["legacypeers"] = len([1 for version, _ in self._versions.values()
+                                        if version < framing.MULTI_FRAME_VERSION])
+        return stats
@@ -1,12 +1,14 @@
 '''Module to deal with the in-memory storage of the status of our contacts'''
 import datetime
 from murmeli.system import System, Component
+from murmeli.clock import get_default_clock
 
 class Contacts(Component):
     '''Class to manage the set of which of our contacts are currently online'''
 
-    def __init__(self, parent):
+    def __init__(self, parent, clock=None):
         Component.__init__(self, parent, System.COMPNAME_CONTACTS)
+        self.clock = clock or get_default_clock()
         self._online_list = set()
         self._last_times = {}
 
@@ -20,17 +22,29 @@ class Contacts(Component):
     def come_online(self, tor_id):
         '''The given tor id has announced it is online'''
         if not self.is_online(tor_id):
-            self._last_times[tor_id] = datetime.datetime.now()
+            self._last_times[tor_id] = self._get_now()
         self._online_list.add(tor_id)
+        self._inform_postservice(tor_id, True)
         #print("Contacts just informed that", tor_id, "is online.  Set is now", self._online_list)
 
     def gone_offline(self, tor_id):
         '''The given tor id has announced it is offline (or we failed to send to it)'''
         if self.is_online(tor_id):
             self._online_list.remove(tor_id)
-            self._last_times[tor_id] = datetime.datetime.now()
+            self._last_times[tor_id] = self._get_now()
+        self._inform_postservice(tor_id, False)
         #print("Contacts just informed that", tor_id, "is offline.  Set is now", self._online_list)
 
+    def _inform_postservice(self, tor_id, online):
+        '''Let the post service know, so it can send to online contacts first'''
+        if self.get_component(System.COMPNAME_POSTSERVICE):
+            self.call_component(System.COMPNAME_POSTSERVICE, "set_recipient_online",
+                                tor_id=tor_id, online=online)
+
+    def _get_now(self):
+        '''Get the current time from the clock as a datetime'''
+        return datetime.datetime.fromtimestamp(self.clock.time())
+
     def is_online(self, tor_id):
         '''Check whether the given tor id is currently online (as far as we know)'''
         # print("Contact list asked about", tor_id, ", answer is", (tor_id in self._online_list))
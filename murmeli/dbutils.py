@@ -311,32 +311,57 @@ def add_message_to_outbox(msg, crypto, database, dont_relay=None):
                 try:
                     encrypter = EncrypterShim(database=database, crypto=crypto,
                                               encrypt_key=encrypt_key)
-                    to_send = imageutils.bytes_to_string(msg.create_output(encrypter=encrypter))
+                    output = msg.create_output(encrypter=encrypter)
+                    to_send = imageutils.bytes_to_string(output)
                     if not to_send:
                         print("WARN: message to send is empty for enc type:", msg.enc_type)
                     database.add_row_to_outbox({"recipient":recpt,
                                                 "relays":list(relays.difference({recpt})),
                                                 "message":to_send,
+                                                "checksum":message.Message.get_frame_checksum(
+                                                    output),
                                                 "queue":msg.should_be_queued,
                                                 "encType":msg.enc_type,
-                                                "msgType":msg.describe_message_type()})
+                                                "msgType":msg.describe_message_type(),
+                                                "timestamp":msg.make_current_timestamp(),
+                                                "coalesceKey":msg.get_coalesce_key()})
                 except CryptoError as exc:
                     print("CryptoError thrown: can't add message to Outbox!", exc)
             else:
                 print("Profile for '%s' has no keyid so can't add message to outbox!" % recpt)
 
-def add_relayed_message_to_outbox(msg, sender_id, database):
-    '''Unpack the given relayed message and copy contents to the outbox.'''
+def add_relayed_message_to_outbox(msg, sender_id, database, fanout=None, order=None,
+                                  quota=None):
+    '''Unpack the given relayed message and copy contents to the outbox.
+       With a fanout, only that many contacts get it, the first ones after
+       putting them in the given order.  With a quota, older copies may be
+       evicted to make room, or this one may not be stored at all.'''
     assert msg
     print("Relayed msg is of type:", type(msg))
     recipients = {profile['torid'] for profile in \
       database.get_profiles_with_status(["trusted", "owner"])}
     recipients.discard(sender_id)
-    # convert output to string for storage
-    to_send = imageutils.bytes_to_string(msg.create_output(encrypter=None))
+    recipients = order(sorted(recipients)) if order else sorted(recipients)
+    if fanout:
+        recipients = recipients[:fanout]
+    # convert output to string for storage, with one hop fewer if it goes further
+    output = msg.get_forward_output()
+    to_send = imageutils.bytes_to_string(output)
     if not to_send:
         print("ERROR: Relayed message to send is empty for type", msg.enc_type)
-    database.add_row_to_outbox({"recipientList":list(recipients),
-                                "relays":[], "message":to_send,
-                                "queue":True, "encType":msg.enc_type,
-                                "msgType":msg.describe_message_type()})
+    # After the last hop, recipients which understand it get it marked as relayed
+    last_hop_output = msg.get_last_hop_output()
+    # The original sender may later tell us to drop this copy, using the checksum
+    row = {"recipientList":list(recipients),
+           "relays":[], "message":to_send,
+           "checksum":message.Message.get_frame_checksum(msg.received_bytes or output),
+           "origin":sender_id,
+           "queue":True, "encType":msg.enc_type,
+           "msgType":msg.describe_message_type(),
+           "timestamp":msg.make_current_timestamp()}
+    if last_hop_output:
+        row["lastHop"] = imageutils.bytes_to_string(last_hop_output)
+    if quota:
+        return quota.store(database, sender_id, row)
+    database.add_row_to_outbox(row)
+    return True
@@ -12,12 +12,13 @@ class DecrypterShim:
 
     def decrypt(self, enc_data, enc_type):
         '''Decrypt the given encrypted data, return 2-tuple of data and sender keyid'''
-        if enc_type == Message.ENCTYPE_NONE:
+        if enc_type in [Message.ENCTYPE_NONE, Message.ENCTYPE_ENVELOPE]:
+            # The messages inside an envelope are decrypted separately
             return (enc_data, None)
         if enc_type == Message.ENCTYPE_ASYM:
             assert self.crypto
             return self.crypto.decrypt_and_check_signature(message=enc_data)
-        if enc_type == Message.ENCTYPE_RELAY:
+        if enc_type in [Message.ENCTYPE_RELAY, Message.ENCTYPE_RELAY_HOPS]:
             assert self.crypto
             return self.crypto.verify_signed_data(message=enc_data)
         # Unsupported encryption type
@@ -0,0 +1,185 @@
+'''Splitting of a stream of received bytes into message frames, and the
+   hello and ack exchanged when several frames are sent over one connection'''
+
+import collections
+import hashlib
+import threading
+from murmeli.clock import get_default_clock
+from murmeli.message import Message
+
+
+# Version 1 peers only understand one message per connection
+PROTOCOL_VERSION = 5
+MULTI_FRAME_VERSION = 2
+# Peers from this version can unpack envelopes of several messages
+ENVELOPE_VERSION = 3
+# Peers from this version can pass on relay messages with more than one hop
+RELAY_HOPS_VERSION = 4
+# Peers from this version know that relay messages with no hops left aren't passed on
+LAST_HOP_VERSION = 5
+
+MAGIC = Message.MAGIC_TOKEN.encode("utf-8")
+HELLO_TOKEN = MAGIC + "hello".encode("utf-8")
+ACK_TOKEN = MAGIC + "ack".encode("utf-8")
+# magic, checksum, enc type, payload length
+HEADER_LENGTH = len(MAGIC) + 16 + 1 + 4
+TRAILER_LENGTH = len(MAGIC)
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def make_hello(version=PROTOCOL_VERSION):
+    '''Make the bytes sent by a sender at the start of a multi-frame connection'''
+    return HELLO_TOKEN + bytes([version])
+
+def make_ack(version=PROTOCOL_VERSION):
+    '''Make the bytes sent back by a receiver which understands the hello'''
+    return ACK_TOKEN + bytes([version])
+
+def parse_ack(data):
+    '''Get the version from the given ack, or None if it isn't an ack'''
+    if data and len(data) == len(ACK_TOKEN) + 1 and data.startswith(ACK_TOKEN):
+        return data[-1]
+    return None
+
+def get_frame_length(data):
+    '''Get the total length of the frame at the start of the data,
+       or None if the header hasn't been received yet'''
+    if len(data) < HEADER_LENGTH:
+        return None
+    payload_length = int.from_bytes(data[HEADER_LENGTH - 4:HEADER_LENGTH], "little")
+    return HEADER_LENGTH + payload_length + TRAILER_LENGTH
+
+
+class FrameReader:
+    '''Collects the bytes received on a connection and splits them into frames.
+       A connection may start with a hello, giving the sender's version.
+       Data which doesn't start with the magic token isn't framed, so it's all kept
+       until the connection closes, just like connections from older versions.'''
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.framed = None        # None until we know
+        self.hello_version = None
+        self.invalid = False
+        self.num_frames = 0
+
+    def feed(self, data):
+        '''Add the received bytes, and return the list of frames now complete'''
+        self.buffer += data
+        if self.framed is None:
+            self._check_start()
+        frames = []
+        while self.framed and not self.invalid:
+            length = get_frame_length(self.buffer)
+            if length is None or len(self.buffer) < length:
+                if length and length > self.max_frame_size:
+                    print("Frame of %d bytes is too big" % length)
+                    self.invalid = True
+                break
+            frame = bytes(self.buffer[:length])
+            del self.buffer[:length]
+            if not frame.endswith(MAGIC):
+                # We've lost track of the frames, so the rest can't be trusted
+                self.invalid = True
+            frames.append(frame)
+            self.num_frames += 1
+        return frames
+
+    def _check_start(self):
+        '''Find out from the first bytes whether the data is framed, and take the hello'''
+        hello_length = len(HELLO_TOKEN) + 1
+        if len(self.buffer) < hello_length and HELLO_TOKEN.startswith(bytes(self.buffer)):
+            return    # could still be a hello, need more bytes
+        if self.buffer.startswith(HELLO_TOKEN):
+            self.hello_version = self.buffer[hello_length - 1]
+            del self.buffer[:hello_length]
+            self.framed = True
+        else:
+            self.framed = self.buffer.startswith(MAGIC)
+
+    def get_remainder(self):
+        '''Get the bytes which weren't part of a complete frame, when the connection closes'''
+        remainder = bytes(self.buffer)
+        self.buffer = bytearray()
+        return remainder
+
+
+class RecentFrames:
+    '''Remembers the checksums of the frames received in the last window seconds, up to
+       a maximum number, so that copies arriving again (directly and through relays)
+       can be dropped before any decryption.  The checksum in the header is only
+       trusted if it matches the payload.  Relay frames with a number of hops are
+       keyed without it, so copies passed on by different relays are also caught.'''
+
+    def __init__(self, window=3600, max_entries=10000, clock=None):
+        self.window = window
+        self.max_entries = max_entries
+        self.clock = clock or get_default_clock()
+        self._checksums = collections.OrderedDict()    # checksum -> time received
+        self._lock = threading.Lock()
+        self._stats = {"checked":0, "duplicates":0, "unchecked":0}
+
+    @staticmethod
+    def get_key(frame):
+        '''Get the key of the given frame, or None if it's not a valid frame'''
+        if not frame or len(frame) < HEADER_LENGTH + TRAILER_LENGTH \
+          or not frame.startswith(MAGIC) or get_frame_length(frame) != len(frame):
+            return None
+        payload = bytes(frame[HEADER_LENGTH:-TRAILER_LENGTH])
+        checksum = bytes(frame[len(MAGIC):len(MAGIC) + 16])
+        if hashlib.md5(payload).digest() != checksum:
+            return None
+        if frame[HEADER_LENGTH - 5] == Message.ENCTYPE_RELAY_HOPS:
+            # Same key as the plain relay frame of the same signed message
+            return hashlib.md5(payload[1:]).hexdigest()
+        return checksum.hex()
+
+    def is_duplicate(self, frame, remember=True):
+        '''Return True if the given frame has already been received, otherwise remember
+           it unless told not to, for example until it's been accepted'''
+        return self.is_duplicate_checksum(self.get_key(frame), remember)
+
+    def is_duplicate_checksum(self, key, remember=True):
+        '''Like is_duplicate, but for the hex checksum of a frame already checked'''
+        with self._lock:
+            if not key:
+                self._stats["unchecked"] += 1
+                return False
+            self._stats["checked"] += 1
+            now = self.clock.monotonic()
+            self._expire(now)
+            if key in self._checksums:
+                self._stats["duplicates"] += 1
+                return True
+            if remember:
+                self._add(key, now)
+            return False
+
+    def remember(self, frame):
+        '''Remember the given frame as received'''
+        key = self.get_key(frame)
+        if key:
+            with self._lock:
+                self._add(key, self.clock.monotonic())
+
+    def _add(self, key, now):
+        '''Add the key, forgetting the oldest ones if there are too many'''
+        self._checksums[key] = now
+        while len(self._checksums) > self.max_entries:
+            self._checksums.popitem(last=False)
+
+    def _expire(self, now):
+        '''Forget the checksums which are older than the window'''
+        while self._checksums:
+            checksum, received = next(iter(self._checksums.items()))
+            if now - received <= self.window:
+                break
+            del self._checksums[checksum]
+
+    def get_stats(self):
+        '''Return a dictionary of counts'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats["remembered"] = len(self._checksums)
+            return stats
@@ -0,0 +1,423 @@
+'''Pipeline for processing incoming connections and messages in stages'''
+
+import queue
+import random
+import selectors
+import threading
+import time
+from murmeli.system import System
+from murmeli.admission import AdmissionControl
+from murmeli.message import Message, EnvelopeMessage, RelayMessage
+from murmeli.decrypter import DecrypterShim
+from murmeli.framing import FrameReader, RecentFrames, make_ack, HEADER_LENGTH, \
+    TRAILER_LENGTH
+from murmeli import dbutils
+from murmeli import guinotification
+
+
+def looks_like_http(data):
+    '''Check if the given byte array looks like a HTTP request'''
+    allowed_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ" \
+                    "0123456789/_. \t".encode("utf-8")
+    if not data or not isinstance(data, bytes) or len(data) < 5:
+        return False
+    if "GET".encode("utf-8") != data[:3]:
+        return False
+    for char in data:
+        if char in "\r\n".encode("utf-8"):
+            return True
+        if char not in allowed_chars:
+            return False
+    return True
+
+
+def make_http_reply():
+    '''Make the reply bytes to send back to a http request'''
+    reply = "This is not the hidden service you are looking for (%d)" \
+            % random.Random().choice(range(10000))
+    return reply.encode("utf-8")
+
+
+class PipelineStage:
+    '''One stage of the pipeline, with a bounded queue and a number of worker threads.
+       Each item taken from the queue is passed to the process function, and if that
+       returns something other than None, the result is passed on to the next stage.
+       With zero workers, each item is processed straight away in the calling thread.'''
+
+    def __init__(self, name, process, num_workers=1, max_queued=10):
+        self.name = name
+        self.process = process
+        self.num_workers = max(0, num_workers)
+        self.next_stage = None
+        self._queue = queue.Queue(maxsize=max(1, max_queued))
+        self._stats_lock = threading.Lock()
+        self._num_processed = 0
+        self._num_failed = 0
+        self._total_wait = 0.0
+        self._total_time = 0.0
+        self._max_time = 0.0
+        self._workers = []
+
+    def start(self):
+        '''Start the worker threads'''
+        for _ in range(self.num_workers - len(self._workers)):
+            worker = threading.Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        '''Ask the workers to stop once they've finished what's already queued'''
+        for _ in self._workers:
+            self._queue.put(None)
+        self._workers = []
+
+    def put(self, item, block=True, timeout=None):
+        '''Add an item to the queue, blocking if the queue is full.
+           Returns False if the item couldn't be added within the timeout'''
+        if not self.num_workers:
+            self._process(time.monotonic(), item)
+            return True
+        try:
+            self._queue.put((time.monotonic(), item), block=block, timeout=timeout)
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self):
+        '''Worker loop, running in a separate thread'''
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            self._process(*entry)
+
+    def _process(self, queued_time, item):
+        '''Process one item and pass the result on to the next stage'''
+        start_time = time.monotonic()
+        result = None
+        try:
+            result = self.process(item)
+        except Exception as exc:
+            print("Exception in pipeline stage '%s':" % self.name, exc)
+            with self._stats_lock:
+                self._num_failed += 1
+        end_time = time.monotonic()
+        with self._stats_lock:
+            self._num_processed += 1
+            self._total_wait += start_time - queued_time
+            self._total_time += end_time - start_time
+            self._max_time = max(self._max_time, end_time - start_time)
+        if result is not None and self.next_stage:
+            # blocks if the next stage is full, which slows this stage down too
+            self.next_stage.put(result)
+
+    def get_stats(self):
+        '''Return a dictionary of the current queue depth and latencies'''
+        with self._stats_lock:
+            num_processed = self._num_processed
+            return {"workers":self.num_workers,
+                    "queued":self._queue.qsize(),
+                    "capacity":self._queue.maxsize,
+                    "processed":num_processed,
+                    "failed":self._num_failed,
+                    "avgwait":(self._total_wait / num_processed) if num_processed else 0.0,
+                    "avgtime":(self._total_time / num_processed) if num_processed else 0.0,
+                    "maxtime":self._max_time}
+
+
+class PersistentConnections:
+    '''Connections which have said hello and may stay open between frames, so they're
+       read here instead of holding on to one of the frame workers each.  A single
+       thread waits on all of them at once, passes each complete frame to the submit
+       function, and closes a connection when the sender closes it or it's been idle
+       for idle_timeout seconds.  The on_close function is called after closing each one.'''
+
+    def __init__(self, submit, on_close=None, idle_timeout=60, poll_interval=0.5):
+        self.submit = submit
+        self.on_close = on_close
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._stats = {"adopted":0, "closed":0, "timedout":0}
+
+    def add(self, conn, reader):
+        '''Take over the given connection and the reader of the frames received so far'''
+        with self._lock:
+            self._selector.register(conn, selectors.EVENT_READ, [reader, time.monotonic()])
+            self._stats["adopted"] += 1
+            if not self._running:
+                self._running = True
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        '''Stop the thread, which closes all the connections'''
+        with self._lock:
+            self._running = False
+            thread = self._thread
+            self._thread = None
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout=5)
+
+    def _run(self):
+        '''Read from whichever connections have data, until stopped'''
+        while True:
+            with self._lock:
+                if not self._running:
+                    break
+            for key, _ in self._selector.select(timeout=self.poll_interval):
+                self._read(key.fileobj, key.data)
+            self._close_idle()
+        with self._lock:
+            conns = [key.fileobj for key in self._selector.get_map().values()]
+        for conn in conns:
+            self._close(conn)
+
+    def _read(self, conn, state):
+        '''Read what's arrived on the connection and submit the complete frames'''
+        reader = state[0]
+        try:
+            received = conn.recv(4096)
+        except OSError as exc:
+            print("Failed to receive data from connection:", exc)
+            received = None
+        if not received:
+            self._close(conn)
+            return
+        state[1] = time.monotonic()
+        for frame in reader.feed(received):
+            self.submit(frame)
+        if reader.invalid:
+            self._close(conn)
+
+    def _close_idle(self):
+        '''Close the connections which haven't sent anything for too long'''
+        now = time.monotonic()
+        with self._lock:
+            expired = [key.fileobj for key in self._selector.get_map().values()
+                       if now - key.data[1] > self.idle_timeout]
+            self._stats["timedout"] += len(expired)
+        for conn in expired:
+            self._close(conn)
+
+    def _close(self, conn):
+        '''Stop watching the connection and close it'''
+        with self._lock:
+            self._selector.unregister(conn)
+            self._stats["closed"] += 1
+        conn.close()
+        if self.on_close:
+            self.on_close()
+
+    def get_stats(self):
+        '''Return a dictionary of connection counts'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats["open"] = len(self._selector.get_map())
+        return stats
+
+
+class InboundPipeline:
+    '''Processes incoming connections through a chain of stages, each with
+       a bounded queue and its own worker threads:
+         frame   - read the frames from the connection, answer http probes
+         decrypt - check the frame, decrypt and verify the payload
+         resolve - look up the sender using the signature's key id
+         handle  - pass to the message handler, which stores the results
+       When the queues are full, submitting a new connection blocks, which
+       pushes back onto the accept loop instead of creating more threads.
+       Connections which say hello may stay open for more frames, and after the
+       first read they're watched by a single thread instead of a frame worker.
+       Frames which have already been received recently are dropped before
+       they reach the decrypt stage, and so are messages from senders who
+       have sent too many, as early as they can be identified.'''
+
+    STAGE_FRAME = "frame"
+    STAGE_DECRYPT = "decrypt"
+    STAGE_RESOLVE = "resolve"
+    STAGE_HANDLE = "handle"
+
+    # Default number of workers for each stage
+    DEFAULT_WORKERS = {STAGE_FRAME:4, STAGE_DECRYPT:2, STAGE_RESOLVE:1, STAGE_HANDLE:1}
+    # Seconds to wait for data on an incoming connection before giving up
+    RECEIVE_TIMEOUT = 60
+
+    def __init__(self, component, workers=None, max_queued=10, recent_frames=None,
+                 admission=None):
+        self.component = component
+        self.recent_frames = recent_frames or RecentFrames()
+        self.admission = admission or AdmissionControl()
+        num_workers = dict(self.DEFAULT_WORKERS)
+        num_workers.update(workers or {})
+        self.stages = [PipelineStage(self.STAGE_FRAME, self._read_connection,
+                                     num_workers[self.STAGE_FRAME], max_queued),
+                       PipelineStage(self.STAGE_DECRYPT, self._decrypt_data,
+                                     num_workers[self.STAGE_DECRYPT], max_queued),
+                       PipelineStage(self.STAGE_RESOLVE, self._resolve_sender,
+                                     num_workers[self.STAGE_RESOLVE], max_queued),
+                       PipelineStage(self.STAGE_HANDLE, self._handle_message,
+                                     num_workers[self.STAGE_HANDLE], max_queued)]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+        self.persistent = PersistentConnections(self.submit_data, self._notify_received,
+                                                idle_timeout=self.RECEIVE_TIMEOUT)
+        self.running = False
+
+    def start(self):
+        '''Start the worker threads of all stages'''
+        self.running = True
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        '''Stop the worker threads of all stages'''
+        self.running = False
+        self.persistent.stop()
+        for stage in self.stages:
+            stage.stop()
+
+    def get_stage(self, name):
+        '''Get the stage with the given name'''
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    def submit_connection(self, conn, timeout=None):
+        '''Pass a newly accepted connection to the first stage, blocking if full'''
+        return self.stages[0].put(conn, timeout=timeout)
+
+    def submit_data(self, data, timeout=None):
+        '''Pass the bytes of an already-received message to the decrypt stage,
+           unless it's a copy of one received recently or over the limits.
+           Returns False if the stage is full, and then the frame may be submitted again.'''
+        if self.recent_frames.is_duplicate(data, remember=False):
+            print("Dropping a copy of a frame already received")
+            return True
+        if not self.admission.admit_frame(data):
+            return True
+        if not self.get_stage(self.STAGE_DECRYPT).put(data, timeout=timeout):
+            # Not accepted, so it may be submitted again later without being a copy
+            self.admission.refund_frame(data)
+            return False
+        self.recent_frames.remember(data)
+        return True
+
+    def get_stats(self):
+        '''Return a dictionary of stats for each stage, the duplicate counts
+           and the admission counts'''
+        stats = {stage.name:stage.get_stats() for stage in self.stages}
+        stats["recentframes"] = self.recent_frames.get_stats()
+        stats["admission"] = self.admission.get_stats()
+        stats["persistent"] = self.persistent.get_stats()
+        return stats
+
+    def _read_connection(self, conn):
+        '''Read the frames from the connection until it's closed, passing each one
+           on to the decrypt stage as soon as it's complete, and reply to http requests'''
+        reader = FrameReader()
+        remainder = None
+        try:
+            conn.settimeout(self.RECEIVE_TIMEOUT)
+            while not reader.invalid:
+                received = conn.recv(4096)
+                if not received:
+                    remainder = reader.get_remainder()
+                    break
+                if not reader.buffer and not reader.num_frames and looks_like_http(received):
+                    print("Got Http request: ", received)
+                    conn.send(make_http_reply())
+                    self.component.call_component(System.COMPNAME_LOGGING, "log",
+                                                  logstr="Received http request")
+                    break
+                had_hello = reader.hello_version is not None
+                frames = reader.feed(received)
+                if reader.hello_version is not None and not had_hello:
+                    # Let the sender know it can send several frames over this connection
+                    conn.sendall(make_ack())
+                for frame in frames:
+                    self.submit_data(frame)
+                if reader.hello_version is not None and not reader.invalid and self.running:
+                    # Don't keep this worker waiting for the sender's next frame
+                    self.persistent.add(conn, reader)
+                    return None
+        except OSError as exc:
+            print("Failed to receive data from connection:", exc)
+        conn.close()
+        self._notify_received()
+        # Unframed data from old senders is passed on as a whole
+        return remainder or None
+
+    def _notify_received(self):
+        '''Let the gui know that a connection has finished'''
+        self.component.call_component(System.COMPNAME_GUI, "notify_gui",
+                                      notify_type=guinotification.NOTIFY_MSG_RECEIVED)
+
+    def _decrypt_data(self, data):
+        '''Reconstruct the message from the received bytes'''
+        crypto = self.component.get_component(System.COMPNAME_CRYPTO)
+        if len(data) > HEADER_LENGTH and data[HEADER_LENGTH - 5] == Message.ENCTYPE_ENVELOPE:
+            self._open_envelope(data, DecrypterShim(crypto))
+            return None
+        received_msg = Message.from_received_data(data, decrypter=DecrypterShim(crypto))
+        if not received_msg:
+            print("Hang on, why is the incoming message None?")
+        elif received_msg.received_via_relay and not isinstance(received_msg, RelayMessage) \
+          and self.recent_frames.is_duplicate_checksum(received_msg.frame_checksum):
+            # Already got this one directly or through another relay
+            print("Dropping a copy of a message already received")
+            return None
+        return received_msg
+
+    def _open_envelope(self, data, decrypter):
+        '''Pass each of the messages in the envelope on separately, after the same
+           checks for copies and limits as for the frames arriving on their own'''
+        if not RecentFrames.get_key(data):
+            print("Dropping an invalid envelope")
+            return
+        parcels = EnvelopeMessage.split_payload(bytes(data[HEADER_LENGTH:-TRAILER_LENGTH]))
+        for parcel in parcels or []:
+            if parcel[HEADER_LENGTH - 5] == Message.ENCTYPE_ENVELOPE:
+                print("Ignoring envelope inside an envelope")
+            elif self.recent_frames.is_duplicate(parcel):
+                print("Dropping a copy of a message already received")
+            elif self.admission.admit_frame(parcel):
+                msg = Message.from_received_data(parcel, decrypter=decrypter)
+                if msg:
+                    self.get_stage(self.STAGE_RESOLVE).put(msg)
+
+    def _resolve_sender(self, received_msg):
+        '''If msg has signature id, get corresponding sender id,
+           and drop the message if that sender has sent too many'''
+        signature_keyid = received_msg.get_field(Message.FIELD_SIGNATURE_KEYID)
+        database = self.component.get_component(System.COMPNAME_DATABASE)
+        sender_id = dbutils.user_id_from_key_id(database, signature_keyid)
+        if not self.admission.admit_message(received_msg, sender_id, signature_keyid):
+            return None
+        if sender_id:
+            received_msg.set_field(Message.FIELD_SENDER_ID, sender_id)
+            received_msg.sender_verified = True
+        return received_msg
+
+    def _handle_message(self, received_msg):
+        '''Pass the message to the system's message handler'''
+        logstr = "Received '%s' from '%s'" % (received_msg.describe_message_type(),
+                                              received_msg.get_sender_id())
+        self.component.call_component(System.COMPNAME_LOGGING, "log", logstr=logstr)
+        self.component.call_component(System.COMPNAME_MSG_HANDLER, "receive", msg=received_msg)
+        database = self.component.get_component(System.COMPNAME_DATABASE)
+        own_tor_id = dbutils.get_own_tor_id(database)
+        self.component.call_component(System.COMPNAME_CONTACTS, "come_online",
+                                      tor_id=own_tor_id)
+        # The sender has just reached us directly, so we can try to reach them again,
+        # but only if they signed it, because an unencrypted sender id could be anyone's
+        sender_id = received_msg.get_sender_id()
+        if sender_id and received_msg.sender_verified and not received_msg.received_via_relay \
+          and self.component.get_component(System.COMPNAME_POSTSERVICE):
+            self.component.call_component(System.COMPNAME_POSTSERVICE, "heard_from",
+                                          tor_id=sender_id)
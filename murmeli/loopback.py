@@ -0,0 +1,272 @@
+'''Loopback transport between several Murmeli systems in the same process,
+   so that they can exchange messages without Tor or any network'''
+
+import random
+import socket
+import threading
+from murmeli.system import System, Component
+from murmeli.clock import get_default_clock
+from murmeli.connectionpool import PeerConnectionPool
+from murmeli.inbound import InboundPipeline
+from murmeli.asyncserver import AsyncSocketServer
+from murmeli.postservice import PostService
+from murmeli import framing
+
+
+class LoopbackNetwork:
+    '''Directory of the nodes by tor id, with the conditions between them.
+       Each send waits for the latency (plus a random jitter) on the sender's
+       thread, fails with the loss probability as if the connection couldn't
+       be made, and is silently dropped with the drop probability.  Nodes can
+       be taken offline by hand or given a schedule of offline periods, in
+       seconds since the network was made.  Latency and loss can also be set
+       for each recipient.  With a scheduler, sends return straight away and the
+       deliveries are scheduled after the latency instead, so that a whole network
+       can be simulated on one thread with a virtual clock.'''
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, drop=0.0, clock=None, rand=None,
+                 scheduler=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.drop = drop
+        self.clock = clock or get_default_clock()
+        self.rand = rand or random.Random()
+        self.scheduler = scheduler
+        self.start_time = self.clock.time()
+        self._lock = threading.Lock()
+        self._pipelines = {}     # tor id -> inbound pipeline, for in-process delivery
+        self._addresses = {}     # tor id -> (host, port), for delivery over tcp
+        self._offline = set()
+        self._schedules = {}     # tor id -> list of (start, end) offline periods
+        self._conditions = {}    # tor id -> dictionary of latency and loss
+        self._stats = {"sent":0, "delivered":0, "lost":0, "dropped":0, "offline":0,
+                       "unknown":0, "bytes":0}
+
+    def register(self, tor_id, pipeline=None, address=None):
+        '''Register the node with the given tor id, reached either through its
+           inbound pipeline or through the given local address'''
+        with self._lock:
+            if pipeline:
+                self._pipelines[tor_id] = pipeline
+            if address:
+                self._addresses[tor_id] = address
+
+    def unregister(self, tor_id):
+        '''Remove the given node, so that it can't be reached any more'''
+        with self._lock:
+            self._pipelines.pop(tor_id, None)
+            self._addresses.pop(tor_id, None)
+
+    def get_address(self, tor_id):
+        '''Get the local address of the given node, or None if it isn't listening on tcp'''
+        with self._lock:
+            return self._addresses.get(tor_id)
+
+    def is_registered(self, tor_id):
+        '''Check whether the given node is known to the network'''
+        with self._lock:
+            return tor_id in self._pipelines or tor_id in self._addresses
+
+    def set_online(self, tor_id, online):
+        '''Take the given node offline or bring it back online'''
+        with self._lock:
+            if online:
+                self._offline.discard(tor_id)
+            else:
+                self._offline.add(tor_id)
+
+    def set_offline_schedule(self, tor_id, periods):
+        '''Set the list of (start, end) periods when the given node is offline'''
+        with self._lock:
+            self._schedules[tor_id] = list(periods or [])
+
+    def set_conditions(self, tor_id, latency=None, loss=None):
+        '''Set the latency and loss for sending to the given node, None for the default'''
+        with self._lock:
+            self._conditions[tor_id] = {"latency":latency, "loss":loss}
+
+    def is_online(self, tor_id):
+        '''Check whether the given node is online now'''
+        now = self.clock.time() - self.start_time
+        with self._lock:
+            if tor_id in self._offline:
+                return False
+            return not any(start <= now < end for start, end in self._schedules.get(tor_id, []))
+
+    def get_latency(self, tor_id):
+        '''Get the time taken by the next send to the given node'''
+        with self._lock:
+            latency = self._conditions.get(tor_id, {}).get("latency")
+            jitter = self.rand.uniform(0.0, self.jitter) if self.jitter else 0.0
+        return (self.latency if latency is None else latency) + jitter
+
+    def check_send(self, from_id, to_id, num_bytes):
+        '''Count a send between the given nodes and check whether it gets through.
+           Return a PostService return code, or None if it gets through.'''
+        with self._lock:
+            self._stats["sent"] += 1
+        if not self.is_registered(to_id):
+            return self._count(PostService.RC_MESSAGE_FAILED, "unknown")
+        if not self.is_online(from_id) or not self.is_online(to_id):
+            return self._count(PostService.RC_MESSAGE_FAILED, "offline")
+        with self._lock:
+            loss = self._conditions.get(to_id, {}).get("loss")
+            if self.rand.random() < (self.loss if loss is None else loss):
+                self._stats["lost"] += 1
+                return PostService.RC_MESSAGE_FAILED
+            if self.drop and self.rand.random() < self.drop:
+                self._stats["dropped"] += 1
+                return PostService.RC_MESSAGE_SENT
+            self._stats["bytes"] += num_bytes
+        return None
+
+    def _count(self, result, key):
+        '''Count the given outcome and return the result'''
+        with self._lock:
+            self._stats[key] += 1
+        return result
+
+    def deliver(self, to_id, msg_bytes):
+        '''Pass the bytes to the inbound pipeline of the given node'''
+        with self._lock:
+            pipeline = self._pipelines.get(to_id)
+        if pipeline and pipeline.submit_data(bytes(msg_bytes), timeout=10):
+            return self._count(PostService.RC_MESSAGE_SENT, "delivered")
+        return PostService.RC_MESSAGE_FAILED
+
+    def deliver_later(self, to_id, msg_bytes, delay):
+        '''Use the scheduler to deliver the bytes to the given node after the delay'''
+        msg_bytes = bytes(msg_bytes)
+        self.scheduler.call_later(delay, lambda: self.deliver(to_id, msg_bytes))
+
+    def count_delivered(self):
+        '''Count a delivery made over tcp'''
+        self._count(None, "delivered")
+
+    def get_transport(self, tor_id, use_tcp=False, reuse_connections=False):
+        '''Make an outgoing transport for the post service of the given node'''
+        return LoopbackTransport(self, tor_id, use_tcp, reuse_connections)
+
+    def get_stats(self):
+        '''Return a dictionary of counts'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats["nodes"] = len(set(self._pipelines) | set(self._addresses))
+            return stats
+
+
+class LoopbackTransport:
+    '''Outgoing transport for one node of a loopback network, which can replace the
+       default transport of the post service.  The bytes are either passed straight
+       to the recipient's inbound pipeline or sent over a tcp connection to its
+       local listener, optionally keeping the connections open for reuse.'''
+
+    def __init__(self, network, own_tor_id, use_tcp=False, reuse_connections=False):
+        self.network = network
+        self.own_tor_id = own_tor_id
+        self.use_tcp = use_tcp
+        self.reuse_connections = reuse_connections
+        self.pool = PeerConnectionPool(self._connect, clock=network.clock)
+
+    def _connect(self, whoto):
+        '''Open a connection to the local listener of the given node'''
+        address = self.network.get_address(whoto)
+        if not address:
+            raise OSError("No address for '%s'" % whoto)
+        return socket.create_connection(address, timeout=10)
+
+    def send_message(self, msg_bytes, whoto):
+        '''Send the given bytes to the given node, return a PostService return code'''
+        result = self.network.check_send(self.own_tor_id, whoto, len(msg_bytes))
+        if result is not None:
+            return result
+        latency = self.network.get_latency(whoto)
+        if self.network.scheduler and not self.use_tcp:
+            self.network.deliver_later(whoto, msg_bytes, latency)
+            return PostService.RC_MESSAGE_SENT
+        self.network.clock.sleep(latency)
+        if not self.use_tcp:
+            return self.network.deliver(whoto, msg_bytes)
+        if self.reuse_connections:
+            sent = self.pool.send(whoto, msg_bytes)
+        else:
+            try:
+                sock = self._connect(whoto)
+                sock.sendall(msg_bytes)
+                sock.close()
+                sent = True
+            except OSError as exc:
+                print("Loopback send failed:", exc)
+                sent = False
+        if sent:
+            self.network.count_delivered()
+            return PostService.RC_MESSAGE_SENT
+        return PostService.RC_MESSAGE_FAILED
+
+    def get_peer_version(self, whoto):
+        '''All the nodes run the current version, once they've been reached'''
+        if self.use_tcp and self.reuse_connections:
+            return self.pool.get_peer_version(whoto)
+        return framing.PROTOCOL_VERSION if self.network.is_registered(whoto) else None
+
+    def close(self):
+        '''Close any connections which are still open'''
+        self.pool.close_all()
+
+    def get_stats(self):
+        '''Return a dictionary of connection counts'''
+        return self.pool.get_stats()
+
+
+class LoopbackClient(Component):
+    '''Transport component receiving the messages for one node of a loopback network,
+       instead of the TorClient.  Received bytes go through the usual inbound pipeline,
+       either passed in directly or through an async server on a free local port.'''
+
+    def __init__(self, parent, network, tor_id, use_tcp=False, pipeline_workers=None):
+        Component.__init__(self, parent, System.COMPNAME_TRANSPORT)
+        self.network = network
+        self.tor_id = tor_id
+        self.use_tcp = use_tcp
+        self.pipeline_workers = pipeline_workers
+        self.pipeline = None
+        self.server = None
+
+    def checked_start(self):
+        '''Start the pipeline and register with the network'''
+        self.pipeline = InboundPipeline(self, workers=self.pipeline_workers)
+        self.pipeline.start()
+        if self.use_tcp:
+            self.server = AsyncSocketServer(self, self.pipeline, interface="localhost", port=0,
+                                            shutdown_grace=1)
+            self.server.listening.wait(10)
+            if not self.server.server:
+                print("Loopback client couldn't listen")
+                return False
+            self.network.register(self.tor_id, address=("localhost", self.server.port))
+        else:
+            self.network.register(self.tor_id, pipeline=self.pipeline)
+        return True
+
+    def get_own_torid(self):
+        '''Get our own tor id'''
+        return self.tor_id
+
+    def stop(self):
+        '''Unregister from the network and stop receiving'''
+        self.network.unregister(self.tor_id)
+        if self.server:
+            self.server.close()
+            self.server = None
+        if self.pipeline:
+            self.pipeline.stop()
+            self.pipeline = None
+        Component.stop(self)
+
+    def get_stats(self):
+        '''Return the statistics of the inbound pipeline'''
+        stats = {"pipeline":self.pipeline.get_stats() if self.pipeline else {}}
+        if self.server:
+            stats["server"] = self.server.get_stats()
+        return stats
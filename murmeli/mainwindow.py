@@ -13,6 +13,7 @@ from murmeli.i18n import I18nManager
 from murmeli.logger import Logger, PlainLogSink
 from murmeli.loggergui import GuiLogSink
 from murmeli.messagehandler import RegularMessageHandler
+from murmeli.metrics import Metrics
 from murmeli.pageserver import MurmeliPageServer
 from murmeli.postservice import PostService
 from murmeli.supersimpledb import MurmeliDb
@@ -96,6 +97,9 @@ class MainWindow(GuiWindow):
         if not my_system.has_component(System.COMPNAME_POSTSERVICE):
             post = PostService(my_system)
             my_system.add_component(post)
+        # Add metrics
+        if not my_system.has_component(System.COMPNAME_METRICS):
+            my_system.add_component(Metrics(my_system))
         # Add log
         if not my_system.has_component(System.COMPNAME_LOGGING):
             logger = Logger(my_system)
@@ -4,6 +4,7 @@ from random import SystemRandom
 import hashlib
 import datetime
 import json
+from murmeli.clock import get_default_clock
 
 
 class ByteChomper:
@@ -57,13 +58,17 @@ class Message:
     TYPE_INFO_RESPONSE = 6
     TYPE_FRIEND_REFERRAL = 7
     TYPE_FRIENDREFER_REQUEST = 8
+    TYPE_ACK = 9
     TYPE_REGULAR_MESSAGE = 20
     TYPE_RELAYED_MESSAGE = 21
+    TYPE_ENVELOPE = 22
 
     ENCTYPE_NONE = 0
     ENCTYPE_ASYM = 1
     # ENCTYPE_SYMM = 2
     ENCTYPE_RELAY = 3
+    ENCTYPE_ENVELOPE = 4
+    ENCTYPE_RELAY_HOPS = 5
 
     FIELD_SENDER_ID = "senderId"
     FIELD_SIGNATURE_KEYID = "signatureId"
@@ -77,6 +82,9 @@ class Message:
         self.sender_must_be_trusted = True  # Most should only be accepted if sender is trusted
         self.original_payload = None # Perhaps the original payload is needed later
         self.should_be_relayed = False
+        self.received_via_relay = False # True if it didn't come directly from the sender
+        self.sender_verified = False # True if the sender id was found from the signature
+        self.frame_checksum = None # Hex checksum of the received frame, for acknowledging
         self.timestamp = None
         self.body = {}
         self.recipients = []
@@ -138,6 +146,14 @@ class Message:
         if calculated_check != checksum:
             return None        # checksum doesn't match
 
+        hops = 1
+        if enc_type == Message.ENCTYPE_RELAY_HOPS:
+            # The number of hops is outside the signature, so that relays can change it
+            if not enc_payload:
+                return None
+            hops = min(enc_payload[0], RelayMessage.MAX_HOPS)
+            enc_payload = enc_payload[1:]
+
         if decrypter:
             payload, sig_id = decrypter.decrypt(enc_payload, enc_type)
         else:
@@ -152,9 +168,22 @@ class Message:
                 msg.original_payload = enc_payload
             if msg and sig_id and isinstance(msg, ContactReferralMessage):
                 msg.original_payload = enc_payload
-        elif enc_type == Message.ENCTYPE_RELAY:
+        elif enc_type in [Message.ENCTYPE_RELAY, Message.ENCTYPE_RELAY_HOPS]:
             msg = RelayMessage.unpack_payload(payload, decrypter)
-        if sig_id and enc_type in [Message.ENCTYPE_ASYM, Message.ENCTYPE_RELAY]:
+            if isinstance(msg, RelayMessage):
+                msg.hops = hops
+                msg.signed_blob = enc_payload
+                # Only the signer sends plain relay frames, relays pass on ones with hops
+                msg.received_via_relay = enc_type == Message.ENCTYPE_RELAY_HOPS
+            elif msg:
+                msg.received_via_relay = True
+        elif enc_type == Message.ENCTYPE_ENVELOPE:
+            msg = EnvelopeMessage.unpack_payload(payload, decrypter)
+        if msg and not msg.frame_checksum:
+            # A relayed message keeps the checksum of the frame inside
+            msg.frame_checksum = bytes(checksum).hex()
+        if sig_id and enc_type in [Message.ENCTYPE_ASYM, Message.ENCTYPE_RELAY,
+                                   Message.ENCTYPE_RELAY_HOPS]:
             msg.set_field(msg.FIELD_SIGNATURE_KEYID, sig_id)
         return msg
 
@@ -198,6 +227,15 @@ class Message:
         '''Make an md5 checksum of the payload'''
         return hashlib.md5(payload).digest()
 
+    @staticmethod
+    def get_frame_checksum(data):
+        '''Get the checksum from the header of the given output bytes as a hex string,
+           or None if the data is too short'''
+        start = len(Message.MAGIC_TOKEN)
+        if not data or len(data) < start + 16:
+            return None
+        return bytes(data[start:start + 16]).hex()
+
     @staticmethod
     def encode_number_to_bytes(num, num_bytes=1):
         '''Pack the given number into a series of bytes'''
@@ -218,8 +256,8 @@ class Message:
 
     @staticmethod
     def make_current_timestamp():
-        '''Make a timestamp float according to UTC'''
-        return datetime.datetime.now(datetime.timezone.utc).timestamp()
+        '''Make a timestamp float according to UTC, using the default clock'''
+        return get_default_clock().time()
 
     @staticmethod
     def timestamp_to_string(tstamp):
@@ -253,6 +291,11 @@ class Message:
         '''Create the payload from the message contents (will be overridden)'''
         return bytes()
 
+    def get_coalesce_key(self):
+        '''Get a key for replacing older queued messages of the same kind to the
+           same recipient, or None if older ones shouldn't be replaced'''
+        return None
+
     def describe_message_type(self):
         '''Return a string describing the message type (for diagnostics only)'''
         typedescs = {self.TYPE_CONTACT_REQUEST:"contactrequest",
@@ -262,8 +305,10 @@ class Message:
                      self.TYPE_INFO_RESPONSE:"inforesponse",
                      self.TYPE_FRIEND_REFERRAL:"referral",
                      self.TYPE_FRIENDREFER_REQUEST:"referrequest",
+                     self.TYPE_ACK:"ack",
                      self.TYPE_REGULAR_MESSAGE:"regular",
-                     self.TYPE_RELAYED_MESSAGE:"relay"}
+                     self.TYPE_RELAYED_MESSAGE:"relay",
+                     self.TYPE_ENVELOPE:"envelope"}
         return typedescs.get(self.msg_type)
 
 
@@ -381,6 +426,8 @@ class AsymmetricMessage(Message):
                 msg = ContactReferralMessage()
             elif msg_type == Message.TYPE_FRIENDREFER_REQUEST:
                 msg = ContactReferRequestMessage()
+            elif msg_type == Message.TYPE_ACK:
+                msg = AckMessage()
             if msg:
                 msg.timestamp = msg.string_to_timestamp(timestr)
                 msg.version_number = msg_version
@@ -465,6 +512,11 @@ class StatusNotifyMessage(AsymmetricMessage):
         '''Get which fields should be packed in body'''
         return [self.FIELD_PING, self.FIELD_ONLINE, self.FIELD_PROFILE_HASH]
 
+    def get_coalesce_key(self):
+        '''Only the latest status is of interest, but a pong mustn't replace a ping'''
+        return "%s:%s" % (self.describe_message_type(),
+                          "ping" if self.get_field(self.FIELD_PING) else "pong")
+
     @staticmethod
     def get_required_body_fields():
         '''Get which fields are necessary for the message to be valid'''
@@ -484,6 +536,10 @@ class InfoMessage(AsymmetricMessage):
         self.should_be_queued = False
         self.set_field(self.FIELD_INFOTYPE, info_type)
 
+    def get_coalesce_key(self):
+        '''Only the latest request or response of each info type is needed'''
+        return "%s:%s" % (self.describe_message_type(), self.get_field(self.FIELD_INFOTYPE))
+
 
 class InfoRequestMessage(InfoMessage):
     '''An info request can be a request for a profile, or for a list of friends'''
@@ -572,6 +628,12 @@ class ContactReferralMessage(AsymmetricMessage):
         '''Get which fields are necessary for the message to be valid'''
         return [self.FIELD_FRIEND_ID, self.FIELD_FRIEND_NAME, self.FIELD_FRIEND_KEY]
 
+    def get_coalesce_key(self):
+        '''A robot referral or removal replaces an earlier one for the same robot'''
+        if self.is_normal_referral():
+            return None
+        return "robotreferral:%s" % self.get_field(self.FIELD_FRIEND_ID)
+
     def is_normal_referral(self):
         '''Return true if this is a normal referral, not a robot referral'''
         return not self.get_field(self.FIELD_REFERRAL_TYPE)
@@ -603,25 +665,78 @@ class ContactReferRequestMessage(AsymmetricMessage):
         return [self.FIELD_FRIEND_ID]
 
 
-class RelayMessage(Message):
-    '''A relay message is some (unknown) kind of binary message which we cannot decrypt
-       but we can check the signature and relay it to our contacts'''
+class AckMessage(AsymmetricMessage):
+    '''Message to acknowledge the receipt of other messages, given by the checksums
+       of their frames, so that the sender can stop trying to deliver them'''
+
+    FIELD_CHECKSUMS = "checksums"
 
     def __init__(self):
-        Message.__init__(self, Message.ENCTYPE_RELAY, Message.TYPE_RELAYED_MESSAGE)
+        AsymmetricMessage.__init__(self, Message.TYPE_ACK)
+        self.should_be_relayed = False
+
+    def get_body_fields(self):
+        '''Get which fields should be packed in body'''
+        return [self.FIELD_CHECKSUMS]
+
+    def get_required_body_fields(self):
+        '''Get which fields are necessary for the message to be valid'''
+        return [self.FIELD_CHECKSUMS]
+
+
+class RelayMessage(Message):
+    '''A relay message is some (unknown) kind of binary message which we cannot decrypt
+       but we can check the signature and relay it to our contacts.
+       With more than one hop, the receiving relay passes on the signed message
+       as a relay message with one hop fewer, otherwise it passes on the message
+       with no hops left, so that the recipient knows that it didn't come directly
+       from the sender, and the other contacts don't pass it on.  Peers which are
+       too old for that get just the message inside.
+       Only one hop is possible with the plain relay enc type.'''
+
+    MAX_HOPS = 4
+
+    def __init__(self, hops=1):
+        Message.__init__(self, Message.ENCTYPE_RELAY if hops == 1 else Message.ENCTYPE_RELAY_HOPS,
+                         Message.TYPE_RELAYED_MESSAGE)
         self.parcel = None
         self.received_bytes = None
+        self.signed_blob = None
+        self.hops = hops
 
     @staticmethod
-    def wrap_outgoing_message(msg_bytes):
+    def wrap_outgoing_message(msg_bytes, hops=1):
         '''Create a relay wrapper around an existing outgoing message'''
-        relay_msg = RelayMessage()
+        relay_msg = RelayMessage(min(hops, RelayMessage.MAX_HOPS))
         relay_msg.parcel = msg_bytes
         return relay_msg.create_output() if msg_bytes else None
 
+    @staticmethod
+    def with_hops(relay_output, hops):
+        '''Rewrap the output of a single-hop relay message to allow the given number of hops'''
+        if hops <= 1 or not relay_output:
+            return relay_output
+        header_length = len(Message.MAGIC_TOKEN) + 16 + 1 + 4
+        signed_blob = relay_output[header_length:-len(Message.MAGIC_TOKEN)]
+        return RelayMessage.wrap_outgoing_message(signed_blob, hops)
+
+    def get_forward_output(self):
+        '''Get the bytes to pass on to our contacts, with one hop fewer'''
+        if self.hops > 1 and self.signed_blob:
+            return RelayMessage.wrap_outgoing_message(self.signed_blob, self.hops - 1)
+        return self.create_output()
+
+    def get_last_hop_output(self):
+        '''Get the bytes to pass on to the recipient after the last hop, or None'''
+        if self.hops <= 1 and self.signed_blob:
+            return RelayMessage.wrap_outgoing_message(self.signed_blob, 0)
+        return None
+
     def create_payload(self):
         '''If we were given a parcel, then this is the payload we need'''
         assert self.parcel
+        if self.enc_type == Message.ENCTYPE_RELAY_HOPS:
+            return bytes([self.hops]) + bytes(self.parcel)
         return self.parcel
 
     def create_output(self, encrypter=None):
@@ -642,3 +757,56 @@ class RelayMessage(Message):
             msg.received_bytes = payload
             return msg
         return None
+
+
+class EnvelopeMessage(Message):
+    '''An envelope carries several complete messages, each already encrypted, for the
+       same recipient in a single frame so that they can be sent together'''
+
+    def __init__(self):
+        Message.__init__(self, Message.ENCTYPE_ENVELOPE, Message.TYPE_ENVELOPE)
+        self.parcels = []     # output bytes of the messages to send
+        self.messages = []    # messages unpacked on receipt
+
+    @staticmethod
+    def wrap_outgoing_messages(msg_bytes_list):
+        '''Create an envelope around the given list of outgoing messages'''
+        envelope = EnvelopeMessage()
+        envelope.parcels = [msg_bytes for msg_bytes in msg_bytes_list if msg_bytes]
+        return envelope.create_output() if envelope.parcels else None
+
+    def create_payload(self):
+        '''The payload is just the messages one after the other'''
+        return Message.pack_bytes(self.parcels)
+
+    @staticmethod
+    def split_payload(payload):
+        '''Split the payload into the bytes of each message, or return None if invalid'''
+        parcels = []
+        chomper = ByteChomper(payload)
+        while chomper.pos < len(chomper.data):
+            start = chomper.pos
+            chomper.get_field(len(Message.MAGIC_TOKEN) + 16 + 1)
+            payload_size = chomper.get_byte_value(4)
+            chomper.get_field(payload_size + len(Message.MAGIC_TOKEN))
+            if chomper.pos > len(chomper.data):
+                return None    # last message is cut off
+            parcels.append(chomper.data[start:chomper.pos])
+        return parcels
+
+    @staticmethod
+    def unpack_payload(payload, decrypter):
+        '''Unpack and decrypt each of the messages in the envelope'''
+        parcels = EnvelopeMessage.split_payload(payload) if payload else None
+        if not parcels:
+            return None
+        envelope = EnvelopeMessage()
+        for parcel in parcels:
+            enc_type = parcel[len(Message.MAGIC_TOKEN) + 16]
+            if enc_type == Message.ENCTYPE_ENVELOPE:
+                print("Ignoring envelope inside an envelope")
+                continue
+            msg = Message.from_received_data(parcel, decrypter)
+            if msg:
+                envelope.messages.append(msg)
+        return envelope
@@ -1,7 +1,11 @@
 '''Message handlers for Murmeli'''
 
 import re
+import threading
 from murmeli.system import System, Component
+from murmeli.scheduler import get_default_scheduler
+from murmeli.bloomfilter import RotatingBloomFilter
+from murmeli.relayquota import RelayQuota
 from murmeli.config import Config
 from murmeli.contactmgr import ContactManager
 from murmeli import message
@@ -15,6 +19,26 @@ class MessageHandler(Component):
 
     def __init__(self, parent):
         Component.__init__(self, parent, System.COMPNAME_MSG_HANDLER)
+        # Checksums of the relayed messages already passed on, kept in the database
+        self.relay_seen = RotatingBloomFilter()
+        self.relay_seen_loaded = False
+        self.relay_lock = threading.Lock()
+        self.relay_stats = {"relayed":0, "duplicates":0, "own":0}
+        # The seen-set is stored a while after it changes, not after every relay
+        self.relay_seen_changed = False
+        self.relay_seen_rotations = 0
+        self.relay_save_delay = 60
+        self.relay_save_call = None
+        # Limits on the outbox space used by the copies we relay
+        self.relay_quota = RelayQuota()
+
+    def prepare_stop(self):
+        '''Store the seen-set if it's changed, while the database is still running'''
+        with self.relay_lock:
+            if self.relay_save_call:
+                self.relay_save_call.cancel()
+                self.relay_save_call = None
+        self.save_relay_seen()
 
     def receive(self, msg):
         '''Receive an incoming message'''
@@ -42,6 +66,13 @@ class MessageHandler(Component):
                 self.receive_regular_message(msg)
             elif msg.msg_type == msg.TYPE_RELAYED_MESSAGE:
                 self.receive_relayed_message(msg)
+            elif msg.msg_type == msg.TYPE_ACK:
+                self.receive_ack(msg)
+            if msg.should_be_relayed and msg.frame_checksum \
+              and self.is_from_trusted_contact(msg):
+                # The sender may still be trying to deliver it, directly or through relays
+                self.call_component(System.COMPNAME_POSTSERVICE, "queue_ack",
+                                    tor_id=msg.get_sender_id(), checksum=msg.frame_checksum)
 
     def receive_contact_request(self, msg):
         '''Receive a contact request'''
@@ -75,10 +106,89 @@ class MessageHandler(Component):
         _ = msg
 
     def receive_relayed_message(self, msg):
-        '''Receive a relayed message for somebody else'''
+        '''Receive a relayed message for somebody else, and pass it on
+           unless it's one of our own or we've passed it on before'''
         sender_id = msg.get_sender_id() if msg else None
         database = self.get_component(System.COMPNAME_DATABASE)
-        dbutils.add_relayed_message_to_outbox(msg, sender_id, database)
+        if sender_id and sender_id == dbutils.get_own_tor_id(database):
+            print("Not relaying our own message")
+            self._count_relay("own")
+            return
+        if msg.hops < 1:
+            print("Not relaying a message which has already had its last hop")
+            return
+        if self._has_relayed(message.Message.get_frame_checksum(msg.received_bytes), database):
+            print("Already relayed this message, not relaying it again")
+            self._count_relay("duplicates")
+            return
+        try:
+            fanout = int(self.get_config_property(Config.KEY_RELAY_FANOUT) or 0)
+        except ValueError:
+            fanout = 0
+        postservice = self.get_component(System.COMPNAME_POSTSERVICE)
+        if dbutils.add_relayed_message_to_outbox(msg, sender_id, database, fanout=fanout,
+                                                 order=postservice.order_relays
+                                                 if postservice else None,
+                                                 quota=self.relay_quota):
+            self._count_relay("relayed")
+
+    def relay_row_deleted(self, row_id):
+        '''Called by the database when a relayed copy has been deleted from the outbox'''
+        self.relay_quota.row_deleted(row_id)
+
+    def _has_relayed(self, checksum, database):
+        '''Check the seen-set for the given checksum, and add it if it's new'''
+        if not checksum:
+            return False
+        with self.relay_lock:
+            if not self.relay_seen_loaded:
+                self.relay_seen.load(database.get_relay_seen_state())
+                self.relay_seen_loaded = True
+            if self.relay_seen.check_and_add(checksum):
+                return True
+            self.relay_seen_changed = True
+            # A rotation forgets a whole generation, so that's stored straight away
+            save_now = self.relay_seen.num_rotations != self.relay_seen_rotations
+            if not save_now and not self.relay_save_call:
+                scheduler = self.get_component(System.COMPNAME_SCHEDULER) \
+                    or get_default_scheduler()
+                self.relay_save_call = scheduler.call_later(self.relay_save_delay,
+                                                            self.save_relay_seen)
+        if save_now:
+            self.save_relay_seen()
+        return False
+
+    def save_relay_seen(self):
+        '''Store the seen-set in the database, if it's changed since it was last stored'''
+        with self.relay_lock:
+            self.relay_save_call = None
+            if not self.relay_seen_changed:
+                return
+            self.relay_seen_changed = False
+            self.relay_seen_rotations = self.relay_seen.num_rotations
+            state = self.relay_seen.get_state()
+        database = self.get_component(System.COMPNAME_DATABASE)
+        if database:
+            database.set_relay_seen_state(state)
+
+    def _count_relay(self, key):
+        '''Increment the given relay counter'''
+        with self.relay_lock:
+            self.relay_stats[key] += 1
+
+    def get_stats(self):
+        '''Return a dictionary of relay counts and the relay storage quota'''
+        with self.relay_lock:
+            return {"relay":dict(self.relay_stats),
+                    "relayseenrotations":self.relay_seen.num_rotations,
+                    "relayquota":self.relay_quota.get_stats()}
+
+    def receive_ack(self, msg):
+        '''Receive an acknowledgement of messages we sent'''
+        checksums = msg.get_field(msg.FIELD_CHECKSUMS)
+        if isinstance(checksums, list):
+            self.call_component(System.COMPNAME_POSTSERVICE, "acknowledge",
+                                tor_id=msg.get_sender_id(), checksums=checksums)
 
     def is_from_trusted_contact(self, msg):
         '''Return true if given message is from a contact with trusted status'''
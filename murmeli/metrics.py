@@ -0,0 +1,31 @@
+'''Metrics component, collecting the statistics of the other components'''
+
+from murmeli.system import System, Component
+
+
+class Metrics(Component):
+    '''Component to gather the statistics published by the other components.
+       Any component with a get_stats method returning a dictionary is included.'''
+
+    def __init__(self, parent):
+        Component.__init__(self, parent, System.COMPNAME_METRICS)
+
+    def get_all_stats(self):
+        '''Return a dictionary of the stats of each component, keyed by component name'''
+        all_stats = {}
+        components = self._parent.components if self._parent else {}
+        for name, comp in list(components.items()):
+            if comp is self:
+                continue
+            get_stats = getattr(comp, "get_stats", None)
+            if callable(get_stats):
+                all_stats[name] = get_stats()
+        return all_stats
+
+    def get_stats_value(self, comp_name, *keys):
+        '''Return a single value from the stats, for example
+           get_stats_value("comp.transport", "pipeline", "frame", "queued")'''
+        value = self.get_all_stats().get(comp_name)
+        for key in keys:
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
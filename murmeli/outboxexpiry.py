@@ -0,0 +1,111 @@
+'''Expiry of old messages from the outbox'''
+
+import threading
+import time
+
+
+HOUR_SECS = 3600
+DAY_SECS = 24 * HOUR_SECS
+
+# How long each type of message may stay in the outbox
+MSGTYPE_TTLS = {"statusnotify":15 * 60,
+                "inforequest":DAY_SECS,
+                "ack":3 * DAY_SECS,
+                "inforesponse":DAY_SECS,
+                "referrequest":7 * DAY_SECS,
+                "referral":14 * DAY_SECS,
+                "relay":14 * DAY_SECS,
+                "contactrequest":30 * DAY_SECS,
+                "contactresponse":30 * DAY_SECS,
+                "regular":60 * DAY_SECS}
+DEFAULT_TTL = 30 * DAY_SECS
+
+# These are just dropped when they expire, the others are kept as dead letters
+DISPOSABLE_MSGTYPES = ["statusnotify", "inforequest", "inforesponse", "ack"]
+# How long the dead letters are kept, and how many of them at most
+DEADLETTER_TTL = 90 * DAY_SECS
+MAX_DEADLETTERS = 500
+
+
+def get_ttl(msg_type):
+    '''Get the time to live in seconds for the given message type (as stored in the outbox)'''
+    return MSGTYPE_TTLS.get(msg_type, DEFAULT_TTL)
+
+
+class OutboxSweeper:
+    '''Removes outbox rows which are older than the time to live for their type.
+       Expired rows which aren't disposable are copied to the dead letters table
+       of the database before being deleted from the outbox.  The same sweep removes
+       the dead letters older than deadletter_ttl, and the oldest ones beyond
+       max_deadletters, so that the table doesn't keep growing.'''
+
+    def __init__(self, sweep_interval=10 * 60, clock=None, deadletter_ttl=DEADLETTER_TTL,
+                 max_deadletters=MAX_DEADLETTERS):
+        self.sweep_interval = sweep_interval
+        self.clock = clock or time.time
+        self.deadletter_ttl = deadletter_ttl
+        self.max_deadletters = max_deadletters
+        self._lock = threading.Lock()
+        self._last_sweep = None
+        self._expired = {}   # msgType -> count
+        self._num_dead = 0
+        self._num_pruned = 0
+
+    def is_due(self):
+        '''Return True if it's time for another sweep'''
+        return self._last_sweep is None or \
+            self.clock() - self._last_sweep >= self.sweep_interval
+
+    def is_expired(self, row):
+        '''Check whether the given outbox row has passed its time to live'''
+        timestamp = row.get('timestamp') if row else None
+        if timestamp is None:
+            return False
+        return self.clock() - timestamp > get_ttl(row.get('msgType'))
+
+    def expire_row(self, database, row):
+        '''If the given row has expired, dead-letter it if necessary and delete it
+           from the outbox.  Return True if it was expired.'''
+        if not self.is_expired(row):
+            return False
+        msg_type = row.get('msgType')
+        if msg_type not in DISPOSABLE_MSGTYPES:
+            dead_row = {key:value for key, value in row.items()
+                        if key not in ['_id', 'relayMessage']}
+            dead_row['expired'] = self.clock()
+            database.add_row_to_deadletters(dead_row)
+        database.delete_from_outbox(index=row['_id'])
+        with self._lock:
+            self._expired[msg_type] = self._expired.get(msg_type, 0) + 1
+            if msg_type not in DISPOSABLE_MSGTYPES:
+                self._num_dead += 1
+        return True
+
+    def sweep(self, database):
+        '''Go through the whole outbox, stamping rows without a timestamp
+           and removing the expired ones.  Return the number removed.'''
+        now = self.clock()
+        self._last_sweep = now
+        num_expired = 0
+        for row in database.get_outbox():
+            if not row:
+                continue
+            if row.get('timestamp') is None:
+                # Older row from before timestamps were stored, so start its clock now
+                database.update_outbox_message(index=row['_id'], props={"timestamp":now})
+            elif self.expire_row(database, row):
+                num_expired += 1
+        num_pruned = database.prune_deadletters(expired_before=now - self.deadletter_ttl,
+                                                max_rows=self.max_deadletters)
+        with self._lock:
+            self._num_pruned += num_pruned or 0
+        return num_expired
+
+    def get_stats(self):
+        '''Return a dictionary of expiry counts'''
+        with self._lock:
+            return {"expired":sum(self._expired.values()),
+                    "deadletters":self._num_dead,
+                    "pruned":self._num_pruned,
+                    "bytype":dict(self._expired),
+                    "lastsweep":self._last_sweep}
@@ -0,0 +1,128 @@
+'''In-memory scheduling of the outbox messages, indexed by recipient'''
+
+import heapq
+import itertools
+import threading
+
+
+# Priority classes, lower values are sent first
+PRIORITY_CONTACT = 0
+PRIORITY_REGULAR = 1
+PRIORITY_INFO = 2
+PRIORITY_STATUS = 3
+
+MSGTYPE_PRIORITIES = {"contactrequest":PRIORITY_CONTACT,
+                      "contactresponse":PRIORITY_CONTACT,
+                      "ack":PRIORITY_CONTACT,
+                      "regular":PRIORITY_REGULAR,
+                      "referral":PRIORITY_REGULAR,
+                      "referrequest":PRIORITY_REGULAR,
+                      "relay":PRIORITY_REGULAR,
+                      "inforequest":PRIORITY_INFO,
+                      "inforesponse":PRIORITY_INFO,
+                      "statusnotify":PRIORITY_STATUS}
+
+
+def get_priority(msg_type):
+    '''Get the priority class for the given message type (as stored in the outbox)'''
+    return MSGTYPE_PRIORITIES.get(msg_type, PRIORITY_REGULAR)
+
+def get_row_recipients(row):
+    '''Get the list of recipients of the given outbox row'''
+    if not row:
+        return []
+    if row.get('recipient'):
+        return [row.get('recipient')]
+    return list(row.get('recipientList') or [])
+
+
+class OutboxScheduler:
+    '''Keeps a queue of outbox row ids for each recipient, ordered by priority
+       and then by age, and a set of recipients which are known to be online.
+       Rows with a recipientList are queued once for each of their recipients.
+       The rows themselves stay in the database, only their ids are held here.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {}    # recipient -> heap of (priority, sequence, row id)
+        self._queued = set() # (recipient, row id) pairs, to avoid duplicates
+        self._online = set()
+        self._sequence = itertools.count()
+        self._stale = True   # need to load everything from the database
+
+    def is_stale(self):
+        '''Return True if the contents need to be loaded from the database'''
+        return self._stale
+
+    def mark_stale(self):
+        '''Mark the contents as out of date, so they'll be reloaded from the database'''
+        self._stale = True
+
+    def load(self, rows):
+        '''Clear the queues and fill them from the given outbox rows'''
+        with self._lock:
+            self._queues.clear()
+            self._queued.clear()
+            self._stale = False
+        for row in rows:
+            self.add_row(row)
+
+    def add_row(self, row):
+        '''Add a new outbox row to the queue of each of its recipients'''
+        if not row or row.get('_id') is None:
+            return
+        priority = get_priority(row.get('msgType'))
+        for recipient in get_row_recipients(row):
+            self.add(recipient, row.get('_id'), priority)
+
+    def add(self, recipient, row_id, priority=PRIORITY_REGULAR):
+        '''Add the given row id to the queue for the given recipient'''
+        with self._lock:
+            if (recipient, row_id) not in self._queued:
+                self._queued.add((recipient, row_id))
+                heapq.heappush(self._queues.setdefault(recipient, []),
+                               (priority, next(self._sequence), row_id))
+
+    def set_online(self, recipient, online):
+        '''Add the recipient to or remove it from the set of online recipients'''
+        with self._lock:
+            if online:
+                self._online.add(recipient)
+            else:
+                self._online.discard(recipient)
+
+    def get_recipients(self, order=None):
+        '''Get the recipients with queued messages, with the online ones first.
+           If given, order is a function to sort each of these two groups.'''
+        with self._lock:
+            ready = [recpt for recpt in self._queues if recpt in self._online]
+            others = [recpt for recpt in self._queues if recpt not in self._online]
+        if order:
+            return order(ready) + order(others)
+        return ready + others
+
+    def take_messages(self, recipient):
+        '''Remove and return the queued (row id, priority) pairs for the given recipient,
+           in the order in which they should be sent'''
+        with self._lock:
+            heap = self._queues.pop(recipient, [])
+            result = []
+            while heap:
+                priority, _, row_id = heapq.heappop(heap)
+                self._queued.discard((recipient, row_id))
+                result.append((row_id, priority))
+        return result
+
+    def get_num_queued(self, recipient=None):
+        '''Get the number of messages queued, either for one recipient or for all'''
+        with self._lock:
+            if recipient:
+                return len(self._queues.get(recipient, []))
+            return len(self._queued)
+
+    def get_stats(self):
+        '''Return a dictionary of queue sizes'''
+        with self._lock:
+            return {"queued":len(self._queued),
+                    "recipients":len(self._queues),
+                    "ready":len([recpt for recpt in self._queues if recpt in self._online])}
@@ -27,8 +27,14 @@ class TestPageSet(PageSet):
             if url == 'deleteoutbox':
                 database.delete_all_from_outbox()
             mails = [msg for msg in database.get_outbox() if msg]
+            postservice = self.system.get_component(self.system.COMPNAME_POSTSERVICE)
+            expiry = postservice.get_stats().get("expiry") if postservice else None
+            expired_types = sorted(expiry["bytype"].items(), key=lambda x: str(x[0])) \
+                            if expiry else []
             page = self.outbox_template.get_html(self.get_all_i18n(),
-                                                 {"mails":mails})
+                                                 {"mails":mails, "expiry":expiry,
+                                                  "expiredtypes":expired_types,
+                                                  "deadletters":database.get_deadletters()})
         elif url == 'showcontacts':
             database = self.system.get_component(self.system.COMPNAME_DATABASE)
             profiles = [prof for prof in database.get_profiles()]
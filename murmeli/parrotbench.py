@@ -0,0 +1,336 @@
+'''Benchmark of the round trips between a client system and a parrot robot,
+   which echoes each regular message back to its owner'''
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from murmeli.system import System, Component
+from murmeli.config import Config
+from murmeli.cryptoclient import CryptoClient
+from murmeli.messagehandler import RegularMessageHandler
+from murmeli.postservice import PostService
+from murmeli.loopback import LoopbackNetwork, LoopbackClient
+from murmeli.simulator import StandInCrypto, SimDatabase, get_percentile
+from murmeli.robot import Robot
+from murmeli.message import Message, RegularMessage, EnvelopeMessage
+from murmeli.framing import HEADER_LENGTH, TRAILER_LENGTH
+from murmeli import dbutils
+
+
+SIDE_CLIENT = "client"
+SIDE_PARROT = "parrot"
+
+
+class Journeys:
+    '''Times at which each benchmark message passes each point on its way to the
+       parrot and back, so that the round trip can be split into stages:
+         encode  - making the message, up to the start of encryption
+         encrypt - encrypting and signing by the client
+         send    - storing in the outbox and flushing, up to handing it to the transport
+         receive - transferring, reading the frame and queueing it for decryption
+         decrypt - decrypting and checking the signature by the parrot
+         handle  - finding the sender and handling it, up to encrypting the reply
+         reply   - encrypting, storing and flushing the reply
+         return  - transferring, decrypting and handling the reply by the client
+       Each point is noted before the next one can be reached, so no stage is negative.'''
+
+    TAG_PATTERN = re.compile(rb"\[sim (\d+)\]")
+    STAGES = [("encode", "compose", "encrypt"), ("encrypt", "encrypt", "encrypted"),
+              ("send", "encrypted", "sent"), ("receive", "sent", "decrypt"),
+              ("decrypt", "decrypt", "decrypted"), ("handle", "decrypted", "replyencrypt"),
+              ("reply", "replyencrypt", "replysent"), ("return", "replysent", "arrived")]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._arrival = threading.Condition(self._lock)
+        self._next_tag = 0
+        self._points = {}       # tag -> dictionary of point name -> monotonic time
+        self._checksums = {}    # checksum of ciphertext -> tag
+
+    def make_body(self, text):
+        '''Make a tagged message body, and note when it was composed'''
+        with self._lock:
+            self._next_tag += 1
+            self._points[self._next_tag] = {"compose":time.monotonic()}
+            return "[sim %d] %s" % (self._next_tag, text)
+
+    def _mark(self, tag, point, when):
+        '''Note the first time that the given message reached the given point'''
+        with self._lock:
+            if tag in self._points:
+                self._points[tag].setdefault(point, when)
+
+    def _find_tag(self, plaintext):
+        '''Find the tag in the given plaintext, or None'''
+        found = self.TAG_PATTERN.search(bytes(plaintext or b""))
+        return int(found.group(1)) if found else None
+
+    def encrypted(self, side, plaintext, ciphertext, start_time, end_time):
+        '''Note the encryption of a message, and remember its ciphertext'''
+        tag = self._find_tag(plaintext)
+        if tag is None or not ciphertext:
+            return
+        with self._lock:
+            self._checksums[Message.make_checksum(bytes(ciphertext)).hex()] = tag
+        if side == SIDE_CLIENT:
+            self._mark(tag, "encrypt", start_time)
+            self._mark(tag, "encrypted", end_time)
+        else:
+            self._mark(tag, "replyencrypt", start_time)
+
+    def decrypted(self, side, ciphertext, plaintext, start_time, end_time):
+        '''Note the decryption of a message by the parrot'''
+        _ = ciphertext
+        tag = self._find_tag(plaintext)
+        if tag is not None and side == SIDE_PARROT:
+            self._mark(tag, "decrypt", start_time)
+            self._mark(tag, "decrypted", end_time)
+
+    def sent(self, side, frame, when):
+        '''Note the sending of a frame, or of all the messages in an envelope'''
+        parcels = [frame]
+        if frame and len(frame) > HEADER_LENGTH \
+          and frame[HEADER_LENGTH - 5] == Message.ENCTYPE_ENVELOPE:
+            parcels = EnvelopeMessage.split_payload(
+                bytes(frame[HEADER_LENGTH:-TRAILER_LENGTH])) or []
+        for parcel in parcels:
+            with self._lock:
+                tag = self._checksums.get(Message.get_frame_checksum(parcel))
+            if tag is not None:
+                self._mark(tag, "sent" if side == SIDE_CLIENT else "replysent", when)
+
+    def record_arrival(self, tor_id, row):
+        '''Note the arrival of the reply in the client's inbox'''
+        _ = tor_id
+        tag = self._find_tag(str((row or {}).get("messageBody")).encode("utf-8"))
+        if tag is not None:
+            self._mark(tag, "arrived", time.monotonic())
+            with self._arrival:
+                self._arrival.notify_all()
+
+    def get_num_arrived(self):
+        '''Get the number of replies which have arrived'''
+        with self._lock:
+            return self._count_arrived()
+
+    def _count_arrived(self):
+        '''Count the replies which have arrived, with the lock already held'''
+        return len([points for points in self._points.values() if "arrived" in points])
+
+    def wait_for_arrivals(self, number, timeout):
+        '''Wait until the given number of replies have arrived, return True if they have'''
+        with self._arrival:
+            return self._arrival.wait_for(lambda: self._count_arrived() >= number, timeout)
+
+    def get_stats(self):
+        '''Return the round trip times, and the times taken by each stage'''
+        with self._lock:
+            journeys = [dict(points) for points in self._points.values()]
+        round_trips = [points["arrived"] - points["compose"] for points in journeys
+                       if "arrived" in points]
+        stats = {"sent":len(journeys), "completed":len(round_trips),
+                 "roundtrip":_summarize(round_trips), "stages":{}}
+        for stage, start, end in self.STAGES:
+            stats["stages"][stage] = _summarize([points[end] - points[start]
+                                                 for points in journeys
+                                                 if start in points and end in points])
+        return stats
+
+
+def _summarize(values):
+    '''Summarize the given times in seconds'''
+    return {"count":len(values),
+            "mean":(sum(values) / len(values)) if values else None,
+            "p50":get_percentile(values, 0.5),
+            "p90":get_percentile(values, 0.9),
+            "p99":get_percentile(values, 0.99),
+            "max":max(values) if values else None}
+
+
+class TimedCrypto(Component):
+    '''Crypto component passing everything on to the real one,
+       and noting when the benchmark messages are encrypted and decrypted'''
+
+    def __init__(self, parent, crypto, side, journeys):
+        Component.__init__(self, parent, System.COMPNAME_CRYPTO)
+        self.crypto = crypto
+        self.side = side
+        self.journeys = journeys
+
+    def __getattr__(self, name):
+        '''Everything else goes straight to the real crypto'''
+        return getattr(self.__dict__["crypto"], name)
+
+    def encrypt_and_sign(self, message, recipient, own_key):
+        '''Encrypt and sign, noting the times'''
+        start_time = time.monotonic()
+        result = self.crypto.encrypt_and_sign(message=message, recipient=recipient,
+                                              own_key=own_key)
+        self.journeys.encrypted(self.side, message, result, start_time, time.monotonic())
+        return result
+
+    def decrypt_and_check_signature(self, message):
+        '''Decrypt and check the signature, noting the times'''
+        start_time = time.monotonic()
+        result = self.crypto.decrypt_and_check_signature(message=message)
+        self.journeys.decrypted(self.side, message, result[0], start_time, time.monotonic())
+        return result
+
+
+class TimedTransport:
+    '''Transport passing everything on to the real one, noting when frames are sent'''
+
+    def __init__(self, transport, side, journeys):
+        self.transport = transport
+        self.side = side
+        self.journeys = journeys
+
+    def __getattr__(self, name):
+        '''Everything else goes straight to the real transport'''
+        return getattr(self.__dict__["transport"], name)
+
+    def send_message(self, msg_bytes, whoto):
+        '''Send the message, and if it was sent, note when it was handed over.
+           The other side may already have received it by the time this returns.'''
+        start_time = time.monotonic()
+        result = self.transport.send_message(msg_bytes, whoto)
+        if result == PostService.RC_MESSAGE_SENT:
+            self.journeys.sent(self.side, msg_bytes, start_time)
+        return result
+
+
+class ParrotBenchmark:
+    '''A client system sends a fixed number of regular messages at a fixed rate to
+       a parrot robot over a loopback network, and measures the round trips until
+       the echoes arrive in its inbox.  Both sides use the real components, with the
+       gpg test keys from the given directory, or otherwise the stand-in crypto.'''
+
+    CLIENT_ID = "benchclient00000"
+    PARROT_ID = "benchparrot00000"
+    # Files of the client's key pair and the parrot's key pair in the key directory
+    KEY_FILES = {SIDE_CLIENT:("key1_private.txt", "key1_public.txt"),
+                 SIDE_PARROT:("key2_private.txt", "key2_public.txt")}
+
+    def __init__(self, num_messages=100, rate=10.0, use_tcp=False, send_gap=0.0,
+                 key_dir=None, timeout=60):
+        self.num_messages = num_messages
+        self.rate = rate
+        self.use_tcp = use_tcp
+        self.send_gap = send_gap
+        self.key_dir = key_dir
+        self.timeout = timeout
+        self.journeys = Journeys()
+        self.network = LoopbackNetwork()
+        self.keyring_dir = None
+        self.client = None
+        self.parrot = None
+        self.elapsed = None
+
+    def _make_crypto(self, side):
+        '''Make the crypto for one side, and return it with its own key id'''
+        other_side = SIDE_PARROT if side == SIDE_CLIENT else SIDE_CLIENT
+        if not self.key_dir:
+            return (StandInCrypto(None, side.upper()), side.upper(),
+                    StandInCrypto.KEY_PREFIX + other_side.upper())
+        keyring_path = os.path.join(self.keyring_dir, side)
+        os.makedirs(keyring_path)
+        crypto = CryptoClient(None, keyring_path)
+        key_ids = []
+        for filename in self.KEY_FILES[side] + self.KEY_FILES[other_side][1:]:
+            with open(os.path.join(self.key_dir, filename), "r") as keyfile:
+                key_ids.append(crypto.import_public_key(keyfile.read()))
+        return (crypto, key_ids[1], crypto.get_public_key(key_ids[2]))
+
+    def _make_system(self, side, tor_id, other_id, other_status):
+        '''Make the system for one side, apart from the message handler'''
+        system = System()
+        crypto, own_key, other_key = self._make_crypto(side)
+        other_key = crypto.import_public_key(other_key)
+        if side == SIDE_PARROT:
+            config = Config(system)
+            system.add_component(config)
+            config.load(os.devnull)
+            config.set_property(Config.KEY_ROBOT_OWNER_KEY, other_key)
+        database = SimDatabase(system, tor_id, self.journeys)
+        database.add_or_update_profile({"torid":tor_id, "status":"self", "keyid":own_key,
+                                        "name":side, "displayName":side})
+        database.add_or_update_profile({"torid":other_id, "status":other_status,
+                                        "keyid":other_key, "name":other_id,
+                                        "displayName":other_id})
+        system.add_component(database)
+        system.add_component(TimedCrypto(system, crypto, side, self.journeys))
+        postservice = PostService(system, TimedTransport(
+            self.network.get_transport(tor_id, use_tcp=self.use_tcp), side, self.journeys),
+                                  send_gap=self.send_gap)
+        postservice.should_broadcast = False
+        system.add_component(postservice)
+        system.add_component(LoopbackClient(system, self.network, tor_id, use_tcp=self.use_tcp))
+        return system
+
+    def start(self):
+        '''Start the parrot robot and the client system'''
+        if self.key_dir:
+            self.keyring_dir = tempfile.mkdtemp(prefix="murmelibench")
+        self.parrot = self._make_system(SIDE_PARROT, self.PARROT_ID, self.CLIENT_ID, "owner")
+        Robot(self.parrot).start(parrot_mode=True)
+        self.client = self._make_system(SIDE_CLIENT, self.CLIENT_ID, self.PARROT_ID, "trusted")
+        self.client.add_component(RegularMessageHandler(self.client))
+
+    def stop(self):
+        '''Stop both systems and remove the keyrings'''
+        for system in [self.client, self.parrot]:
+            if system:
+                system.stop()
+        if self.keyring_dir:
+            shutil.rmtree(self.keyring_dir, ignore_errors=True)
+            self.keyring_dir = None
+
+    def run(self):
+        '''Send the messages at the given rate, then wait for the echoes'''
+        crypto = self.client.get_component(System.COMPNAME_CRYPTO)
+        database = self.client.get_component(System.COMPNAME_DATABASE)
+        start_time = time.monotonic()
+        for index in range(self.num_messages):
+            if self.rate:
+                delay = start_time + index / self.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            msg = RegularMessage()
+            msg.set_field(msg.FIELD_RECIPIENTS, self.PARROT_ID)
+            msg.set_field(msg.FIELD_MSGBODY, self.journeys.make_body(
+                "Benchmark message %d" % index))
+            msg.recipients = [self.PARROT_ID]
+            dbutils.add_message_to_outbox(msg, crypto, database)
+        self.journeys.wait_for_arrivals(self.num_messages, self.timeout)
+        self.elapsed = time.monotonic() - start_time
+
+    def get_report(self):
+        '''Return a dictionary of the settings, the round trip times,
+           the times of each stage and the throughput'''
+        report = self.journeys.get_stats()
+        report["settings"] = {"messages":self.num_messages, "rate":self.rate,
+                              "tcp":self.use_tcp, "sendgap":self.send_gap,
+                              "crypto":"gpg" if self.key_dir else "stand-in"}
+        report["secs"] = self.elapsed
+        report["throughput"] = (report["completed"] / self.elapsed) if self.elapsed else None
+        return report
+
+
+def format_report(report):
+    '''Format the report as lines of text'''
+    def format_secs(secs):
+        return "%8.2f" % (secs * 1000.0) if secs is not None else "       -"
+    settings = report["settings"]
+    lines = ["%d of %d messages echoed at %s per second, %s crypto, %s: %.1f per second"
+             % (report["completed"], settings["messages"], settings["rate"] or "max",
+                settings["crypto"], "tcp" if settings["tcp"] else "in process",
+                report["throughput"] or 0.0),
+             "%-10s %8s %8s %8s %8s %8s (ms)" % ("", "mean", "p50", "p90", "p99", "max")]
+    for name, stats in [("roundtrip", report["roundtrip"])] + \
+                       [(stage, report["stages"][stage]) for stage, _, _ in Journeys.STAGES]:
+        lines.append("%-10s %s" % (name, " ".join(format_secs(stats[key]) for key in
+                                                  ["mean", "p50", "p90", "p99", "max"])))
+    return lines
@@ -1,11 +1,23 @@
 '''Post service, dealing with outgoing post'''
 
+import random
 import threading
-import time
 import socks
 from murmeli.system import System, Component
-from murmeli.signals import Timer
-from murmeli.message import StatusNotifyMessage, Message, RelayMessage
+from murmeli.scheduler import Scheduler, get_default_scheduler
+from murmeli.clock import SystemClock, get_default_clock
+from murmeli.senderpool import SenderPool
+from murmeli.outboxscheduler import OutboxScheduler, get_row_recipients
+from murmeli.backoff import DeliveryBackoff
+from murmeli.outboxexpiry import OutboxSweeper
+from murmeli.presence import PresenceScheduler
+from murmeli.reachability import ReachabilityModel
+from murmeli.tokenbucket import BandwidthLimiter
+from murmeli.connectionpool import PeerConnectionPool
+from murmeli.circuitslots import CircuitSlots
+from murmeli.message import StatusNotifyMessage, Message, RelayMessage, EnvelopeMessage, \
+    AckMessage
+from murmeli.framing import ENVELOPE_VERSION, RELAY_HOPS_VERSION, LAST_HOP_VERSION
 from murmeli import dbutils
 from murmeli import imageutils
 from murmeli import guinotification
@@ -13,15 +25,68 @@ from murmeli import guinotification
 
 class DefaultMessageTransport:
     '''Class which the outgoing postman usually uses to send messages.
-       May be substituted by another object for use in unit tests.'''
+       May be substituted by another object for use in unit tests.
+       By default each message gets its own connection, but with reuse_connections
+       the connections are kept open for a while to send several messages.
+       Connections go through Tor's SOCKS5 port with isolation credentials from
+       the circuit slots, so that sends to different peers use different circuits.'''
 
-    @staticmethod
-    def send_message(msg_bytes, whoto):
+    def __init__(self, reuse_connections=False, idle_timeout=20, num_slots=8,
+                 proxy_host="localhost", proxy_port=11109, peer_port=11009):
+        self.reuse_connections = reuse_connections
+        self.proxy_host = proxy_host
+        self.proxy_port = proxy_port
+        self.peer_port = peer_port
+        self.slots = CircuitSlots(num_slots)
+        self.pool = PeerConnectionPool(self._connect, idle_timeout=idle_timeout)
+
+    def _connect(self, whoto):
+        '''Open a connection to the given peer through the Tor proxy'''
+        username, password = self.slots.get_credentials(whoto)
+        sock = socks.socksocket()
+        sock.set_proxy(socks.SOCKS5, self.proxy_host, self.proxy_port, rdns=True,
+                       username=username, password=password)
+        sock.connect((whoto + ".onion", self.peer_port))
+        return sock
+
+    def get_peer_version(self, whoto):
+        '''Get the protocol version of the given peer if we know it, otherwise None'''
+        return self.pool.get_peer_version(whoto) if self.reuse_connections else None
+
+    def close(self):
+        '''Close any connections which are still open'''
+        self.pool.close_all()
+
+    def get_idle_interval(self):
+        '''Get how often close_idle should be called, or None if there's no pool'''
+        return self.pool.idle_timeout / 2 if self.reuse_connections else None
+
+    def close_idle(self):
+        '''Close the connections which haven't been used for a while'''
+        self.pool.close_idle()
+
+    def get_stats(self):
+        '''Return a dictionary of connection counts'''
+        stats = self.pool.get_stats()
+        stats["circuits"] = self.slots.get_stats()
+        return stats
+
+    def send_message(self, msg_bytes, whoto):
         '''Try to send the given message over the default mechanism'''
+        self.slots.acquire(whoto)
+        try:
+            return self._send_message(msg_bytes, whoto)
+        finally:
+            self.slots.release(whoto)
+
+    def _send_message(self, msg_bytes, whoto):
+        '''Send the message using the circuit slot already chosen'''
+        if self.reuse_connections:
+            if self.pool.send(whoto, msg_bytes):
+                return PostService.RC_MESSAGE_SENT
+            return PostService.RC_MESSAGE_FAILED
         try:
-            sock = socks.socksocket()
-            sock.setproxy(socks.PROXY_TYPE_SOCKS4, "localhost", 11109)
-            sock.connect((whoto + ".onion", 11009))
+            sock = self._connect(whoto)
             num_sent = sock.send(msg_bytes)
             sock.close()
             if num_sent != len(msg_bytes):
@@ -42,107 +107,532 @@ class PostService(Component):
     RC_MESSAGE_FAILED = 3
     RC_MESSAGE_INVALID = 4
 
-    def __init__(self, parent, transport=None):
+    def __init__(self, parent, transport=None, num_senders=4, send_gap=0.5, clock=None,
+                 threaded=True):
         Component.__init__(self, parent, System.COMPNAME_POSTSERVICE)
+        self.clock = clock or get_default_clock()
+        # Without a thread of its own, delivery is done by the scheduler
+        self.threaded = threaded
         self.work_lock = threading.Lock()
-        self.flush_timer = None
+        self.count_lock = threading.Lock()
+        self.relay_lock = threading.Lock()
+        self.ack_lock = threading.Lock()
+        # Queues of outbox messages for each recipient
+        self.scheduler = OutboxScheduler()
+        # Delays before trying again to reach recipients who couldn't be reached
+        self.backoff = DeliveryBackoff(clock=self.clock.time)
+        # Removal of messages which have been in the outbox for too long
+        self.sweeper = OutboxSweeper(clock=self.clock.time)
+        # History of when each contact could be reached, to predict when they're online
+        self.reachability = ReachabilityModel(clock=self.clock.time)
+        # Choice of which contacts should be told our status, and when
+        self.presence = PresenceScheduler(clock=self.clock.time, reachability=self.reachability)
+        # Parallel senders, with a minimum gap between sends to avoid overloading the network
+        self.sender_pool = SenderPool(num_senders, send_gap, clock=self.clock)
+        # Limits on the outgoing bytes per second, overall and to each recipient
+        self.bandwidth = BandwidthLimiter(clock=self.clock)
+        # Single delivery thread, woken up whenever there's something to do
+        self.delivery_thread = None
+        self.wake_condition = threading.Condition()
+        self.timer_scheduler = None
+        self.own_scheduler = None
+        self.tick_call = None
+        self.retry_call = None
+        self.wake_call = None
+        self.idle_call = None
+        self.tick_pending = False
         self.need_to_flush = True
-        self.step_counter = -1
+        self.broadcast_requested = False
+        # Nothing is sent until the transport is ready, for example until tor has bootstrapped
+        self.transport_ready = True
+        self.transport_ready_told = False
         self.running = False
-        self.flush_interval = 30 # By default, flush every 30 seconds
+        self.flush_interval = 30 # By default, check the outbox every 30 seconds
+        # Number of hops allowed for our relayed messages, and how many relays get a copy
+        self.relay_hops = 1
+        self.relay_fanout = None    # None means all of them
+        self.relay_rand = random.Random()
+        # Limits on the messages put together in a single envelope
+        self.max_envelope_messages = 20
+        self.max_envelope_bytes = 256 * 1024
+        # Acknowledgements waiting to be sent, collected for a few seconds first
+        self.pending_acks = {}    # tor id -> set of frame checksums
+        self.ack_delay = 5
+        self.max_ack_checksums = 100
+        self.ack_call = None
+        self.ack_stats = {"queued":0, "sent":0, "received":0, "acked":0, "cancelled":0}
         self.transport = transport or DefaultMessageTransport()
         self.should_broadcast = True
+        self.own_tor_id = None
 
     def set_timer_interval(self, timer_secs):
-        '''Set the interval to a non-default value (especially for tests)'''
+        '''Set the interval to a non-default value (especially for tests).
+           With 0, flushes only happen on request, and with None there's
+           no delivery thread at all and _flush must be called explicitly.'''
         self.flush_interval = timer_secs
-        self.step_counter = 0
+
+    def set_bandwidth_limits(self, global_rate, peer_rate):
+        '''Set the upload limits in bytes per second, None or 0 for no limit'''
+        self.bandwidth.set_limits(global_rate, peer_rate)
+
+    def _load_network_config(self):
+        '''Take the upload limits (in KiB per second), the connection reuse,
+           the circuit slots and the relay settings from the config, if any'''
+        config = self.get_component(System.COMPNAME_CONFIG)
+        if not config:
+            return
+        try:
+            self.relay_hops = max(1, min(RelayMessage.MAX_HOPS,
+                                         int(config.get_property(config.KEY_RELAY_HOPS) or 1)))
+            self.relay_fanout = int(config.get_property(config.KEY_RELAY_FANOUT) or 0) or None
+        except ValueError:
+            print("Ignoring invalid relay settings")
+        if isinstance(self.transport, DefaultMessageTransport):
+            self.transport.reuse_connections = \
+                bool(config.get_property(config.KEY_REUSE_CONNECTIONS))
+            try:
+                self.transport.slots.set_num_slots(
+                    int(config.get_property(config.KEY_CIRCUIT_SLOTS) or 0))
+            except ValueError:
+                print("Ignoring invalid number of circuit slots:",
+                      config.get_property(config.KEY_CIRCUIT_SLOTS))
+        rates = []
+        for key in [config.KEY_UPLOAD_LIMIT, config.KEY_PEER_UPLOAD_LIMIT]:
+            try:
+                rates.append(float(config.get_property(key) or 0) * 1024)
+            except ValueError:
+                print("Ignoring invalid upload limit:", config.get_property(key))
+                rates.append(None)
+        self.set_bandwidth_limits(*rates)
 
     def checked_start(self):
         '''Start the separate threads'''
         self.running = True
-        if self.flush_interval:
-            self.flush_timer = Timer(self.flush_interval, self._flush)
+        self._load_network_config()
+        transport_comp = self.get_component(System.COMPNAME_TRANSPORT)
+        with self.wake_condition:
+            # Only ask if the transport hasn't already told us
+            if hasattr(transport_comp, "is_ready") and not self.transport_ready_told:
+                self.transport_ready = transport_comp.is_ready()
+        self.sender_pool.start()
+        if self.flush_interval is not None:
+            self.timer_scheduler = self.get_component(System.COMPNAME_SCHEDULER)
+            if not self.timer_scheduler:
+                # The shared scheduler uses the real time, otherwise make our own
+                if isinstance(self.clock, SystemClock):
+                    self.timer_scheduler = get_default_scheduler()
+                else:
+                    self.own_scheduler = Scheduler(clock=self.clock, threaded=self.threaded)
+                    self.own_scheduler.start()
+                    self.timer_scheduler = self.own_scheduler
+            if self.flush_interval:
+                self.tick_call = self.timer_scheduler.call_repeatedly(self.flush_interval,
+                                                                      self._request_tick)
+            # Idle connections are closed on time, not only when the next message is sent
+            idle_interval = self.transport.get_idle_interval() \
+                if hasattr(self.transport, "get_idle_interval") else None
+            if idle_interval:
+                self.idle_call = self.timer_scheduler.call_repeatedly(idle_interval,
+                                                                      self.transport.close_idle)
+            if self.threaded:
+                self.delivery_thread = threading.Thread(target=self._run_delivery)
+                self.delivery_thread.daemon = True
+                self.delivery_thread.start()
         return True
 
     def stop(self):
         '''Stop this component'''
-        self.running = False
-        if self.flush_timer:
-            self.flush_timer.stop()
+        with self.wake_condition:
+            self.running = False
+            self.wake_condition.notify_all()
+        for call in [self.tick_call, self.retry_call, self.wake_call, self.ack_call,
+                     self.idle_call]:
+            if call:
+                call.cancel()
+        self.sender_pool.stop()
+        if hasattr(self.transport, "close"):
+            self.transport.close()
+        if self.own_scheduler:
+            self.own_scheduler.stop()
+            self.own_scheduler = None
+        if self.delivery_thread and self.delivery_thread is not threading.current_thread():
+            self.delivery_thread.join(timeout=5)
+        self.delivery_thread = None
+
+    def get_stats(self):
+        '''Return the statistics of the sender pool and the queues'''
+        return {"senders":self.sender_pool.get_stats(),
+                "queues":self.scheduler.get_stats(),
+                "backoff":self.backoff.get_stats(),
+                "expiry":self.sweeper.get_stats(),
+                "presence":self.presence.get_stats(),
+                "reachability":self.reachability.get_stats(),
+                "bandwidth":self.bandwidth.get_stats(),
+                "acks":self._get_ack_stats(),
+                "connections":self.transport.get_stats()
+                              if hasattr(self.transport, "get_stats") else {}}
 
     def request_broadcast(self):
-        '''Request a broadcast in a separate thread'''
-        self.step_counter = -1
-        self.request_flush()
+        '''Request a broadcast to all contacts in a separate thread'''
+        self.presence.make_all_due()
+        self.broadcast_requested = True
+        self._trigger_flush()
 
-    def request_flush(self):
-        '''Request a flush in a separate thread'''
-        self.need_to_flush = True
-        if self.flush_interval == 0:
-            Timer(1, self._flush, repeated=False)
+    def request_flush(self, new_row=None):
+        '''Request a flush in a separate thread.  If a new outbox row is given, then
+           it's added to the queues, otherwise the whole outbox will be checked again'''
+        if new_row:
+            self.scheduler.add_row(new_row)
+        else:
+            self.scheduler.mark_stale()
+        self._trigger_flush()
 
-    def _flush(self):
-        '''Flush the outbox'''
-        self.step_counter = (self.step_counter + 1) % 10
-        if not self.step_counter:
+    def set_transport_ready(self, ready):
+        '''Called by the transport when it's ready to send, to kick the first flush'''
+        with self.wake_condition:
+            self.transport_ready = ready
+            self.transport_ready_told = True
+            if ready:
+                self.need_to_flush = True
+                self._wake()
+
+    def _request_tick(self):
+        '''Called regularly by the scheduler to wake up the delivery thread'''
+        with self.wake_condition:
+            self.tick_pending = True
+            self._wake()
+
+    def _trigger_flush(self):
+        '''Wake up the delivery thread to flush straight away'''
+        with self.wake_condition:
+            self.need_to_flush = True
+            self._wake()
+
+    def _wake(self):
+        '''Wake up the delivery, either on our own thread or on the scheduler's.
+           Called with the wake condition already held.'''
+        if not self.transport_ready:
+            return    # the transport will wake us up once it's ready
+        if self.threaded:
+            self.wake_condition.notify_all()
+        elif self.timer_scheduler and not self.wake_call and self.running:
+            self.wake_call = self.timer_scheduler.call_later(0, self._deliver)
+
+    def set_recipient_online(self, tor_id, online):
+        '''Called by the contacts when the given recipient comes online or goes offline'''
+        if tor_id == self._get_own_tor_id():
+            return    # we're marked as online too, but we're not one of the recipients
+        self.scheduler.set_online(tor_id, online)
+        if online:
+            self.presence.record_reachable(tor_id)
+            self._record_seen(tor_id)
+            self.reset_backoff(tor_id)
+            if self.scheduler.get_num_queued(tor_id):
+                self._trigger_flush()
+
+    def _get_own_tor_id(self):
+        '''Get our own tor id, which doesn't change once it's known'''
+        if not self.own_tor_id:
+            self.own_tor_id = dbutils.get_own_tor_id(self.get_component(System.COMPNAME_DATABASE))
+        return self.own_tor_id
+
+    def heard_from(self, tor_id):
+        '''Called when a message arrives directly from the given contact'''
+        if not self._is_known(tor_id):
+            return
+        self.presence.heard_from(tor_id)
+        self._record_seen(tor_id)
+        self.reset_backoff(tor_id)
+
+    def _record_seen(self, tor_id):
+        '''Count the current hour as one in which the given contact was online'''
+        new_state = self.reachability.record_seen(tor_id)
+        database = self.get_component(System.COMPNAME_DATABASE) if new_state else None
+        if database and database.get_profile(torid=tor_id):
+            database.update_reachability_state(tor_id, new_state)
+
+    def _is_known(self, tor_id):
+        '''Return True if we have a profile for the given id which isn't deleted or blocked'''
+        database = self.get_component(System.COMPNAME_DATABASE)
+        profile = database.get_profile(torid=tor_id) if database and tor_id else None
+        return bool(profile) and profile.get('status') not in ['deleted', 'blocked']
+
+    def reset_backoff(self, tor_id):
+        '''Called when we hear directly from the given recipient, so it can be tried again'''
+        new_state = self.backoff.reset(tor_id)
+        if new_state:
+            database = self.get_component(System.COMPNAME_DATABASE)
+            if database:
+                database.update_delivery_state(tor_id, new_state)
+
+    def queue_ack(self, tor_id, checksum):
+        '''Acknowledge the receipt of the message with the given frame checksum from
+           the given contact, so that it stops trying to deliver it.  Acks are
+           collected for a few seconds and then sent together.'''
+        if not tor_id or not checksum:
+            return
+        with self.ack_lock:
+            self.pending_acks.setdefault(tor_id, set()).add(checksum)
+            self.ack_stats["queued"] += 1
+            if self.ack_call or not self.running or not self.timer_scheduler:
+                return    # otherwise they'll go with the next flush
+            self.ack_call = self.timer_scheduler.call_later(self.ack_delay, self._ack_due)
+
+    def _ack_due(self):
+        '''Called by the scheduler when the collected acks should be sent'''
+        with self.ack_lock:
+            self.ack_call = None
+        self._trigger_flush()
+
+    def _send_acks(self):
+        '''Put the collected acks into the outbox, in one message per contact'''
+        with self.ack_lock:
+            pending = self.pending_acks
+            self.pending_acks = {}
+        database = self.get_component(System.COMPNAME_DATABASE) if pending else None
+        if not database:
+            return
+        crypto = self.get_component(System.COMPNAME_CRYPTO)
+        for tor_id, checksums in pending.items():
+            checksums = sorted(checksums)
+            for start in range(0, len(checksums), self.max_ack_checksums):
+                msg = AckMessage()
+                msg.set_field(msg.FIELD_CHECKSUMS, checksums[start:start + self.max_ack_checksums])
+                msg.recipients = [tor_id]
+                dbutils.add_message_to_outbox(msg, crypto, database)
+                with self.ack_lock:
+                    self.ack_stats["sent"] += 1
+
+    def acknowledge(self, tor_id, checksums):
+        '''Called when the given contact acknowledges the messages with the given frame
+           checksums.  Our messages to that contact are deleted from the outbox, so they
+           aren't sent or relayed again, and the relays which were given a copy are told
+           to drop it too.  Copies we're relaying for that contact are also dropped.'''
+        database = self.get_component(System.COMPNAME_DATABASE)
+        checksums = set(checksums or [])
+        if not database or not tor_id or not checksums:
+            return
+        with self.ack_lock:
+            self.ack_stats["received"] += 1
+        for row in database.get_outbox_messages_with_checksums(checksums):
+            if row.get('recipient') == tor_id:
+                counter = "acked"
+                for relay in row.get('relayedTo') or []:
+                    self.queue_ack(relay, row['checksum'])
+            elif row.get('recipientList') and row.get('origin') == tor_id:
+                counter = "cancelled"
+            else:
+                continue
+            if database.delete_from_outbox(index=row['_id']):
+                with self.ack_lock:
+                    self.ack_stats[counter] += 1
+
+    def _get_ack_stats(self):
+        '''Return a dictionary of ack counts'''
+        with self.ack_lock:
+            stats = dict(self.ack_stats)
+            stats["pending"] = sum(len(checksums) for checksums in self.pending_acks.values())
+        return stats
+
+    def _run_delivery(self):
+        '''Delivery loop, running in a separate thread'''
+        while True:
+            with self.wake_condition:
+                self.wake_condition.wait_for(lambda: not self.running or self.transport_ready
+                                             and (self.need_to_flush or self.tick_pending))
+                if not self.running:
+                    return
+            self._deliver()
+
+    def _deliver(self):
+        '''Do the pending delivery work, after a tick or a request'''
+        with self.wake_condition:
+            self.wake_call = None
+            tick = self.tick_pending
+            self.tick_pending = False
+        self._flush(tick)
+        self._schedule_retry()
+        if self.broadcast_requested:
+            # Requested while this flush was already under way
+            self._trigger_flush()
+
+    def run_pending(self):
+        '''Without threads, run whatever is due now according to the clock'''
+        if self.timer_scheduler:
+            self.timer_scheduler.run_pending()
+
+    def run_for(self, secs):
+        '''Without threads and with a virtual clock, simulate the given number of seconds'''
+        if self.timer_scheduler:
+            self.timer_scheduler.run_for(secs)
+
+    def _schedule_retry(self):
+        '''Make sure we wake up when the next queued recipient stops backing off'''
+        next_attempt = self.backoff.get_next_attempt(self.scheduler.get_recipients())
+        if self.retry_call:
+            self.retry_call.cancel()
+            self.retry_call = None
+        if next_attempt is not None and self.running and self.timer_scheduler:
+            self.retry_call = self.timer_scheduler.call_later(
+                next_attempt - self.backoff.clock(), self._trigger_flush)
+
+    def _flush(self, tick=True):
+        '''Flush the outbox.  Each regular tick is also a presence cycle.'''
+        if tick or self.broadcast_requested:
+            self.broadcast_requested = False
             self._broadcast()
+        self._send_acks()
+        if self.sweeper.is_due():
+            self._sweep()
         if not self.need_to_flush:
             return
-        if self.work_lock.acquire(timeout=2):
+        with self.work_lock:
             print("Flush")
             self.need_to_flush = False
             self.call_component(System.COMPNAME_GUI, "notify_gui",
                                 notify_type=guinotification.NOTIFY_OUTBOX_FLUSHING)
-            # Look in the outbox for messages
             database = self.get_component(System.COMPNAME_DATABASE)
-            messages_found = 0
-            messages_sent = 0
-            failed_recpts = set()
-            # Loop twice over all messages, firstly dealing with priority messages
-            for flush_iter in range(2):
-                print("Flush iter %d" % flush_iter)
-                for msg in database.get_outbox():
-                    if not msg:
-                        continue    # message already deleted
-                    if not self.running:
-                        break    # flushing stopped from outside
-                    if flush_iter == 0:
-                        messages_found += 1
-                        recipient = msg.get('recipient')
-                        if not self.call_component(System.COMPNAME_CONTACTS,
-                                                   "is_online", tor_id=recipient):
-                            continue # not a priority for the first iter
-                    msg_sent, should_delete = self.deal_with_outbox_msg(msg, failed_recpts)
-                    if msg_sent:
-                        messages_sent += 1
-                        self.call_component(System.COMPNAME_GUI, "notify_gui",
-                                            notify_type=guinotification.NOTIFY_MSG_SENT)
-                    if should_delete \
-                      and not database.delete_from_outbox(index=msg.get("_id")):
-                        print("Failed to delete from outbox:", msg)
-
-                    # Wait inbetween sending to avoid overloading the network
-                    time.sleep(3)
+            if not database:
+                return
+            if self.scheduler.is_stale():
+                self.scheduler.load(database.get_outbox())
+            if not self.backoff.loaded:
+                self.backoff.load(database.get_delivery_states())
+            if not self.reachability.loaded:
+                self.reachability.load(database.get_reachability_states())
+            counts = {"found":0, "sent":0}
+            # Recipients which are backing off are treated as failed, without trying them
+            deferred_recpts = self.backoff.get_deferred(self.scheduler.get_recipients())
+            failed_recpts = set(deferred_recpts)
+            # Deal with the queues of online recipients first, then all the others,
+            # each starting with the ones most likely to be online at this time
+            for recipient in self.scheduler.get_recipients(
+                    order=self.reachability.order_recipients):
+                if not self.running:
+                    break    # flushing stopped from outside
+                queued = self.scheduler.take_messages(recipient)
+                counts["found"] += len(queued)
+                # Messages for the same recipient are sent in order, one at a time
+                if not self.sender_pool.submit(recipient, self._make_send_job(
+                        recipient, queued, failed_recpts, counts)):
+                    # The taken messages are still in the outbox, so get them again next time
+                    self.scheduler.mark_stale()
+                    self.need_to_flush = True
+                    break
+            self.sender_pool.wait_until_idle()
 
-            print("From %d messages, I managed to send %d" % (messages_found, messages_sent))
+            print("From %d messages, I managed to send %d" % (counts["found"], counts["sent"]))
             # We tried to send a message to these recipients but failed - set them to be offline
-            for recpt in failed_recpts:
+            for recpt in failed_recpts - deferred_recpts:
                 self.call_component(System.COMPNAME_CONTACTS, "gone_offline",
                                     tor_id=recpt)
+                self.backoff.record_failure(recpt)
+                # No need to wait for the backoff if the recipient is usually online sooner
+                likely_time = self.reachability.get_next_likely_online(recpt)
+                if likely_time is not None:
+                    self.backoff.bring_forward(recpt, likely_time)
+                database.update_delivery_state(recpt, self.backoff.get_state(recpt))
+                self.presence.record_unreachable(recpt)
+            # Only keep statistics for contacts, not for everyone we send a request to
+            for state in self.reachability.take_changed_states():
+                if database.get_profile(torid=state['torid']):
+                    database.update_reachability_state(state['torid'], state)
             print("Finished flush, releasing lock")
-            self.work_lock.release()
 
-    def deal_with_outbox_msg(self, msg, failed_recpts):
-        '''Deal with a message in the outbox, trying to send if possible'''
-        # send_timestamp = msg.get('timestamp', None) # not used yet
-        # TODO: if timestamp is too old, either delete the message or move to inbox
+    def _sweep(self):
+        '''Remove the expired messages from the outbox'''
+        database = self.get_component(System.COMPNAME_DATABASE)
+        if database:
+            num_expired = self.sweeper.sweep(database)
+            if num_expired:
+                print("Removed %d expired messages from the outbox" % num_expired)
+
+    def _make_send_job(self, recipient, queued, failed_recpts, counts):
+        '''Make a job for the sender pool to deal with the queued messages for one recipient'''
+        def send_job():
+            database = self.get_component(System.COMPNAME_DATABASE)
+            remaining = queued
+            if len(queued) > 1 and self._can_receive_envelopes(recipient):
+                remaining = self._send_in_envelopes(recipient, queued, failed_recpts, counts)
+            for row_id, priority in remaining:
+                msg = database.get_outbox_message(index=row_id) if self.running else None
+                if not msg or self.sweeper.expire_row(database, msg):
+                    continue    # message already deleted or expired, or flushing stopped
+                msg_sent, should_delete = self.deal_with_outbox_msg(msg, failed_recpts,
+                                                                    recipient)
+                if msg_sent:
+                    with self.count_lock:
+                        counts["sent"] += 1
+                    self.call_component(System.COMPNAME_GUI, "notify_gui",
+                                        notify_type=guinotification.NOTIFY_MSG_SENT)
+                if should_delete:
+                    if not database.delete_from_outbox(index=row_id):
+                        print("Failed to delete from outbox:", msg)
+                elif recipient in get_row_recipients(database.get_outbox_message(index=row_id)):
+                    # Still needs to be sent to this recipient, so put it back in the queue
+                    self.scheduler.add(recipient, row_id, priority)
+        return send_job
+
+    def _can_receive_envelopes(self, recipient):
+        '''Check whether the transport knows that the recipient can unpack envelopes'''
+        get_peer_version = getattr(self.transport, "get_peer_version", None)
+        version = get_peer_version(recipient) if get_peer_version else None
+        return bool(version and version >= ENVELOPE_VERSION)
+
+    def _send_in_envelopes(self, recipient, queued, failed_recpts, counts):
+        '''Send the queued encrypted messages for just this recipient together in
+           envelopes, and return the queued entries still to be dealt with one by one'''
+        database = self.get_component(System.COMPNAME_DATABASE)
+        bundles = [[]]
+        bundle_size = 0
+        for row_id, _ in queued:
+            msg = database.get_outbox_message(index=row_id) if self.running else None
+            if not msg or msg.get('recipient') != recipient \
+              or msg.get('encType') != Message.ENCTYPE_ASYM or self.sweeper.is_expired(msg):
+                continue
+            msg_bytes = imageutils.string_to_bytes(msg['message'])
+            if len(bundles[-1]) >= self.max_envelope_messages \
+              or (bundles[-1] and bundle_size + len(msg_bytes) > self.max_envelope_bytes):
+                bundles.append([])
+                bundle_size = 0
+            bundles[-1].append((row_id, msg, msg_bytes))
+            bundle_size += len(msg_bytes)
+        sent_ids = set()
+        for bundle in bundles:
+            if len(bundle) < 2 or recipient in failed_recpts:
+                continue
+            envelope = EnvelopeMessage.wrap_outgoing_messages([entry[2] for entry in bundle])
+            send_result = self._send_message(envelope, Message.ENCTYPE_ENVELOPE, recipient,
+                                             "envelope")
+            if send_result != self.RC_MESSAGE_SENT:
+                if send_result == self.RC_MESSAGE_FAILED:
+                    failed_recpts.add(recipient)
+                continue
+            print("Sent %d messages in an envelope to '%s'" % (len(bundle), recipient))
+            self.call_component(System.COMPNAME_CONTACTS, "come_online", tor_id=recipient)
+            self.call_component(System.COMPNAME_CONTACTS, "come_online",
+                                tor_id=dbutils.get_own_tor_id(database))
+            for row_id, msg, _ in bundle:
+                sent_ids.add(row_id)
+                with self.count_lock:
+                    counts["sent"] += 1
+                self.call_component(System.COMPNAME_GUI, "notify_gui",
+                                    notify_type=guinotification.NOTIFY_MSG_SENT)
+                self.call_component(System.COMPNAME_LOGGING, "log",
+                                    logstr="Sent '%s' to '%s'" % (msg.get('msgType'), recipient))
+                if not database.delete_from_outbox(index=row_id):
+                    print("Failed to delete from outbox:", msg)
+        return [entry for entry in queued if entry[0] not in sent_ids]
+
+    def deal_with_outbox_msg(self, msg, failed_recpts, recipient=None):
+        '''Deal with a message in the outbox, trying to send if possible.
+           For messages with a recipientList, recipient may specify just one of them.'''
         # Some messages have a single recipient, others only have a recipientList
-        recipient = msg.get('recipient')
-        if recipient:
-            return self.deal_with_single_recipient(msg, recipient, failed_recpts)
+        single_recipient = msg.get('recipient')
+        if single_recipient:
+            return self.deal_with_single_recipient(msg, single_recipient, failed_recpts)
         if msg.get('recipientList'):
-            return self.deal_with_relayed_message(msg, failed_recpts)
+            return self.deal_with_relayed_message(msg, failed_recpts, recipient)
 
         print("msg in outbox had neither recipient nor recipientList?", msg)
         msg_sent = False
@@ -166,7 +656,8 @@ class PostService(Component):
             send_result = self.RC_MESSAGE_FAILED
         else:
             msg_bytes = imageutils.string_to_bytes(msg['message'])
-            send_result = self._send_message(msg_bytes, msg.get('encType'), recipient)
+            send_result = self._send_message(msg_bytes, msg.get('encType'), recipient,
+                                             msg.get('msgType'))
             msg_sent = (send_result == self.RC_MESSAGE_SENT)
             if msg_sent:
                 # The recipient and I are both online
@@ -187,22 +678,35 @@ class PostService(Component):
             elif msg.get('relays'):
                 print("Failed to send but I can try to relay it")
                 signed_blob = self._get_blob_to_relay(msg, database)
-                # Loop over each relay in the list and try to send to each one
+                # Try the relays in turn, the likeliest to be online first,
+                # until as many have a copy as the fan-out allows
                 failed_relays = set()
-                for relay in msg.get('relays'):
+                relayed_to = set(msg.get('relayedTo') or [])
+                num_wanted = self.relay_fanout - len(relayed_to) if self.relay_fanout else None
+                for relay in self.order_relays(msg.get('relays')):
+                    if num_wanted is not None and num_wanted <= 0:
+                        break
                     if relay not in failed_recpts and \
-                      self._send_message(signed_blob, Message.ENCTYPE_RELAY,
-                                         relay) == self.RC_MESSAGE_SENT:
+                      self._send_message(self._add_relay_hops(signed_blob, relay),
+                                         Message.ENCTYPE_RELAY, relay, "relay") \
+                      == self.RC_MESSAGE_SENT:
                         print("Sent message to relay '%s'" % relay)
+                        relayed_to.add(relay)
+                        if num_wanted is not None:
+                            num_wanted -= 1
                         self.call_component(System.COMPNAME_LOGGING, "log",
                                             logstr="Relayed '%s'" % msg.get('msgType'))
                     else:
                         # Send failed, so add this relay to the list of failed ones
                         failed_relays.add(relay)
                         failed_recpts.add(relay)
-                # here we update the list even if it hasn't changed
+                if num_wanted is not None and num_wanted <= 0:
+                    failed_relays = set()    # enough relays have a copy, no need for more
+                # here we update the lists even if they haven't changed, and remember
+                # which relays have a copy in case they need to be told to drop it
                 database.update_outbox_message(index=msg["_id"],
-                                               props={"relays":list(failed_relays)})
+                                               props={"relays":list(failed_relays),
+                                                      "relayedTo":sorted(relayed_to)})
         return (msg_sent, should_delete)
 
     def _get_blob_to_relay(self, msg, database):
@@ -216,6 +720,30 @@ class PostService(Component):
                                        props={"relayMessage":list(signed_blob)})
         return signed_blob
 
+    def _add_relay_hops(self, signed_blob, relay):
+        '''Allow the configured number of hops, unless the relay is too old to pass them on'''
+        if self.relay_hops <= 1:
+            return signed_blob
+        get_peer_version = getattr(self.transport, "get_peer_version", None)
+        version = get_peer_version(relay) if get_peer_version else None
+        if version and version < RELAY_HOPS_VERSION:
+            return signed_blob
+        return RelayMessage.with_hops(signed_blob, self.relay_hops)
+
+    def _can_receive_last_hop(self, recipient):
+        '''Check whether the transport knows that the recipient understands the
+           last hop marker, as older peers would drop it'''
+        get_peer_version = getattr(self.transport, "get_peer_version", None)
+        version = get_peer_version(recipient) if get_peer_version else None
+        return bool(version and version >= LAST_HOP_VERSION)
+
+    def order_relays(self, relays):
+        '''Put the given relays in a random order, then the ones most likely
+           to be online now first'''
+        relays = list(relays or [])
+        self.relay_rand.shuffle(relays)
+        return self.reachability.order_recipients(relays)
+
     def _sign_message(self, msg_bytes):
         '''Sign the given bytes with our own key id'''
         database = self.get_component(System.COMPNAME_DATABASE)
@@ -226,41 +754,52 @@ class PostService(Component):
             return None
         return crypto.sign_data(msg_bytes, own_key_id)
 
-    def deal_with_relayed_message(self, msg, failed_recpts):
-        '''Try to send the given relay message to a recipient list'''
+    def deal_with_relayed_message(self, msg, failed_recpts, recipient=None):
+        '''Try to send the given relay message to its recipient list,
+           or only to the given recipient if specified'''
         msg_sent = False
         should_delete = False
         msg_bytes = imageutils.string_to_bytes(msg['message'])
-        failed_recpts_for_message = set()
+        last_hop_bytes = imageutils.string_to_bytes(msg['lastHop']) \
+                         if msg.get('lastHop') else None
+        done_recpts = set()
         database = self.get_component(System.COMPNAME_DATABASE)
         own_tor_id = dbutils.get_own_tor_id(database)
         for recpt in msg.get('recipientList'):
-            if recpt in failed_recpts:
-                failed_recpts_for_message.add(recpt)
-            else:
-                send_result = self._send_message(msg_bytes, msg.get('encType'), recpt)
-                if send_result == self.RC_MESSAGE_SENT:
-                    msg_sent = True
-                    self.call_component(System.COMPNAME_CONTACTS, "come_online", tor_id=recpt)
-                    self.call_component(System.COMPNAME_CONTACTS, "come_online", tor_id=own_tor_id)
-                elif send_result == self.RC_MESSAGE_FAILED:
-                    # Couldn't send to this relay recipient
-                    failed_recpts_for_message.add(recpt)
-                    failed_recpts.add(recpt)
-        if failed_recpts_for_message:
-            # update msg with the new recipientList
-            relays = list(failed_recpts_for_message)
-            database.update_outbox_message(index=msg["_id"],
-                                           props={"recipientList":relays})
-            print("Failed to send a relay to:", failed_recpts_for_message)
-        else:
-            print("Relayed everything, now deleting relay message")
-            should_delete = True
+            if (recipient and recpt != recipient) or recpt in failed_recpts:
+                continue
+            send_result = self._send_message(
+                last_hop_bytes if last_hop_bytes and self._can_receive_last_hop(recpt)
+                else msg_bytes, msg.get('encType'), recpt, msg.get('msgType'))
+            if send_result == self.RC_MESSAGE_SENT:
+                msg_sent = True
+                self.call_component(System.COMPNAME_CONTACTS, "come_online", tor_id=recpt)
+                self.call_component(System.COMPNAME_CONTACTS, "come_online", tor_id=own_tor_id)
+            elif send_result == self.RC_MESSAGE_FAILED:
+                # Couldn't send to this relay recipient
+                failed_recpts.add(recpt)
+                continue
+            done_recpts.add(recpt)
+        # Other senders may be dealing with the same message for other recipients
+        with self.relay_lock:
+            current_msg = database.get_outbox_message(index=msg["_id"])
+            remaining = [recpt for recpt in get_row_recipients(current_msg)
+                         if recpt not in done_recpts]
+            if not remaining:
+                print("Relayed everything, now deleting relay message")
+                should_delete = True
+            elif done_recpts:
+                # update msg with the new recipientList
+                database.update_outbox_message(index=msg["_id"],
+                                               props={"recipientList":remaining})
+        if remaining:
+            print("Failed to send a relay to:", remaining)
         return (msg_sent, should_delete)
 
 
-    def _send_message(self, msg_bytes, enctype, whoto):
-        '''Send the given message to the specified recipient'''
+    def _send_message(self, msg_bytes, enctype, whoto, msg_type=None):
+        '''Send the given message to the specified recipient,
+           within the bandwidth limits for its type'''
         if not msg_bytes:
             return self.RC_MESSAGE_INVALID
         print("Send_message (%d bytes) to '%s'" % (len(msg_bytes), whoto))
@@ -279,22 +818,34 @@ class PostService(Component):
         # Use configured transport object to send
         if self.transport:
             print("passing on to self.transport")
-            return self.transport.send_message(msg_bytes, whoto)
+            self.sender_pool.pace()
+            self.bandwidth.acquire(whoto, len(msg_bytes), msg_type)
+            start_time = self.clock.monotonic()
+            send_result = self.transport.send_message(msg_bytes, whoto)
+            # The changed statistics are stored together at the end of the flush
+            if send_result == self.RC_MESSAGE_SENT:
+                self.reachability.record_success(whoto,
+                                                 latency=self.clock.monotonic() - start_time)
+            elif send_result == self.RC_MESSAGE_FAILED:
+                self.reachability.record_failure(whoto)
+            return send_result
         print("no transport available, so failed")
         return self.RC_MESSAGE_FAILED
 
     def _broadcast(self):
-        '''Broadcast our online status by adding to the outbox'''
+        '''Tell the contacts which are due for it our online status by adding to the outbox'''
         database = self.get_component(System.COMPNAME_DATABASE)
         if not database or not self.should_broadcast:
             return
-        if self.work_lock.acquire(timeout=2):
-            print("Broadcast")
+        with self.work_lock:
             profile_list = database.get_profiles_with_status(["trusted", "robot"])
-            if profile_list:
+            # Contacts which are backing off will be tried again by the backoff anyway
+            tor_ids = [c['torid'] for c in profile_list or [] if self.backoff.is_due(c['torid'])]
+            recipients = self.presence.select_contacts(tor_ids)
+            if recipients:
+                print("Broadcast to %d contacts" % len(recipients))
                 crypto = self.get_component(System.COMPNAME_CRYPTO)
                 msg = StatusNotifyMessage()
-                msg.recipients = [c['torid'] for c in profile_list]
+                msg.recipients = recipients
                 dbutils.add_message_to_outbox(msg, crypto, database)
-            self.work_lock.release()
-        self.need_to_flush = True
+                self.need_to_flush = True
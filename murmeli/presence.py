@@ -0,0 +1,90 @@
+'''Adaptive scheduling of presence notifications to our contacts'''
+
+import random
+import threading
+import time
+
+
+class PresenceScheduler:
+    '''Decides which contacts should be sent a status notification in each cycle.
+       Each contact has its own jittered interval, which grows while the contact
+       can't be reached, and contacts we've heard from recently are skipped.
+       At most max_per_cycle contacts are chosen each time, the most overdue first.
+       With a reachability model, contacts which are usually online at this time
+       are probed at the base interval regardless of their misses, and first.'''
+
+    def __init__(self, base_interval=300, max_interval=3*3600, jitter=0.3,
+                 max_per_cycle=20, clock=None, rand=None, reachability=None):
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.max_per_cycle = max_per_cycle
+        self.clock = clock or time.time
+        self.rand = rand or random.random
+        self.reachability = reachability
+        self._lock = threading.Lock()
+        self._next_probe = {}    # tor id -> time when status should next be sent
+        self._last_probe = {}    # tor id -> time when status was last sent
+        self._misses = {}        # tor id -> number of failed deliveries since last reached
+        self._num_probed = 0
+        self._num_postponed = 0
+        self._num_deferred = 0
+
+    def get_interval(self, tor_id):
+        '''Get the jittered interval before the next probe of the given contact'''
+        misses = self._misses.get(tor_id, 0)
+        interval = min(self.max_interval, self.base_interval * 2 ** min(misses, 30))
+        return interval * (1.0 + self.jitter * (2.0 * self.rand() - 1.0))
+
+    def select_contacts(self, tor_ids):
+        '''Choose which of the given contacts should be sent a status now'''
+        with self._lock:
+            now = self.clock()
+            due = []
+            for tor_id in tor_ids:
+                likely = self._is_likely_online(tor_id, now)
+                if self._next_probe.get(tor_id, 0) <= now or (likely and \
+                  now - self._last_probe.get(tor_id, 0) >= self.base_interval):
+                    due.append((not likely, self._next_probe.get(tor_id, 0), tor_id))
+            due.sort()
+            selected = [tor_id for _, _, tor_id in due[:self.max_per_cycle]]
+            for tor_id in selected:
+                self._next_probe[tor_id] = now + self.get_interval(tor_id)
+                self._last_probe[tor_id] = now
+            self._num_probed += len(selected)
+            self._num_deferred += len(due) - len(selected)
+        return selected
+
+    def _is_likely_online(self, tor_id, now):
+        '''Ask the reachability model, if there is one, whether the contact is usually online'''
+        return bool(self.reachability and self.reachability.is_likely_online(tor_id, now))
+
+    def make_all_due(self):
+        '''Make all the contacts due for a probe straight away'''
+        with self._lock:
+            self._next_probe.clear()
+
+    def heard_from(self, tor_id):
+        '''We've just heard directly from this contact, so no need to probe it for a while'''
+        with self._lock:
+            self._misses.pop(tor_id, None)
+            self._num_postponed += 1
+            self._next_probe[tor_id] = self.clock() + self.get_interval(tor_id)
+
+    def record_reachable(self, tor_id):
+        '''We managed to send something to this contact'''
+        with self._lock:
+            self._misses.pop(tor_id, None)
+
+    def record_unreachable(self, tor_id):
+        '''We failed to send something to this contact, so probe it less often'''
+        with self._lock:
+            self._misses[tor_id] = self._misses.get(tor_id, 0) + 1
+
+    def get_stats(self):
+        '''Return a dictionary of probe counts'''
+        with self._lock:
+            return {"probed":self._num_probed,
+                    "postponed":self._num_postponed,
+                    "deferred":self._num_deferred,
+                    "unreachable":len(self._misses)}
@@ -0,0 +1,153 @@
+'''Statistics of when each contact can be reached, to predict when to deliver'''
+
+import threading
+import time
+
+
+HOUR_SECS = 3600
+
+
+class ReachabilityModel:
+    '''Keeps for each contact the counts of successful and failed sends, the number
+       of distinct hours in which the contact was seen online or offline for each
+       hour of the day (UTC), and a moving average of the time taken to send.
+       From these it estimates how likely a contact is to be online at a given time.
+       States are dictionaries keyed by torid, so that they can be stored in the
+       database and survive a restart.'''
+
+    def __init__(self, latency_weight=0.2, min_observations=3, likely_threshold=0.6,
+                 clock=None):
+        self.latency_weight = latency_weight
+        self.min_observations = min_observations
+        self.likely_threshold = likely_threshold
+        self.clock = clock or time.time
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._states = {}
+        self._changed = set()    # torids whose states haven't been stored yet
+
+    def load(self, states):
+        '''Load the given list of states, for example from the database'''
+        with self._lock:
+            self._states = {state['torid']:dict(state) for state in states or []
+                            if state and state.get('torid')}
+            self.loaded = True
+
+    def _get_state(self, tor_id):
+        '''Get the state of the given contact, creating it if necessary'''
+        state = self._states.get(tor_id)
+        if not state:
+            state = {'torid':tor_id, 'successes':0, 'failures':0,
+                     'onlineHours':[0] * 24, 'offlineHours':[0] * 24}
+            self._states[tor_id] = state
+        return state
+
+    @staticmethod
+    def _mark_hour(state, online, now):
+        '''Count this hour for the contact being on- or offline, at most once per hour'''
+        slot = int(now // HOUR_SECS)
+        slot_key = 'lastOnlineSlot' if online else 'lastOfflineSlot'
+        if state.get(slot_key) == slot:
+            return False
+        state[slot_key] = slot
+        state['onlineHours' if online else 'offlineHours'][slot % 24] += 1
+        return True
+
+    def record_success(self, tor_id, latency=None):
+        '''Record a successful send taking the given number of seconds, return the new state'''
+        with self._lock:
+            now = self.clock()
+            state = self._get_state(tor_id)
+            state['successes'] += 1
+            state['lastSeen'] = now
+            self._changed.add(tor_id)
+            if latency is not None:
+                old_latency = state.get('latency')
+                state['latency'] = latency if old_latency is None else \
+                    old_latency + self.latency_weight * (latency - old_latency)
+            self._mark_hour(state, True, now)
+            return dict(state)
+
+    def record_failure(self, tor_id):
+        '''Record a failed send, return the new state'''
+        with self._lock:
+            state = self._get_state(tor_id)
+            state['failures'] += 1
+            self._mark_hour(state, False, self.clock())
+            self._changed.add(tor_id)
+            return dict(state)
+
+    def take_changed_states(self):
+        '''Return copies of the states changed by sends since the last call,
+           so that they can be stored together'''
+        with self._lock:
+            states = [dict(self._states[tor_id]) for tor_id in sorted(self._changed)]
+            self._changed.clear()
+        return states
+
+    def record_seen(self, tor_id):
+        '''Record that the contact is online without sending to it,
+           return the new state if it changed'''
+        with self._lock:
+            now = self.clock()
+            state = self._get_state(tor_id)
+            state['lastSeen'] = now
+            return dict(state) if self._mark_hour(state, True, now) else None
+
+    def get_online_probability(self, tor_id, when=None):
+        '''Estimate the probability that the contact is online at the given time'''
+        with self._lock:
+            state = self._states.get(tor_id)
+            if not state:
+                return 0.5
+            hour = int((self.clock() if when is None else when) // HOUR_SECS) % 24
+            online = state['onlineHours'][hour]
+            offline = state['offlineHours'][hour]
+        return (online + 1.0) / (online + offline + 2.0)
+
+    def is_likely_online(self, tor_id, when=None):
+        '''Return True if there's enough history to say that the contact
+           is usually online at the given time'''
+        with self._lock:
+            state = self._states.get(tor_id)
+            hour = int((self.clock() if when is None else when) // HOUR_SECS) % 24
+            if not state or state['onlineHours'][hour] + state['offlineHours'][hour] \
+              < self.min_observations:
+                return False
+        return self.get_online_probability(tor_id, when) >= self.likely_threshold
+
+    def get_next_likely_online(self, tor_id, after=None):
+        '''Get the start of the next hour in the coming day when the contact
+           is likely to be online, or None if there isn't one'''
+        now = self.clock() if after is None else after
+        next_hour = (int(now // HOUR_SECS) + 1) * HOUR_SECS
+        for hours_ahead in range(24):
+            when = next_hour + hours_ahead * HOUR_SECS
+            if self.is_likely_online(tor_id, when):
+                return when
+        return None
+
+    def get_latency(self, tor_id):
+        '''Get the average time in seconds taken to send to this contact, or None'''
+        with self._lock:
+            state = self._states.get(tor_id)
+            return state.get('latency') if state else None
+
+    def order_recipients(self, recipients):
+        '''Sort the given recipients so that the ones most likely to be online now
+           come first, keeping the given order otherwise'''
+        now = self.clock()
+        return sorted(recipients, key=lambda recpt: -self.get_online_probability(recpt, now))
+
+    def get_stats(self):
+        '''Return a dictionary of reachability counts'''
+        with self._lock:
+            tor_ids = list(self._states)
+            successes = sum(state['successes'] for state in self._states.values())
+            failures = sum(state['failures'] for state in self._states.values())
+        now = self.clock()
+        return {"contacts":len(tor_ids),
+                "likelyonline":len([tor_id for tor_id in tor_ids
+                                    if self.is_likely_online(tor_id, now)]),
+                "successes":successes,
+                "failures":failures}
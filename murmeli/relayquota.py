@@ -0,0 +1,152 @@
+'''Quotas on the storage used by the messages we relay for our contacts'''
+
+import threading
+
+
+# Eviction policies when the overall quota is full
+EVICT_OLDEST = "oldest"
+# Copies from the origin using the most storage go first, oldest first within each origin
+EVICT_LARGEST_ORIGIN = "largestorigin"
+
+
+def is_relay_row(row):
+    '''Check whether the given outbox row is a copy we're relaying for somebody else'''
+    return bool(row and row.get('msgType') == "relay" and row.get('recipientList') is not None)
+
+def get_row_size(row):
+    '''Get the number of bytes of the message stored in the given outbox row,
+       including the copy for the last hop if there is one'''
+    return (len(row.get('message') or "") + len(row.get('lastHop') or "")) // 2
+
+def _over(num_rows, num_bytes, max_rows, max_bytes):
+    '''Check whether the given number of rows and bytes is over either limit'''
+    return (max_rows is not None and num_rows > max_rows) \
+        or (max_bytes is not None and num_bytes > max_bytes)
+
+
+class RelayQuota:
+    '''Limits the number of rows and bytes of relayed messages in the outbox, both
+       for each origin (the contact who gave us the copies) and overall.  Before a
+       new copy is stored, the oldest copies from the same origin are evicted until
+       it fits in that origin's quota, then copies are evicted according to the
+       policy until it fits in the overall quota.  A copy bigger than an origin's
+       whole quota isn't stored at all.  A limit of None means no limit.
+       The relayed rows are counted for each origin, read from the outbox only once
+       and then kept up to date as copies are stored and deleted, so that storing
+       a copy doesn't need to go through the whole outbox.'''
+
+    def __init__(self, max_rows=1000, max_bytes=16 * 1024 * 1024, max_origin_rows=100,
+                 max_origin_bytes=2 * 1024 * 1024, policy=EVICT_OLDEST):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_origin_rows = max_origin_rows
+        self.max_origin_bytes = max_origin_bytes
+        self.policy = policy
+        # Reentrant, because deleting a row from the outbox tells us about it again
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._rows = {}         # row id -> (origin, size, timestamp)
+        self._origins = {}      # origin -> [row ids, oldest first], and their bytes
+        self._origin_bytes = {}
+        self._num_bytes = 0
+        self._stats = {"evicted":0, "evictedbytes":0, "rejected":0, "rows":0, "bytes":0}
+        self._evicted_by_origin = {}
+
+    def store(self, database, origin, row):
+        '''Make room for the given relayed row and add it to the outbox, with nothing
+           else stored in between.  Return False if it can't be stored.'''
+        with self._lock:
+            if not self.make_room(database, origin, get_row_size(row)):
+                return False
+            database.add_row_to_outbox(row)
+            self._add(row.get('_id'), origin, get_row_size(row), row.get('timestamp'))
+            return True
+
+    def make_room(self, database, origin, num_bytes):
+        '''Evict relayed copies from the outbox so that a new one of the given size from
+           the given origin fits in the quotas.  Return False if it can't be stored.'''
+        origin = origin or ""
+        with self._lock:
+            if _over(1, num_bytes, self.max_origin_rows, self.max_origin_bytes) \
+              or _over(1, num_bytes, self.max_rows, self.max_bytes):
+                print("Relayed message of %d bytes from '%s' is too big to store"
+                      % (num_bytes, origin))
+                self._stats["rejected"] += 1
+                return False
+            self._load(database)
+            while _over(len(self._origins.get(origin, [])) + 1,
+                        self._origin_bytes.get(origin, 0) + num_bytes,
+                        self.max_origin_rows, self.max_origin_bytes):
+                self._evict(database, self._origins[origin][0])
+            while _over(len(self._rows) + 1, self._num_bytes + num_bytes,
+                        self.max_rows, self.max_bytes):
+                self._evict(database, self._choose_victim())
+            self._stats["rows"] = len(self._rows) + 1
+            self._stats["bytes"] = self._num_bytes + num_bytes
+            return True
+
+    def row_deleted(self, row_id):
+        '''Forget the given outbox row, if it was a relayed copy, as it's been deleted'''
+        with self._lock:
+            self._remove(row_id)
+
+    def _load(self, database):
+        '''Count the relayed rows already in the outbox, the first time only'''
+        if self._loaded:
+            return
+        rows = sorted([row for row in database.get_outbox() if is_relay_row(row)],
+                      key=lambda row: (row.get('timestamp') or 0, row['_id']))
+        for row in rows:
+            self._add(row['_id'], row.get('origin'), get_row_size(row), row.get('timestamp'))
+        self._loaded = True
+
+    def _add(self, row_id, origin, num_bytes, timestamp):
+        '''Count the given row, which is newer than all the others'''
+        if row_id is None or row_id in self._rows:
+            return
+        origin = origin or ""
+        self._rows[row_id] = (origin, num_bytes, timestamp or 0)
+        self._origins.setdefault(origin, []).append(row_id)
+        self._origin_bytes[origin] = self._origin_bytes.get(origin, 0) + num_bytes
+        self._num_bytes += num_bytes
+
+    def _remove(self, row_id):
+        '''Stop counting the given row, return its origin and size or None'''
+        found = self._rows.pop(row_id, None)
+        if not found:
+            return None
+        origin, num_bytes, _ = found
+        own_rows = self._origins[origin]
+        own_rows.remove(row_id)
+        self._origin_bytes[origin] -= num_bytes
+        if not own_rows:
+            del self._origins[origin]
+            del self._origin_bytes[origin]
+        self._num_bytes -= num_bytes
+        return origin, num_bytes
+
+    def _choose_victim(self):
+        '''Choose which of the rows to evict next'''
+        if self.policy == EVICT_LARGEST_ORIGIN:
+            largest = max(self._origin_bytes,
+                          key=lambda origin: (self._origin_bytes[origin], origin))
+            return self._origins[largest][0]
+        # The oldest row is the oldest one of one of the origins
+        return min((own_rows[0] for own_rows in self._origins.values()),
+                   key=lambda row_id: (self._rows[row_id][2], row_id))
+
+    def _evict(self, database, row_id):
+        '''Delete the given row from the outbox and count it'''
+        origin, num_bytes = self._remove(row_id)
+        print("Evicting relayed message from '%s' to make room" % origin)
+        database.delete_from_outbox(index=row_id)
+        self._stats["evicted"] += 1
+        self._stats["evictedbytes"] += num_bytes
+        self._evicted_by_origin[origin] = self._evicted_by_origin.get(origin, 0) + 1
+
+    def get_stats(self):
+        '''Return a dictionary of eviction counts and the storage used after the last copy'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats["byorigin"] = dict(self._evicted_by_origin)
+            return stats
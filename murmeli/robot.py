@@ -8,6 +8,7 @@ from murmeli.torclient import TorClient
 from murmeli.cryptoclient import CryptoClient
 from murmeli.supersimpledb import MurmeliDb
 from murmeli.messagehandler import RobotMessageHandler, ParrotMessageHandler
+from murmeli.metrics import Metrics
 from murmeli.postservice import PostService
 try:
     from murmeli.scrollbot import ScrollbotGuiNotifier as RobotNotifier
@@ -74,6 +75,9 @@ class Robot:
             post = PostService(self.system)
             post.should_broadcast = False
             self.system.add_component(post)
+        # Add metrics
+        if not self.system.has_component(System.COMPNAME_METRICS):
+            self.system.add_component(Metrics(self.system))
         # Add gui notifier
         self.system.remove_component(System.COMPNAME_GUI)
         notifier = RobotNotifier(self.system)
@@ -0,0 +1,181 @@
+'''Scheduler for running calls after a delay or at regular intervals, all on one thread'''
+
+import heapq
+import itertools
+import random
+import threading
+from murmeli.system import System, Component
+from murmeli.clock import get_default_clock
+
+
+class ScheduledCall:
+    '''Handle for a call which has been scheduled, which can be used to cancel it'''
+
+    def __init__(self, target, interval=None, jitter=0.0):
+        self.target = target
+        self.interval = interval
+        self.jitter = jitter
+        self.when = None
+        self.cancelled = False
+
+    def cancel(self):
+        '''Cancel this call, so that it won't be run (again)'''
+        self.cancelled = True
+
+    def is_repeated(self):
+        '''Return True if this call is repeated at regular intervals'''
+        return self.interval is not None
+
+
+class Scheduler(Component):
+    '''Keeps a heap of calls ordered by when they're due, and runs them either on
+       its own thread once started, or whenever run_pending is called.
+       Delays may have a jitter, as a fraction by which they're randomly lengthened
+       or shortened.  The clock can be replaced, for example for testing.'''
+
+    def __init__(self, parent=None, clock=None, rand=None, threaded=True):
+        Component.__init__(self, parent, System.COMPNAME_SCHEDULER)
+        self.clock = clock or get_default_clock()
+        self.rand = rand or random.random
+        self.threaded = threaded
+        self._condition = threading.Condition()
+        self._heap = []      # (when, sequence, call)
+        self._sequence = itertools.count()
+        self._running = False
+        self._thread = None
+        self._num_run = 0
+        self._num_failed = 0
+
+    def checked_start(self):
+        '''Start the separate thread if required'''
+        with self._condition:
+            self._running = True
+        if self.threaded and not self._thread:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return True
+
+    def stop(self):
+        '''Stop the thread and drop all the scheduled calls'''
+        with self._condition:
+            self._running = False
+            self._heap.clear()
+            self._condition.notify_all()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self._thread = None
+        Component.stop(self)
+
+    def call_later(self, delay, target, jitter=0.0):
+        '''Call the given target once, after the given delay in seconds'''
+        call = ScheduledCall(target, jitter=jitter)
+        self._schedule(call, delay)
+        return call
+
+    def call_repeatedly(self, interval, target, jitter=0.0, first_delay=None):
+        '''Call the given target every interval seconds, until the call is cancelled'''
+        call = ScheduledCall(target, interval=interval, jitter=jitter)
+        self._schedule(call, interval if first_delay is None else first_delay)
+        return call
+
+    def get_jittered(self, delay, jitter):
+        '''Apply the jitter fraction to the given delay'''
+        if not jitter:
+            return delay
+        return max(0.0, delay * (1.0 + jitter * (2.0 * self.rand() - 1.0)))
+
+    def _schedule(self, call, delay, start_time=None):
+        '''Put the given call in the heap'''
+        if start_time is None:
+            start_time = self.clock.monotonic()
+        call.when = start_time + self.get_jittered(delay, call.jitter)
+        with self._condition:
+            heapq.heappush(self._heap, (call.when, next(self._sequence), call))
+            self._condition.notify_all()
+
+    def get_next_time(self):
+        '''Get the time (from the clock's monotonic) when the next call is due, or None'''
+        with self._condition:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def get_num_scheduled(self):
+        '''Get the number of calls still scheduled'''
+        with self._condition:
+            return len([entry for entry in self._heap if not entry[2].cancelled])
+
+    def run_pending(self):
+        '''Run all the calls which are due now, return the number run'''
+        num_run = 0
+        while True:
+            with self._condition:
+                now = self.clock.monotonic()
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap or self._heap[0][0] > now:
+                    return num_run
+                _, _, call = heapq.heappop(self._heap)
+            self._run_call(call)
+            num_run += 1
+            if call.is_repeated() and not call.cancelled:
+                # Keep to the original rhythm unless we've fallen behind
+                start_time = call.when if call.when + call.interval > now else now
+                self._schedule(call, call.interval, start_time=start_time)
+
+    def run_for(self, secs):
+        '''Only for a virtual clock, move it forward by the given number of seconds,
+           stopping at each scheduled call on the way to run it'''
+        end_time = self.clock.monotonic() + secs
+        while True:
+            next_time = self.get_next_time()
+            if next_time is None or next_time > end_time:
+                break
+            self.clock.advance_to(next_time)
+            self.run_pending()
+        self.clock.advance_to(end_time)
+
+    def _run_call(self, call):
+        '''Run the given call, catching any exceptions'''
+        try:
+            call.target()
+        except Exception as exc:
+            print("Exception thrown by scheduled call:", exc)
+            with self._condition:
+                self._num_failed += 1
+        with self._condition:
+            self._num_run += 1
+
+    def _run(self):
+        '''Loop running in the separate thread'''
+        while True:
+            with self._condition:
+                while self._running:
+                    next_time = self.get_next_time()
+                    delay = None if next_time is None else next_time - self.clock.monotonic()
+                    if delay is not None and delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if not self._running:
+                    return
+            self.run_pending()
+
+    def get_stats(self):
+        '''Return a dictionary of call counts'''
+        return {"scheduled":self.get_num_scheduled(),
+                "run":self._num_run,
+                "failed":self._num_failed}
+
+
+_DEFAULT_SCHEDULER = None
+_DEFAULT_LOCK = threading.Lock()
+
+def get_default_scheduler():
+    '''Get the scheduler shared by everything which doesn't have its own'''
+    global _DEFAULT_SCHEDULER
+    with _DEFAULT_LOCK:
+        if not _DEFAULT_SCHEDULER or not _DEFAULT_SCHEDULER.is_started():
+            _DEFAULT_SCHEDULER = Scheduler()
+            _DEFAULT_SCHEDULER.start()
+        return _DEFAULT_SCHEDULER
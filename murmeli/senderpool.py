@@ -0,0 +1,117 @@
+'''Pool of sender threads for delivering outgoing messages in parallel'''
+
+import collections
+import threading
+from murmeli.clock import get_default_clock
+
+
+class SenderPool:
+    '''Runs send jobs on a number of parallel sender threads.
+       Jobs are submitted for a particular recipient, and the jobs for each recipient
+       are run in the order they were submitted, never more than one at a time.
+       Senders call pace() before each send so that there is a minimum gap between sends.
+       With zero senders, each job is run immediately in the calling thread.'''
+
+    def __init__(self, num_senders=4, send_gap=0.5, clock=None):
+        self.num_senders = max(0, num_senders)
+        self.send_gap = send_gap
+        self.clock = clock or get_default_clock()
+        self._condition = threading.Condition()
+        self._queues = {}        # recipient -> deque of jobs
+        self._ready = collections.deque()   # recipients with jobs waiting, none running
+        self._active = set()     # recipients with a job running
+        self._next_start = 0.0
+        self._running = False
+        self._threads = []
+        self._num_jobs = 0
+        self._num_failed = 0
+
+    def start(self):
+        '''Start the sender threads'''
+        with self._condition:
+            self._running = True
+        for _ in range(self.num_senders - len(self._threads)):
+            sender = threading.Thread(target=self._run)
+            sender.daemon = True
+            sender.start()
+            self._threads.append(sender)
+
+    def stop(self):
+        '''Stop the sender threads, dropping any jobs which haven't started yet'''
+        with self._condition:
+            self._running = False
+            self._queues.clear()
+            self._ready.clear()
+            self._condition.notify_all()
+        self._threads = []
+
+    def submit(self, recipient, job):
+        '''Add a job (a callable without parameters) to the queue for the given recipient,
+           return False if it can't be accepted because the pool isn't running'''
+        if not self.num_senders:
+            self._run_job(job)
+            return True
+        with self._condition:
+            if not self._running:
+                return False    # pool has been stopped
+            jobs = self._queues.setdefault(recipient, collections.deque())
+            jobs.append(job)
+            if len(jobs) == 1 and recipient not in self._active:
+                self._ready.append(recipient)
+            self._condition.notify()
+        return True
+
+    def wait_until_idle(self, timeout=None):
+        '''Block until all submitted jobs have finished, return False on timeout'''
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queues and not self._active,
+                                            timeout=timeout)
+
+    def get_stats(self):
+        '''Return a dictionary of job counts'''
+        with self._condition:
+            return {"senders":self.num_senders,
+                    "waiting":sum(len(jobs) for jobs in self._queues.values()),
+                    "active":len(self._active),
+                    "jobs":self._num_jobs,
+                    "failed":self._num_failed}
+
+    def _run(self):
+        '''Sender loop, running in a separate thread'''
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._ready or not self._running)
+                if not self._running:
+                    return
+                recipient = self._ready.popleft()
+                job = self._queues[recipient].popleft()
+                self._active.add(recipient)
+            self._run_job(job)
+            with self._condition:
+                self._active.discard(recipient)
+                jobs = self._queues.get(recipient)
+                if jobs:
+                    self._ready.append(recipient)
+                elif jobs is not None:
+                    del self._queues[recipient]
+                self._condition.notify_all()
+
+    def pace(self):
+        '''Wait if necessary so that sends start at least send_gap seconds apart'''
+        with self._condition:
+            now = self.clock.monotonic()
+            start_time = max(now, self._next_start)
+            self._next_start = start_time + self.send_gap
+        if start_time > now:
+            self.clock.sleep(start_time - now)
+
+    def _run_job(self, job):
+        '''Run the given job, catching any exceptions'''
+        try:
+            job()
+        except Exception as exc:
+            print("Exception thrown by send job:", exc)
+            with self._condition:
+                self._num_failed += 1
+        with self._condition:
+            self._num_jobs += 1
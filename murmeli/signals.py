@@ -1,7 +1,6 @@
 '''Simple signal and timer functionality to remove dependency on Qt'''
 
-import threading
-import time
+from murmeli.scheduler import get_default_scheduler
 
 class Signal:
     '''A signal which can be connected to one or more listeners'''
@@ -25,22 +24,26 @@ class Signal:
 
 
 class Timer:
-    '''Calls a given method either repeatedly or after a given period'''
-    def __init__(self, delay, target, repeated=True):
+    '''Calls a given method either repeatedly or after a given period.
+       All timers share the thread of a scheduler, by default the shared one.'''
+    def __init__(self, delay, target, repeated=True, scheduler=None):
         self.delay = delay
         self.target = target
         self.repeated = repeated
         self.running = True
-        threading.Thread(target=self.run).start()
+        scheduler = scheduler or get_default_scheduler()
+        if repeated:
+            self._call = scheduler.call_repeatedly(delay, self.run)
+        else:
+            self._call = scheduler.call_later(delay, self.run)
 
     def run(self):
-        '''Run in separate thread'''
-        while self.running:
-            time.sleep(self.delay)
-            if self.running:
-                self.target()
-                self.running = self.running and self.repeated
+        '''Called by the scheduler when the delay is over'''
+        if self.running:
+            self.running = self.repeated
+            self.target()
 
     def stop(self):
-        '''Stop the separate thread from running'''
+        '''Stop the timer, so the target won't be called again'''
         self.running = False
+        self._call.cancel()
@@ -0,0 +1,403 @@
+'''Simulation of a whole network of Murmeli nodes in one process, to measure how the
+   protocol and the post service behave with hundreds of nodes on a single machine'''
+
+import os
+import random
+import re
+import time
+from murmeli.system import System, Component
+from murmeli.clock import VirtualClock, set_default_clock
+from murmeli.scheduler import Scheduler
+from murmeli.config import Config
+from murmeli.supersimpledb import MurmeliDb
+from murmeli.messagehandler import RegularMessageHandler
+from murmeli.postservice import PostService
+from murmeli.contacts import Contacts
+from murmeli.contactmgr import ContactManager
+from murmeli.loopback import LoopbackNetwork, LoopbackClient
+from murmeli.inbound import InboundPipeline
+from murmeli.cryptoclient import CryptoError
+from murmeli.relayquota import get_row_size
+from murmeli.message import RegularMessage
+from murmeli import dbutils
+from murmeli import inbox
+
+
+def get_percentile(values, fraction):
+    '''Get the given percentile (as a fraction) of the values, by the nearest rank'''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+class StandInCrypto(Component):
+    '''Crypto component which only pretends to encrypt and sign, so that hundreds of
+       nodes can run without a gpg keyring each.  Each node has a single key pair.
+       The "ciphertext" names the recipient's key and the signer's key, so that
+       only the recipient can read it and the signer is only recognised if their
+       key has been imported, like with gpg.  A random nonce makes each output
+       different, and some padding stands in for the size of real ciphertext.'''
+
+    KEY_PREFIX = "standinkey:"
+    ENCRYPTED_TAG = b"standinenc"
+    SIGNED_TAG = b"standinsig"
+
+    def __init__(self, parent, own_key, overhead=0, rand=None):
+        Component.__init__(self, parent, System.COMPNAME_CRYPTO)
+        self.own_key = own_key
+        self.overhead = overhead
+        self.rand = rand or random.Random()
+        self.public_keys = {own_key}
+
+    def check_gpg(self):
+        '''There's no gpg, but it can be used in the same way'''
+        return True
+
+    @staticmethod
+    def get_gpg_version():
+        '''Get a version string to show instead of the gpg version'''
+        return "stand-in"
+
+    def get_keys(self, public_keys=False, private_keys=False):
+        '''Get the list of keys in the same form as gpg'''
+        if private_keys:
+            return [{"keyid":self.own_key}]
+        if public_keys:
+            return [{"keyid":key_id} for key_id in sorted(self.public_keys)]
+        return []
+
+    def get_public_key(self, key_id):
+        '''Get the given public key as a string, if we have it'''
+        return self.KEY_PREFIX + key_id if key_id in self.public_keys else None
+
+    def import_public_key(self, strkey):
+        '''If the given string holds a key, then remember it and return the key id'''
+        if strkey and strkey.startswith(self.KEY_PREFIX):
+            key_id = strkey[len(self.KEY_PREFIX):]
+            self.public_keys.add(key_id)
+            return key_id
+        return None
+
+    def _wrap(self, tag, fields, message):
+        '''Join the tag, the fields and a nonce with the padding before the message'''
+        nonce = "%016x" % self.rand.getrandbits(64) + "." * self.overhead
+        header = b":".join([tag] + [field.encode("utf-8") for field in fields]
+                           + [nonce.encode("utf-8")])
+        return header + b":" + bytes(message)
+
+    @staticmethod
+    def _unwrap(tag, num_fields, message):
+        '''Split the fields and the message again, or return None if it doesn't fit'''
+        parts = bytes(message or b"").split(b":", num_fields + 2)
+        if len(parts) != num_fields + 3 or parts[0] != tag:
+            return None
+        return [part.decode("utf-8") for part in parts[1:num_fields + 1]] + [parts[-1]]
+
+    def encrypt_and_sign(self, message, recipient, own_key):
+        '''Pretend to encrypt the given message for the given recipient, signed with own_key'''
+        if not recipient or not own_key:
+            print("Can't encryptAndSign without a recipient and an own key!")
+            raise CryptoError()
+        return self._wrap(self.ENCRYPTED_TAG, [recipient, own_key], message)
+
+    def decrypt_and_check_signature(self, message):
+        '''Returns the contents if they're for us, and the signing key_id if recognised,
+           otherwise the tuple (None, None)'''
+        fields = self._unwrap(self.ENCRYPTED_TAG, 2, message)
+        if not fields or fields[0] != self.own_key:
+            return (None, None)
+        _, signer, data = fields
+        return (data, signer if signer in self.public_keys else None)
+
+    def sign_data(self, message, own_key):
+        '''Pretend to sign the given message with the given key'''
+        return self._wrap(self.SIGNED_TAG, [own_key], message)
+
+    def verify_signed_data(self, message):
+        '''Return the data which was signed, and the signing keyid if the signature is valid'''
+        fields = self._unwrap(self.SIGNED_TAG, 1, message)
+        if not fields or fields[0] not in self.public_keys:
+            return (None, None)
+        return (fields[1], fields[0])
+
+
+class DeliveryTracker:
+    '''Tags the bodies of the messages sent during the simulation, and measures
+       the time until each one arrives in the inbox of each of its recipients'''
+
+    TAG_PATTERN = re.compile(r"\[sim (\d+)\]")
+
+    def __init__(self, clock):
+        self.clock = clock
+        self._next_tag = 0
+        self._pending = {}     # (tag, recipient) -> (kind, time sent)
+        self._latencies = {}   # kind -> list of seconds
+        self._num_sent = {}
+        self._num_unexpected = 0
+
+    def make_body(self, kind, recipients, text=""):
+        '''Make a tagged message body, expected to arrive at each of the recipients'''
+        self._next_tag += 1
+        now = self.clock.time()
+        for recipient in recipients:
+            self._pending[(self._next_tag, recipient)] = (kind, now)
+        self._num_sent[kind] = self._num_sent.get(kind, 0) + len(recipients)
+        return "[sim %d] %s" % (self._next_tag, text)
+
+    def record_arrival(self, tor_id, row):
+        '''Measure the delay of the given inbox row, if it's one of ours'''
+        found = self.TAG_PATTERN.search((row or {}).get(inbox.FN_MSG_BODY) or "")
+        entry = self._pending.pop((int(found.group(1)), tor_id), None) if found else None
+        if not entry:
+            self._num_unexpected += 1
+            return
+        kind, sent_time = entry
+        self._latencies.setdefault(kind, []).append(self.clock.time() - sent_time)
+
+    def get_num_delivered(self):
+        '''Get the total number of deliveries so far'''
+        return sum(len(latencies) for latencies in self._latencies.values())
+
+    def get_stats(self):
+        '''Return the delivery counts and latency percentiles for each kind of message'''
+        stats = {"unexpected":self._num_unexpected}
+        for kind, num_sent in self._num_sent.items():
+            latencies = self._latencies.get(kind, [])
+            stats[kind] = {"sent":num_sent, "delivered":len(latencies),
+                           "p50":get_percentile(latencies, 0.5),
+                           "p90":get_percentile(latencies, 0.9),
+                           "p99":get_percentile(latencies, 0.99),
+                           "max":max(latencies) if latencies else None}
+        return stats
+
+
+class SimDatabase(MurmeliDb):
+    '''In-memory database which tells the tracker about each new inbox row'''
+
+    def __init__(self, parent, tor_id, tracker):
+        MurmeliDb.__init__(self, parent)
+        self.tor_id = tor_id
+        self.tracker = tracker
+
+    def add_row_to_inbox(self, msg):
+        '''Append the given row to the inbox table and measure its delay'''
+        MurmeliDb.add_row_to_inbox(self, msg)
+        self.tracker.record_arrival(self.tor_id, msg)
+
+
+class SimNode:
+    '''One complete node of the simulated network, with its own system of components
+       but sharing the clock, the scheduler and the network with all the others'''
+
+    def __init__(self, simulator, index):
+        self.index = index
+        self.tor_id = "simnode%09d" % index
+        self.key_id = "%016X" % (0x5100000000000000 + index)
+        self.name = "Node %d" % index
+        self.friends = set()
+        self.system = System()
+        self.config = Config(self.system)
+        self.system.add_component(self.config)
+        # Only the simulation's settings, not the ones from the user's own config file
+        self.config.load(os.devnull)
+        self.config.set_property(Config.KEY_RELAY_HOPS, simulator.relay_hops)
+        self.config.set_property(Config.KEY_RELAY_FANOUT, simulator.relay_fanout)
+        self.system.add_component(simulator.scheduler)
+        self.database = SimDatabase(self.system, self.tor_id, simulator.tracker)
+        self.database.add_or_update_profile({"torid":self.tor_id, "status":"self",
+                                             "keyid":self.key_id, "name":self.name,
+                                             "displayName":self.name})
+        self.system.add_component(self.database)
+        rand = random.Random(simulator.rand.random())
+        self.crypto = StandInCrypto(self.system, self.key_id, simulator.crypto_overhead, rand)
+        self.system.add_component(self.crypto)
+        self.system.add_component(RegularMessageHandler(self.system))
+        self.system.add_component(Contacts(self.system, clock=simulator.clock))
+        self.postservice = PostService(self.system, simulator.network.get_transport(self.tor_id),
+                                       num_senders=0, send_gap=0, clock=simulator.clock,
+                                       threaded=False)
+        self.postservice.relay_rand = rand
+        self.postservice.presence.rand = rand.random
+        self.system.add_component(self.postservice)
+        self.client = LoopbackClient(self.system, simulator.network, self.tor_id,
+                                     pipeline_workers={stage:0 for stage in
+                                                       InboundPipeline.DEFAULT_WORKERS})
+        self.system.add_component(self.client)
+
+    def add_friend(self, other):
+        '''Add the other node as a trusted contact, and import its key'''
+        self.friends.add(other.tor_id)
+        self.crypto.import_public_key(other.crypto.get_public_key(other.key_id))
+        dbutils.create_profile(self.database, other.tor_id,
+                               {"status":"trusted", "keyid":other.key_id, "name":other.name,
+                                "displayName":other.name})
+
+    def get_db_size(self):
+        '''Get the numbers of outbox rows, outbox bytes and inbox rows'''
+        outbox = self.database.get_outbox()
+        return (len(outbox), sum(get_row_size(row) for row in outbox),
+                len(self.database.get_inbox()))
+
+    def stop(self):
+        '''Stop all the components'''
+        self.system.stop()
+
+
+class NetworkSimulator:
+    '''Network of complete nodes exchanging messages over a loopback network, all on one
+       thread with a virtual clock so that hours of traffic take a few minutes at most.
+       The friendships form a random graph with about the given number of friends each.
+       A fraction of the nodes go offline for a while, so that their messages have to
+       wait or be relayed.  The traffic is regular messages and referrals at the given
+       rates per node per hour, on top of the presence messages sent by the post
+       services themselves.  Crypto is only a stand-in, so the cpu time measured is
+       that of everything else.'''
+
+    def __init__(self, num_nodes, num_friends=8, latency=2.0, jitter=1.0, loss=0.0,
+                 offline_fraction=0.2, relay_hops=1, relay_fanout=0, crypto_overhead=400,
+                 seed=1):
+        self.num_nodes = num_nodes
+        self.num_friends = num_friends
+        self.offline_fraction = offline_fraction
+        self.relay_hops = relay_hops
+        self.relay_fanout = relay_fanout
+        self.crypto_overhead = crypto_overhead
+        self.rand = random.Random(seed)
+        self.clock = VirtualClock()
+        self.scheduler = Scheduler(clock=self.clock, rand=self.rand.random, threaded=False)
+        self.network = LoopbackNetwork(latency=latency, jitter=jitter, loss=loss,
+                                       clock=self.clock, rand=random.Random(seed + 1),
+                                       scheduler=self.scheduler)
+        self.tracker = DeliveryTracker(self.clock)
+        self.nodes = []
+        self.previous_clock = None
+        self.db_samples = []
+        self.times = {"cpu":0.0, "wall":0.0, "sim":0.0}
+
+    def start(self):
+        '''Make all the nodes and the friendships between them'''
+        self.previous_clock = set_default_clock(self.clock)
+        self.nodes = [SimNode(self, index) for index in range(self.num_nodes)]
+        self._make_friends()
+
+    def stop(self):
+        '''Stop all the nodes and put back the previous default clock'''
+        for node in self.nodes:
+            node.stop()
+        self.scheduler.stop()
+        if self.previous_clock:
+            set_default_clock(self.previous_clock)
+            self.previous_clock = None
+
+    def get_node(self, tor_id):
+        '''Get the node with the given tor id'''
+        for node in self.nodes:
+            if node.tor_id == tor_id:
+                return node
+        return None
+
+    def _make_friends(self):
+        '''Join each node to about half its friends at random, the rest join it'''
+        for node in self.nodes:
+            others = [other for other in self.nodes if other is not node]
+            for other in self.rand.sample(others, min(len(others), self.num_friends // 2)):
+                if other.tor_id not in node.friends:
+                    node.add_friend(other)
+                    other.add_friend(node)
+
+    def set_offline_schedules(self, duration):
+        '''Take some of the nodes offline for a random part of the given duration'''
+        num_offline = int(round(self.offline_fraction * len(self.nodes)))
+        for node in self.rand.sample(self.nodes, num_offline):
+            length = self.rand.uniform(0.1, 0.5) * duration
+            start = self.rand.uniform(0.0, duration - length)
+            self.network.set_offline_schedule(node.tor_id, [(start, start + length)])
+
+    def schedule_traffic(self, duration, message_rate=2.0, referral_rate=0.2, max_recipients=3):
+        '''Schedule messages and referrals from random nodes at random times during
+           the given duration, at the given rates per node per hour'''
+        for rate, send in [(message_rate, self.send_message),
+                           (referral_rate, self.send_referral)]:
+            num_events = int(round(rate * len(self.nodes) * duration / 3600.0))
+            for _ in range(num_events):
+                node = self.rand.choice(self.nodes)
+                self.scheduler.call_later(self.rand.uniform(0.0, duration),
+                                          lambda node=node, send=send:
+                                          send(node, max_recipients))
+
+    def send_message(self, node, max_recipients=1):
+        '''Send a regular message from the given node to some of its friends'''
+        if not node.friends:
+            return
+        recipients = self.rand.sample(sorted(node.friends),
+                                      self.rand.randint(1, min(max_recipients, len(node.friends))))
+        msg = RegularMessage()
+        msg.set_field(msg.FIELD_RECIPIENTS, ",".join(recipients))
+        msg.set_field(msg.FIELD_MSGBODY, self.tracker.make_body("regular", recipients,
+                                                                "Hello from %s" % node.name))
+        msg.recipients = recipients
+        dbutils.add_message_to_outbox(msg, node.crypto, node.database)
+
+    def send_referral(self, node, max_recipients=1):
+        '''Refer two of the node's friends who aren't friends yet to each other'''
+        _ = max_recipients
+        friends = sorted(node.friends)
+        self.rand.shuffle(friends)
+        for friend_id in friends:
+            strangers = [other for other in friends if other != friend_id
+                         and other not in self.get_node(friend_id).friends]
+            if strangers:
+                pair = [friend_id, strangers[0]]
+                intro = self.tracker.make_body("referral", pair, "You should meet")
+                ContactManager(node.database, node.crypto).send_referral_messages(
+                    pair[0], pair[1], intro)
+                return
+
+    def run(self, duration, sample_interval=300):
+        '''Run the simulation for the given number of seconds of virtual time,
+           measuring the cpu time and sampling the size of the databases'''
+        sample_call = self.scheduler.call_repeatedly(sample_interval, self._sample_db)
+        self._sample_db()
+        start_cpu = time.process_time()
+        start_wall = time.monotonic()
+        self.scheduler.run_for(duration)
+        self.times["cpu"] += time.process_time() - start_cpu
+        self.times["wall"] += time.monotonic() - start_wall
+        self.times["sim"] += duration
+        sample_call.cancel()
+        self._sample_db()
+
+    def _sample_db(self):
+        '''Remember the total and the largest sizes of the nodes' databases'''
+        sizes = [node.get_db_size() for node in self.nodes]
+        self.db_samples.append({"outboxrows":sum(size[0] for size in sizes),
+                                "outboxbytes":sum(size[1] for size in sizes),
+                                "inboxrows":sum(size[2] for size in sizes),
+                                "maxoutboxrows":max([size[0] for size in sizes] or [0])})
+
+    def get_report(self):
+        '''Return a dictionary of the delivery latencies, the amplification,
+           the cpu time used and the growth of the databases'''
+        network = self.network.get_stats()
+        by_type = {}
+        relay = {}
+        for node in self.nodes:
+            sent = node.postservice.get_stats()["bandwidth"]["messagesbytype"]
+            for msg_type, count in sent.items():
+                by_type[msg_type] = by_type.get(msg_type, 0) + count
+            handler = node.system.get_component(System.COMPNAME_MSG_HANDLER)
+            for key, count in handler.get_stats()["relay"].items():
+                relay[key] = relay.get(key, 0) + count
+        delivered = self.tracker.get_num_delivered()
+        first, last = (self.db_samples[0], self.db_samples[-1]) if self.db_samples else ({}, {})
+        return {"nodes":len(self.nodes),
+                "times":dict(self.times),
+                "latency":self.tracker.get_stats(),
+                "network":network,
+                "sentbytype":by_type,
+                "relay":relay,
+                "amplification":(network["sent"] / delivered) if delivered else None,
+                "db":{key:{"start":first.get(key), "end":last.get(key),
+                           "peak":max(sample[key] for sample in self.db_samples)}
+                      for key in last}}
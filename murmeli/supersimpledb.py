@@ -4,6 +4,7 @@ import json
 import os.path
 import threading
 from murmeli.system import System, Component
+from murmeli.relayquota import is_relay_row
 from murmeli import inbox
 from murmeli import pendingtable
 
@@ -117,6 +118,10 @@ class MurmeliDb(Component):
     TABLE_PENDING = "pendingcontacts"
     TABLE_OUTBOX = "outbox"
     TABLE_INBOX = "inbox"
+    TABLE_DELIVERY = "delivery"
+    TABLE_DEADLETTERS = "deadletters"
+    TABLE_REACHABILITY = "reachability"
+    TABLE_RELAY_SEEN = "relayseen"
 
     def __init__(self, parent, file_path=None):
         '''Constructor.  If file_path is None, then there will be no file loading or saving.'''
@@ -125,7 +130,15 @@ class MurmeliDb(Component):
         with threading.Condition(self.db_write_lock):
             self.compress_table(MurmeliDb.TABLE_INBOX)
             self.compress_table(MurmeliDb.TABLE_OUTBOX)
-            # TODO: Remove expired outbox messages?
+            # Index of the queued messages which can be replaced by newer ones
+            self.coalesce_index = {}
+            # Index of the queued messages by frame checksum, for finding acknowledged ones
+            self.checksum_index = {}
+            for row in self.db.get_table(MurmeliDb.TABLE_OUTBOX):
+                if row.get("coalesceKey") and row.get("recipient"):
+                    self.coalesce_index[(row["recipient"], row["coalesceKey"])] = row["_id"]
+                if row.get("checksum"):
+                    self.checksum_index.setdefault(row["checksum"], set()).add(row["_id"])
 
     def compress_table(self, table_name):
         '''Compress the table and renumber the indexes'''
@@ -173,6 +186,13 @@ class MurmeliDb(Component):
         '''Get copies of all the messages in the outbox'''
         return [m.copy() for m in self.db.get_table(MurmeliDb.TABLE_OUTBOX) if m]
 
+    def get_outbox_message(self, index):
+        '''Get a copy of the outbox message at the given index, or None if it's been deleted'''
+        outbox = self.db.get_table(MurmeliDb.TABLE_OUTBOX)
+        if index is None or index < 0 or index >= len(outbox) or not outbox[index]:
+            return None
+        return outbox[index].copy()
+
     def add_row_to_pending_table(self, row):
         '''Add the given row to the pending contacts table,
            if it isn't there in the table already'''
@@ -224,21 +244,60 @@ class MurmeliDb(Component):
         return False
 
     def add_row_to_outbox(self, msg):
-        '''Append the given row to the outbox'''
+        '''Append the given row to the outbox, replacing any older row
+           with the same recipient and coalesce key'''
         assert isinstance(msg, dict)
         with threading.Condition(self.db_write_lock):
             # Get current number in outbox, use this as index for msg
             outbox = self.db.get_table(MurmeliDb.TABLE_OUTBOX)
             msg['_id'] = len(outbox)
+            if msg.get("coalesceKey") and msg.get("recipient"):
+                index_key = (msg["recipient"], msg["coalesceKey"])
+                old_index = self.coalesce_index.get(index_key)
+                old_row = outbox[old_index] if old_index is not None else None
+                if old_row and old_row.get("recipient") == msg["recipient"] \
+                  and old_row.get("coalesceKey") == msg["coalesceKey"]:
+                    # The older one is superseded by this new one
+                    outbox[old_index] = {}
+                    self._remove_from_checksum_index(old_row)
+                self.coalesce_index[index_key] = msg['_id']
+            if msg.get("checksum"):
+                self.checksum_index.setdefault(msg["checksum"], set()).add(msg['_id'])
             # print("Adding message to outbox:", repr(msg))
             outbox.append(msg)
         # Inform postman that a flush can be made now
-        self.call_component(System.COMPNAME_POSTSERVICE, "request_flush")
+        self.call_component(System.COMPNAME_POSTSERVICE, "request_flush", new_row=msg)
 
     def delete_from_outbox(self, index):
         '''Delete the message at the given index from the outbox, return True on success'''
         with threading.Condition(self.db_write_lock):
-            return self.db.delete_from_table(MurmeliDb.TABLE_OUTBOX, index)
+            row = self.get_outbox_message(int(index) if isinstance(index, str) else index)
+            deleted = self.db.delete_from_table(MurmeliDb.TABLE_OUTBOX, index)
+            if deleted:
+                self._remove_from_checksum_index(row)
+        if deleted and is_relay_row(row):
+            # Let the relay quota know that this space is free again
+            handler = self.get_component(System.COMPNAME_MSG_HANDLER)
+            if hasattr(handler, "relay_row_deleted"):
+                handler.relay_row_deleted(row_id=row['_id'])
+        return deleted
+
+    def _remove_from_checksum_index(self, row):
+        '''Remove the given row from the checksum index, assuming we have the write lock'''
+        if row and row.get("checksum"):
+            row_ids = self.checksum_index.get(row["checksum"])
+            if row_ids is not None:
+                row_ids.discard(row.get("_id"))
+                if not row_ids:
+                    self.checksum_index.pop(row["checksum"])
+
+    def get_outbox_messages_with_checksums(self, checksums):
+        '''Get copies of the outbox messages with any of the given frame checksums'''
+        with threading.Condition(self.db_write_lock):
+            outbox = self.db.get_table(MurmeliDb.TABLE_OUTBOX)
+            row_ids = sorted(set().union(*[self.checksum_index.get(checksum, ())
+                                           for checksum in checksums]))
+            return [outbox[i].copy() for i in row_ids if i < len(outbox) and outbox[i]]
 
     def delete_all_from_outbox(self):
         '''Delete all the messages from the outbox'''
@@ -271,6 +330,70 @@ class MurmeliDb(Component):
             tab.append(profile)
         return True
 
+    def get_deadletters(self):
+        '''Get copies of the expired messages which were moved out of the outbox'''
+        return [m.copy() for m in self.db.get_table(MurmeliDb.TABLE_DEADLETTERS) if m]
+
+    def add_row_to_deadletters(self, row):
+        '''Append the given expired outbox row to the dead letters'''
+        assert isinstance(row, dict)
+        with threading.Condition(self.db_write_lock):
+            self.db.get_table(MurmeliDb.TABLE_DEADLETTERS).append(row)
+
+    def prune_deadletters(self, expired_before, max_rows):
+        '''Remove the dead letters which expired before the given time, and then the
+           oldest ones beyond the maximum number.  Return the number removed.'''
+        with threading.Condition(self.db_write_lock):
+            table = self.db.get_table(MurmeliDb.TABLE_DEADLETTERS)
+            kept = [row for row in table
+                    if row and (row.get('expired') or 0) >= expired_before]
+            # Rows are added as they expire, so the oldest ones come first
+            kept = kept[max(0, len(kept) - max_rows):]
+            num_removed = len([row for row in table if row]) - len(kept)
+            table[:] = kept
+        return num_removed
+
+    def get_delivery_states(self):
+        '''Get copies of the delivery states of all the recipients'''
+        return [m.copy() for m in self.db.get_table(MurmeliDb.TABLE_DELIVERY) if m]
+
+    def update_delivery_state(self, torid, state):
+        '''Either insert or update the delivery state of the given recipient'''
+        return self._update_contact_state(MurmeliDb.TABLE_DELIVERY, torid, state)
+
+    def get_reachability_states(self):
+        '''Get copies of the reachability statistics of all the contacts'''
+        return [m.copy() for m in self.db.get_table(MurmeliDb.TABLE_REACHABILITY) if m]
+
+    def update_reachability_state(self, torid, state):
+        '''Either insert or update the reachability statistics of the given contact'''
+        return self._update_contact_state(MurmeliDb.TABLE_REACHABILITY, torid, state)
+
+    def get_relay_seen_state(self):
+        '''Get a copy of the stored seen-set of relayed messages, or None'''
+        rows = [m for m in self.db.get_table(MurmeliDb.TABLE_RELAY_SEEN) if m]
+        return rows[0].copy() if rows else None
+
+    def set_relay_seen_state(self, state):
+        '''Store the seen-set of relayed messages, replacing the previous one'''
+        with threading.Condition(self.db_write_lock):
+            self.db.get_table(MurmeliDb.TABLE_RELAY_SEEN)[:] = [dict(state)]
+
+    def _update_contact_state(self, table_name, torid, state):
+        '''Either insert or update the row for the given torid in the given table'''
+        if not torid:
+            return False
+        with threading.Condition(self.db_write_lock):
+            tab = self.db.get_table(table_name)
+            for found_state in tab:
+                if found_state and found_state.get("torid") == torid:
+                    found_state.update(state)
+                    return True
+            new_state = dict(state)
+            new_state["torid"] = torid
+            tab.append(new_state)
+        return True
+
     def load_from_file(self):
         '''Load the database from file'''
         with threading.Condition(self.db_write_lock):
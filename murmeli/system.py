@@ -14,6 +14,8 @@ class System:
     COMPNAME_I18N = "comp.i18n"
     COMPNAME_GUI = "comp.gui"
     COMPNAME_POSTSERVICE = "comp.post"
+    COMPNAME_METRICS = "comp.metrics"
+    COMPNAME_SCHEDULER = "comp.scheduler"
 
 
     def __init__(self):
@@ -42,11 +44,15 @@ class System:
         '''Remove the component with the given name, but don't complain if it's not there'''
         assert name
         if name in self.components:
+            self.components[name].prepare_stop()
             self.components[name].stop()
             self.components.pop(name)
 
     def stop(self):
         '''Stop system and remove components'''
+        # Let each component store what it needs to while the others are still running
+        for _, comp in self.components.items():
+            comp.prepare_stop()
         for _, comp in self.components.items():
             comp.stop()
         self.components = {}
@@ -86,6 +92,9 @@ class Component:
         '''Return True if the component was properly started'''
         return self.started
 
+    def prepare_stop(self):
+        '''Called before any of the components is stopped, so they can all still be used'''
+
     def stop(self):
         '''Stop this component'''
         print("Component '%s' stopping..." % self.name)
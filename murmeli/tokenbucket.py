@@ -0,0 +1,154 @@
+'''Token buckets for limiting the rate of outgoing bytes, overall and per peer'''
+
+import threading
+from murmeli.clock import get_default_clock
+
+
+# Traffic classes, lower values may use the bandwidth first
+CLASS_CONTACT = 0
+CLASS_REGULAR = 1
+CLASS_BULK = 2
+
+MSGTYPE_CLASSES = {"contactrequest":CLASS_CONTACT,
+                   "contactresponse":CLASS_CONTACT,
+                   "statusnotify":CLASS_CONTACT,
+                   "ack":CLASS_CONTACT,
+                   "inforequest":CLASS_CONTACT,
+                   "regular":CLASS_REGULAR,
+                   "referral":CLASS_REGULAR,
+                   "referrequest":CLASS_REGULAR,
+                   "inforesponse":CLASS_BULK,
+                   "relay":CLASS_BULK}
+
+
+def get_traffic_class(msg_type):
+    '''Get the traffic class for the given message type (as stored in the outbox)'''
+    return MSGTYPE_CLASSES.get(msg_type, CLASS_REGULAR)
+
+
+class TokenBucket:
+    '''Bucket filling up with tokens at the given rate per second, up to its capacity.
+       Amounts bigger than the capacity may be taken once the bucket is full,
+       leaving the bucket in debt, so that big messages aren't blocked forever.
+       Not thread-safe on its own.'''
+
+    def __init__(self, rate, capacity=None, clock=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.clock = clock or get_default_clock().monotonic
+        self.tokens = self.capacity
+        self._last_time = self.clock()
+
+    def _refill(self):
+        '''Add the tokens gained since the last refill'''
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last_time) * self.rate)
+        self._last_time = now
+
+    def get_wait(self, amount):
+        '''Get the number of seconds before the given amount may be taken'''
+        self._refill()
+        needed = min(amount, self.capacity) - self.tokens
+        return max(0.0, needed / self.rate) if self.rate > 0 else 0.0
+
+    def take(self, amount):
+        '''Take the given amount if possible, return True if successful'''
+        if self.get_wait(amount) > 0.0:
+            return False
+        self.tokens -= amount
+        return True
+
+    def give_back(self, amount):
+        '''Return the given amount which was taken but not used'''
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class BandwidthLimiter:
+    '''Limits the outgoing bytes per second, both overall and to each peer, with
+       bursts of up to burst_secs worth of bytes.  A limit of None means no limit.
+       Senders of a lower traffic class wait while any sender of a higher class is
+       waiting, so contact and regular messages go ahead of bulk relays.
+       Bytes are counted for each message type whether or not there are limits.'''
+
+    def __init__(self, global_rate=None, peer_rate=None, burst_secs=2.0, clock=None):
+        self.clock = clock or get_default_clock()
+        self.burst_secs = burst_secs
+        self._condition = threading.Condition()
+        self._global = None
+        self._peer_rate = None
+        self._peers = {}         # peer -> TokenBucket
+        self._waiting = {}       # traffic class -> number of senders waiting
+        self._bytes = {}         # message type -> bytes sent
+        self._messages = {}      # message type -> messages sent
+        self._num_throttled = 0
+        self._throttled_secs = 0.0
+        self.set_limits(global_rate, peer_rate)
+
+    def set_limits(self, global_rate, peer_rate):
+        '''Set the limits in bytes per second, None for no limit'''
+        with self._condition:
+            self._global = self._make_bucket(global_rate)
+            self._peer_rate = peer_rate or None
+            self._peers = {}
+            self._condition.notify_all()
+
+    def _make_bucket(self, rate):
+        '''Make a bucket for the given rate, or None if there's no limit'''
+        if not rate:
+            return None
+        return TokenBucket(rate, rate * self.burst_secs, clock=self.clock.monotonic)
+
+    def _get_wait(self, peer, num_bytes, traffic_class):
+        '''Get how long to wait before sending, or None if another class goes first'''
+        if any(num for cls, num in self._waiting.items() if cls < traffic_class and num):
+            return None
+        buckets = [self._global]
+        if self._peer_rate:
+            if peer not in self._peers:
+                self._peers[peer] = self._make_bucket(self._peer_rate)
+            buckets.append(self._peers[peer])
+        waits = [bucket.get_wait(num_bytes) for bucket in buckets if bucket]
+        wait = max(waits) if waits else 0.0
+        if not wait:
+            for bucket in buckets:
+                if bucket:
+                    bucket.take(num_bytes)
+        return wait
+
+    def acquire(self, peer, num_bytes, msg_type=None):
+        '''Wait until the given number of bytes may be sent to the given peer,
+           then count them against the message type'''
+        traffic_class = get_traffic_class(msg_type)
+        start_time = self.clock.monotonic()
+        waited = False
+        with self._condition:
+            while True:
+                wait = self._get_wait(peer, num_bytes, traffic_class)
+                if wait == 0.0:
+                    break
+                if not waited:
+                    waited = True
+                    self._waiting[traffic_class] = self._waiting.get(traffic_class, 0) + 1
+                # Sleep without holding the lock, so that other senders can check too
+                self._condition.release()
+                try:
+                    self.clock.sleep(wait if wait is not None else 0.05)
+                finally:
+                    self._condition.acquire()
+            if waited:
+                self._waiting[traffic_class] -= 1
+                self._num_throttled += 1
+                self._throttled_secs += self.clock.monotonic() - start_time
+            key = msg_type or "unknown"
+            self._bytes[key] = self._bytes.get(key, 0) + num_bytes
+            self._messages[key] = self._messages.get(key, 0) + 1
+
+    def get_stats(self):
+        '''Return a dictionary of byte counts and throttling'''
+        with self._condition:
+            return {"bytes":sum(self._bytes.values()),
+                    "bytesbytype":dict(self._bytes),
+                    "messagesbytype":dict(self._messages),
+                    "throttled":self._num_throttled,
+                    "throttledsecs":self._throttled_secs}
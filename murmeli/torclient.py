@@ -6,24 +6,30 @@ import time
 import subprocess
 import threading
 import socket
-import random
 from murmeli.system import System, Component
-from murmeli.message import Message
-from murmeli.decrypter import DecrypterShim
-from murmeli import dbutils
+from murmeli.inbound import InboundPipeline
+from murmeli.asyncserver import AsyncSocketServer
 from murmeli import guinotification
 
 
 class TorClient(Component):
     '''Transport layer using Tor's hidden services'''
 
-    def __init__(self, parent, file_path, tor_exe="tor"):
+    def __init__(self, parent, file_path, tor_exe="tor", pipeline_workers=None,
+                 use_async_server=False):
         Component.__init__(self, parent, System.COMPNAME_TRANSPORT)
         self.file_path = file_path
         self.tor_exe = tor_exe
         self.daemon = None
         self.socket_broker = None
+        self.pipeline = None
+        self.pipeline_workers = pipeline_workers
+        self.use_async_server = use_async_server
         self.started = False
+        # Set once tor has finished bootstrapping, so that messages can be sent
+        self.ready = threading.Event()
+        self.watcher = None
+        self.ready_timeout = 300
 
     def ignite_to_get_tor_id(self):
         '''Start tor, but only to get the tor id, then stop it again.
@@ -35,6 +41,11 @@ class TorClient(Component):
         return result
 
 
+    @staticmethod
+    def _get_log_path(tor_dir):
+        '''Get the path of the log file which tor writes its progress to'''
+        return os.path.join(tor_dir, "tor_log.txt")
+
     @staticmethod
     def _write_torrc_file(tor_dir, rc_filename):
         service_dir = os.path.join(tor_dir, "hidden_service")
@@ -43,18 +54,22 @@ class TorClient(Component):
         try:
             with open(rc_filename, "w") as rc_file:
                 rc_file.writelines(["# Configuration file for tor\n\n",
-                                    "SocksPort 11109\n",
+                                    "SocksPort 11109 IsolateSOCKSAuth\n",
                                     "HiddenServiceDir " + service_dir + "\n",
                                     "HiddenServicePort 11009 127.0.0.1:11009\n",
-                                    "DataDirectory " + data_dir + "\n"])
+                                    "DataDirectory " + data_dir + "\n",
+                                    "Log notice stdout\n",
+                                    "Log notice file " + TorClient._get_log_path(tor_dir)
+                                    + "\n"])
             return True
         except PermissionError:
             return False # can't write file
 
-    def get_own_torid(self, is_started=True):
+    def get_own_torid(self, is_started=True, timeout=15):
         '''Get our own Torid from the hostname file'''
-        # maybe the id hasn't been written yet, so we'll try a few times and wait
-        for _ in range(10):
+        # maybe the id hasn't been written yet, so we'll keep checking until the timeout
+        give_up_time = time.monotonic() + timeout
+        while True:
             try:
                 hostfile_path = os.path.join(self.file_path, "hidden_service", "hostname")
                 with open(hostfile_path, "r") as hostfile:
@@ -67,8 +82,9 @@ class TorClient(Component):
             except Exception:
                 if not is_started:
                     return None # no point in trying again if starting failed
-                time.sleep(1.5) # keep trying a few times more
-        return None # dropped out of the loop, so the hostname isn't there yet
+            if time.monotonic() > give_up_time:
+                return None # the hostname isn't there yet
+            time.sleep(0.1)
 
     def start_tor(self, start_socket_broker=True):
         '''Start the tor process and attach a socket broker for listening'''
@@ -80,6 +96,12 @@ class TorClient(Component):
             print("Failed to write rc file so failing start")
             return False
 
+        # Remove the old log so that only the new progress is read
+        log_path = self._get_log_path(self.file_path)
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        self.ready.clear()
+
         # try to start tor
         started = False
         try:
@@ -90,8 +112,15 @@ class TorClient(Component):
             print("failed to start tor daemon - is it already running or did it just fail?")
             print("Exception:", exc)
             started = False
+        if started:
+            self.watcher = BootstrapWatcher(self, log_path, self.ready_timeout)
         if start_socket_broker:
-            self.socket_broker = SocketBroker(self)
+            self.pipeline = InboundPipeline(self, workers=self.pipeline_workers)
+            self.pipeline.start()
+            if self.use_async_server:
+                self.socket_broker = AsyncSocketServer(self, self.pipeline)
+            else:
+                self.socket_broker = SocketBroker(self, self.pipeline)
         return started
 
     def stop_tor(self):
@@ -103,9 +132,40 @@ class TorClient(Component):
             self.started = False
         else:
             print("Can't stop tor because we haven't got a handle on the process")
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+        if self.ready.is_set():
+            self.ready.clear()
+            self._tell_post_service(ready=False)
         if self.socket_broker:
             self.socket_broker.close()
             self.socket_broker = None
+        if self.pipeline:
+            self.pipeline.stop()
+            self.pipeline = None
+
+    def is_ready(self):
+        '''Return True if tor has finished bootstrapping'''
+        return self.ready.is_set()
+
+    def wait_until_ready(self, timeout=None):
+        '''Wait until tor has finished bootstrapping, return True if it has'''
+        return self.ready.wait(timeout)
+
+    def set_ready(self):
+        '''Called by the watcher when tor is ready, to kick the first flush'''
+        print("Tor is ready")
+        # Set first, so that a post service starting now sees it if it misses the call
+        self.ready.set()
+        self.call_component(System.COMPNAME_GUI, "notify_gui",
+                            notify_type=guinotification.NOTIFY_TOR_CONNECTED)
+        self._tell_post_service(ready=True)
+
+    def _tell_post_service(self, ready):
+        '''Tell the post service whether it can send messages now'''
+        if self.get_component(System.COMPNAME_POSTSERVICE):
+            self.call_component(System.COMPNAME_POSTSERVICE, "set_transport_ready", ready=ready)
 
     def checked_start(self):
         '''Start the component'''
@@ -116,60 +176,133 @@ class TorClient(Component):
         self.stop_tor()
         Component.stop(self)
 
+    def get_stats(self):
+        '''Return the statistics of the inbound pipeline'''
+        stats = {"pipeline":self.pipeline.get_stats() if self.pipeline else {}}
+        if self.socket_broker and hasattr(self.socket_broker, "get_stats"):
+            stats["server"] = self.socket_broker.get_stats()
+        if self.watcher:
+            stats["bootstrap"] = self.watcher.get_stats()
+        return stats
+
+
+###############################################################################
+
+class BootstrapWatcher(threading.Thread):
+    '''This class watches tor's log file for its bootstrap progress, and tells the
+    TorClient as soon as tor has finished bootstrapping.  If the log doesn't show it
+    within the timeout, then tor is assumed to be ready anyway.'''
+
+    BOOTSTRAP_PATTERN = re.compile(r'Bootstrapped (\d+)%')
+
+    def __init__(self, parent, log_path, timeout=300, poll_interval=0.1):
+        threading.Thread.__init__(self)
+        self.parent = parent
+        self.log_path = log_path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.progress = 0
+        self.start_time = time.monotonic()
+        self.ready_secs = None
+        self.stopping = threading.Event()
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        '''Running in separate thread'''
+        log_pos = 0
+        give_up_time = self.start_time + self.timeout
+        while not self.stopping.wait(self.poll_interval):
+            log_pos = self._read_progress(log_pos)
+            if self.progress >= 100:
+                break
+            if time.monotonic() > give_up_time:
+                print("No bootstrap progress from tor, so assuming it's ready")
+                break
+        if not self.stopping.is_set():
+            self.ready_secs = time.monotonic() - self.start_time
+            self.parent.set_ready()
+
+    def _read_progress(self, log_pos):
+        '''Read the new lines of the log, and return the position to read from next time'''
+        try:
+            with open(self.log_path, "r") as log_file:
+                log_file.seek(log_pos)
+                for line in iter(log_file.readline, ""):
+                    if not line.endswith("\n"):
+                        break    # not finished yet, so read it again next time
+                    log_pos += len(line.encode("utf-8"))
+                    progress_match = self.BOOTSTRAP_PATTERN.search(line)
+                    if progress_match:
+                        self.progress = max(self.progress, int(progress_match.group(1)))
+        except OSError:
+            pass    # log not written yet
+        return log_pos
+
+    def get_stats(self):
+        '''Return the bootstrap progress, and how long it took'''
+        return {"progress":self.progress, "readysecs":self.ready_secs}
+
+    def close(self):
+        '''Call from outside to stop watching'''
+        self.stopping.set()
+
 
 ###############################################################################
 
 class SocketBroker(threading.Thread):
     '''This class listens on the Tor port for incoming connection requests on our socket
-    and starts a new thread for each accepted connection.  Connections should deal with
-    only one message or command, and then be destroyed.'''
+    and passes each accepted connection to the inbound pipeline.  Connections may carry
+    several messages if the sender starts with a hello, otherwise just one.'''
 
-    def __init__(self, parent):
+    def __init__(self, parent, pipeline):
         threading.Thread.__init__(self)
         self.parent = parent
+        self.pipeline = pipeline
         self.socket = None
-        self.running = False
+        self.running = True
+        self.listening = threading.Event()
         self.setDaemon(True)
         self.start()
 
     def run(self):
         '''Running in separate thread'''
-        self.running = True
         interface = "localhost"
         port = 11009
 
-        # Try a few times to open the socket, we need to wait until tor has finished starting
+        # Open the socket straight away, trying again only if the port isn't free yet
         started = False
         attempts = 0
-        while not started and attempts < 4:
-            time.sleep(5)
-
+        while not started and attempts < 4 and self.running:
+            if attempts:
+                time.sleep(1)
             try:
                 self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 self.socket.bind((interface, port))
-                print("Started tor and opened socket on attempt number", attempts)
+                print("Opened socket for listening on attempt number", attempts)
                 started = True
             except Exception as exc:
                 print("Attempt", attempts, "- failed to open socket for listening!", exc)
                 attempts += 1
         if not started:
-            print("Failed after", attempts, "attempts to start the socket - tor failed to start?")
+            print("Failed after", attempts, "attempts to start the socket - port in use?")
+            self.listening.set()
             return
 
         self.socket.listen(5)
+        self.listening.set()
 
         while self.running:
             try:
                 print("Waiting for connection")
                 conn, address = self.socket.accept()
-                print("Accepted new connection from ", address, ", now start a new thread...")
+                print("Accepted new connection from ", address, ", now pass to pipeline...")
                 self.parent.call_component(System.COMPNAME_GUI, "notify_gui",
                                            notify_type=guinotification.NOTIFY_MSG_RECEIVING)
-                # Start new listener thread with this conn
-                # (address is meaningless, just comes from proxy)
-                SocketListener(conn, self.parent)
-                # Don't need to keep a handle on this as it'll start its own thread
+                # Pass conn to the pipeline (address is meaningless, just comes from proxy)
+                # This blocks if the pipeline is full, so we stop accepting for a while
+                self.pipeline.submit_connection(conn)
             except:
                 print("socket listener error, failed to accept connection!")
         print("Socket broker has finished accepting new connections, exiting thread")
@@ -177,93 +310,14 @@ class SocketBroker(threading.Thread):
     def close(self):
         '''Call from outside to cleanly close the thread and its socket'''
         self.running = False
-        # TODO: Tell each of the socket listeners to close down too? (Most should be dead anyway)
         try:
             print("SocketBroker.close - closing the socket")
+            # Shutting down first also wakes up the accept, so the port is freed straight away
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass    # wasn't listening
             self.socket.close()
             print("SocketBroker.close - closed the socket")
         except:
             print("SocketBroker.close - failed to close the socket")
-
-
-###############################################################################
-
-class SocketListener(threading.Thread):
-    '''This class listens on the given connection obtained from our socket
-    and starts a new thread to receive data on this connection.
-    Connections should deal with only one message or command, and then be destroyed.'''
-
-    def __init__(self, conn, component):
-        '''Constructor'''
-        threading.Thread.__init__(self)
-        self.conn = conn
-        self.component = component
-        self.running = False
-        self.start()
-
-    def run(self):
-        '''Running in separate thread'''
-        self.running = True
-        print("I'm a socket listener, running in a separate thread now")
-        received = "."
-        msg = bytes()
-        is_http_req = False
-
-        while received and not is_http_req:
-            received = self.conn.recv(1024)
-            print("Got something" if received else "Got nothing!")
-            if received:
-                is_http_req = not msg and self.looks_like_http(received)
-                msg += received
-                if is_http_req:
-                    print("Got Http request: ", msg)
-                    reply_to_send = "This is not the hidden service you are looking for (%d)" \
-                                    % random.Random().choice(range(10000))
-                    self.conn.send(reply_to_send.encode("utf-8"))
-                    self.component.call_component(System.COMPNAME_LOGGING, "log",
-                                                  logstr="Received http request")
-            elif msg:
-                crypto = self.component.get_component(System.COMPNAME_CRYPTO)
-                received_msg = Message.from_received_data(msg, decrypter=DecrypterShim(crypto))
-                if received_msg:
-                    # if msg has signature id, get corresponding sender id
-                    signature_keyid = received_msg.get_field(Message.FIELD_SIGNATURE_KEYID)
-                    database = self.component.get_component(System.COMPNAME_DATABASE)
-                    sender_id = dbutils.user_id_from_key_id(database, signature_keyid)
-                    if sender_id:
-                        received_msg.set_field(Message.FIELD_SENDER_ID, sender_id)
-                    else:
-                        sender_id = received_msg.get_field(Message.FIELD_SENDER_ID)
-                    logstr = "Received '%s' from '%s'" % (received_msg.describe_message_type(),
-                                                          sender_id)
-                    self.component.call_component(System.COMPNAME_LOGGING, "log", logstr=logstr)
-                    # Pass to the system's message handler
-                    self.component.call_component(System.COMPNAME_MSG_HANDLER, "receive",
-                                                  msg=received_msg)
-                    own_tor_id = dbutils.get_own_tor_id(database)
-                    self.component.call_component(System.COMPNAME_CONTACTS, "come_online",
-                                                  tor_id=own_tor_id)
-                else:
-                    print("Hang on, why is the incoming message None?")
-                # Note: should reply with ACK/NACK, but this doesn't work through the proxy
-        # close socket
-        self.conn.close()
-        self.component.call_component(System.COMPNAME_GUI, "notify_gui",
-                                      notify_type=guinotification.NOTIFY_MSG_RECEIVED)
-        print("closed connection, exiting listener thread")
-
-    @staticmethod
-    def looks_like_http(data):
-        '''Check if the given byte array looks like a HTTP request'''
-        allowed_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ" \
-                        "0123456789/_. \t".encode("utf-8")
-        if not data or not isinstance(data, bytes) or len(data) < 5:
-            return False
-        if "GET".encode("utf-8") != data[:3]:
-            return False
-        for char in data:
-            if char in "\r\n".encode("utf-8"):
-                return True
-            if char not in allowed_chars:
-                return False
-        return True
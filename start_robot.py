@@ -1,6 +1,8 @@
 '''Start script for Murmeli Robot
    Copyright activityworkshop.net and released under the GPL v2.'''
 
+import contextlib
+import json
 import os
 import sys
 import pkg_resources as pkgs
@@ -10,6 +12,7 @@ from murmeli.config import Config
 from murmeli.i18n import I18nManager
 from murmeli.supersimpledb import MurmeliDb
 from murmeli.robot import Robot
+from murmeli.parrotbench import ParrotBenchmark, format_report
 
 
 def check_dependencies():
@@ -88,8 +91,31 @@ def launch(system):
     return None
 
 
+def run_benchmark(args):
+    '''Run the parrot benchmark with the given number of messages, rate per second
+       (0 for as fast as possible) and directory of gpg test keys, and print the results'''
+    num_messages = int(args[0]) if args else 100
+    rate = float(args[1]) if len(args) > 1 else 10.0
+    key_dir = args[2] if len(args) > 2 else None
+    benchmark = ParrotBenchmark(num_messages, rate, key_dir=key_dir)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            benchmark.start()
+            benchmark.run()
+        finally:
+            benchmark.stop()
+    report = benchmark.get_report()
+    for line in format_report(report):
+        print(line)
+    # Whole report on one line, to keep for comparison
+    print(json.dumps(report, sort_keys=True))
+
+
 if __name__ == "__main__":
-    if check_dependencies():
+    if len(sys.argv) >= 2 and sys.argv[1] == "benchmark":
+        # Usage: start_robot.py benchmark [messages] [rate] [key directory]
+        run_benchmark(sys.argv[2:])
+    elif check_dependencies():
         SYSTEM = create_system()
         MY_ROBOT = launch(SYSTEM)
         if MY_ROBOT:
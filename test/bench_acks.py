@@ -0,0 +1,277 @@
+'''Loopback simulation of the deliveries to a contact who is often offline, with the
+   messages also given to relays, with and without acknowledgements of receipt.
+   The sender is a real PostService with a virtual clock, while the recipient and
+   the relays are simple stand-ins reached through a loopback transport.
+   Not a unit test, so not discoverable.
+   Run with: python3 -m test.bench_acks'''
+
+import contextlib
+import io
+import random
+from murmeli.system import System, Component
+from murmeli.postservice import PostService
+from murmeli.clock import VirtualClock, set_default_clock
+from murmeli.backoff import DeliveryBackoff
+from murmeli.message import Message, RegularMessage, AckMessage
+from murmeli import framing
+from murmeli import dbutils
+
+STEP_SECS = 30
+SIM_HOURS = 48
+OWN_ID = "sender0000000000"
+RECIPIENT_ID = "recipient0000000"
+
+
+class StandInDatabase(Component):
+    '''In-memory database with just what the PostService and dbutils need'''
+    def __init__(self, parent, contacts):
+        Component.__init__(self, parent, System.COMPNAME_DATABASE)
+        self.own_profile = {"torid":OWN_ID, "status":"self", "keyid":"ownkey"}
+        self.profiles = {torid:{"torid":torid, "status":"trusted", "keyid":torid + "key"}
+                         for torid in contacts}
+        self.outbox = []
+
+    def add_row_to_outbox(self, msg):
+        '''Append the row and tell the postman'''
+        msg["_id"] = len(self.outbox)
+        self.outbox.append(msg)
+        self.call_component(System.COMPNAME_POSTSERVICE, "request_flush", new_row=msg)
+
+    def get_outbox(self):
+        '''Get copies of the outbox rows'''
+        return [dict(msg) for msg in self.outbox if msg]
+
+    def get_outbox_messages_with_checksums(self, checksums):
+        '''Get the outbox rows with any of the given checksums'''
+        return [dict(msg) for msg in self.outbox if msg and msg.get('checksum') in checksums]
+
+    def get_outbox_message(self, index):
+        '''Get a copy of the given row'''
+        return dict(self.outbox[index]) if self.outbox[index] else None
+
+    def delete_from_outbox(self, index):
+        '''Delete the given row'''
+        self.outbox[index] = None
+        return True
+
+    def update_outbox_message(self, index, props):
+        '''Update the given row'''
+        if self.outbox[index]:
+            self.outbox[index].update(props)
+
+    def get_delivery_states(self):
+        '''No stored delivery states at the start'''
+        return []
+
+    def update_delivery_state(self, torid, state):
+        '''Delivery states aren't stored'''
+
+    def get_reachability_states(self):
+        '''No stored reachability statistics at the start'''
+        return []
+
+    def update_reachability_state(self, torid, state):
+        '''Reachability statistics aren't stored'''
+
+    def add_row_to_deadletters(self, row):
+        '''Dead letters aren't stored'''
+
+    def prune_deadletters(self, expired_before, max_rows):
+        '''No dead letters to remove'''
+        return 0
+
+    def get_profile(self, torid=None):
+        '''Get the profile for this torid, or our own'''
+        return self.profiles.get(torid) if torid else self.own_profile
+
+    def get_profiles_with_status(self, status):
+        '''Return list of profiles with the given status'''
+        return [profile for profile in self.profiles.values() if profile['status'] in status]
+
+
+class StandInCrypto(Component):
+    '''Crypto which leaves the messages as they are, so the stand-ins can read them'''
+    def __init__(self, parent):
+        Component.__init__(self, parent, System.COMPNAME_CRYPTO)
+
+    @staticmethod
+    def encrypt_and_sign(message, recipient, own_key):
+        '''No encryption'''
+        _ = (recipient, own_key)
+        return bytes(message)
+
+    @staticmethod
+    def sign_data(message, own_key):
+        '''No signature'''
+        _ = own_key
+        return bytes(message)
+
+
+def make_sessions(rand, online_fraction, sim_secs):
+    '''Make a list of (start, end) times when a contact is online'''
+    sessions = []
+    now = rand.uniform(0, 3600)
+    while now < sim_secs:
+        length = rand.expovariate(1.0 / (3600 * online_fraction * 2))
+        sessions.append((now, now + length))
+        now += length + rand.expovariate(1.0 / (3600 * (1.0 - online_fraction) * 2))
+    return sessions
+
+
+class LoopbackNetwork:
+    '''Transport for the sender, delivering straight to the stand-in recipient and relays.
+       Each relay keeps its copies for all its other contacts until they've had them,
+       and the recipient sends acks back to the sender when it's online.'''
+
+    def __init__(self, rand, relays, num_others, use_acks, sim_secs):
+        self.clock = None
+        self.clock_start = 0.0
+        self.postman = None
+        self.use_acks = use_acks
+        self.sessions = {RECIPIENT_ID:make_sessions(rand, 0.25, sim_secs)}
+        self.relay_contacts = {}
+        for relay in relays:
+            others = ["%s_other%d" % (relay, i) for i in range(num_others)]
+            for other in others:
+                self.sessions[other] = make_sessions(rand, 0.25, sim_secs)
+            self.relay_contacts[relay] = [RECIPIENT_ID] + others
+        self.relay_copies = {relay:{} for relay in relays}   # checksum -> set of contacts
+        self.relay_backoffs = {relay:DeliveryBackoff(clock=self._time, rand=rand.random)
+                               for relay in relays}
+        self.received = set()
+        self.pending_acks = set()
+        self.counts = {"direct":0, "directfailed":0, "torelays":0, "relayed":0,
+                       "relayfailed":0, "duplicates":0, "acksfromrecipient":0,
+                       "acksforrelays":0, "dropped":0}
+
+    def _time(self):
+        '''Time since the start of the simulation'''
+        return self.clock.time() - self.clock_start
+
+    def start(self, clock, postman):
+        '''Attach the clock and the sending postman'''
+        self.clock = clock
+        self.clock_start = clock.time()
+        self.postman = postman
+
+    def is_online(self, torid):
+        '''Relays are always online, the others according to their sessions'''
+        now = self._time()
+        return torid in self.relay_copies or \
+            any(start <= now < end for start, end in self.sessions.get(torid, []))
+
+    def send_message(self, msg_bytes, whoto):
+        '''Deliver the bytes from the sender to the given stand-in'''
+        if whoto == RECIPIENT_ID:
+            self.counts["direct"] += 1
+            if not self.is_online(whoto):
+                self.counts["directfailed"] += 1
+                return PostService.RC_MESSAGE_FAILED
+            self._receive_at_recipient(Message.get_frame_checksum(msg_bytes))
+            return PostService.RC_MESSAGE_SENT
+        msg_bytes = bytes(msg_bytes)
+        enc_type = msg_bytes[framing.HEADER_LENGTH - 5]
+        if enc_type == Message.ENCTYPE_RELAY:
+            # Without a signature, the relayed payload is just the original frame
+            self.counts["torelays"] += 1
+            inner = msg_bytes[framing.HEADER_LENGTH:-framing.TRAILER_LENGTH]
+            self.relay_copies[whoto][Message.get_frame_checksum(inner)] = \
+                set(self.relay_contacts[whoto])
+        else:
+            ack = Message.from_received_data(msg_bytes)
+            if isinstance(ack, AckMessage):
+                self.counts["acksforrelays"] += 1
+                for checksum in ack.get_field(ack.FIELD_CHECKSUMS):
+                    if self.relay_copies[whoto].pop(checksum, None):
+                        self.counts["dropped"] += 1
+        return PostService.RC_MESSAGE_SENT
+
+    def _receive_at_recipient(self, checksum):
+        '''The recipient gets the message with the given checksum, perhaps again'''
+        if checksum in self.received:
+            self.counts["duplicates"] += 1
+        self.received.add(checksum)
+        if self.use_acks:
+            self.pending_acks.add(checksum)
+
+    def step(self):
+        '''Let the relays try to pass on their copies, and the recipient send its acks'''
+        for relay, copies in self.relay_copies.items():
+            backoff = self.relay_backoffs[relay]
+            for checksum, contacts in list(copies.items()):
+                for contact in sorted(contacts):
+                    if not backoff.is_due(contact):
+                        continue
+                    if self.is_online(contact):
+                        self.counts["relayed"] += 1
+                        backoff.reset(contact)
+                        contacts.discard(contact)
+                        if contact == RECIPIENT_ID:
+                            self._receive_at_recipient(checksum)
+                    else:
+                        self.counts["relayfailed"] += 1
+                        backoff.record_failure(contact)
+                if not contacts:
+                    del copies[checksum]
+        if self.pending_acks and self.is_online(RECIPIENT_ID):
+            self.counts["acksfromrecipient"] += 1
+            self.postman.acknowledge(RECIPIENT_ID, sorted(self.pending_acks))
+            self.pending_acks = set()
+
+    def get_pending_copies(self):
+        '''Count the copies which the relays still hold'''
+        return sum(len(copies) for copies in self.relay_copies.values())
+
+
+def simulate(use_acks, num_messages=20, num_relays=3, num_others=5):
+    '''Simulate the sending of messages to the often-offline recipient over a few days'''
+    rand = random.Random(11)
+    sim_secs = SIM_HOURS * 3600
+    clock = VirtualClock()
+    previous_clock = set_default_clock(clock)
+    relays = ["relay%011d" % i for i in range(num_relays)]
+    system = System()
+    database = StandInDatabase(system, [RECIPIENT_ID] + relays)
+    system.add_component(database)
+    crypto = StandInCrypto(system)
+    system.add_component(crypto)
+    network = LoopbackNetwork(rand, relays, num_others, use_acks, sim_secs)
+    postman = PostService(system, network, num_senders=0, send_gap=0, clock=clock,
+                          threaded=False)
+    postman.set_timer_interval(STEP_SECS)
+    postman.should_broadcast = False
+    network.start(clock, postman)
+    send_times = sorted(rand.uniform(0, 12 * 3600) for _ in range(num_messages))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            system.add_component(postman)
+            for step in range(sim_secs // STEP_SECS):
+                while send_times and send_times[0] <= step * STEP_SECS:
+                    send_times.pop(0)
+                    msg = RegularMessage()
+                    msg.set_field(msg.FIELD_MSGBODY, "Message at step %d" % step)
+                    msg.set_field(msg.FIELD_RECIPIENTS, RECIPIENT_ID)
+                    msg.recipients = [RECIPIENT_ID]
+                    dbutils.add_message_to_outbox(msg, crypto, database)
+                postman.run_for(STEP_SECS)
+                network.step()
+            system.stop()
+    finally:
+        set_default_clock(previous_clock)
+    counts = network.counts
+    counts["delivered"] = len(network.received)
+    counts["stillqueued"] = len(database.get_outbox())
+    counts["relaycopies"] = network.get_pending_copies()
+    return counts
+
+
+if __name__ == "__main__":
+    RESULTS = {ACKS:simulate(ACKS) for ACKS in [False, True]}
+    for KEY in ["delivered", "direct", "directfailed", "torelays", "relayed", "relayfailed",
+                "duplicates", "acksfromrecipient", "acksforrelays", "dropped", "stillqueued",
+                "relaycopies"]:
+        print("%-18s without acks: %6d   with acks: %6d"
+              % (KEY, RESULTS[False][KEY], RESULTS[True][KEY]))
+    for KEY in ["direct", "relayed", "relayfailed"]:
+        SAVED = RESULTS[False][KEY] - RESULTS[True][KEY]
+        print("Acks saved %d of %d %s sends" % (SAVED, RESULTS[False][KEY], KEY))
@@ -0,0 +1,77 @@
+'''Simulation of the connection attempts made to contacts who are often offline,
+   with and without the exponential backoff of delivery attempts.
+   Not a unit test, so not discoverable.
+   Run with: python3 -m test.bench_backoff'''
+
+import random
+from murmeli.backoff import DeliveryBackoff
+
+FLUSH_SECS = 30
+SIM_HOURS = 24
+
+
+class SimClock:
+    '''Simulated clock for the backoff'''
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_sessions(rand, online_fraction):
+    '''Make a list of (start, end) times when a contact is online'''
+    sessions = []
+    now = rand.uniform(0, 3600)
+    while now < SIM_HOURS * 3600:
+        length = rand.expovariate(1.0 / (3600 * online_fraction * 2))
+        sessions.append((now, now + length))
+        now += length + rand.expovariate(1.0 / (3600 * (1.0 - online_fraction) * 2))
+    return sessions
+
+def is_online(sessions, now):
+    '''Check whether the given time is inside one of the sessions'''
+    return any(start <= now < end for start, end in sessions)
+
+
+def simulate(use_backoff, num_contacts=50, online_fraction=0.2, notify_chance=0.5):
+    '''Simulate a day of flushes with always something queued for each contact.
+       Only some of the status notifications reach us when contacts come online.
+       Returns the number of failed attempts and the average delay to deliver
+       after a contact comes online.'''
+    rand = random.Random(7)
+    clock = SimClock()
+    backoff = DeliveryBackoff(clock=clock, rand=rand.random)
+    contacts = {"contact%02d" % i:make_sessions(rand, online_fraction)
+                for i in range(num_contacts)}
+    was_online = {contact:False for contact in contacts}
+    waiting_since = {}
+    failed_attempts = 0
+    delays = []
+    for step in range(SIM_HOURS * 3600 // FLUSH_SECS):
+        clock.now = step * FLUSH_SECS
+        for contact, sessions in contacts.items():
+            online = is_online(sessions, clock.now)
+            if online and not was_online[contact]:
+                # Contact comes online and perhaps we get a status notification
+                waiting_since[contact] = clock.now
+                if rand.random() < notify_chance:
+                    backoff.reset(contact)
+            was_online[contact] = online
+            if use_backoff and not backoff.is_due(contact):
+                continue
+            if online:
+                backoff.reset(contact)
+                if contact in waiting_since:
+                    delays.append(clock.now - waiting_since.pop(contact))
+            else:
+                failed_attempts += 1
+                backoff.record_failure(contact)
+    return (failed_attempts, sum(delays) / max(1, len(delays)))
+
+
+if __name__ == "__main__":
+    for BACKOFF in [False, True]:
+        FAILED, DELAY = simulate(BACKOFF)
+        print("Backoff %-5s: %6d failed connection attempts, avg delivery delay %.0f s"
+              % (BACKOFF, FAILED, DELAY))
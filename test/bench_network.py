@@ -0,0 +1,72 @@
+'''Load test of whole networks of Murmeli nodes, from 50 to 500 nodes, each with its own
+   database, message handler, post service and contacts, exchanging messages, referrals,
+   presence messages and relays over a loopback network with a virtual clock.
+   Reports the delivery latencies, the amplification (frames sent for each delivery),
+   the cpu time and the growth of the databases.  The crypto is a stand-in, so the
+   cpu time doesn't include gpg.  Runs are repeatable with the same seed.
+   Not a unit test, so not discoverable.
+   Run with: python3 -m test.bench_network [number of nodes ...]'''
+
+import contextlib
+import os
+import sys
+from murmeli.simulator import NetworkSimulator
+
+# Virtual seconds of traffic, then some more for the stragglers to arrive
+TRAFFIC_SECS = 2 * 3600
+SETTLE_SECS = 3600
+# Regular messages and referrals per node per hour
+MESSAGE_RATE = 2.0
+REFERRAL_RATE = 0.2
+
+
+def simulate(num_nodes, relay_hops=1, relay_fanout=0):
+    '''Run a network of the given size, and return the report'''
+    simulator = NetworkSimulator(num_nodes, relay_hops=relay_hops, relay_fanout=relay_fanout)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            simulator.start()
+            simulator.set_offline_schedules(TRAFFIC_SECS)
+            simulator.schedule_traffic(TRAFFIC_SECS, MESSAGE_RATE, REFERRAL_RATE)
+            simulator.run(TRAFFIC_SECS + SETTLE_SECS)
+            return simulator.get_report()
+        finally:
+            simulator.stop()
+
+
+def format_secs(secs):
+    '''Format a latency which may be missing'''
+    return "%7.1f" % secs if secs is not None else "      -"
+
+
+def print_report(report):
+    '''Print the main figures of the given report'''
+    print("%d nodes: %.1f s cpu, %.1f s wall for %d s simulated"
+          % (report["nodes"], report["times"]["cpu"], report["times"]["wall"],
+             report["times"]["sim"]))
+    for kind in ["regular", "referral"]:
+        stats = report["latency"].get(kind)
+        if stats:
+            print("  %-8s %5d of %5d delivered, latency p50 %s p90 %s p99 %s max %s"
+                  % (kind, stats["delivered"], stats["sent"], format_secs(stats["p50"]),
+                     format_secs(stats["p90"]), format_secs(stats["p99"]),
+                     format_secs(stats["max"])))
+    network = report["network"]
+    print("  %d frames sent (%d to offline nodes), %.1f MiB, %.1f frames per delivery"
+          % (network["sent"], network["offline"], network["bytes"] / 1048576.0,
+             report["amplification"] or 0.0))
+    print("  by type: " + ", ".join("%s %d" % (msg_type, count) for msg_type, count in
+                                    sorted(report["sentbytype"].items())))
+    print("  relayed copies stored %d, duplicates %d"
+          % (report["relay"].get("relayed", 0), report["relay"].get("duplicates", 0)))
+    db_stats = report["db"]
+    print("  outbox rows peak %d (largest single outbox %d), outbox bytes peak %d, "
+          "inbox rows at the end %d"
+          % (db_stats["outboxrows"]["peak"], db_stats["maxoutboxrows"]["peak"],
+             db_stats["outboxbytes"]["peak"], db_stats["inboxrows"]["end"]))
+
+
+if __name__ == "__main__":
+    SIZES = [int(arg) for arg in sys.argv[1:]] or [50, 100, 200, 500]
+    for SIZE in SIZES:
+        print_report(simulate(SIZE))
@@ -0,0 +1,114 @@
+'''Benchmark of how long the PostService takes to drain a backlog of messages.
+   Uses a stand-in database and transport, with all times scaled down so that
+   it runs quickly.  Not a unit test, so not discoverable.
+   Run with: python3 -m test.bench_postdrain'''
+
+import random
+import time
+from murmeli.system import System, Component
+from murmeli.postservice import PostService
+
+# All the delays are divided by this factor to make the benchmark quicker
+TIME_SCALE = 40.0
+# Time taken for a successful send through tor, and for a failed one
+SEND_SECS = 2.0
+FAIL_SECS = 8.0
+
+
+class StandInDatabase(Component):
+    '''In-memory database with just what the PostService needs'''
+    def __init__(self, parent, num_recipients, num_messages):
+        Component.__init__(self, parent, System.COMPNAME_DATABASE)
+        self.profiles = {"recipient%012d" % i:{"torid":"recipient%012d" % i,
+                                                "status":"trusted"}
+                         for i in range(num_recipients)}
+        recipients = sorted(self.profiles)
+        self.outbox = [{"_id":i, "recipient":random.choice(recipients), "relays":[],
+                        "message":"a1fa8008", "queue":True, "encType":1,
+                        "msgType":"regular"} for i in range(num_messages)]
+
+    def get_outbox(self):
+        '''Get copies of the outbox rows'''
+        return [dict(msg) for msg in self.outbox if msg]
+
+    def get_outbox_message(self, index):
+        '''Get a copy of the given row'''
+        return dict(self.outbox[index]) if self.outbox[index] else None
+
+    def delete_from_outbox(self, index):
+        '''Delete the given row'''
+        self.outbox[index] = None
+        return True
+
+    def get_delivery_states(self):
+        '''No stored delivery states at the start'''
+        return []
+
+    def update_delivery_state(self, torid, state):
+        '''Delivery states aren't stored'''
+
+    def get_reachability_states(self):
+        '''No stored reachability statistics at the start'''
+        return []
+
+    def update_reachability_state(self, torid, state):
+        '''Reachability statistics aren't stored'''
+
+    def add_row_to_deadletters(self, row):
+        '''Dead letters aren't stored'''
+
+    def prune_deadletters(self, expired_before, max_rows):
+        '''No dead letters to remove'''
+        return 0
+
+    def get_profile(self, torid=None):
+        '''Get the profile for this torid'''
+        return self.profiles.get(torid)
+
+    def update_outbox_message(self, index, props):
+        '''Update the given row'''
+        if self.outbox[index]:
+            self.outbox[index].update(props)
+
+
+class StandInTransport:
+    '''Transport which takes a while to send, and fails for unreachable recipients'''
+    def __init__(self, unreachable):
+        self.unreachable = unreachable
+
+    def send_message(self, msg_bytes, whoto):
+        '''Pretend to send the message'''
+        _ = msg_bytes
+        if whoto in self.unreachable:
+            time.sleep(FAIL_SECS / TIME_SCALE)
+            return PostService.RC_MESSAGE_FAILED
+        time.sleep(SEND_SECS / TIME_SCALE)
+        return PostService.RC_MESSAGE_SENT
+
+
+def drain_backlog(num_senders, send_gap, num_messages=1000, num_recipients=100):
+    '''Measure how long it takes to drain the backlog, return scaled-up seconds'''
+    random.seed(1)
+    system = System()
+    database = StandInDatabase(system, num_recipients, num_messages)
+    system.add_component(database)
+    unreachable = set(sorted(database.profiles)[:num_recipients // 10])
+    postman = PostService(system, StandInTransport(unreachable),
+                          num_senders=num_senders, send_gap=send_gap / TIME_SCALE)
+    postman.set_timer_interval(None)
+    postman.should_broadcast = False
+    system.add_component(postman)
+    start_time = time.monotonic()
+    postman.request_flush()
+    postman._flush()
+    duration = (time.monotonic() - start_time) * TIME_SCALE
+    remaining = len(database.get_outbox())
+    system.stop()
+    return (duration, remaining)
+
+
+if __name__ == "__main__":
+    for senders, gap in [(1, 3.0), (4, 0.5), (8, 0.5), (16, 0.25)]:
+        SECS, REMAINING = drain_backlog(senders, gap)
+        print("Senders: %2d, gap %.2fs: drained in %6.0f s (%.1f min), %d undeliverable left"
+              % (senders, gap, SECS, SECS / 60.0, REMAINING))
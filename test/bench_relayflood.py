@@ -0,0 +1,114 @@
+'''Simulation of relayed messages flooding through random friend graphs, to compare
+   the amplification (frames sent for each message) and the delivery rate with
+   different numbers of hops, fan-outs and with or without the seen-set of relays.
+   The frames are real relay messages and each node has a real Bloom filter seen-set,
+   but there's no encryption and every node is assumed to pass on what it gets.
+   Not a unit test, so not discoverable.
+   Run with: python3 -m test.bench_relayflood'''
+
+import contextlib
+import io
+import os
+import random
+from murmeli.bloomfilter import RotatingBloomFilter
+from murmeli.message import Message, RelayMessage
+
+NUM_NODES = 200
+NUM_MESSAGES = 100
+# hops, fanout (None for all), whether relays keep a seen-set
+CONFIGS = [(1, None, False), (2, None, False), (2, None, True), (3, None, False),
+           (3, None, True), (1, 3, True), (2, 3, True), (3, 3, True), (3, 2, True), (4, 2, True)]
+
+
+def make_graph(rand, num_nodes, degree):
+    '''Make a random friend graph, with roughly the given number of friends each'''
+    friends = {node:set() for node in range(num_nodes)}
+    nodes = list(friends)
+    # a ring first, so that nobody is left without friends
+    for node in nodes:
+        friends[node].add((node + 1) % num_nodes)
+        friends[(node + 1) % num_nodes].add(node)
+    num_links = num_nodes * degree // 2 - num_nodes
+    while num_links > 0:
+        node1, node2 = rand.sample(nodes, 2)
+        if node2 not in friends[node1]:
+            friends[node1].add(node2)
+            friends[node2].add(node1)
+            num_links -= 1
+    return friends
+
+
+class FloodSimulation:
+    '''Passes one message at a time from a sender to a recipient who is offline,
+       so that it has to go through the sender's other friends'''
+
+    def __init__(self, rand, friends, hops, fanout, use_seen):
+        self.rand = rand
+        self.friends = friends
+        self.hops = hops
+        self.fanout = fanout
+        self.seen = {node:RotatingBloomFilter(capacity=1000) for node in friends} \
+                    if use_seen else None
+        self.counts = {"sent":0, "delivered":0, "duplicates":0, "dropped":0}
+
+    def _choose(self, contacts):
+        '''Choose the contacts to pass the message on to'''
+        contacts = sorted(contacts)
+        self.rand.shuffle(contacts)
+        return contacts[:self.fanout] if self.fanout else contacts
+
+    def send(self, sender, recipient):
+        '''Pass one message from the sender through the relays, return True if delivered'''
+        # Stands in for a message encrypted for the recipient, with a unique checksum
+        inner = "encrypt".encode("utf-8") + os.urandom(16) + bytes([recipient % 256])
+        single = RelayMessage.wrap_outgoing_message(inner)
+        frame = RelayMessage.with_hops(single, self.hops)
+        pending = [(relay, sender, frame) for relay in
+                   self._choose(self.friends[sender] - {recipient})]
+        received = 0
+        while pending:
+            node, from_node, frame = pending.pop(0)
+            self.counts["sent"] += 1
+            if node == recipient:
+                received += 1
+                continue
+            msg = Message.from_received_data(frame)
+            if not isinstance(msg, RelayMessage) or node == sender:
+                continue    # can't be read by anybody else, and not relayed
+            if self.seen is not None \
+              and self.seen[node].check_and_add(Message.get_frame_checksum(msg.received_bytes)):
+                self.counts["dropped"] += 1
+                continue
+            output = msg.get_forward_output()
+            pending.extend((contact, node, output) for contact in
+                           self._choose(self.friends[node] - {from_node}))
+        if received:
+            self.counts["delivered"] += 1
+            self.counts["duplicates"] += received - 1
+        return received > 0
+
+
+def simulate(degree, hops, fanout, use_seen):
+    '''Send messages between random friends in a random graph, and return the counts'''
+    rand = random.Random(5)
+    friends = make_graph(rand, NUM_NODES, degree)
+    sim = FloodSimulation(rand, friends, hops, fanout, use_seen)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(NUM_MESSAGES):
+            sender = rand.randrange(NUM_NODES)
+            recipient = rand.choice(sorted(friends[sender]))
+            sim.send(sender, recipient)
+    return sim.counts
+
+
+if __name__ == "__main__":
+    for DEGREE in [4, 8]:
+        print("Graph of %d nodes with %d friends each on average" % (NUM_NODES, DEGREE))
+        for HOPS, FANOUT, USE_SEEN in CONFIGS:
+            COUNTS = simulate(DEGREE, HOPS, FANOUT, USE_SEEN)
+            print("  hops %d, fanout %-3s %-13s: %7.1f frames per message, "
+                  "%3d%% delivered, %5d duplicates, %6d dropped as seen"
+                  % (HOPS, FANOUT or "all", "with seen-set" if USE_SEEN else "no seen-set",
+                     COUNTS["sent"] / NUM_MESSAGES,
+                     100 * COUNTS["delivered"] // NUM_MESSAGES,
+                     COUNTS["duplicates"], COUNTS["dropped"]))
@@ -0,0 +1,92 @@
+'''Benchmark of the time from starting the TorClient until the first message is sent,
+   using test/faketor.py as a stand-in for tor which takes a given time to bootstrap.
+   Sends before the bootstrap has finished fail, as they would with tor.
+   Not a unit test, so not discoverable.
+   Run with: python3 -m test.bench_torstartup [bootstrap secs ...]'''
+
+import os
+import shutil
+import sys
+import threading
+import time
+from murmeli.system import System, Component
+from murmeli.postservice import PostService
+from murmeli.torclient import TorClient
+from murmeli import guinotification
+from test.bench_postdrain import StandInDatabase
+
+
+class StartupTimes(Component):
+    '''Gui notifier which notes the time of the first notification of each type'''
+    def __init__(self, parent, start_time):
+        Component.__init__(self, parent, System.COMPNAME_GUI)
+        self.start_time = start_time
+        self.times = {}
+
+    def notify_gui(self, notify_type):
+        '''Note the time since the start, if it's the first one'''
+        self.times.setdefault(notify_type, time.monotonic() - self.start_time)
+
+
+class FakeTorTransport:
+    '''Transport which can only send once the fake tor has bootstrapped'''
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.tor_client = None
+        self.num_failed = 0
+        self.first_send_secs = None
+        self.sent = threading.Event()
+
+    def send_message(self, msg_bytes, whoto):
+        '''Pretend to send the message'''
+        _ = (msg_bytes, whoto)
+        if not self.tor_client.is_ready():
+            self.num_failed += 1
+            return PostService.RC_MESSAGE_FAILED
+        if self.first_send_secs is None:
+            self.first_send_secs = time.monotonic() - self.start_time
+        self.sent.set()
+        return PostService.RC_MESSAGE_SENT
+
+
+def measure_startup(bootstrap_secs):
+    '''Start up with a message waiting in the outbox, and return the times'''
+    tor_dir = os.path.join("test", "outputdata", "benchtor")
+    shutil.rmtree(tor_dir, ignore_errors=True)
+    os.makedirs(tor_dir)
+    os.environ["FAKE_TOR_DELAY"] = str(bootstrap_secs)
+    start_time = time.monotonic()
+    system = System()
+    notifier = StartupTimes(system, start_time)
+    system.add_component(notifier)
+    system.add_component(StandInDatabase(system, 1, 1))
+    fake_tor = os.path.join(os.path.dirname(os.path.abspath(__file__)), "faketor.py")
+    tor_client = TorClient(system, tor_dir, tor_exe=fake_tor)
+    system.add_component(tor_client)
+    transport = FakeTorTransport(start_time)
+    transport.tor_client = tor_client
+    postman = PostService(system, transport, num_senders=1, send_gap=0)
+    postman.should_broadcast = False
+    system.add_component(postman)
+    tor_client.socket_broker.listening.wait(bootstrap_secs + 10)
+    listening_secs = time.monotonic() - start_time
+    transport.sent.wait(bootstrap_secs + 10)
+    system.stop()
+    return {"listening":listening_secs,
+            "connected":notifier.times.get(guinotification.NOTIFY_TOR_CONNECTED),
+            "firstsend":transport.first_send_secs, "failed":transport.num_failed}
+
+
+def format_secs(secs):
+    '''Format a time which may be missing'''
+    return "%6.2f s" % secs if secs is not None else "     -  "
+
+
+if __name__ == "__main__":
+    DELAYS = [float(arg) for arg in sys.argv[1:]] or [0.5, 2.0, 5.0]
+    for DELAY in DELAYS:
+        TIMES = measure_startup(DELAY)
+        print("Bootstrap %5.1f s: listening after %s, connected after %s, first send after %s,"
+              " %d failed sends" % (DELAY, format_secs(TIMES["listening"]),
+                                    format_secs(TIMES["connected"]),
+                                    format_secs(TIMES["firstsend"]), TIMES["failed"]))
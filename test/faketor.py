@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+'''Stand-in for the tor executable, for testing the startup of the TorClient without tor.
+   Reads the torrc given with -f, writes a hostname for the hidden service and then
+   the bootstrap progress to the log file, after the delay given in FAKE_TOR_DELAY.
+   Then it waits until it's terminated.  Not a unit test, so not discoverable.'''
+
+import os
+import sys
+import time
+
+FAKE_TORID = "fake" * 13 + "ftor"
+
+
+def read_torrc(rc_path):
+    '''Get the hidden service dir and the log file from the torrc'''
+    settings = {}
+    with open(rc_path, "r") as rc_file:
+        for line in rc_file:
+            if line.startswith("HiddenServiceDir "):
+                settings["service_dir"] = line.split(" ", 1)[1].strip()
+            elif line.startswith("Log notice file "):
+                settings["log_path"] = line.split(" ", 3)[3].strip()
+    return settings
+
+
+def write_log(log_path, line):
+    '''Append a line to the log file, if there is one'''
+    if log_path:
+        with open(log_path, "a") as log_file:
+            log_file.write("Jan 01 00:00:00.000 [notice] " + line + "\n")
+
+
+def main(args):
+    '''Pretend to start tor with the given arguments'''
+    settings = read_torrc(args[args.index("-f") + 1])
+    delay = float(os.environ.get("FAKE_TOR_DELAY", "0.5"))
+    log_path = settings.get("log_path")
+    write_log(log_path, "Tor 0.0.0 (fake) opening log file.")
+    service_dir = settings.get("service_dir")
+    if service_dir:
+        os.makedirs(service_dir, exist_ok=True)
+        with open(os.path.join(service_dir, "hostname"), "w") as hostfile:
+            hostfile.write(FAKE_TORID + ".onion\n")
+    write_log(log_path, "Bootstrapped 0% (starting): Starting")
+    time.sleep(delay / 2)
+    write_log(log_path, "Bootstrapped 50% (loading_descriptors): Loading relay descriptors")
+    time.sleep(delay / 2)
+    write_log(log_path, "Bootstrapped 100% (done): Done")
+    while True:
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
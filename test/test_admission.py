@@ -0,0 +1,85 @@
+'''Module for testing the admission control of incoming messages'''
+
+import unittest
+from murmeli.admission import AdmissionControl
+from murmeli.clock import VirtualClock
+from murmeli.message import ContactRequestMessage, RegularMessage, Message
+from murmeli import framing
+
+
+def make_conreq_bytes(sender_name):
+    '''Make the output of an unencrypted contact request'''
+    req = ContactRequestMessage()
+    req.set_field(req.FIELD_SENDER_NAME, sender_name)
+    return req.create_output(encrypter=None)
+
+
+class AdmissionControlTest(unittest.TestCase):
+    '''Tests for the admission control'''
+
+    def setUp(self):
+        self.clock = VirtualClock()
+
+    def test_unencrypted_frames(self):
+        '''Unencrypted frames should share the anonymous budget, others aren't checked'''
+        admission = AdmissionControl(anonymous_rate=0.1, anonymous_burst=2, clock=self.clock)
+        frame = make_conreq_bytes("Worzel")
+        enc_pos = framing.HEADER_LENGTH - 5
+        encrypted = frame[:enc_pos] + bytes([Message.ENCTYPE_ASYM]) + frame[enc_pos + 1:]
+        self.assertTrue(admission.admit_frame(frame))
+        self.assertTrue(admission.admit_frame(frame))
+        self.assertFalse(admission.admit_frame(frame), "over the limit")
+        self.assertTrue(admission.admit_frame(encrypted), "can't be checked yet")
+        self.assertTrue(admission.admit_frame("abc".encode("utf-8")))
+        self.clock.advance(10)
+        self.assertTrue(admission.admit_frame(frame), "one more after ten seconds")
+        stats = admission.get_stats()
+        self.assertEqual(stats["dropped"], 1)
+        self.assertEqual(stats["anonymousdropped"], 1)
+        self.assertEqual(stats["throttled"], {AdmissionControl.KEY_ANONYMOUS:1})
+
+    def test_senders(self):
+        '''Each sender should have its own budget, and unknown keys also the anonymous one'''
+        admission = AdmissionControl(sender_rate=1, sender_burst=3, anonymous_rate=1,
+                                     anonymous_burst=4, clock=self.clock)
+        msg = RegularMessage()
+        for _ in range(3):
+            self.assertTrue(admission.admit_message(msg, "abcdef", "key1"))
+        self.assertFalse(admission.admit_message(msg, "abcdef", "key1"))
+        self.assertTrue(admission.admit_message(msg, "ghijkl", "key2"), "other sender")
+        for _ in range(3):
+            self.assertTrue(admission.admit_message(msg, None, "unknown1"))
+        self.assertTrue(admission.admit_message(msg, None, "unknown2"))
+        self.assertFalse(admission.admit_message(msg, None, "unknown3"), "anonymous used up")
+        self.assertFalse(admission.admit_message(msg, None, None))
+        self.clock.advance(1)
+        self.assertTrue(admission.admit_message(msg, "abcdef", "key1"))
+        self.assertTrue(admission.admit_message(ContactRequestMessage(), None, None),
+                        "unencrypted ones checked before")
+        stats = admission.get_stats()
+        self.assertEqual(stats["throttled"], {"abcdef":1, AdmissionControl.KEY_ANONYMOUS:2})
+        self.assertEqual(stats["senders"], 4, "no bucket for unknown3")
+
+    def test_max_senders(self):
+        '''Only the most recent senders should be remembered'''
+        admission = AdmissionControl(sender_burst=1, max_senders=2, clock=self.clock)
+        msg = RegularMessage()
+        for sender in ["abc", "def", "ghi"]:
+            self.assertTrue(admission.admit_message(msg, sender, None))
+        self.assertFalse(admission.admit_message(msg, "ghi", None))
+        self.assertTrue(admission.admit_message(msg, "abc", None), "forgotten, so new bucket")
+        self.assertEqual(admission.get_stats()["senders"], 2)
+
+    def test_no_limits(self):
+        '''Without rates, nothing should be dropped'''
+        admission = AdmissionControl(sender_rate=None, anonymous_rate=None, clock=self.clock)
+        frame = make_conreq_bytes("Worzel")
+        for _ in range(100):
+            self.assertTrue(admission.admit_frame(frame))
+            self.assertTrue(admission.admit_message(RegularMessage(), "abc", None))
+            self.assertTrue(admission.admit_message(RegularMessage(), None, "key"))
+        self.assertEqual(admission.get_stats()["dropped"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
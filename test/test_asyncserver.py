@@ -0,0 +1,149 @@
+'''Module for testing the asyncio-based listener'''
+
+import unittest
+import socket
+import time
+from murmeli.system import System, Component
+from murmeli.asyncserver import AsyncSocketServer
+from murmeli.message import ContactRequestMessage
+from murmeli import framing
+
+
+class FakePipeline:
+    '''Pipeline which just collects the submitted data'''
+    def __init__(self, accept=True):
+        self.received = []
+        self.accept = accept
+
+    def submit_data(self, data, timeout=None):
+        '''Receive the data, or refuse it if we're full'''
+        _ = timeout
+        if self.accept:
+            self.received.append(data)
+        return self.accept
+
+
+def wait_for(condition, timeout=5.0):
+    '''Wait until the condition is true or the timeout runs out'''
+    end_time = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end_time:
+        time.sleep(0.05)
+    return condition()
+
+
+class AsyncServerTest(unittest.TestCase):
+    '''Tests for the async server'''
+
+    def setUp(self):
+        self.sys = System()
+        self.comp = Component(self.sys, "listener")
+        self.pipeline = FakePipeline()
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.close()
+        self.sys.stop()
+
+    def start_server(self, **kwargs):
+        '''Start the server on a free port'''
+        self.server = AsyncSocketServer(self.comp, self.pipeline, port=0, **kwargs)
+        self.assertTrue(self.server.listening.wait(5), "server started")
+        return self.server.port
+
+    def test_receive_messages(self):
+        '''Send several messages over concurrent connections'''
+        port = self.start_server()
+        conns = [socket.create_connection(("localhost", port)) for _ in range(20)]
+        for i, conn in enumerate(conns):
+            conn.sendall(("message number %d" % i).encode("utf-8"))
+        for conn in conns:
+            conn.close()
+        self.assertTrue(wait_for(lambda: len(self.pipeline.received) == 20))
+        self.assertIn("message number 7".encode("utf-8"), self.pipeline.received)
+        stats = self.server.get_stats()
+        self.assertEqual(stats["accepted"], 20)
+        self.assertEqual(stats["submitted"], 20)
+        self.assertTrue(wait_for(lambda: self.server.get_stats()["open"] == 0))
+
+    def test_several_frames(self):
+        '''Several frames over one connection should each be submitted'''
+        port = self.start_server(read_timeout=1)
+        conn = socket.create_connection(("localhost", port))
+        conn.sendall(framing.make_hello())
+        self.assertEqual(conn.recv(1024), framing.make_ack())
+        frames = []
+        for name in ["Worzel", "Aunt Sally", "Crowman"]:
+            req = ContactRequestMessage()
+            req.set_field(req.FIELD_SENDER_NAME, name)
+            frames.append(req.create_output(encrypter=None))
+            conn.sendall(frames[-1])
+            # Each frame restarts the timeout
+            time.sleep(0.6)
+        self.assertEqual(self.pipeline.received, frames)
+        self.assertEqual(self.server.get_stats()["timedout"], 0)
+        conn.close()
+        self.assertTrue(wait_for(lambda: self.server.get_stats()["open"] == 0))
+        self.assertEqual(self.server.get_stats()["hellos"], 1)
+
+    def test_http_request(self):
+        '''Http requests should get a reply but not be passed on'''
+        port = self.start_server()
+        conn = socket.create_connection(("localhost", port))
+        conn.sendall("GET / HTTP/1.1\r\n\r\n".encode("utf-8"))
+        reply = conn.recv(1024)
+        conn.close()
+        self.assertTrue(reply.startswith("This is not".encode("utf-8")))
+        self.assertFalse(self.pipeline.received)
+
+    def test_read_timeout(self):
+        '''Connections which never finish should be closed after the timeout'''
+        port = self.start_server(read_timeout=0.3)
+        conn = socket.create_connection(("localhost", port))
+        conn.sendall("murmeli".encode("utf-8"))
+        self.assertTrue(wait_for(lambda: self.server.get_stats()["timedout"] == 1))
+        self.assertEqual(conn.recv(1024), bytes(), "connection closed by server")
+        conn.close()
+        self.assertFalse(self.pipeline.received)
+
+    def test_connection_limit(self):
+        '''Connections above the limit should be rejected'''
+        port = self.start_server(max_connections=2)
+        conns = [socket.create_connection(("localhost", port)) for _ in range(2)]
+        self.assertTrue(wait_for(lambda: self.server.get_stats()["open"] == 2))
+        extra = socket.create_connection(("localhost", port))
+        self.assertTrue(wait_for(lambda: self.server.get_stats()["rejected"] == 1))
+        self.assertEqual(extra.recv(1024), bytes(), "extra connection closed by server")
+        extra.close()
+        for conn in conns:
+            conn.sendall("abc".encode("utf-8"))
+            conn.close()
+        self.assertTrue(wait_for(lambda: len(self.pipeline.received) == 2))
+
+    def test_graceful_shutdown(self):
+        '''Open connections can finish during the shutdown, then the thread ends'''
+        port = self.start_server(shutdown_grace=0.5)
+        conn = socket.create_connection(("localhost", port))
+        self.assertTrue(wait_for(lambda: self.server.get_stats()["open"] == 1))
+        self.server.close()
+        self.assertFalse(self.server.is_alive(), "server thread finished")
+        self.assertEqual(self.server.get_stats()["open"], 0)
+        conn.close()
+        # port is free again
+        self.assertRaises(OSError, socket.create_connection, ("localhost", port))
+
+    def test_pipeline_full(self):
+        '''When the pipeline is full, the server should wait and not drop the message'''
+        self.pipeline.accept = False
+        port = self.start_server()
+        conn = socket.create_connection(("localhost", port))
+        conn.sendall("waiting".encode("utf-8"))
+        conn.close()
+        time.sleep(0.3)
+        self.assertEqual(self.server.get_stats()["submitted"], 0)
+        self.pipeline.accept = True
+        self.assertTrue(wait_for(lambda: len(self.pipeline.received) == 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+'''Module for testing the backoff of delivery attempts'''
+
+import unittest
+from murmeli.backoff import DeliveryBackoff
+
+
+class FakeClock:
+    '''Clock which only moves when told to'''
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class DeliveryBackoffTest(unittest.TestCase):
+    '''Tests for the delivery backoff'''
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_delays(self):
+        '''Delays should double, up to the maximum, and be reduced by the jitter'''
+        backoff = DeliveryBackoff(base_delay=10, max_delay=100, jitter=0.5,
+                                  clock=self.clock, rand=lambda: 0.0)
+        self.assertEqual([backoff.get_delay(f) for f in range(6)], [0, 10, 20, 40, 80, 100])
+        backoff.rand = lambda: 1.0
+        self.assertEqual(backoff.get_delay(3), 20)
+        self.assertEqual(backoff.get_delay(1000), 50, "no overflow with many failures")
+
+    def test_failures_and_reset(self):
+        '''Failures should delay the next attempt until reset'''
+        backoff = DeliveryBackoff(base_delay=10, clock=self.clock, rand=lambda: 0.0)
+        self.assertTrue(backoff.is_due("albert"))
+        self.assertIsNone(backoff.reset("albert"), "nothing to reset")
+        state = backoff.record_failure("albert")
+        self.assertEqual(state, {"torid":"albert", "failures":1, "nextAttempt":1010.0})
+        self.assertFalse(backoff.is_due("albert"))
+        self.assertEqual(backoff.get_deferred(["albert", "bertha"]), {"albert"})
+        self.assertEqual(backoff.get_stats(), {"backingoff":1, "deferred":1})
+        self.assertEqual(backoff.get_next_attempt(["albert", "bertha"]), 1010.0)
+        self.assertIsNone(backoff.get_next_attempt(["bertha"]))
+        self.clock.now = 1010.0
+        self.assertTrue(backoff.is_due("albert"))
+        self.assertIsNone(backoff.get_next_attempt(["albert"]), "not in the future")
+        self.assertEqual(backoff.record_failure("albert")["nextAttempt"], 1030.0)
+        self.assertEqual(backoff.reset("albert")["failures"], 0)
+        self.assertTrue(backoff.is_due("albert"))
+
+    def test_load(self):
+        '''States loaded from the database should be used'''
+        backoff = DeliveryBackoff(clock=self.clock)
+        self.assertFalse(backoff.loaded)
+        backoff.load([{"torid":"cecil", "failures":3, "nextAttempt":2000.0}, {}, None])
+        self.assertTrue(backoff.loaded)
+        self.assertFalse(backoff.is_due("cecil"))
+        self.assertTrue(backoff.is_due("dolly"))
+
+    def test_bring_forward(self):
+        '''The next attempt should only ever be brought forward'''
+        backoff = DeliveryBackoff(base_delay=100, clock=self.clock, rand=lambda: 0.0)
+        self.assertIsNone(backoff.get_state("albert"))
+        self.assertIsNone(backoff.bring_forward("albert", 1050.0), "not backing off")
+        backoff.record_failure("albert")
+        self.assertIsNone(backoff.bring_forward("albert", 1200.0), "already sooner")
+        self.assertEqual(backoff.bring_forward("albert", 1050.0)["nextAttempt"], 1050.0)
+        self.assertEqual(backoff.get_state("albert"),
+                         {"torid":"albert", "failures":1, "nextAttempt":1050.0})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+'''Module for testing the Bloom filters used for the seen-set of relayed messages'''
+
+import unittest
+from murmeli.bloomfilter import BloomFilter, RotatingBloomFilter
+
+
+class FakeClock:
+    '''Clock which only moves when told to'''
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class BloomFilterTest(unittest.TestCase):
+    '''Tests for the single Bloom filter'''
+
+    def test_adding(self):
+        '''Added items should always be found, others only rarely'''
+        num_bits, num_hashes = BloomFilter.get_size(1000, 0.01)
+        self.assertGreater(num_bits, 9000)
+        self.assertEqual(num_hashes, 7)
+        bloom = BloomFilter(num_bits, num_hashes)
+        items = ["item%d" % i for i in range(1000)]
+        for item in items:
+            bloom.add(item)
+        self.assertFalse(bloom.add("item7"), "already there")
+        self.assertGreater(bloom.count, 980, "only a few already looked present")
+        for item in items:
+            self.assertIn(item, bloom)
+        false_positives = len([i for i in range(10000) if "other%d" % i in bloom])
+        self.assertLess(false_positives, 300)
+
+    def test_storing(self):
+        '''The bits should survive being stored as a string'''
+        bloom = BloomFilter(1000, 3)
+        bloom.add("abc")
+        copy = BloomFilter(1000, 3)
+        self.assertTrue(copy.load_string(bloom.to_string()))
+        self.assertIn("abc", copy)
+        self.assertFalse(BloomFilter(2000, 3).load_string(bloom.to_string()), "wrong size")
+
+
+class RotatingBloomFilterTest(unittest.TestCase):
+    '''Tests for the seen-set with two generations'''
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_rotation_by_count(self):
+        '''Old items should be forgotten after two rotations'''
+        seen = RotatingBloomFilter(capacity=10, error_rate=0.001, clock=self.clock)
+        self.assertFalse(seen.check_and_add("first"))
+        self.assertTrue(seen.check_and_add("first"), "now seen")
+        for i in range(9):
+            seen.check_and_add("more%d" % i)
+        self.assertTrue(seen.check_and_add("first"), "still in the previous generation")
+        self.assertEqual(seen.num_rotations, 1)
+        for i in range(10):
+            seen.check_and_add("newer%d" % i)
+        self.assertFalse(seen.check_and_add("first"), "forgotten")
+        self.assertEqual(seen.num_rotations, 2)
+
+    def test_rotation_by_age(self):
+        '''Items should be forgotten after twice the maximum age'''
+        seen = RotatingBloomFilter(capacity=10, max_age=100, clock=self.clock)
+        seen.check_and_add("first")
+        self.clock.now += 150
+        self.assertTrue(seen.check_and_add("first"))
+        self.clock.now += 150
+        self.assertFalse(seen.check_and_add("first"))
+
+    def test_state(self):
+        '''The state should be loaded again, unless the sizes are different'''
+        seen = RotatingBloomFilter(capacity=10, clock=self.clock)
+        for i in range(15):
+            seen.check_and_add("item%d" % i)
+        state = seen.get_state()
+        copy = RotatingBloomFilter(capacity=10, clock=self.clock)
+        self.assertTrue(copy.load(state))
+        self.assertIn("item1", copy)
+        self.assertIn("item14", copy)
+        self.assertEqual(copy.get_state(), state)
+        self.assertFalse(RotatingBloomFilter(capacity=20).load(state))
+        self.assertFalse(copy.load(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+'''Module for testing the isolation of the circuits used for sending'''
+
+import unittest
+import random
+import socket
+import struct
+import threading
+import time
+from murmeli.circuitslots import CircuitSlots
+from murmeli.postservice import DefaultMessageTransport, PostService
+
+
+class Socks5StandIn(threading.Thread):
+    '''SOCKS5 proxy which records the credentials and destination of each connection,
+       and the data sent on it, without connecting anywhere.  Each connection is held
+       for the given delay before it's accepted, like a slow circuit.'''
+    def __init__(self, delay=0.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.connections = []    # (username, password, host, port, start, end, data)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(("localhost", 0))
+        self.socket.listen(10)
+        self.port = self.socket.getsockname()[1]
+        self.start()
+
+    def run(self):
+        '''Accept connections until the socket is closed'''
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def read(conn, length):
+        '''Read exactly the given number of bytes'''
+        data = bytes()
+        while len(data) < length:
+            received = conn.recv(length - len(data))
+            if not received:
+                raise OSError("closed early")
+            data += received
+        return data
+
+    def handle(self, conn):
+        '''Deal with the socks negotiation, then read the data until it's closed'''
+        try:
+            _, num_methods = self.read(conn, 2)
+            if 2 not in self.read(conn, num_methods):
+                conn.sendall(b"\x05\xff")
+                return
+            conn.sendall(b"\x05\x02")
+            _, user_length = self.read(conn, 2)
+            username = self.read(conn, user_length).decode("utf-8")
+            password = self.read(conn, self.read(conn, 1)[0]).decode("utf-8")
+            conn.sendall(b"\x01\x00")
+            _, command, _, address_type = self.read(conn, 4)
+            if command != 1 or address_type != 3:
+                return
+            host = self.read(conn, self.read(conn, 1)[0]).decode("utf-8")
+            port = struct.unpack(">H", self.read(conn, 2))[0]
+            start_time = time.monotonic()
+            time.sleep(self.delay)
+            conn.sendall(b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00")
+            data = bytes()
+            received = conn.recv(1024)
+            while received:
+                data += received
+                received = conn.recv(1024)
+            with self.lock:
+                self.connections.append((username, password, host, port, start_time,
+                                         time.monotonic(), data))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        '''Stop listening'''
+        self.socket.close()
+
+
+class CircuitSlotsTest(unittest.TestCase):
+    '''Tests for the choice of slots'''
+
+    def test_spread(self):
+        '''Concurrent sends should use different slots, and peers should keep theirs'''
+        slots = CircuitSlots(num_slots=2, rand=random.Random(1))
+        self.assertEqual(slots.acquire("abc"), 0)
+        self.assertEqual(slots.acquire("def"), 1)
+        self.assertEqual(slots.acquire("abc"), 0, "still sending to abc")
+        self.assertEqual(slots.acquire("ghi"), 0, "shared when all are busy")
+        for whoto in ["abc", "abc", "def", "ghi"]:
+            slots.release(whoto)
+        self.assertEqual(slots.acquire("def"), 1, "kept while free")
+        self.assertEqual(slots.acquire("ghi"), 0)
+        self.assertEqual(slots.acquire("jkl"), 0)
+        slots.release("ghi")
+        self.assertEqual(slots.acquire("ghi"), 0, "no less busy slot")
+        slots.release("def")
+        slots.release("ghi")
+        self.assertEqual(slots.acquire("ghi"), 1, "moved to the free slot")
+        stats = slots.get_stats()
+        self.assertEqual((stats["moved"], stats["shared"], stats["busy"]), (1, 3, 2))
+
+    def test_credentials(self):
+        '''The credentials should depend on the slot, or on the peer without slots'''
+        slots = CircuitSlots(num_slots=2)
+        slots.acquire("abc")
+        slots.acquire("def")
+        abc_user, abc_password = slots.get_credentials("abc")
+        def_user, def_password = slots.get_credentials("def")
+        self.assertNotEqual(abc_user, def_user)
+        self.assertEqual(abc_password, def_password)
+        self.assertNotEqual(abc_password, CircuitSlots(num_slots=2).session, "random session")
+        slots.release("abc")
+        slots.release("def")
+        slots.set_num_slots(0)
+        self.assertIsNone(slots.acquire("abc"))
+        self.assertEqual(slots.get_credentials("abc")[0], "murmeli-abc")
+        self.assertEqual(slots.get_credentials("def")[0], "murmeli-def")
+
+    def test_resize_while_sending(self):
+        '''A new number of slots should be used once the current sends have finished'''
+        slots = CircuitSlots(num_slots=2)
+        self.assertEqual(slots.acquire("abc"), 0)
+        self.assertEqual(slots.acquire("def"), 1)
+        slots.set_num_slots(4)
+        self.assertEqual(slots.get_stats()["slots"], 2, "not while sending")
+        self.assertEqual(slots.get_credentials("abc")[0], "murmeli-slot0")
+        slots.release("abc")
+        self.assertEqual(slots.get_stats()["slots"], 2, "still sending to def")
+        slots.release("def")
+        self.assertEqual(slots.get_stats()["slots"], 4)
+        self.assertEqual(slots.get_stats()["busy"], 0)
+        for whoto in ["abc", "def", "ghi", "jkl"]:
+            slots.acquire(whoto)
+        self.assertEqual(slots.get_stats()["busy"], 4)
+        # Setting the current number again cancels an earlier request
+        slots.set_num_slots(1)
+        slots.set_num_slots(4)
+        for whoto in ["abc", "def", "ghi", "jkl"]:
+            slots.release(whoto)
+        self.assertEqual(slots.get_stats()["slots"], 4)
+
+
+class IsolatedTransportTest(unittest.TestCase):
+    '''Tests for sending through a SOCKS5 proxy with isolation credentials'''
+
+    def setUp(self):
+        self.proxy = Socks5StandIn(delay=0.5)
+        self.transport = DefaultMessageTransport(num_slots=4, proxy_port=self.proxy.port)
+
+    def tearDown(self):
+        self.transport.close()
+        self.proxy.close()
+
+    def wait_for_connections(self, number):
+        '''Wait until the proxy has recorded the given number of connections'''
+        end_time = time.monotonic() + 5
+        while len(self.proxy.connections) < number and time.monotonic() < end_time:
+            time.sleep(0.05)
+        return sorted(self.proxy.connections, key=lambda conn: conn[4])
+
+    def test_concurrent_sends(self):
+        '''Concurrent sends to different peers should be isolated from each other'''
+        peers = ["peer%012d" % i for i in range(4)]
+        results = []
+        threads = [threading.Thread(target=lambda whoto=whoto: results.append(
+            self.transport.send_message(b"hello " + whoto.encode("utf-8"), whoto)))
+                   for whoto in peers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [PostService.RC_MESSAGE_SENT] * 4)
+        connections = self.wait_for_connections(4)
+        self.assertEqual(sorted(conn[2] for conn in connections),
+                         [whoto + ".onion" for whoto in peers])
+        self.assertTrue(all(conn[3] == 11009 for conn in connections))
+        self.assertEqual(len(set(conn[0] for conn in connections)), 4, "all isolated")
+        self.assertEqual(len(set(conn[1] for conn in connections)), 1, "same session")
+        for conn in connections:
+            self.assertEqual(conn[6], b"hello " + conn[2][:-6].encode("utf-8"))
+        self.assertTrue(connections[-1][4] < connections[0][5], "not one after another")
+
+        # Another send to the first peer should use the same circuit again
+        self.transport.send_message(b"again", peers[0])
+        connections = self.wait_for_connections(5)
+        first_user = [conn[0] for conn in connections if conn[2] == peers[0] + ".onion"]
+        self.assertEqual(first_user[0], first_user[1])
+        self.assertEqual(self.transport.get_stats()["circuits"]["acquired"], 5)
+
+    def test_proxy_refuses(self):
+        '''A send should fail if the proxy doesn't accept the connection'''
+        self.proxy.close()
+        self.assertEqual(self.transport.send_message(b"hello", "abc"),
+                         PostService.RC_MESSAGE_FAILED)
+        self.assertEqual(self.transport.get_stats()["circuits"]["busy"], 0, "slot freed")
+
+
+if __name__ == "__main__":
+    unittest.main()
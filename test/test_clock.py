@@ -0,0 +1,47 @@
+'''Module for testing the clocks'''
+
+import unittest
+import time
+from murmeli import clock
+
+
+class ClockTest(unittest.TestCase):
+    '''Tests for the system clock and the virtual clock'''
+
+    def test_system_clock(self):
+        '''The system clock should follow the real time'''
+        sys_clock = clock.SystemClock()
+        self.assertAlmostEqual(sys_clock.time(), time.time(), delta=1.0)
+        start_time = sys_clock.monotonic()
+        sys_clock.sleep(0.1)
+        self.assertGreaterEqual(sys_clock.monotonic() - start_time, 0.09)
+
+    def test_virtual_clock(self):
+        '''The virtual clock should only move when told to, and tell its listeners'''
+        virtual = clock.VirtualClock(start_time=1000.0)
+        moves = []
+        virtual.add_listener(moves.append)
+        self.assertEqual(virtual.time(), 1000.0)
+        virtual.sleep(3600)
+        self.assertEqual(virtual.monotonic(), 4600.0)
+        virtual.advance_to(2000.0)
+        self.assertEqual(virtual.time(), 4600.0, "never goes backwards")
+        virtual.advance(-5)
+        virtual.advance_to(5000.0)
+        self.assertEqual(moves, [4600.0, 5000.0])
+
+    def test_default_clock(self):
+        '''The default clock can be replaced and restored'''
+        virtual = clock.VirtualClock(start_time=123.0)
+        previous = clock.set_default_clock(virtual)
+        try:
+            self.assertIs(clock.get_default_clock(), virtual)
+            from murmeli.message import Message
+            self.assertEqual(Message.make_current_timestamp(), 123.0)
+        finally:
+            clock.set_default_clock(previous)
+        self.assertIs(clock.get_default_clock(), previous)
+
+
+if __name__ == "__main__":
+    unittest.main()
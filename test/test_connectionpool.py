@@ -0,0 +1,156 @@
+'''Module for testing the pool of outgoing connections'''
+
+import unittest
+import socket
+import threading
+import time
+from murmeli.system import System, Component
+from murmeli.asyncserver import AsyncSocketServer
+from murmeli.connectionpool import PeerConnectionPool
+from murmeli.clock import VirtualClock
+from murmeli.message import ContactRequestMessage
+from murmeli import framing
+
+
+class FakePipeline:
+    '''Pipeline which just collects the submitted data'''
+    def __init__(self):
+        self.received = []
+
+    def submit_data(self, data, timeout=None):
+        '''Receive the data'''
+        _ = timeout
+        self.received.append(data)
+        return True
+
+
+class OldListener(threading.Thread):
+    '''Listener which reads each connection until it's closed, without replying'''
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.received = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(("localhost", 0))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+        self.start()
+
+    def run(self):
+        '''Accept connections until the socket is closed'''
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                return
+            msg = bytes()
+            received = conn.recv(1024)
+            while received:
+                msg += received
+                received = conn.recv(1024)
+            conn.close()
+            self.received.append(msg)
+
+
+def make_frame(sender_name):
+    '''Make the output of an unencrypted contact request'''
+    req = ContactRequestMessage()
+    req.set_field(req.FIELD_SENDER_NAME, sender_name)
+    req.set_field(req.FIELD_MESSAGE, "Hello")
+    return req.create_output(encrypter=None)
+
+
+def wait_for(condition, timeout=5.0):
+    '''Wait until the condition is true or the timeout runs out'''
+    end_time = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end_time:
+        time.sleep(0.05)
+    return condition()
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    '''Tests for the connection pool'''
+
+    def setUp(self):
+        self.sys = System()
+        self.pipeline = FakePipeline()
+        self.server = None
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool:
+            self.pool.close_all()
+        if self.server:
+            self.server.close()
+        self.sys.stop()
+
+    def start_server(self, **kwargs):
+        '''Start a listener which understands several frames per connection'''
+        self.server = AsyncSocketServer(Component(self.sys, "listener"), self.pipeline,
+                                        port=0, **kwargs)
+        self.assertTrue(self.server.listening.wait(5), "server started")
+        return self.server.port
+
+    @staticmethod
+    def make_connect(port):
+        '''Make a function to connect to the given port'''
+        return lambda peer: socket.create_connection(("localhost", port))
+
+    def test_reuse(self):
+        '''Several messages should go over a single connection'''
+        port = self.start_server()
+        self.pool = PeerConnectionPool(self.make_connect(port))
+        self.assertIsNone(self.pool.get_peer_version("albert"))
+        frames = [make_frame(name) for name in ["Worzel", "Aunt Sally", "Crowman"]]
+        for frame in frames:
+            self.assertTrue(self.pool.send("albert", frame))
+        self.assertTrue(wait_for(lambda: len(self.pipeline.received) == 3))
+        self.assertEqual(self.pipeline.received, frames)
+        self.assertEqual(self.pool.get_peer_version("albert"), framing.PROTOCOL_VERSION)
+        stats = self.pool.get_stats()
+        self.assertEqual((stats["connects"], stats["reused"], stats["open"]), (1, 2, 1))
+        self.assertEqual(self.server.get_stats()["accepted"], 1)
+        self.assertEqual(self.server.get_stats()["hellos"], 1)
+
+    def test_old_peer(self):
+        '''Peers which don't answer the hello should get a connection per message'''
+        listener = OldListener()
+        self.pool = PeerConnectionPool(self.make_connect(listener.port), hello_timeout=0.2)
+        frames = [make_frame(name) for name in ["Worzel", "Aunt Sally"]]
+        for frame in frames:
+            self.assertTrue(self.pool.send("albert", frame))
+        self.assertTrue(wait_for(lambda: len(listener.received) == 3))
+        listener.socket.close()
+        self.assertEqual(listener.received, [framing.make_hello()] + frames)
+        self.assertEqual(self.pool.get_peer_version("albert"), 1)
+        stats = self.pool.get_stats()
+        self.assertEqual((stats["connects"], stats["legacy"], stats["open"]), (3, 1, 0))
+        self.assertEqual(stats["legacypeers"], 1)
+
+    def test_idle_timeout(self):
+        '''Idle connections should be closed, by us or by the receiver'''
+        port = self.start_server(read_timeout=0.3)
+        clock = VirtualClock()
+        self.pool = PeerConnectionPool(self.make_connect(port), idle_timeout=10, clock=clock)
+        self.assertTrue(self.pool.send("albert", make_frame("Worzel")))
+        clock.advance(11)
+        self.pool.close_idle()
+        self.assertEqual(self.pool.get_stats()["idleclosed"], 1)
+        self.assertTrue(self.pool.send("albert", make_frame("Aunt Sally")))
+        # Now the receiver times out and closes the connection
+        self.assertTrue(wait_for(lambda: self.server.get_stats()["timedout"] == 1))
+        self.assertTrue(self.pool.send("albert", make_frame("Crowman")))
+        self.assertTrue(wait_for(lambda: len(self.pipeline.received) == 3))
+        self.assertEqual(self.pool.get_stats()["connects"], 3)
+
+    def test_connect_fails(self):
+        '''A failure to connect should be reported'''
+        def connect(peer):
+            raise OSError("can't reach " + peer)
+        self.pool = PeerConnectionPool(connect)
+        self.assertFalse(self.pool.send("albert", make_frame("Worzel")))
+        self.assertEqual(self.pool.get_stats()["failed"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
 '''Module for testing the contact list class'''
 
 import unittest
+import datetime
 from murmeli.contacts import Contacts
+from murmeli.clock import VirtualClock
 
 
 class ContactListTest(unittest.TestCase):
@@ -51,6 +53,16 @@ class ContactListTest(unittest.TestCase):
         self.assertNotEqual(go_online_time, reappear_time)
         self.assertNotEqual(go_offline_time, reappear_time)
 
+    def test_virtual_clock(self):
+        '''Check that the last seen times come from the given clock'''
+        clock = VirtualClock(start_time=1600000000.0)
+        contacts = Contacts(None, clock=clock)
+        contacts.come_online("abcdef")
+        clock.advance(3600)
+        contacts.gone_offline("abcdef")
+        self.assertEqual(contacts.last_seen("abcdef"),
+                         datetime.datetime.fromtimestamp(1600003600.0))
+
 
 if __name__ == "__main__":
     unittest.main()
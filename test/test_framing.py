@@ -0,0 +1,125 @@
+'''Module for testing the splitting of received bytes into frames'''
+
+import unittest
+from murmeli import framing
+from murmeli.framing import FrameReader, RecentFrames
+from murmeli.message import ContactRequestMessage, RelayMessage
+from murmeli.clock import VirtualClock
+
+
+def make_frame(sender_name):
+    '''Make the output of an unencrypted contact request'''
+    req = ContactRequestMessage()
+    req.set_field(req.FIELD_SENDER_NAME, sender_name)
+    req.set_field(req.FIELD_MESSAGE, "Hello")
+    return req.create_output(encrypter=None)
+
+
+class FramingTest(unittest.TestCase):
+    '''Tests for the framing'''
+
+    def test_hello_and_ack(self):
+        '''Check the making and parsing of the hello and ack'''
+        self.assertEqual(framing.parse_ack(framing.make_ack()), framing.PROTOCOL_VERSION)
+        self.assertEqual(framing.parse_ack(framing.make_ack(5)), 5)
+        self.assertIsNone(framing.parse_ack(framing.make_hello()))
+        self.assertIsNone(framing.parse_ack(bytes()))
+        self.assertIsNone(framing.parse_ack(None))
+
+    def test_frame_length(self):
+        '''The frame length should be read from the header'''
+        frame = make_frame("Worzel")
+        self.assertIsNone(framing.get_frame_length(frame[:10]))
+        self.assertEqual(framing.get_frame_length(frame[:framing.HEADER_LENGTH]), len(frame))
+
+    def test_several_frames(self):
+        '''Several frames arriving in pieces should be split correctly'''
+        frames = [make_frame(name) for name in ["Worzel", "Aunt Sally", "Crowman"]]
+        data = framing.make_hello() + bytes().join(frames)
+        reader = FrameReader()
+        received = []
+        for pos in range(0, len(data), 7):
+            received += reader.feed(data[pos:pos + 7])
+        self.assertEqual(received, frames)
+        self.assertEqual(reader.hello_version, framing.PROTOCOL_VERSION)
+        self.assertTrue(reader.framed)
+        self.assertFalse(reader.invalid)
+        self.assertEqual(reader.get_remainder(), bytes())
+
+    def test_single_frame_without_hello(self):
+        '''Old senders send a single frame without a hello'''
+        frame = make_frame("Worzel")
+        reader = FrameReader()
+        self.assertEqual(reader.feed(frame), [frame])
+        self.assertIsNone(reader.hello_version)
+
+    def test_unframed(self):
+        '''Data without the magic token should be kept until the end'''
+        reader = FrameReader()
+        self.assertEqual(reader.feed("abc".encode("utf-8")), [])
+        self.assertEqual(reader.feed("def".encode("utf-8")), [])
+        self.assertFalse(reader.framed)
+        self.assertEqual(reader.get_remainder(), "abcdef".encode("utf-8"))
+        reader = FrameReader()
+        self.assertEqual(reader.feed("murm".encode("utf-8")), [])
+        self.assertIsNone(reader.framed, "can't tell yet")
+
+    def test_invalid(self):
+        '''Frames without the trailer or which are too big should stop the reading'''
+        frame = make_frame("Worzel")
+        reader = FrameReader()
+        self.assertEqual(len(reader.feed(frame[:-1] + "x".encode("utf-8") + frame)), 1)
+        self.assertTrue(reader.invalid)
+        reader = FrameReader(max_frame_size=50)
+        self.assertEqual(reader.feed(frame[:framing.HEADER_LENGTH]), [])
+        self.assertTrue(reader.invalid)
+
+
+class RecentFramesTest(unittest.TestCase):
+    '''Tests for the dropping of frames already received'''
+
+    def test_duplicates(self):
+        '''Copies should be found, but only within the window'''
+        clock = VirtualClock()
+        recent = RecentFrames(window=60, clock=clock)
+        frame = make_frame("Worzel")
+        self.assertFalse(recent.is_duplicate(frame))
+        self.assertFalse(recent.is_duplicate(make_frame("Aunt Sally")))
+        clock.advance(30)
+        self.assertTrue(recent.is_duplicate(frame))
+        clock.advance(40)
+        self.assertFalse(recent.is_duplicate(frame), "forgotten after the window")
+        self.assertEqual(recent.get_stats(), {"checked":4, "duplicates":1, "unchecked":0,
+                                              "remembered":1})
+
+    def test_max_entries(self):
+        '''Only the newest checksums should be kept'''
+        recent = RecentFrames(max_entries=2)
+        frames = [make_frame(name) for name in ["Worzel", "Aunt Sally", "Crowman"]]
+        for frame in frames:
+            self.assertFalse(recent.is_duplicate(frame))
+        self.assertFalse(recent.is_duplicate(frames[0]), "pushed out")
+        self.assertTrue(recent.is_duplicate(frames[2]))
+        self.assertEqual(recent.get_stats()["remembered"], 2)
+
+    def test_unchecked(self):
+        '''Frames with a wrong checksum or length shouldn't be remembered'''
+        recent = RecentFrames()
+        frame = make_frame("Worzel")
+        bad_checksum = frame[:10] + bytes([frame[10] ^ 1]) + frame[11:]
+        for data in [bad_checksum, bad_checksum, frame[:-1], "abc".encode("utf-8"), None]:
+            self.assertFalse(recent.is_duplicate(data))
+        self.assertFalse(recent.is_duplicate(frame), "not poisoned by the bad checksum")
+        self.assertEqual(recent.get_stats()["unchecked"], 5)
+
+    def test_relay_hops(self):
+        '''Relay frames with different numbers of hops should count as copies'''
+        recent = RecentFrames()
+        single = RelayMessage.wrap_outgoing_message("signed message".encode("utf-8"))
+        self.assertFalse(recent.is_duplicate(RelayMessage.with_hops(single, 3)))
+        self.assertTrue(recent.is_duplicate(RelayMessage.with_hops(single, 2)))
+        self.assertTrue(recent.is_duplicate(single))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,384 @@
+'''Module for testing the inbound pipeline'''
+
+import unittest
+import socket
+import threading
+import time
+from murmeli.system import System, Component
+from murmeli.inbound import InboundPipeline, PipelineStage, looks_like_http
+from murmeli.admission import AdmissionControl
+from murmeli.message import ContactRequestMessage, EnvelopeMessage, RegularMessage, \
+    RelayMessage, Message
+from murmeli.decrypter import DecrypterShim
+from murmeli.simulator import StandInCrypto
+from murmeli import framing
+
+
+class FakeMessageHandler(Component):
+    '''Handler for receiving messages from the pipeline'''
+    def __init__(self, parent):
+        Component.__init__(self, parent, System.COMPNAME_MSG_HANDLER)
+        self.messages = []
+
+    def receive(self, msg):
+        '''Receive an incoming message'''
+        if msg:
+            self.messages.append(msg)
+
+
+class FakeDatabase(Component):
+    '''Database with just the profiles, to find the senders'''
+    def __init__(self, parent, profiles):
+        Component.__init__(self, parent, System.COMPNAME_DATABASE)
+        self.profiles = profiles
+
+    def get_profiles(self):
+        '''Get all the profiles'''
+        return self.profiles
+
+    def get_profile(self, torid=None):
+        '''Get the profile for the given torid, or our own'''
+        for profile in self.profiles:
+            if profile.get('torid') == torid or (not torid and profile['status'] == "self"):
+                return profile
+        return None
+
+
+class FakePostService(Component):
+    '''Post service which remembers who we've heard from'''
+    def __init__(self, parent):
+        Component.__init__(self, parent, System.COMPNAME_POSTSERVICE)
+        self.heard = []
+
+    def heard_from(self, tor_id):
+        '''Remember the sender'''
+        self.heard.append(tor_id)
+
+
+def make_conreq_bytes(sender_name):
+    '''Make the output of an unencrypted contact request'''
+    req = ContactRequestMessage()
+    req.set_field(req.FIELD_SENDER_NAME, sender_name)
+    req.set_field(req.FIELD_MESSAGE, "Hello")
+    return req.create_output(encrypter=None)
+
+
+def wait_for(condition, timeout=5.0):
+    '''Wait until the condition is true or the timeout runs out'''
+    end_time = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end_time:
+        time.sleep(0.05)
+    return condition()
+
+
+class PipelineStageTest(unittest.TestCase):
+    '''Tests for a single pipeline stage'''
+
+    def test_process_and_pass_on(self):
+        '''Check that results are passed on to the next stage, but not None'''
+        results = []
+        first = PipelineStage("double", lambda x: x * 2 if x else None, num_workers=2)
+        second = PipelineStage("collect", results.append)
+        first.next_stage = second
+        first.start()
+        second.start()
+        for item in [1, 2, 0, 3]:
+            first.put(item)
+        self.assertTrue(wait_for(lambda: len(results) == 3))
+        self.assertEqual(sorted(results), [2, 4, 6])
+        self.assertEqual(first.get_stats()["processed"], 4)
+        self.assertEqual(second.get_stats()["processed"], 3)
+        first.stop()
+        second.stop()
+
+    def test_no_workers(self):
+        '''Without workers, items should be processed straight away in the calling thread'''
+        results = []
+        first = PipelineStage("double", lambda x: x * 2 if x else None, num_workers=0)
+        second = PipelineStage("collect", results.append, num_workers=0)
+        first.next_stage = second
+        first.start()
+        for item in [1, 2, 0, 3]:
+            self.assertTrue(first.put(item))
+        self.assertEqual(results, [2, 4, 6], "in order, without waiting")
+        self.assertEqual(first.get_stats()["workers"], 0)
+        self.assertEqual(second.get_stats()["processed"], 3)
+
+    def test_backpressure(self):
+        '''Check that a full queue refuses more items instead of growing'''
+        release = threading.Event()
+        stage = PipelineStage("slow", lambda x: release.wait(), num_workers=1, max_queued=2)
+        stage.start()
+        self.assertTrue(stage.put(1, timeout=0.5))    # taken by the worker
+        time.sleep(0.2)
+        self.assertTrue(stage.put(2, timeout=0.5))
+        self.assertTrue(stage.put(3, timeout=0.5))
+        self.assertFalse(stage.put(4, timeout=0.2), "queue should be full")
+        self.assertEqual(stage.get_stats()["queued"], 2)
+        release.set()
+        self.assertTrue(wait_for(lambda: stage.get_stats()["processed"] == 3))
+        stage.stop()
+
+    def test_exception_in_stage(self):
+        '''Check that exceptions are counted but don't kill the worker'''
+        results = []
+        def process(item):
+            if item == 1:
+                raise ValueError("can't handle this")
+            results.append(item)
+        stage = PipelineStage("fragile", process)
+        stage.start()
+        stage.put(1)
+        stage.put(2)
+        self.assertTrue(wait_for(lambda: results == [2]))
+        self.assertEqual(stage.get_stats()["failed"], 1)
+        stage.stop()
+
+
+class InboundPipelineTest(unittest.TestCase):
+    '''Tests for the whole inbound pipeline'''
+
+    def setUp(self):
+        self.sys = System()
+        self.handler = FakeMessageHandler(self.sys)
+        self.sys.add_component(self.handler)
+        self.pipeline = InboundPipeline(self.handler, workers={InboundPipeline.STAGE_FRAME:2})
+        self.pipeline.start()
+
+    def tearDown(self):
+        self.pipeline.stop()
+        self.sys.stop()
+
+    def send_over_socket(self, data):
+        '''Send the given data through a connected socket pair into the pipeline'''
+        sender, receiver = socket.socketpair()
+        self.assertTrue(self.pipeline.submit_connection(receiver, timeout=1))
+        sender.sendall(data)
+        sender.shutdown(socket.SHUT_WR)
+        return sender
+
+    def test_receive_over_connections(self):
+        '''Send valid and invalid data through connections'''
+        self.send_over_socket("abcdef".encode("utf-8")).close()
+        self.send_over_socket(make_conreq_bytes("Worzel")).close()
+        self.send_over_socket(make_conreq_bytes("Aunt Sally")).close()
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 2))
+        names = {msg.get_field(ContactRequestMessage.FIELD_SENDER_NAME)
+                 for msg in self.handler.messages}
+        self.assertEqual(names, {"Worzel", "Aunt Sally"})
+        stats = self.pipeline.get_stats()
+        self.assertEqual(stats["frame"]["processed"], 3)
+        self.assertEqual(stats["decrypt"]["processed"], 3)
+        self.assertEqual(stats["handle"]["processed"], 2)
+        self.assertEqual(stats["frame"]["workers"], 2)
+        self.assertEqual(stats["decrypt"]["workers"], 2)
+
+    def test_several_frames(self):
+        '''Several frames over one connection should each be passed on'''
+        sender, receiver = socket.socketpair()
+        self.assertTrue(self.pipeline.submit_connection(receiver, timeout=1))
+        sender.sendall(framing.make_hello())
+        self.assertEqual(sender.recv(1024), framing.make_ack())
+        sender.sendall(make_conreq_bytes("Worzel"))
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 1),
+                        "first frame handled before the connection closes")
+        sender.sendall(make_conreq_bytes("Aunt Sally") + make_conreq_bytes("Crowman"))
+        sender.close()
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 3))
+        stats = self.pipeline.get_stats()
+        self.assertEqual(stats["frame"]["processed"], 1)
+        self.assertEqual(stats["decrypt"]["processed"], 3)
+
+    def test_persistent_connections(self):
+        '''Open connections waiting for more frames shouldn't hold up the frame workers'''
+        self.pipeline.stop()
+        self.pipeline = InboundPipeline(self.handler, workers={InboundPipeline.STAGE_FRAME:1})
+        self.pipeline.persistent.idle_timeout = 0.5
+        self.pipeline.start()
+        senders = []
+        for name in ["Worzel", "Aunt Sally"]:
+            sender, receiver = socket.socketpair()
+            self.assertTrue(self.pipeline.submit_connection(receiver, timeout=1))
+            sender.sendall(framing.make_hello())
+            self.assertEqual(sender.recv(1024), framing.make_ack())
+            sender.sendall(make_conreq_bytes(name))
+            senders.append(sender)
+        # Both are still open, but the single worker is free for a third connection
+        self.send_over_socket(make_conreq_bytes("Crowman")).close()
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 3))
+        self.assertEqual(self.pipeline.get_stats()["persistent"]["open"], 2)
+        senders[0].sendall(make_conreq_bytes("Scarecrow"))
+        senders[0].close()
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 4))
+        # The other one is closed after it's been idle for too long
+        senders[1].settimeout(5)
+        self.assertTrue(wait_for(lambda: senders[1].recv(1024) == b""))
+        stats = self.pipeline.get_stats()["persistent"]
+        self.assertEqual((stats["adopted"], stats["closed"], stats["timedout"], stats["open"]),
+                         (2, 2, 1, 0))
+        senders[1].close()
+
+    def test_envelope(self):
+        '''The messages in an envelope should be handled separately'''
+        names = ["Worzel", "Aunt Sally", "Crowman"]
+        envelope = EnvelopeMessage.wrap_outgoing_messages([make_conreq_bytes(name)
+                                                           for name in names])
+        self.send_over_socket(envelope).close()
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 3))
+        self.assertEqual([msg.get_field(ContactRequestMessage.FIELD_SENDER_NAME)
+                          for msg in self.handler.messages], names)
+        self.assertEqual(self.pipeline.get_stats()["decrypt"]["processed"], 1)
+
+    def test_http_request(self):
+        '''Http requests should get a reply but not be passed on'''
+        sender = self.send_over_socket("GET / HTTP/1.1\r\n\r\n".encode("utf-8"))
+        reply = sender.recv(1024)
+        sender.close()
+        self.assertTrue(reply.startswith("This is not".encode("utf-8")))
+        self.assertTrue(wait_for(lambda: self.pipeline.get_stats()["frame"]["processed"] == 1))
+        self.assertEqual(self.pipeline.get_stats()["decrypt"]["processed"], 0)
+
+    def test_submit_data(self):
+        '''Data can also be passed in directly, skipping the frame stage'''
+        self.assertTrue(self.pipeline.submit_data(make_conreq_bytes("Mrs Bloomsbury-Barton")))
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 1))
+        self.assertEqual(self.pipeline.get_stats()["frame"]["processed"], 0)
+
+    def test_duplicates_dropped(self):
+        '''Copies of a frame should be dropped before the decrypt stage'''
+        frame = make_conreq_bytes("Worzel")
+        self.assertTrue(self.pipeline.submit_data(frame))
+        self.send_over_socket(frame).close()
+        self.assertTrue(self.pipeline.submit_data(frame))
+        self.assertTrue(wait_for(lambda: self.pipeline.get_stats()["frame"]["processed"] == 1))
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 1))
+        stats = self.pipeline.get_stats()
+        self.assertEqual(stats["decrypt"]["processed"], 1)
+        self.assertEqual(stats["recentframes"]["duplicates"], 2)
+
+    def test_admission(self):
+        '''Unencrypted frames over the limit should be dropped before the decrypt stage'''
+        self.pipeline.admission = AdmissionControl(anonymous_rate=0.001, anonymous_burst=2)
+        for name in ["Worzel", "Aunt Sally", "Crowman"]:
+            self.assertTrue(self.pipeline.submit_data(make_conreq_bytes(name)))
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 2))
+        stats = self.pipeline.get_stats()
+        self.assertEqual(stats["decrypt"]["processed"], 2)
+        self.assertEqual(stats["admission"]["anonymousdropped"], 1)
+
+    def test_envelope_limits(self):
+        '''Messages in an envelope should get the same checks as frames on their own'''
+        self.pipeline.admission = AdmissionControl(anonymous_rate=0.001, anonymous_burst=2)
+        frames = [make_conreq_bytes(name) for name in ["Worzel", "Aunt Sally", "Crowman"]]
+        self.assertTrue(self.pipeline.submit_data(frames[0]))
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 1))
+        self.assertTrue(self.pipeline.submit_data(EnvelopeMessage.wrap_outgoing_messages(
+            frames + [frames[1]])))
+        self.assertTrue(wait_for(lambda: self.pipeline.get_stats()["decrypt"]["processed"] == 2))
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 2))
+        time.sleep(0.2)
+        self.assertEqual(len(self.handler.messages), 2, "only one more within the limit")
+        stats = self.pipeline.get_stats()
+        self.assertEqual(stats["recentframes"]["duplicates"], 2)
+        self.assertEqual(stats["admission"]["anonymousdropped"], 1)
+
+    def test_retry_when_full(self):
+        '''A frame which didn't fit into the full stage should be accepted when retried'''
+        self.pipeline.stop()
+        self.pipeline = InboundPipeline(self.handler, max_queued=1,
+                                        admission=AdmissionControl(anonymous_rate=0.001,
+                                                                   anonymous_burst=2))
+        first_frame = make_conreq_bytes("Worzel")
+        second_frame = make_conreq_bytes("Aunt Sally")
+        self.assertTrue(self.pipeline.submit_data(first_frame, timeout=0))
+        self.assertFalse(self.pipeline.submit_data(second_frame, timeout=0), "stage full")
+        self.pipeline.start()
+        self.assertTrue(self.pipeline.submit_data(second_frame, timeout=1))
+        self.assertTrue(wait_for(lambda: len(self.handler.messages) == 2))
+        stats = self.pipeline.get_stats()
+        self.assertEqual(stats["recentframes"]["duplicates"], 0)
+        self.assertEqual(stats["admission"]["anonymousdropped"], 0)
+        self.assertTrue(self.pipeline.submit_data(second_frame, timeout=0))
+        self.assertEqual(self.pipeline.get_stats()["recentframes"]["duplicates"], 1)
+
+    def test_relay_path(self):
+        '''Only a message which came directly from its sender counts as hearing from them'''
+        alice = StandInCrypto(None, "AAAA")
+        def make_frame(body):
+            msg = RegularMessage()
+            msg.set_field(msg.FIELD_MSGBODY, body)
+            frame = msg.create_output(encrypter=None)
+            ciphertext = alice.encrypt_and_sign(msg.create_payload(), "BBBB", "AAAA")
+            return frame[:7] + Message.make_checksum(ciphertext) + \
+                bytes([Message.ENCTYPE_ASYM]) + Message.encode_number_to_bytes(
+                    len(ciphertext), 4) + ciphertext + frame[-7:]
+        inner = make_frame("Hello")
+        wrapped = RelayMessage.wrap_outgoing_message(alice.sign_data(inner, "AAAA"))
+        # The relay got the wrapper directly from Alice, and passes it on after its last hop
+        relay_crypto = StandInCrypto(None, "RRRR")
+        relay_crypto.import_public_key("standinkey:AAAA")
+        at_relay = Message.from_received_data(wrapped, DecrypterShim(relay_crypto))
+        self.assertTrue(isinstance(at_relay, RelayMessage))
+        self.assertFalse(at_relay.received_via_relay, "plain relay frames come from the signer")
+        last_hop = at_relay.get_last_hop_output()
+        self.assertEqual(Message.from_received_data(last_hop, DecrypterShim(relay_crypto)).hops,
+                         0)
+
+        self.pipeline.stop()
+        crypto = StandInCrypto(self.sys, "BBBB")
+        crypto.import_public_key("standinkey:AAAA")
+        self.sys.add_component(crypto)
+        self.sys.add_component(FakeDatabase(self.sys, [
+            {"torid":"bob", "keyid":"BBBB", "status":"self"},
+            {"torid":"alice", "keyid":"AAAA", "status":"trusted"}]))
+        post = FakePostService(self.sys)
+        self.sys.add_component(post)
+        self.pipeline = InboundPipeline(self.handler, workers={InboundPipeline.STAGE_FRAME:0,
+                                                               InboundPipeline.STAGE_DECRYPT:0,
+                                                               InboundPipeline.STAGE_RESOLVE:0,
+                                                               InboundPipeline.STAGE_HANDLE:0})
+        self.assertTrue(self.pipeline.submit_data(last_hop))
+        self.assertEqual(len(self.handler.messages), 1)
+        self.assertTrue(self.handler.messages[0].received_via_relay)
+        self.assertEqual(self.handler.messages[0].get_sender_id(), "alice")
+        self.assertEqual(post.heard, [], "not heard from directly")
+        # The same message directly from Alice is a copy, but a new one counts
+        self.assertTrue(self.pipeline.submit_data(inner))
+        self.assertEqual(len(self.handler.messages), 1, "copy dropped")
+        self.assertTrue(self.pipeline.submit_data(make_frame("Hello again")))
+        self.assertEqual(len(self.handler.messages), 2)
+        self.assertEqual(post.heard, ["alice"])
+
+    def test_forged_sender(self):
+        '''An unsigned sender id doesn't count as hearing from that contact'''
+        self.pipeline.stop()
+        self.sys.add_component(FakeDatabase(self.sys, [
+            {"torid":"bob", "keyid":"BBBB", "status":"self"},
+            {"torid":"alice", "keyid":"AAAA", "status":"trusted"}]))
+        post = FakePostService(self.sys)
+        self.sys.add_component(post)
+        self.pipeline = InboundPipeline(self.handler, workers={InboundPipeline.STAGE_FRAME:0,
+                                                               InboundPipeline.STAGE_DECRYPT:0,
+                                                               InboundPipeline.STAGE_RESOLVE:0,
+                                                               InboundPipeline.STAGE_HANDLE:0})
+        req = ContactRequestMessage()
+        req.set_field(req.FIELD_SENDER_ID, "alice")
+        req.set_field(req.FIELD_SENDER_NAME, "Not Alice")
+        req.set_field(req.FIELD_MESSAGE, "Hello")
+        self.assertTrue(self.pipeline.submit_data(req.create_output(encrypter=None)))
+        self.assertEqual(len(self.handler.messages), 1)
+        self.assertEqual(self.handler.messages[0].get_sender_id(), "alice")
+        self.assertFalse(self.handler.messages[0].sender_verified)
+        self.assertEqual(post.heard, [])
+
+    def test_looks_like_http(self):
+        '''Check the detection of http requests'''
+        self.assertFalse(looks_like_http(None))
+        self.assertFalse(looks_like_http("GET /".encode("utf-8")[:4]))
+        self.assertFalse(looks_like_http("murmeli".encode("utf-8")))
+        self.assertTrue(looks_like_http("GET /index.html HTTP/1.1\r\n".encode("utf-8")))
+        self.assertFalse(looks_like_http("GET /{}\r\n".encode("utf-8")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+'''Module for testing the loopback transport between systems in the same process'''
+
+import random
+import time
+import unittest
+from murmeli.system import System, Component
+from murmeli.loopback import LoopbackNetwork, LoopbackClient
+from murmeli.postservice import PostService
+from murmeli.scheduler import Scheduler
+from murmeli.inbound import InboundPipeline
+from murmeli.clock import VirtualClock
+from murmeli.message import ContactRequestMessage
+from murmeli import framing
+
+
+class FakeMessageHandler(Component):
+    '''Handler for receiving messages from the pipeline'''
+    def __init__(self, parent):
+        Component.__init__(self, parent, System.COMPNAME_MSG_HANDLER)
+        self.messages = []
+
+    def receive(self, msg):
+        '''Receive an incoming message'''
+        if msg:
+            self.messages.append(msg)
+
+
+def make_conreq_bytes(sender_name):
+    '''Make the output of an unencrypted contact request'''
+    req = ContactRequestMessage()
+    req.set_field(req.FIELD_SENDER_NAME, sender_name)
+    return req.create_output(encrypter=None)
+
+
+def wait_for(condition, timeout=5.0):
+    '''Wait until the condition is true or the timeout runs out'''
+    end_time = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end_time:
+        time.sleep(0.05)
+    return condition()
+
+
+class LoopbackNetworkTest(unittest.TestCase):
+    '''Tests for the conditions of the loopback network'''
+
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.network = LoopbackNetwork(latency=2.0, clock=self.clock, rand=random.Random(3))
+        self.network.register("abc", address=("localhost", 1))
+        self.network.register("def", address=("localhost", 2))
+
+    def test_offline(self):
+        '''Nodes should be offline by hand or according to their schedules'''
+        self.network.set_offline_schedule("abc", [(10, 20), (30, 40)])
+        self.assertTrue(self.network.is_online("abc"))
+        self.clock.advance(15)
+        self.assertFalse(self.network.is_online("abc"))
+        self.assertEqual(self.network.check_send("def", "abc", 10),
+                         PostService.RC_MESSAGE_FAILED)
+        self.assertEqual(self.network.check_send("abc", "def", 10),
+                         PostService.RC_MESSAGE_FAILED, "sender offline too")
+        self.clock.advance(10)
+        self.assertIsNone(self.network.check_send("def", "abc", 10))
+        self.network.set_online("def", False)
+        self.assertFalse(self.network.is_online("def"))
+        self.network.set_online("def", True)
+        self.assertTrue(self.network.is_online("def"))
+        self.assertEqual(self.network.check_send("def", "xyz", 10),
+                         PostService.RC_MESSAGE_FAILED)
+        stats = self.network.get_stats()
+        self.assertEqual((stats["sent"], stats["offline"], stats["unknown"], stats["bytes"]),
+                         (4, 2, 1, 10))
+
+    def test_loss_and_latency(self):
+        '''Loss and latency should follow the default and the per-node conditions'''
+        self.network.set_conditions("abc", latency=5.0, loss=1.0)
+        self.assertEqual(self.network.get_latency("abc"), 5.0)
+        self.assertEqual(self.network.get_latency("def"), 2.0)
+        self.assertEqual(self.network.check_send("def", "abc", 10),
+                         PostService.RC_MESSAGE_FAILED)
+        self.assertIsNone(self.network.check_send("abc", "def", 10))
+        self.network.drop = 1.0
+        self.assertEqual(self.network.check_send("abc", "def", 10),
+                         PostService.RC_MESSAGE_SENT, "dropped without the sender knowing")
+        stats = self.network.get_stats()
+        self.assertEqual((stats["lost"], stats["dropped"]), (1, 1))
+        self.network.jitter = 1.0
+        self.assertTrue(2.0 <= self.network.get_latency("def") <= 3.0)
+
+
+class LoopbackDeliveryTest(unittest.TestCase):
+    '''Tests for sending between two systems'''
+
+    def setUp(self):
+        self.network = LoopbackNetwork()
+        self.systems = []
+        self.handlers = []
+
+    def tearDown(self):
+        for system in self.systems:
+            system.stop()
+
+    def add_node(self, tor_id, use_tcp):
+        '''Make a system with a loopback client and a message handler'''
+        system = System()
+        handler = FakeMessageHandler(system)
+        system.add_component(handler)
+        client = LoopbackClient(system, self.network, tor_id, use_tcp=use_tcp)
+        system.add_component(client)
+        self.assertTrue(client.is_started())
+        self.systems.append(system)
+        self.handlers.append(handler)
+        return client
+
+    def check_delivery(self, use_tcp, reuse_connections=False):
+        '''Send a few messages from one node to the other'''
+        self.add_node("abc", use_tcp)
+        receiver = self.add_node("def", use_tcp)
+        transport = self.network.get_transport("abc", use_tcp=use_tcp,
+                                               reuse_connections=reuse_connections)
+        names = ["Worzel", "Aunt Sally", "Crowman"]
+        for name in names:
+            self.assertEqual(transport.send_message(make_conreq_bytes(name), "def"),
+                             PostService.RC_MESSAGE_SENT)
+        self.assertTrue(wait_for(lambda: len(self.handlers[1].messages) == 3))
+        # Several connections and workers, so the order may change
+        self.assertEqual(sorted(msg.get_field(ContactRequestMessage.FIELD_SENDER_NAME)
+                                for msg in self.handlers[1].messages), sorted(names))
+        self.assertFalse(self.handlers[0].messages)
+        self.network.set_online("def", False)
+        self.assertEqual(transport.send_message(make_conreq_bytes("Bloomsbury"), "def"),
+                         PostService.RC_MESSAGE_FAILED)
+        self.assertEqual(self.network.get_stats()["delivered"], 3)
+        self.assertTrue(wait_for(
+            lambda: receiver.get_stats()["pipeline"]["handle"]["processed"] == 3))
+        transport.close()
+        return transport
+
+    def test_in_process(self):
+        '''Messages should be passed straight to the recipient's pipeline'''
+        transport = self.check_delivery(use_tcp=False)
+        self.assertEqual(transport.get_peer_version("def"), framing.PROTOCOL_VERSION)
+        self.assertIsNone(transport.get_peer_version("xyz"))
+
+    def test_tcp(self):
+        '''Messages should go over a new local connection each time'''
+        self.check_delivery(use_tcp=True)
+        self.assertTrue(self.network.get_address("def")[1] > 0, "free port")
+
+    def test_tcp_reused(self):
+        '''Messages should go over one local connection'''
+        transport = self.check_delivery(use_tcp=True, reuse_connections=True)
+        self.assertEqual(transport.get_stats()["connects"], 1)
+        self.assertEqual(transport.get_stats()["reused"], 2)
+        self.assertEqual(transport.get_peer_version("def"), framing.PROTOCOL_VERSION)
+
+    def test_scheduled(self):
+        '''With a scheduler, deliveries should wait for the latency on one thread'''
+        clock = VirtualClock()
+        scheduler = Scheduler(clock=clock, threaded=False)
+        scheduler.start()
+        self.network = LoopbackNetwork(latency=2.0, clock=clock, scheduler=scheduler)
+        system = System()
+        handler = FakeMessageHandler(system)
+        system.add_component(handler)
+        system.add_component(LoopbackClient(system, self.network, "def", pipeline_workers={
+            stage:0 for stage in InboundPipeline.DEFAULT_WORKERS}))
+        self.systems.append(system)
+        transport = self.network.get_transport("abc")
+        self.assertEqual(transport.send_message(make_conreq_bytes("Worzel"), "def"),
+                         PostService.RC_MESSAGE_SENT)
+        scheduler.run_for(1.9)
+        self.assertFalse(handler.messages, "not yet")
+        scheduler.run_for(0.2)
+        self.assertEqual(len(handler.messages), 1, "no waiting for threads")
+        self.assertEqual(self.network.get_stats()["delivered"], 1)
+
+    def test_stopped(self):
+        '''A stopped node can't be reached any more'''
+        self.add_node("abc", False)
+        self.add_node("def", False)
+        self.systems[1].stop()
+        transport = self.network.get_transport("abc")
+        self.assertEqual(transport.send_message(make_conreq_bytes("Worzel"), "def"),
+                         PostService.RC_MESSAGE_FAILED)
+        self.assertEqual(self.network.get_stats()["nodes"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
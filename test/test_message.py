@@ -232,6 +232,26 @@ class AsymmMessageTest(unittest.TestCase):
         self.assertEqual(back_again.body[back_again.FIELD_MSGBODY], msg_body, "Content match")
         self.assertEqual(1, back_again.version_number, "Version 1")
 
+    def test_ack_message(self):
+        '''Test the ack message, and the checksum it refers to'''
+        reg = message.RegularMessage()
+        reg.set_field(reg.FIELD_MSGBODY, "Pudding and pie")
+        reg_output = reg.create_output(encrypter=None)
+        checksum = message.Message.get_frame_checksum(reg_output)
+        self.assertEqual(len(checksum), 32, "hex of md5")
+        self.assertEqual(message.Message.from_received_data(reg_output).frame_checksum, checksum)
+        relayed = message.RelayMessage.wrap_outgoing_message(reg_output)
+        self.assertEqual(message.Message.from_received_data(relayed).frame_checksum, checksum,
+                         "checksum of the inner frame")
+        self.assertIsNone(message.Message.get_frame_checksum(reg_output[:20]))
+        ack = message.AckMessage()
+        ack.set_field(ack.FIELD_CHECKSUMS, [checksum])
+        self.assertFalse(ack.should_be_relayed, "acks aren't relayed")
+        back_again = message.Message.from_received_data(ack.create_output(encrypter=None))
+        self.assertTrue(isinstance(back_again, message.AckMessage), "Correct type")
+        self.assertEqual(back_again.describe_message_type(), "ack")
+        self.assertEqual(back_again.get_field(ack.FIELD_CHECKSUMS), [checksum])
+
     def test_referral_message(self):
         '''Test the contact referral message (still without encryption)'''
         referral = message.ContactReferralMessage()
@@ -269,6 +289,22 @@ class AsymmMessageTest(unittest.TestCase):
         self.assertFalse(referral.is_robot_referral(), "Not a robot referral")
         self.assertTrue(referral.is_robot_removal(), "Robot removal")
 
+    def test_coalesce_keys(self):
+        '''Test which messages can replace older ones in the outbox'''
+        self.assertEqual(message.StatusNotifyMessage().get_coalesce_key(), "statusnotify:ping")
+        pong = message.StatusNotifyMessage()
+        pong.set_field(pong.FIELD_PING, 0)
+        self.assertEqual(pong.get_coalesce_key(), "statusnotify:pong")
+        self.assertEqual(message.InfoRequestMessage().get_coalesce_key(), "inforequest:1")
+        self.assertEqual(message.InfoResponseMessage().get_coalesce_key(), "inforesponse:1")
+        self.assertIsNone(message.RegularMessage().get_coalesce_key())
+        referral = message.ContactReferralMessage()
+        referral.set_field(referral.FIELD_FRIEND_ID, "abc")
+        self.assertIsNone(referral.get_coalesce_key(), "Normal referrals are kept")
+        referral.set_field(referral.FIELD_REFERRAL_TYPE, referral.REFERTYPE_ROBOT)
+        self.assertEqual(referral.get_coalesce_key(), "robotreferral:abc")
+        referral.set_field(referral.FIELD_REFERRAL_TYPE, referral.REFERTYPE_REMOVEROBOT)
+        self.assertEqual(referral.get_coalesce_key(), "robotreferral:abc")
 
     def test_request_referral(self):
         '''Test the contact referral request message (still without encryption)'''
@@ -338,5 +374,61 @@ class RelayMessageTest(unittest.TestCase):
         self.assertEqual(signed_output, forwarded_output, "Forwarded data correct")
 
 
+    def test_relay_hops(self):
+        '''Test that each relay passes on the message with one hop fewer'''
+        signed_output = "This should be a signed message".encode("utf-8")
+        single = message.RelayMessage.wrap_outgoing_message(signed_output)
+        wrapped = message.RelayMessage.with_hops(single, 3)
+        self.assertEqual(wrapped[len("murmeli") + 16], message.Message.ENCTYPE_RELAY_HOPS)
+        self.assertEqual(message.RelayMessage.with_hops(single, 1), single)
+        for hops in [3, 2, 1]:
+            back_again = message.Message.from_received_data(wrapped)
+            self.assertTrue(isinstance(back_again, message.RelayMessage), "Correct type")
+            self.assertEqual(back_again.hops, hops)
+            self.assertEqual(back_again.received_bytes, signed_output)
+            wrapped = back_again.get_forward_output()
+            if hops == 2:
+                self.assertEqual(wrapped, single, "plain relay for the last hop")
+        self.assertEqual(wrapped, signed_output, "just the inside after the last hop")
+        too_many = message.RelayMessage.wrap_outgoing_message(signed_output, 9)
+        self.assertEqual(message.Message.from_received_data(too_many).hops,
+                         message.RelayMessage.MAX_HOPS)
+
+
+class EnvelopeMessageTest(unittest.TestCase):
+    '''Tests for the envelopes of several messages'''
+
+    @staticmethod
+    def make_regular_output(msg_body):
+        '''Make the unencrypted output of a regular message'''
+        reg = message.RegularMessage()
+        reg.set_field(reg.FIELD_MSGBODY, msg_body)
+        return reg.create_output(encrypter=None)
+
+    def test_pack_and_unpack(self):
+        '''Test that several messages can be put in an envelope and taken out again'''
+        bodies = ["Crowman", "Smörgåsbord", "Aunt Sally"]
+        outputs = [self.make_regular_output(body) for body in bodies]
+        wrapped = message.EnvelopeMessage.wrap_outgoing_messages(outputs + [None])
+        self.assertEqual(message.EnvelopeMessage.split_payload(bytes().join(outputs)), outputs)
+        back_again = message.Message.from_received_data(wrapped)
+        self.assertTrue(isinstance(back_again, message.EnvelopeMessage), "Correct type")
+        self.assertEqual(back_again.describe_message_type(), "envelope")
+        self.assertEqual([msg.body[msg.FIELD_MSGBODY] for msg in back_again.messages], bodies)
+        self.assertIsNone(message.EnvelopeMessage.wrap_outgoing_messages([]))
+
+    def test_invalid_contents(self):
+        '''Cut-off and nested contents should be rejected'''
+        output = self.make_regular_output("Worzel")
+        self.assertIsNone(message.EnvelopeMessage.split_payload(output + output[:30]))
+        cut_off = message.EnvelopeMessage()
+        cut_off.parcels = [output, output[:-3]]
+        self.assertIsNone(message.Message.from_received_data(cut_off.create_output()))
+        inner = message.EnvelopeMessage.wrap_outgoing_messages([output])
+        nested = message.EnvelopeMessage.wrap_outgoing_messages([inner, output])
+        back_again = message.Message.from_received_data(nested)
+        self.assertEqual(len(back_again.messages), 1, "nested envelope ignored")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -4,8 +4,11 @@ import unittest
 from murmeli.messagehandler import RobotMessageHandler, RegularMessageHandler
 from murmeli.system import System, Component
 from murmeli.config import Config
+from murmeli.scheduler import Scheduler
+from murmeli.clock import VirtualClock
 from murmeli.message import (StatusNotifyMessage, ContactRequestMessage,
-                             ContactReferralMessage, RegularMessage)
+                             ContactReferralMessage, RegularMessage, AckMessage,
+                             Message, RelayMessage)
 
 
 class MockDatabase(Component):
@@ -15,11 +18,22 @@ class MockDatabase(Component):
         self.inbox = []
         self.outbox = []
         self.profiles = {}
+        self.relay_seen_state = None
 
     def add_row_to_outbox(self, msg):
         '''React to storing messages in the outbox'''
+        msg["_id"] = len(self.outbox)
         self.outbox.append(msg)
 
+    def get_outbox(self):
+        '''Return the rows of the outbox which haven't been deleted'''
+        return [row for row in self.outbox if row]
+
+    def delete_from_outbox(self, index):
+        '''Delete the given row from the outbox'''
+        self.outbox[index] = None
+        return True
+
     def add_row_to_inbox(self, msg):
         '''React to storing messages in the inbox'''
         self.inbox.append(msg)
@@ -39,13 +53,23 @@ class MockDatabase(Component):
     def get_profiles_with_status(self, status):
         '''Return list of profiles with the given status'''
         if self.profiles and status:
-            return [p for _, p in self.profiles.items() if p.get('status') == status]
+            statuses = [status] if isinstance(status, str) else status
+            return [p for _, p in self.profiles.items() if p.get('status') in statuses]
         return None
 
     def add_or_update_profile(self, profile):
         '''Add or update the given profile'''
         self.profiles[profile.get('torid')] = profile
 
+    def get_relay_seen_state(self):
+        '''Get the stored seen-set of relayed messages'''
+        return self.relay_seen_state
+
+    def set_relay_seen_state(self, state):
+        '''Store the seen-set of relayed messages, unless already stopped'''
+        if self.started:
+            self.relay_seen_state = state
+
 
 class MockCrypto(Component):
     '''Use a pretend crypto system for the tests instead of a real one'''
@@ -81,6 +105,22 @@ class MockContacts(Component):
         self.contacts[tor_id] = online
 
 
+class MockPostService(Component):
+    '''Use a pretend post service to collect the acks'''
+    def __init__(self, parent):
+        Component.__init__(self, parent, System.COMPNAME_POSTSERVICE)
+        self.queued_acks = []
+        self.acknowledged = []
+
+    def queue_ack(self, tor_id, checksum):
+        '''Remember the ack to send'''
+        self.queued_acks.append((tor_id, checksum))
+
+    def acknowledge(self, tor_id, checksums):
+        '''Remember the ack received'''
+        self.acknowledged.append((tor_id, checksums))
+
+
 class RobotHandlerTest(unittest.TestCase):
     '''Tests for the handling of messages by a robot handler'''
     def setUp(self):
@@ -268,6 +308,92 @@ class RegularHandlerTest(unittest.TestCase):
         self.handler.receive(msg)
         # self.assertEqual(len(self.fakedb.inbox), 1, "inbox now has one message")
 
+    def test_acks(self):
+        '''Check that messages from trusted contacts are acknowledged, but not acks'''
+        postman = MockPostService(self.sys)
+        self.sys.add_component(postman)
+        friend_id = "Zarniwoop"
+        msg = RegularMessage()
+        msg.set_field(msg.FIELD_SENDER_ID, friend_id)
+        msg.frame_checksum = "0123abcd"
+        self.handler.receive(msg)
+        self.assertFalse(postman.queued_acks, "not acknowledged from unknown contact")
+        self.fakedb.add_or_update_profile({"torid":friend_id, "status":"trusted"})
+        self.handler.receive(msg)
+        self.assertEqual(postman.queued_acks, [(friend_id, "0123abcd")])
+        ack = AckMessage()
+        ack.set_field(ack.FIELD_SENDER_ID, friend_id)
+        ack.set_field(ack.FIELD_CHECKSUMS, ["4567ef"])
+        ack.frame_checksum = "89ab"
+        self.handler.receive(ack)
+        self.assertEqual(len(postman.queued_acks), 1, "acks aren't acknowledged")
+        self.assertEqual(postman.acknowledged, [(friend_id, ["4567ef"])])
+
+    def test_relaying(self):
+        '''Check that relayed messages are passed on once, to at most fanout contacts'''
+        scheduler = Scheduler(self.sys, clock=VirtualClock(), threaded=False)
+        self.sys.add_component(scheduler)
+        self.fakedb.add_or_update_profile({"torid":"Jeltz", "status":"self"})
+        for friend_id in ["Arthur", "Ford", "Trillian", "Zaphod"]:
+            self.fakedb.add_or_update_profile({"torid":friend_id, "status":"trusted"})
+        # Without the recipient's key, the message inside can't be read
+        inner = "encrypted for somebody else".encode("utf-8")
+        wrapped = RelayMessage.wrap_outgoing_message(inner, 2)
+        relayed = Message.from_received_data(wrapped)
+        relayed.set_field(relayed.FIELD_SENDER_ID, "Arthur")
+        self.handler.receive_relayed_message(relayed)
+        self.assertEqual(len(self.fakedb.outbox), 1, "relayed message queued")
+        row = self.fakedb.outbox[0]
+        self.assertEqual(row["recipientList"], ["Ford", "Trillian", "Zaphod"])
+        self.assertEqual(row["encType"], Message.ENCTYPE_RELAY, "one hop fewer")
+        self.assertEqual(row["checksum"], Message.get_frame_checksum(inner))
+        self.assertIsNone(self.fakedb.relay_seen_state, "seen-set not stored straight away")
+        scheduler.run_for(60)
+        self.assertTrue(self.fakedb.relay_seen_state, "seen-set stored")
+        # The same message again, from another contact
+        relayed.set_field(relayed.FIELD_SENDER_ID, "Ford")
+        self.handler.receive_relayed_message(relayed)
+        self.assertEqual(len(self.fakedb.outbox), 1, "duplicate not queued")
+        # Our own message coming back
+        own = Message.from_received_data(RelayMessage.wrap_outgoing_message(
+            "encrypted by us".encode("utf-8")))
+        own.set_field(own.FIELD_SENDER_ID, "Jeltz")
+        self.handler.receive_relayed_message(own)
+        self.assertEqual(len(self.fakedb.outbox), 1, "own message not queued")
+        # Limited fanout, for a new message
+        self.config.set_property(Config.KEY_RELAY_FANOUT, 2)
+        other = Message.from_received_data(RelayMessage.wrap_outgoing_message(
+            "also encrypted for somebody else".encode("utf-8")))
+        other.set_field(other.FIELD_SENDER_ID, "Zaphod")
+        self.handler.receive_relayed_message(other)
+        self.assertEqual(len(self.fakedb.outbox), 2, "new message queued")
+        self.assertEqual(len(self.fakedb.outbox[1]["recipientList"]), 2)
+        self.assertNotIn("Zaphod", self.fakedb.outbox[1]["recipientList"])
+        self.assertEqual(self.handler.get_stats()["relay"],
+                         {"relayed":2, "duplicates":1, "own":1})
+        # Stored once when stopping, with the new message, before the database stops
+        stored = self.fakedb.relay_seen_state
+        self.sys.stop()
+        self.assertNotEqual(self.fakedb.relay_seen_state, stored)
+        self.assertEqual(scheduler.get_num_scheduled(), 0, "delayed store cancelled")
+
+    def test_relay_quota(self):
+        '''Check that older copies are evicted when the relay storage is full'''
+        for friend_id in ["Arthur", "Ford"]:
+            self.fakedb.add_or_update_profile({"torid":friend_id, "status":"trusted"})
+        self.handler.relay_quota.max_origin_rows = 2
+        for i in range(3):
+            relayed = Message.from_received_data(RelayMessage.wrap_outgoing_message(
+                ("copy number %d for somebody else" % i).encode("utf-8")))
+            relayed.set_field(relayed.FIELD_SENDER_ID, "Arthur")
+            self.handler.receive_relayed_message(relayed)
+        self.assertIsNone(self.fakedb.outbox[0], "oldest copy evicted")
+        self.assertEqual(len(self.fakedb.get_outbox()), 2)
+        stats = self.handler.get_stats()
+        self.assertEqual(stats["relay"]["relayed"], 3)
+        self.assertEqual(stats["relayquota"]["evicted"], 1)
+        self.assertEqual(stats["relayquota"]["byorigin"], {"Arthur":1})
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,45 @@
+'''Module for testing the metrics component'''
+
+import unittest
+from murmeli.system import System, Component
+from murmeli.metrics import Metrics
+
+
+class CountingComponent(Component):
+    '''Component which publishes some stats'''
+    def __init__(self, parent, name):
+        Component.__init__(self, parent, name)
+        self.count = 0
+
+    def get_stats(self):
+        '''Return the stats of this component'''
+        return {"count":self.count, "nested":{"value":self.count * 2}}
+
+
+class MetricsTest(unittest.TestCase):
+    '''Tests for the metrics'''
+
+    def test_no_parent(self):
+        '''Metrics without a system should be empty'''
+        metrics = Metrics(None)
+        self.assertEqual(metrics.get_all_stats(), {})
+        self.assertIsNone(metrics.get_stats_value("comp.something", "count"))
+
+    def test_collect_stats(self):
+        '''Only components with stats should be collected'''
+        sys = System()
+        metrics = Metrics(sys)
+        sys.add_component(metrics)
+        counter = CountingComponent(sys, "counter")
+        sys.add_component(counter)
+        sys.add_component(Component(sys, "silent"))
+        counter.count = 3
+        self.assertEqual(set(metrics.get_all_stats()), {"counter"})
+        self.assertEqual(metrics.get_stats_value("counter", "count"), 3)
+        self.assertEqual(metrics.get_stats_value("counter", "nested", "value"), 6)
+        self.assertIsNone(metrics.get_stats_value("counter", "nested", "value", "deeper"))
+        self.assertIsNone(metrics.get_stats_value("silent", "count"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+'''Module for testing the expiry of outbox messages'''
+
+import unittest
+from murmeli import outboxexpiry
+from murmeli.outboxexpiry import OutboxSweeper
+from murmeli.supersimpledb import MurmeliDb
+
+
+class FakeClock:
+    '''Clock which only moves when told to'''
+    def __init__(self):
+        self.now = 100000.0
+
+    def __call__(self):
+        return self.now
+
+
+class OutboxExpiryTest(unittest.TestCase):
+    '''Tests for the outbox sweeper'''
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.database = MurmeliDb(None)
+
+    def add_row(self, msg_type, age):
+        '''Add a row of the given type and age to the outbox'''
+        self.database.add_row_to_outbox({"recipient":"abc", "message":"a1fa8008",
+                                         "msgType":msg_type,
+                                         "timestamp":None if age is None
+                                                     else self.clock.now - age})
+
+    def test_ttls(self):
+        '''Status notifications should expire sooner than regular messages'''
+        self.assertLess(outboxexpiry.get_ttl("statusnotify"), outboxexpiry.get_ttl("inforequest"))
+        self.assertLess(outboxexpiry.get_ttl("inforequest"), outboxexpiry.get_ttl("regular"))
+        self.assertEqual(outboxexpiry.get_ttl("unknown"), outboxexpiry.DEFAULT_TTL)
+
+    def test_sweep(self):
+        '''Expired rows should be removed, and only the important ones dead-lettered'''
+        sweeper = OutboxSweeper(sweep_interval=60, clock=self.clock)
+        self.assertTrue(sweeper.is_due())
+        self.add_row("statusnotify", 3600)
+        self.add_row("statusnotify", 60)
+        self.add_row("regular", 3600)
+        self.add_row("regular", 100 * outboxexpiry.DAY_SECS)
+        self.add_row("inforequest", None)
+        self.assertEqual(sweeper.sweep(self.database), 2)
+        self.assertFalse(sweeper.is_due())
+        outbox = self.database.get_outbox()
+        self.assertEqual([row["_id"] for row in outbox], [1, 2, 4])
+        self.assertEqual(outbox[2]["timestamp"], self.clock.now, "timestamp filled in")
+        deadletters = self.database.get_deadletters()
+        self.assertEqual(len(deadletters), 1)
+        self.assertEqual(deadletters[0]["msgType"], "regular")
+        self.assertEqual(deadletters[0]["expired"], self.clock.now)
+        self.assertNotIn("_id", deadletters[0])
+        self.assertEqual(sweeper.get_stats(), {"expired":2, "deadletters":1, "pruned":0,
+                                               "bytype":{"statusnotify":1, "regular":1},
+                                               "lastsweep":self.clock.now})
+        # Later on, the inforequest expires too
+        self.clock.now += outboxexpiry.DAY_SECS + 1
+        self.assertTrue(sweeper.is_due())
+        self.assertEqual(sweeper.sweep(self.database), 2)
+        self.assertEqual([row["_id"] for row in self.database.get_outbox()], [2])
+
+    def test_prune_deadletters(self):
+        '''Old dead letters should be removed, and only the newest ones kept'''
+        sweeper = OutboxSweeper(clock=self.clock, deadletter_ttl=outboxexpiry.DAY_SECS,
+                                max_deadletters=3)
+        for age in [2, 0.5, 0.4, 0.3, 0.2, 0.1]:
+            self.database.add_row_to_deadletters({"msgType":"regular", "recipient":"abc",
+                                                  "expired":self.clock.now
+                                                             - age * outboxexpiry.DAY_SECS})
+        self.add_row("regular", 100 * outboxexpiry.DAY_SECS)
+        self.assertEqual(sweeper.sweep(self.database), 1)
+        deadletters = self.database.get_deadletters()
+        self.assertEqual([row["expired"] for row in deadletters],
+                         [self.clock.now - age * outboxexpiry.DAY_SECS for age in [0.2, 0.1]]
+                         + [self.clock.now], "newly expired one kept")
+        self.assertEqual(sweeper.get_stats()["pruned"], 4)
+        self.assertEqual(self.database.prune_deadletters(self.clock.now + 1, 3), 3)
+        self.assertEqual(self.database.get_deadletters(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
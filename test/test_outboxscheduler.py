@@ -0,0 +1,78 @@
+'''Module for testing the scheduling of outbox messages'''
+
+import unittest
+from murmeli import outboxscheduler
+from murmeli.outboxscheduler import OutboxScheduler
+
+
+class OutboxSchedulerTest(unittest.TestCase):
+    '''Tests for the outbox scheduler'''
+
+    def test_priorities(self):
+        '''Check the priority classes of the message types'''
+        self.assertLess(outboxscheduler.get_priority("contactrequest"),
+                        outboxscheduler.get_priority("regular"))
+        self.assertLess(outboxscheduler.get_priority("regular"),
+                        outboxscheduler.get_priority("statusnotify"))
+        self.assertEqual(outboxscheduler.get_priority(None), outboxscheduler.PRIORITY_REGULAR)
+
+    def test_row_recipients(self):
+        '''Check getting the recipients from a row'''
+        self.assertEqual(outboxscheduler.get_row_recipients(None), [])
+        self.assertEqual(outboxscheduler.get_row_recipients({"recipient":"abc"}), ["abc"])
+        self.assertEqual(outboxscheduler.get_row_recipients({"recipientList":["d", "e"]}),
+                         ["d", "e"])
+
+    def test_load_and_take(self):
+        '''Check that messages come out in priority order, then in order of adding'''
+        sched = OutboxScheduler()
+        self.assertTrue(sched.is_stale())
+        sched.load([{"_id":0, "recipient":"albert", "msgType":"statusnotify"},
+                    None,
+                    {"_id":2, "recipient":"albert", "msgType":"regular"},
+                    {"_id":3, "recipientList":["albert", "bertha"], "msgType":"relay"},
+                    {"_id":4, "recipient":"albert", "msgType":"contactrequest"}])
+        self.assertFalse(sched.is_stale())
+        self.assertEqual(sched.get_num_queued(), 5)
+        self.assertEqual(sched.get_num_queued("bertha"), 1)
+        self.assertEqual([row_id for row_id, _ in sched.take_messages("albert")],
+                         [4, 2, 3, 0])
+        self.assertEqual(sched.get_num_queued("albert"), 0)
+        self.assertEqual(sched.take_messages("albert"), [])
+        self.assertEqual(sched.get_recipients(), ["bertha"])
+
+    def test_no_duplicates(self):
+        '''Adding the same row twice should only queue it once'''
+        sched = OutboxScheduler()
+        sched.add_row({"_id":1, "recipient":"cecil"})
+        sched.add("cecil", 1)
+        self.assertEqual(sched.get_num_queued(), 1)
+        sched.add_row({"recipient":"cecil"})
+        self.assertEqual(sched.get_num_queued(), 1, "row without id is ignored")
+
+    def test_online_first(self):
+        '''Online recipients should be given first'''
+        sched = OutboxScheduler()
+        for row_id, recpt in enumerate(["dolly", "eric", "fred"]):
+            sched.add(recpt, row_id)
+        sched.set_online("fred", True)
+        self.assertEqual(sched.get_recipients()[0], "fred")
+        self.assertEqual(sched.get_stats()["ready"], 1)
+        sched.set_online("fred", False)
+        self.assertEqual(sched.get_stats(), {"queued":3, "recipients":3, "ready":0})
+        sched.mark_stale()
+        self.assertTrue(sched.is_stale())
+
+    def test_ordering(self):
+        '''Each group of recipients should be sorted by the given order'''
+        sched = OutboxScheduler()
+        for row_id, recpt in enumerate(["dolly", "eric", "fred", "gina"]):
+            sched.add(recpt, row_id)
+        sched.set_online("dolly", True)
+        sched.set_online("fred", True)
+        self.assertEqual(sched.get_recipients(order=lambda recpts: sorted(recpts, reverse=True)),
+                         ["fred", "dolly", "gina", "eric"])
+
+
+if __name__ == "__main__":
+    unittest.main()
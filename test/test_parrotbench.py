@@ -0,0 +1,78 @@
+'''Module for testing the parrot benchmark'''
+
+import time
+import unittest
+from murmeli.parrotbench import ParrotBenchmark, Journeys, format_report, SIDE_CLIENT, \
+    SIDE_PARROT
+from murmeli.message import Message, RegularMessage, EnvelopeMessage
+from murmeli.simulator import StandInCrypto
+
+
+class JourneysTest(unittest.TestCase):
+    '''Tests for the noting of the points of each journey'''
+
+    def test_stages(self):
+        '''Each stage should be measured from the points noted on both sides'''
+        journeys = Journeys()
+        body = journeys.make_body("Hello")
+        msg = RegularMessage()
+        msg.set_field(msg.FIELD_MSGBODY, body)
+        plaintext = msg.create_payload()
+        crypto = StandInCrypto(None, "AAAA")
+        ciphertext = crypto.encrypt_and_sign(plaintext, "BBBB", "AAAA")
+        frame = msg.create_output(encrypter=None)
+        encrypted_frame = frame[:7] + Message.make_checksum(ciphertext) + frame[23:]
+        now = time.monotonic()
+        journeys.encrypted(SIDE_CLIENT, plaintext, ciphertext, now, now + 1)
+        journeys.sent(SIDE_CLIENT, EnvelopeMessage.wrap_outgoing_messages([encrypted_frame]),
+                      now + 3)
+        journeys.decrypted(SIDE_PARROT, ciphertext, plaintext, now + 4, now + 6)
+        journeys.decrypted(SIDE_CLIENT, ciphertext, plaintext, now + 7, now + 8)
+        self.assertEqual(journeys.get_num_arrived(), 0)
+        journeys.record_arrival("abc", {"messageBody":"Parrot: '%s'" % body})
+        journeys.record_arrival("abc", {"messageBody":"Not from the benchmark"})
+        stats = journeys.get_stats()
+        self.assertEqual((stats["sent"], stats["completed"]), (1, 1))
+        self.assertAlmostEqual(stats["stages"]["encrypt"]["mean"], 1.0)
+        self.assertAlmostEqual(stats["stages"]["send"]["mean"], 2.0, msg="found in envelope")
+        self.assertAlmostEqual(stats["stages"]["receive"]["mean"], 1.0)
+        self.assertAlmostEqual(stats["stages"]["decrypt"]["mean"], 2.0, msg="only the parrot's")
+        self.assertEqual(stats["stages"]["handle"]["count"], 0, "no reply yet")
+
+
+class ParrotBenchmarkTest(unittest.TestCase):
+    '''Tests for the round trips to a parrot robot'''
+
+    def check_round_trips(self, use_tcp):
+        '''Send a few messages and check that all the echoes arrive'''
+        benchmark = ParrotBenchmark(num_messages=5, rate=50, use_tcp=use_tcp, timeout=10)
+        try:
+            benchmark.start()
+            benchmark.run()
+        finally:
+            benchmark.stop()
+        report = benchmark.get_report()
+        self.assertEqual(report["completed"], 5)
+        # Everything got through first time, so nothing was retried
+        network = benchmark.network.get_stats()
+        self.assertEqual(network["delivered"], network["sent"])
+        self.assertEqual((network["lost"], network["offline"], network["unknown"]), (0, 0, 0))
+        self.assertTrue(0.0 < report["roundtrip"]["p50"] <= report["roundtrip"]["max"])
+        for stage, _, _ in Journeys.STAGES:
+            self.assertEqual(report["stages"][stage]["count"], 5, stage)
+            self.assertTrue(report["stages"][stage]["mean"] >= 0.0, stage)
+        self.assertTrue(report["throughput"] > 0.0)
+        self.assertEqual(report["settings"]["crypto"], "stand-in")
+        self.assertEqual(len(format_report(report)), 2 + 1 + len(Journeys.STAGES))
+
+    def test_in_process(self):
+        '''Messages passed straight to the other side's pipeline'''
+        self.check_round_trips(use_tcp=False)
+
+    def test_tcp(self):
+        '''Messages sent over local connections'''
+        self.check_round_trips(use_tcp=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,15 @@
 ''''Testing of the functions of the PostService'''
 
 import unittest
+import threading
 import time
 from murmeli.system import System, Component
 from murmeli.postservice import PostService
+from murmeli.clock import VirtualClock, set_default_clock
+from murmeli.message import Message, RegularMessage, EnvelopeMessage
+from murmeli.framing import HEADER_LENGTH, RELAY_HOPS_VERSION, LAST_HOP_VERSION
+from murmeli import dbutils
+from murmeli import imageutils
 
 class MockDatabase(Component):
     '''Use a pretend database for the tests instead of a real one'''
@@ -12,14 +18,20 @@ class MockDatabase(Component):
         self.inbox = []
         self.outbox = []
         self.profiles = []
+        self.delivery = {}
+        self.reachability = {}
+        self.deadletters = []
         self.num_msgs_added_to_outbox = 0
         self.num_msgs_deleted_from_outbox = 0
+        self.num_reachability_updates = 0
 
     def add_row_to_outbox(self, msg):
         '''React to storing messages in the outbox'''
         msg["_id"] = len(self.outbox)
         self.outbox.append(msg)
         self.num_msgs_added_to_outbox += 1
+        if self.get_component(System.COMPNAME_POSTSERVICE):
+            self.call_component(System.COMPNAME_POSTSERVICE, "request_flush", new_row=msg)
 
     def delete_from_outbox(self, index):
         '''React to storing messages in the outbox'''
@@ -31,6 +43,48 @@ class MockDatabase(Component):
         '''Get the list of rows in the outbox'''
         return self.outbox
 
+    def get_outbox_messages_with_checksums(self, checksums):
+        '''Get the outbox rows with any of the given checksums'''
+        return [row for row in self.outbox if row and row.get('checksum') in checksums]
+
+    def get_outbox_message(self, index):
+        '''Get the outbox row at the given index'''
+        return self.outbox[index] if 0 <= index < len(self.outbox) else None
+
+    def update_outbox_message(self, index, props):
+        '''Update the outbox row at the given index'''
+        if self.outbox[index]:
+            self.outbox[index].update(props)
+
+    def add_row_to_deadletters(self, row):
+        '''Store an expired message'''
+        self.deadletters.append(row)
+
+    def prune_deadletters(self, expired_before, max_rows):
+        '''Remove the old dead letters'''
+        kept = [row for row in self.deadletters if row["expired"] >= expired_before]
+        kept = kept[max(0, len(kept) - max_rows):]
+        num_removed = len(self.deadletters) - len(kept)
+        self.deadletters = kept
+        return num_removed
+
+    def get_delivery_states(self):
+        '''Get the delivery states of all the recipients'''
+        return list(self.delivery.values())
+
+    def update_delivery_state(self, torid, state):
+        '''Store the delivery state of the given recipient'''
+        self.delivery[torid] = dict(state)
+
+    def get_reachability_states(self):
+        '''Get the reachability statistics of all the contacts'''
+        return list(self.reachability.values())
+
+    def update_reachability_state(self, torid, state):
+        '''Store the reachability statistics of the given contact'''
+        self.reachability[torid] = dict(state)
+        self.num_reachability_updates += 1
+
     def add_row_to_inbox(self, msg):
         '''React to storing messages in the inbox'''
         self.inbox.append(msg)
@@ -38,7 +92,8 @@ class MockDatabase(Component):
     def get_profile(self, torid=None):
         '''Get the profile for this torid'''
         for profile in self.profiles:
-            if profile and profile.get('torid') == torid:
+            if profile and (profile.get('torid') == torid
+                            or torid is None and profile.get('status') == "self"):
                 return profile
         return None
 
@@ -69,20 +124,65 @@ class MockCrypto(Component):
         result = "'%s' for '%s' signed by '%s'" % (message, recipient, own_key)
         return result.encode("utf-8")
 
+    @staticmethod
+    def sign_data(message, own_key):
+        '''Fake the signing of the given message'''
+        return bytes(message) + ("signed by '%s'" % own_key).encode("utf-8")
+
 
 class MockTransport:
     '''Class to replace the regular message-sending mechanism with a mock'''
-    def __init__(self, succeed):
+    def __init__(self, succeed, unreachable=None, peer_version=None):
         self.succeed = succeed
+        self.unreachable = unreachable or []
+        self.peer_version = peer_version
         self.num_sent = 0
+        self.num_unreachable = 0
+        self.sent = []
+        self.sent_to = {}
 
     def send_message(self, msg, whoto):
         '''Pretend to send the given message'''
+        if msg and whoto in self.unreachable:
+            self.num_unreachable += 1
+            return PostService.RC_MESSAGE_FAILED
         if msg and whoto:
             self.num_sent += 1
+            self.sent.append(msg)
+            self.sent_to[whoto] = msg
             return self.succeed
         return False
 
+    def get_peer_version(self, whoto):
+        '''Pretend to know the version of every peer'''
+        return self.peer_version if whoto else None
+
+
+class MockPooledTransport(MockTransport):
+    '''Transport which keeps connections open, and counts the calls to close them'''
+    def __init__(self):
+        MockTransport.__init__(self, PostService.RC_MESSAGE_SENT)
+        self.num_closes = 0
+
+    def get_idle_interval(self):
+        '''Ask for the idle connections to be closed every ten seconds'''
+        return 10
+
+    def close_idle(self):
+        '''Count the calls'''
+        self.num_closes += 1
+
+
+class MockTorClient(Component):
+    '''Transport component which isn't ready until it's told to be'''
+    def __init__(self, parent):
+        Component.__init__(self, parent, System.COMPNAME_TRANSPORT)
+        self.ready = False
+
+    def is_ready(self):
+        '''Return True if messages can be sent'''
+        return self.ready
+
 
 class PostServiceTest(unittest.TestCase):
     '''Tests for the handling of messages by the postal service'''
@@ -164,6 +264,432 @@ class PostServiceTest(unittest.TestCase):
         # Stop system again
         self.sys.stop()
 
+    def test_flush_after_pool_stopped(self):
+        '''Check that messages aren't lost if the senders can't take them'''
+        transport = MockTransport(PostService.RC_MESSAGE_SENT)
+        postman = PostService(self.sys, transport, num_senders=2, send_gap=0)
+        postman.set_timer_interval(None)
+        postman.should_broadcast = False
+        self.sys.add_component(postman)
+        self.fakedb.add_or_update_profile({"torid":"def1ghi2jkl3mno4", "status":"trusted"})
+        self.fakedb.add_row_to_outbox({"recipient":"def1ghi2jkl3mno4", "relays":None,
+                                       "message":"a1fa8008", "queue":True,
+                                       "msgType":"regular"})
+        postman.sender_pool.stop()
+        postman._flush()
+        self.assertEqual(0, transport.num_sent)
+        self.assertTrue(postman.scheduler.is_stale(), "queues reloaded next time")
+        postman.sender_pool.start()
+        postman._flush()
+        self.assertEqual(1, transport.num_sent)
+        self.sys.stop()
+
+    def test_flush_several_recipients(self):
+        '''Check that messages to several recipients are all sent and deleted'''
+        transport = MockTransport(PostService.RC_MESSAGE_SENT)
+        postman = PostService(self.sys, transport, num_senders=3, send_gap=0)
+        postman.set_timer_interval(0)
+        self.sys.add_component(postman)
+        recipients = ["abc1def2ghi3jkl%d" % i for i in range(4)]
+        for recpt in recipients:
+            self.fakedb.add_or_update_profile({"torid":recpt, "status":"trusted"})
+            for _ in range(3):
+                self.fakedb.add_row_to_outbox({"recipient":recpt, "relays":None,
+                                               "message":"a1fa8008", "queue":True,
+                                               "msgType":1})
+        postman.request_flush()
+        time.sleep(3)
+        self.assertEqual(12, transport.num_sent, "12 messages sent")
+        self.assertEqual(12, self.fakedb.num_msgs_deleted_from_outbox, "12 messages deleted")
+        self.assertEqual(4, postman.get_stats()["senders"]["jobs"], "1 job per recipient")
+        self.assertEqual(0, postman.get_stats()["queues"]["queued"], "nothing left queued")
+
+    def test_flush_recipient_list(self):
+        '''Check that a message with a recipient list is sent to each of them, then deleted'''
+        transport = MockTransport(PostService.RC_MESSAGE_SENT)
+        postman = PostService(self.sys, transport, num_senders=3, send_gap=0)
+        postman.set_timer_interval(0)
+        self.sys.add_component(postman)
+        recipients = ["abc1def2ghi3jkl%d" % i for i in range(3)]
+        for recpt in recipients:
+            self.fakedb.add_or_update_profile({"torid":recpt, "status":"trusted"})
+        self.fakedb.add_row_to_outbox({"recipientList":recipients, "message":"a1fa8008",
+                                       "queue":True, "msgType":"relay", "encType":3})
+        postman.request_flush()
+        time.sleep(3)
+        self.assertEqual(3, transport.num_sent, "3 messages sent")
+        self.assertEqual(1, self.fakedb.num_msgs_deleted_from_outbox, "1 message deleted")
+
+    def test_last_hop_only_when_known(self):
+        '''Only recipients known to understand it should get the last hop marker'''
+        versions = {"abc1def2ghi3jkl0":None, "abc1def2ghi3jkl1":LAST_HOP_VERSION}
+        transport = MockTransport(PostService.RC_MESSAGE_SENT)
+        transport.get_peer_version = versions.get
+        postman = PostService(self.sys, transport, num_senders=0, send_gap=0)
+        postman.set_timer_interval(None)
+        postman.should_broadcast = False
+        self.sys.add_component(postman)
+        for recpt in versions:
+            self.fakedb.add_or_update_profile({"torid":recpt, "status":"trusted"})
+        self.fakedb.add_row_to_outbox({"recipientList":sorted(versions), "message":"a1fa8008",
+                                       "lastHop":"b2fb9009", "queue":True, "msgType":"relay",
+                                       "encType":3})
+        postman._flush()
+        self.assertEqual(transport.sent_to, {"abc1def2ghi3jkl0":bytes.fromhex("a1fa8008"),
+                                             "abc1def2ghi3jkl1":bytes.fromhex("b2fb9009")})
+
+    def test_backoff_after_failure(self):
+        '''Check that a recipient who can't be reached isn't tried again straight away'''
+        transport = MockTransport(PostService.RC_MESSAGE_FAILED)
+        postman = PostService(self.sys, transport, num_senders=0)
+        postman.set_timer_interval(None)
+        postman.should_broadcast = False
+        self.sys.add_component(postman)
+        self.fakedb.add_or_update_profile({"torid":"def1ghi2jkl3mno4", "status":"trusted"})
+        self.fakedb.add_row_to_outbox({"recipient":"def1ghi2jkl3mno4", "relays":None,
+                                       "message":"a1fa8008", "queue":True, "msgType":1})
+        postman.request_flush()
+        postman._flush()
+        self.assertEqual(1, transport.num_sent, "1 attempt made")
+        self.assertEqual(1, self.fakedb.delivery["def1ghi2jkl3mno4"]["failures"])
+        # Flush again, recipient is backing off so no more attempts
+        postman._flush()
+        self.assertEqual(1, transport.num_sent, "no further attempts")
+        self.assertEqual(1, postman.get_stats()["queues"]["queued"], "message still queued")
+        # Hearing from the recipient should allow an attempt again
+        postman.set_recipient_online("def1ghi2jkl3mno4", True)
+        self.assertEqual(0, self.fakedb.delivery["def1ghi2jkl3mno4"]["failures"])
+        postman._flush()
+        self.assertEqual(2, transport.num_sent, "tried again")
+
+    def test_reachability(self):
+        '''Check that sends are recorded, and retries brought forward when usually online'''
+        clock = VirtualClock(start_time=3600 * 24 * 1000)
+        transport = MockTransport(PostService.RC_MESSAGE_SENT)
+        postman = PostService(self.sys, transport, num_senders=0, send_gap=0, clock=clock)
+        postman.set_timer_interval(None)
+        postman.should_broadcast = False
+        self.sys.add_component(postman)
+        self.fakedb.add_or_update_profile({"torid":"def1ghi2jkl3mno4", "status":"trusted"})
+        # Usually online from one o'clock
+        self.fakedb.update_reachability_state("def1ghi2jkl3mno4", {
+            "torid":"def1ghi2jkl3mno4", "successes":5, "failures":0,
+            "onlineHours":[0] + [5] * 23, "offlineHours":[0] * 24})
+        self.fakedb.add_row_to_outbox({"recipient":"def1ghi2jkl3mno4", "relays":None,
+                                       "message":"a1fa8008", "queue":True,
+                                       "msgType":"regular"})
+        postman._flush()
+        self.assertEqual(1, transport.num_sent)
+        self.assertEqual(6, self.fakedb.reachability["def1ghi2jkl3mno4"]["successes"])
+        self.assertEqual(0.0, postman.reachability.get_latency("def1ghi2jkl3mno4"))
+        # Now the sending fails again after many failures, but the next attempt
+        # shouldn't wait for hours
+        transport.succeed = PostService.RC_MESSAGE_FAILED
+        postman.set_recipient_online("def1ghi2jkl3mno4", False)
+        self.fakedb.update_delivery_state("def1ghi2jkl3mno4", {
+            "torid":"def1ghi2jkl3mno4", "failures":9, "nextAttempt":0})
+        postman.backoff.load(self.fakedb.get_delivery_states())
+        self.fakedb.add_row_to_outbox({"recipient":"def1ghi2jkl3mno4", "relays":None,
+                                       "message":"a1fa8008", "queue":True,
+                                       "msgType":"regular"})
+        postman._flush()
+        self.assertEqual(1, self.fakedb.reachability["def1ghi2jkl3mno4"]["failures"])
+        self.assertEqual(10, self.fakedb.delivery["def1ghi2jkl3mno4"]["failures"])
+        self.assertEqual(3600 * 24 * 1000 + 3600,
+                         self.fakedb.delivery["def1ghi2jkl3mno4"]["nextAttempt"])
+        self.assertEqual(1, postman.get_stats()["reachability"]["contacts"])
+        # We're told that we're online ourselves, but that shouldn't be recorded
+        self.fakedb.add_or_update_profile({"torid":"ownid1ownid2own3", "status":"self"})
+        postman.set_recipient_online("ownid1ownid2own3", True)
+        self.assertNotIn("ownid1ownid2own3", self.fakedb.reachability)
+        self.assertEqual(1, postman.get_stats()["reachability"]["contacts"])
+        # Hearing from an id we don't know doesn't add a row for it
+        postman.heard_from("unknown1unknown2")
+        self.assertNotIn("unknown1unknown2", self.fakedb.reachability)
+        postman.heard_from("def1ghi2jkl3mno4")
+        self.assertTrue(postman.backoff.is_due("def1ghi2jkl3mno4"))
+
+    def test_reachability_stored_once(self):
+        '''Check that the statistics are stored once per flush, not for every send'''
+        transport = MockTransport(PostService.RC_MESSAGE_SENT)
+        postman = PostService(self.sys, transport, num_senders=0, send_gap=0)
+        postman.set_timer_interval(None)
+        postman.should_broadcast = False
+        self.sys.add_component(postman)
+        self.fakedb.add_or_update_profile({"torid":"def1ghi2jkl3mno4", "status":"trusted"})
+        for _ in range(3):
+            self.fakedb.add_row_to_outbox({"recipient":"def1ghi2jkl3mno4", "relays":None,
+                                           "message":"a1fa8008", "queue":True,
+                                           "msgType":"regular"})
+        postman._flush()
+        self.assertEqual(3, transport.num_sent)
+        self.assertEqual(1, self.fakedb.num_reachability_updates)
+        self.assertEqual(3, self.fakedb.reachability["def1ghi2jkl3mno4"]["successes"])
+
+    def test_bandwidth(self):
+        '''Check that the sent bytes are counted and limited'''
+        clock = VirtualClock()
+        transport = MockTransport(PostService.RC_MESSAGE_SENT)
+        postman = PostService(self.sys, transport, num_senders=0, send_gap=0, clock=clock)
+        postman.set_timer_interval(None)
+        postman.should_broadcast = False
+        self.sys.add_component(postman)
+        postman.set_bandwidth_limits(100, None)
+        self.fakedb.add_or_update_profile({"torid":"def1ghi2jkl3mno4", "status":"trusted"})
+        for _ in range(3):
+            self.fakedb.add_row_to_outbox({"recipient":"def1ghi2jkl3mno4", "relays":None,
+                                           "message":"ab" * 300, "queue":True,
+                                           "msgType":"regular"})
+        start_time = clock.monotonic()
+        postman._flush()
+        self.assertEqual(3, transport.num_sent)
+        self.assertGreaterEqual(clock.monotonic() - start_time, 5.0, "sending was limited")
+        stats = postman.get_stats()["bandwidth"]
+        self.assertEqual({"regular":900}, stats["bytesbytype"])
+        self.assertEqual(2, stats["throttled"])
+
+    def add_regular_messages(self, num_msgs, recipient="def1ghi2jkl3mno4"):
+        '''Add the given number of encrypted regular messages to the outbox'''
+        reg = RegularMessage()
+        reg.set_field(reg.FIELD_MSGBODY, "Hello")
+        msg_hex = imageutils.bytes_to_string(reg.create_output(encrypter=None))
+        for _ in range(num_msgs):
+            self.fakedb.add_row_to_outbox({"recipient":recipient, "relays":None,
+                                           "message":msg_hex, "queue":True,
+                                           "msgType":"regular", "encType":1})
+
+    def test_envelopes(self):
+        '''Check that several messages for a new enough recipient go in envelopes'''
+        transport = MockTransport(PostService.RC_MESSAGE_SENT, peer_version=3)
+        postman = PostService(self.sys, transport, num_senders=0, send_gap=0)
+        postman.set_timer_interval(None)
+        postman.should_broadcast = False
+        postman.max_envelope_messages = 4
+        self.sys.add_component(postman)
+        self.fakedb.add_or_update_profile({"torid":"def1ghi2jkl3mno4", "status":"trusted"})
+        self.fakedb.add_or_update_profile({"torid":"abc1def2ghi3jkl4", "status":"trusted"})
+        self.add_regular_messages(9)
+        self.add_regular_messages(1, "abc1def2ghi3jkl4")
+        postman._flush()
+        # Envelopes of 4 and 4, then one on its own, and one for the other recipient
+        self.assertEqual(4, transport.num_sent)
+        self.assertEqual(10, self.fakedb.num_msgs_deleted_from_outbox, "all deleted")
+        envelopes = [Message.from_received_data(sent) for sent in transport.sent]
+        self.assertEqual([len(msg.messages) for msg in envelopes
+                          if isinstance(msg, EnvelopeMessage)], [4, 4])
+        self.assertEqual(postman.get_stats()["bandwidth"]["messagesbytype"]["envelope"], 2)
+
+    def test_no_envelopes(self):
+        '''Check that envelopes aren't used for old recipients, or when they fail'''
+        for version, succeed in [(2, PostService.RC_MESSAGE_SENT),
+                                 (3, PostService.RC_MESSAGE_FAILED)]:
+            transport = MockTransport(succeed, peer_version=version)
+            postman = PostService(self.sys, transport, num_senders=0, send_gap=0)
+            postman.set_timer_interval(None)
+            postman.should_broadcast = False
+            self.sys.add_component(postman)
+            self.fakedb.add_or_update_profile({"torid":"def1ghi2jkl3mno4", "status":"trusted"})
+            self.fakedb.outbox = []
+            self.add_regular_messages(3)
+            postman._flush()
+            sent_types = [Message.from_received_data(bytes(sent)).describe_message_type()
+                          for sent in transport.sent]
+            if succeed == PostService.RC_MESSAGE_SENT:
+                self.assertEqual(sent_types, ["regular"] * 3)
+            else:
+                self.assertEqual(sent_types, ["envelope"], "not tried again one by one")
+                self.assertEqual(3, len([row for row in self.fakedb.outbox if row]))
+            self.sys.remove_component(System.COMPNAME_POSTSERVICE)
+
+    def test_acks(self):
+        '''Check that an ack stops the delivery, and tells the relays to drop their copies'''
+        recipient, relay = ("def1ghi2jkl3mno4", "abc1def2ghi3jkl4")
+        transport = MockTransport(PostService.RC_MESSAGE_SENT, unreachable=[recipient])
+        postman = PostService(self.sys, transport, num_senders=0, send_gap=0)
+        postman.set_timer_interval(None)
+        postman.should_broadcast = False
+        self.sys.add_component(postman)
+        self.fakedb.add_or_update_profile({"torid":None, "status":"self",
+                                           "keyid":"ownkey"})
+        for torid in [recipient, relay]:
+            self.fakedb.add_or_update_profile({"torid":torid, "status":"trusted",
+                                               "keyid":torid + "_key"})
+        reg = RegularMessage()
+        reg.set_field(reg.FIELD_MSGBODY, "Aunt Sally")
+        reg.set_field(reg.FIELD_RECIPIENTS, recipient)
+        reg.recipients = [recipient]
+        dbutils.add_message_to_outbox(reg, self.fakecrypto, self.fakedb)
+        postman._flush()
+        row = self.fakedb.outbox[0]
+        self.assertEqual(row["relayedTo"], [relay], "relayed instead")
+        self.assertEqual(row["checksum"], Message.get_frame_checksum(
+            imageutils.string_to_bytes(row["message"])))
+        # We're also relaying a copy from the recipient, which it then acknowledges
+        self.fakedb.add_row_to_outbox({"recipientList":[relay], "message":"a1fa8008",
+                                       "queue":True, "msgType":"relay", "encType":3,
+                                       "checksum":"0123", "origin":recipient})
+        postman.acknowledge(recipient, [row["checksum"], "0123", "4567"])
+        self.assertEqual(self.fakedb.outbox[:2], [None, None], "both deleted")
+        num_sent = transport.num_sent
+        postman._flush()
+        self.assertEqual(transport.num_sent, num_sent + 1, "ack passed on to the relay")
+        self.assertEqual(3, self.fakedb.num_msgs_added_to_outbox)
+        self.assertIn(b"checksums", transport.sent[-1])
+        self.assertIn((relay + "_key").encode("utf-8"), transport.sent[-1], "encrypted for relay")
+        self.assertEqual(postman.get_stats()["acks"],
+                         {"queued":1, "sent":1, "received":1, "acked":1, "cancelled":1,
+                          "pending":0})
+        # Nobody else may cancel our messages
+        postman.acknowledge(relay, ["0123"])
+        self.assertEqual(postman.get_stats()["acks"]["cancelled"], 1)
+
+    def test_relay_fanout_and_hops(self):
+        '''Check that only fanout relays get a copy, with the configured number of hops'''
+        recipient = "def1ghi2jkl3mno4"
+        relays = ["relay%011d" % i for i in range(4)]
+        transport = MockTransport(PostService.RC_MESSAGE_SENT, unreachable=[recipient],
+                                  peer_version=RELAY_HOPS_VERSION)
+        postman = PostService(self.sys, transport, num_senders=0, send_gap=0)
+        postman.set_timer_interval(None)
+        postman.should_broadcast = False
+        self.sys.add_component(postman)
+        postman.relay_fanout = 2
+        postman.relay_hops = 3
+        self.fakedb.add_or_update_profile({"torid":None, "status":"self",
+                                           "keyid":"ownkey"})
+        for torid in [recipient] + relays:
+            self.fakedb.add_or_update_profile({"torid":torid, "status":"trusted",
+                                               "keyid":torid + "_key"})
+        reg = RegularMessage()
+        reg.set_field(reg.FIELD_MSGBODY, "Aunt Sally")
+        reg.set_field(reg.FIELD_RECIPIENTS, recipient)
+        reg.recipients = [recipient]
+        dbutils.add_message_to_outbox(reg, self.fakecrypto, self.fakedb)
+        postman._flush()
+        row = self.fakedb.outbox[0]
+        self.assertEqual(transport.num_sent, 2, "only two relays")
+        self.assertEqual(len(row["relayedTo"]), 2)
+        self.assertEqual(row["relays"], [], "no more relays needed")
+        for sent in transport.sent:
+            self.assertEqual(sent[HEADER_LENGTH - 5], Message.ENCTYPE_RELAY_HOPS)
+            self.assertEqual(sent[HEADER_LENGTH], 3, "number of hops")
+        # Relays known to be too old only get a single hop
+        transport.peer_version = RELAY_HOPS_VERSION - 1
+        self.assertEqual(postman._add_relay_hops(b"blob", relays[0]), b"blob")
+
+    def test_expired_messages(self):
+        '''Check that expired messages are removed instead of being sent'''
+        transport = MockTransport(PostService.RC_MESSAGE_SENT)
+        postman = PostService(self.sys, transport, num_senders=0)
+        postman.set_timer_interval(None)
+        postman.should_broadcast = False
+        self.sys.add_component(postman)
+        self.fakedb.add_or_update_profile({"torid":"def1ghi2jkl3mno4", "status":"trusted"})
+        old_time = time.time() - 3600
+        for msg_type in ["statusnotify", "regular"]:
+            self.fakedb.add_row_to_outbox({"recipient":"def1ghi2jkl3mno4", "relays":None,
+                                           "message":"a1fa8008", "queue":True,
+                                           "msgType":msg_type, "timestamp":old_time})
+        postman.request_flush()
+        postman._flush()
+        self.assertEqual(1, transport.num_sent, "only regular message sent")
+        self.assertEqual(2, self.fakedb.num_msgs_deleted_from_outbox, "both deleted")
+        self.assertEqual([], self.fakedb.deadletters, "status notify not kept")
+        self.assertEqual(1, postman.get_stats()["expiry"]["expired"])
+
+    def test_wake_on_request(self):
+        '''Check that a burst of requests is sent quickly without starting new threads'''
+        transport = MockTransport(PostService.RC_MESSAGE_SENT)
+        postman = PostService(self.sys, transport, num_senders=2, send_gap=0)
+        postman.set_timer_interval(0)
+        self.sys.add_component(postman)
+        self.fakedb.add_or_update_profile({"torid":"def1ghi2jkl3mno4", "status":"trusted"})
+        time.sleep(0.5)
+        num_threads = threading.active_count()
+        for _ in range(20):
+            row = {"recipient":"def1ghi2jkl3mno4", "relays":None, "message":"a1fa8008",
+                   "queue":True, "msgType":"regular"}
+            self.fakedb.add_row_to_outbox(row)
+            postman.request_flush(new_row=row)
+            self.assertLessEqual(threading.active_count(), num_threads, "no new threads")
+        time.sleep(0.5)
+        self.assertEqual(20, transport.num_sent, "all sent without waiting for a timer")
+        self.assertEqual(20, self.fakedb.num_msgs_deleted_from_outbox)
+
+    def test_wait_for_transport(self):
+        '''Check that nothing is sent until the transport says that it's ready'''
+        tor_client = MockTorClient(self.sys)
+        self.sys.add_component(tor_client)
+        transport = MockTransport(PostService.RC_MESSAGE_SENT)
+        postman = PostService(self.sys, transport, num_senders=0, send_gap=0)
+        postman.set_timer_interval(0)
+        self.sys.add_component(postman)
+        self.fakedb.add_or_update_profile({"torid":"def1ghi2jkl3mno4", "status":"trusted"})
+        row = {"recipient":"def1ghi2jkl3mno4", "relays":None, "message":"a1fa8008",
+               "queue":True, "msgType":"regular"}
+        self.fakedb.add_row_to_outbox(row)
+        time.sleep(0.3)
+        self.assertEqual(0, transport.num_sent, "not sent before the transport is ready")
+        tor_client.ready = True
+        postman.set_transport_ready(ready=True)
+        time.sleep(0.3)
+        self.assertEqual(1, transport.num_sent, "sent as soon as the transport is ready")
+
+    def test_told_before_start(self):
+        '''If the transport has already said that it's ready, that shouldn't be undone'''
+        tor_client = MockTorClient(self.sys)
+        self.sys.add_component(tor_client)
+        postman = PostService(self.sys, MockTransport(PostService.RC_MESSAGE_SENT))
+        postman.set_timer_interval(None)
+        postman.set_transport_ready(ready=True)
+        self.sys.add_component(postman)
+        self.assertTrue(postman.transport_ready, "not asked again")
+
+    def test_close_idle_connections(self):
+        '''Idle connections should be closed regularly, even when nothing is being sent'''
+        clock = VirtualClock()
+        transport = MockPooledTransport()
+        postman = PostService(self.sys, transport, num_senders=0, clock=clock, threaded=False)
+        postman.set_timer_interval(0)
+        self.sys.add_component(postman)
+        postman.run_for(35)
+        self.assertEqual(transport.num_closes, 3)
+        self.assertEqual(transport.num_sent, 0)
+
+    def test_simulated_hours(self):
+        '''Check backoff, broadcasts and expiry over many hours using a virtual clock'''
+        clock = VirtualClock()
+        previous_clock = set_default_clock(clock)
+        try:
+            transport = MockTransport(PostService.RC_MESSAGE_SENT,
+                                      unreachable=["def1ghi2jkl3mno4"])
+            postman = PostService(self.sys, transport, num_senders=0, send_gap=3,
+                                  clock=clock, threaded=False)
+            postman.set_timer_interval(30)
+            self.sys.add_component(postman)
+            self.fakedb.add_or_update_profile({"torid":None, "status":"self"})
+            for torid in ["def1ghi2jkl3mno4", "abc1def2ghi3jkl4"]:
+                self.fakedb.add_or_update_profile({"torid":torid, "status":"trusted",
+                                                   "keyid":"somekey"})
+            self.fakedb.add_row_to_outbox({"recipient":"def1ghi2jkl3mno4", "relays":None,
+                                           "message":"a1fa8008", "queue":True,
+                                           "msgType":"inforequest", "timestamp":clock.time()})
+            start_time = time.monotonic()
+            postman.request_flush()
+            postman.run_for(25 * 3600)
+            self.assertLess(time.monotonic() - start_time, 20, "much faster than real time")
+            # Status sent to the reachable contact about every 5 minutes
+            self.assertGreater(transport.num_sent, 250)
+            self.assertLess(transport.num_sent, 350)
+            # Only a few attempts to the unreachable one thanks to the backoff
+            self.assertLess(transport.num_unreachable, 40)
+            self.assertGreater(transport.num_unreachable, 5)
+            # The info request has expired
+            self.assertIsNone(self.fakedb.outbox[0], "expired")
+            self.assertEqual(1, postman.get_stats()["expiry"]["bytype"]["inforequest"])
+        finally:
+            set_default_clock(previous_clock)
+
 
 if __name__ == "__main__":
     unittest.main()
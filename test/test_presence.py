@@ -0,0 +1,99 @@
+'''Module for testing the adaptive scheduling of presence notifications'''
+
+import unittest
+from murmeli.presence import PresenceScheduler
+
+
+class FakeClock:
+    '''Clock which only moves when told to'''
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class PresenceSchedulerTest(unittest.TestCase):
+    '''Tests for the presence scheduler'''
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_scheduler(self, **kwargs):
+        '''Make a scheduler without any jitter'''
+        return PresenceScheduler(base_interval=100, max_interval=1000, clock=self.clock,
+                                 rand=lambda: 0.5, **kwargs)
+
+    def test_intervals(self):
+        '''Intervals should grow with misses up to the maximum, and be jittered'''
+        presence = self.make_scheduler()
+        self.assertEqual(presence.get_interval("albert"), 100)
+        for _ in range(3):
+            presence.record_unreachable("albert")
+        self.assertEqual(presence.get_interval("albert"), 800)
+        presence.record_unreachable("albert")
+        self.assertEqual(presence.get_interval("albert"), 1000)
+        presence.rand = lambda: 1.0
+        self.assertAlmostEqual(presence.get_interval("bertha"), 130)
+        presence.record_reachable("albert")
+        self.assertAlmostEqual(presence.get_interval("albert"), 130)
+
+    def test_select_until_due(self):
+        '''Contacts should only be selected again once their interval has passed'''
+        presence = self.make_scheduler()
+        self.assertEqual(presence.select_contacts(["albert", "bertha"]), ["albert", "bertha"])
+        self.assertEqual(presence.select_contacts(["albert", "bertha"]), [])
+        self.clock.now += 100
+        self.assertEqual(presence.select_contacts(["albert", "bertha"]), ["albert", "bertha"])
+        presence.make_all_due()
+        self.assertEqual(presence.select_contacts(["albert"]), ["albert"])
+
+    def test_cap_most_overdue_first(self):
+        '''Only the maximum number should be chosen per cycle, the most overdue first'''
+        presence = self.make_scheduler(max_per_cycle=2)
+        self.assertEqual(presence.select_contacts(["albert", "bertha"]), ["albert", "bertha"])
+        self.clock.now += 50
+        self.assertEqual(presence.select_contacts(["charles"]), ["charles"])
+        self.clock.now += 200
+        self.assertEqual(presence.select_contacts(["charles", "bertha", "albert", "doris"]),
+                         ["doris", "albert"])
+        self.assertEqual(presence.get_stats()["deferred"], 2)
+        self.assertEqual(presence.select_contacts(["charles", "bertha", "albert", "doris"]),
+                         ["bertha", "charles"])
+
+    def test_heard_from(self):
+        '''Hearing from a contact should postpone its probe and clear its misses'''
+        presence = self.make_scheduler()
+        presence.record_unreachable("albert")
+        presence.record_unreachable("albert")
+        self.assertEqual(presence.get_stats()["unreachable"], 1)
+        presence.heard_from("albert")
+        self.assertEqual(presence.select_contacts(["albert", "bertha"]), ["bertha"])
+        self.clock.now += 100
+        self.assertEqual(presence.select_contacts(["albert"]), ["albert"])
+        self.assertEqual(presence.get_stats(), {"probed":2, "postponed":1, "deferred":0,
+                                                "unreachable":0})
+
+    def test_usually_online(self):
+        '''Contacts usually online at this time should be probed often and first'''
+        presence = self.make_scheduler(reachability=FakeReachability(["bertha"]))
+        for _ in range(5):
+            presence.record_unreachable("albert")
+            presence.record_unreachable("bertha")
+        self.assertEqual(presence.select_contacts(["albert", "bertha"]), ["bertha", "albert"])
+        self.clock.now += 100
+        self.assertEqual(presence.select_contacts(["albert", "bertha"]), ["bertha"])
+
+
+class FakeReachability:
+    '''Reachability model which knows who is usually online'''
+    def __init__(self, online):
+        self.online = online
+
+    def is_likely_online(self, tor_id, when):
+        '''Return True for the contacts given at the start'''
+        return tor_id in self.online
+
+
+if __name__ == "__main__":
+    unittest.main()
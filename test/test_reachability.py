@@ -0,0 +1,97 @@
+'''Module for testing the reachability statistics of contacts'''
+
+import unittest
+from murmeli.reachability import ReachabilityModel, HOUR_SECS
+
+
+class FakeClock:
+    '''Clock which only moves when told to, starting at midnight'''
+    def __init__(self):
+        self.now = 1000 * 24 * HOUR_SECS
+
+    def __call__(self):
+        return self.now
+
+
+class ReachabilityModelTest(unittest.TestCase):
+    '''Tests for the reachability model'''
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.model = ReachabilityModel(clock=self.clock)
+
+    def live_days(self, tor_id, online_hours, num_days=3):
+        '''Simulate some days of sending every ten minutes, succeeding in the given hours'''
+        for _ in range(num_days * 24 * 6):
+            if int(self.clock.now // HOUR_SECS) % 24 in online_hours:
+                self.model.record_success(tor_id)
+            else:
+                self.model.record_failure(tor_id)
+            self.clock.now += 600
+
+    def test_counts(self):
+        '''Successes and failures should be counted, hours only once each'''
+        self.model.record_success("albert")
+        self.model.record_success("albert")
+        state = self.model.record_failure("albert")
+        self.assertEqual(state["successes"], 2)
+        self.assertEqual(state["failures"], 1)
+        self.assertEqual(state["onlineHours"][0], 1)
+        self.assertEqual(state["offlineHours"][0], 1)
+        self.assertIsNone(self.model.record_seen("albert"), "hour already counted")
+        self.clock.now += HOUR_SECS
+        self.assertEqual(self.model.record_seen("albert")["onlineHours"][1], 1)
+        self.assertEqual(self.model.get_stats(), {"contacts":1, "likelyonline":0,
+                                                  "successes":2, "failures":1})
+
+    def test_changed_states(self):
+        '''The states changed by sends should be returned once'''
+        self.assertEqual(self.model.take_changed_states(), [])
+        self.model.record_success("albert")
+        self.model.record_failure("betty")
+        self.model.record_success("albert")
+        self.assertIsNone(self.model.record_seen("albert"))
+        changed = self.model.take_changed_states()
+        self.assertEqual([state["torid"] for state in changed], ["albert", "betty"])
+        self.assertEqual(changed[0]["successes"], 2)
+        self.assertEqual(self.model.take_changed_states(), [])
+
+    def test_latency(self):
+        '''The latency should be a moving average'''
+        self.assertIsNone(self.model.get_latency("albert"))
+        self.model.record_success("albert", latency=10.0)
+        self.assertEqual(self.model.get_latency("albert"), 10.0)
+        self.model.record_success("albert", latency=20.0)
+        self.assertAlmostEqual(self.model.get_latency("albert"), 12.0)
+        self.model.record_success("albert")
+        self.assertAlmostEqual(self.model.get_latency("albert"), 12.0, msg="no time, no change")
+
+    def test_predictions(self):
+        '''Regular online hours should be learnt'''
+        self.assertEqual(self.model.get_online_probability("albert"), 0.5, "no history")
+        self.live_days("albert", [18, 19])
+        self.assertTrue(self.model.is_likely_online("albert", self.clock.now + 18.5 * HOUR_SECS))
+        self.assertFalse(self.model.is_likely_online("albert", self.clock.now + 3 * HOUR_SECS))
+        self.assertEqual(self.model.get_next_likely_online("albert"),
+                         self.clock.now + 18 * HOUR_SECS)
+        self.assertIsNone(self.model.get_next_likely_online("bertha"), "no history")
+
+    def test_ordering_and_loading(self):
+        '''Recipients likely to be online now should come first, also after reloading'''
+        self.live_days("albert", [2, 3, 4])
+        self.live_days("bertha", [])
+        self.clock.now += 3 * HOUR_SECS
+        self.assertEqual(self.model.order_recipients(["bertha", "charles", "albert"]),
+                         ["albert", "charles", "bertha"])
+        states = [self.model.record_seen(tor_id) or self.model.record_failure(tor_id)
+                  for tor_id in ["albert", "bertha"]]
+        reloaded = ReachabilityModel(clock=self.clock)
+        self.assertFalse(reloaded.loaded)
+        reloaded.load(states + [None, {}])
+        self.assertTrue(reloaded.loaded)
+        self.assertEqual(reloaded.order_recipients(["bertha", "charles", "albert"]),
+                         ["albert", "charles", "bertha"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+'''Module for testing the quotas on the storage of relayed messages'''
+
+import unittest
+from murmeli.system import System, Component
+from murmeli.supersimpledb import MurmeliDb
+from murmeli.relayquota import RelayQuota, EVICT_LARGEST_ORIGIN, is_relay_row, get_row_size
+
+
+class MockDatabase:
+    '''Outbox with just what the quota needs'''
+    def __init__(self):
+        self.outbox = []
+        self.num_reads = 0
+
+    def add_relay_row(self, origin, num_bytes, timestamp):
+        '''Add a relayed copy of the given size'''
+        self.outbox.append({"_id":len(self.outbox), "recipientList":["abc"], "origin":origin,
+                            "msgType":"relay", "message":"00" * num_bytes,
+                            "timestamp":timestamp})
+
+    def add_row_to_outbox(self, row):
+        '''Add the given row'''
+        row["_id"] = len(self.outbox)
+        self.outbox.append(row)
+
+    def get_outbox(self):
+        '''Get copies of the rows which haven't been deleted'''
+        self.num_reads += 1
+        return [dict(row) for row in self.outbox if row]
+
+    def delete_from_outbox(self, index):
+        '''Delete the given row'''
+        self.outbox[index] = None
+        return True
+
+    def get_origins(self):
+        '''Get the origins of the remaining rows'''
+        return [row.get("origin") for row in self.outbox if row]
+
+
+class QuotaHandler(Component):
+    '''Message handler with just the relay quota'''
+    def __init__(self, parent, quota):
+        Component.__init__(self, parent, System.COMPNAME_MSG_HANDLER)
+        self.quota = quota
+
+    def relay_row_deleted(self, row_id):
+        '''Pass on to the quota'''
+        self.quota.row_deleted(row_id)
+
+
+def make_relay_row(origin, num_bytes, timestamp):
+    '''Make a relayed copy of the given size'''
+    return {"recipientList":["abc"], "origin":origin, "msgType":"relay",
+            "message":"00" * num_bytes, "timestamp":timestamp}
+
+
+class RelayQuotaTest(unittest.TestCase):
+    '''Tests for the relay storage quotas'''
+
+    def setUp(self):
+        self.database = MockDatabase()
+
+    def test_store(self):
+        '''Stored copies should be counted without reading the outbox again'''
+        quota = RelayQuota(max_rows=None, max_bytes=100, max_origin_rows=2,
+                           max_origin_bytes=None)
+        self.database.add_relay_row("ford", 40, 0)
+        for timestamp in range(1, 4):
+            self.assertTrue(quota.store(self.database, "arthur",
+                                        make_relay_row("arthur", 20, timestamp)))
+        self.assertEqual(self.database.get_origins(), ["ford", "arthur", "arthur"])
+        self.assertIsNone(self.database.outbox[1], "oldest from arthur evicted")
+        self.assertTrue(quota.store(self.database, "zaphod", make_relay_row("zaphod", 30, 4)))
+        self.assertEqual(self.database.get_origins(), ["arthur", "arthur", "zaphod"])
+        self.assertEqual(self.database.num_reads, 1, "only read once")
+        self.assertFalse(quota.store(self.database, "zaphod", make_relay_row("zaphod", 101, 5)))
+        self.assertEqual(len(self.database.outbox), 5, "too big, so not stored")
+        # Once a copy has been deleted, there's room again without evicting anything
+        quota.row_deleted(4)
+        self.database.delete_from_outbox(4)
+        self.assertTrue(quota.store(self.database, "zaphod", make_relay_row("zaphod", 60, 6)))
+        self.assertEqual(self.database.get_origins(), ["arthur", "arthur", "zaphod"])
+        stats = quota.get_stats()
+        self.assertEqual((stats["evicted"], stats["rows"], stats["bytes"]), (2, 3, 100))
+
+    def test_deleted_from_database(self):
+        '''Deleting a relayed copy from the database should free its space in the quota'''
+        system = System()
+        quota = RelayQuota(max_rows=2, max_bytes=None, max_origin_rows=None,
+                           max_origin_bytes=None)
+        system.add_component(QuotaHandler(system, quota))
+        database = MurmeliDb(system)
+        system.add_component(database)
+        for timestamp in range(2):
+            self.assertTrue(quota.store(database, "ford", make_relay_row("ford", 10, timestamp)))
+        database.add_row_to_outbox({"recipient":"ford", "msgType":"regular", "message":"00"})
+        self.assertTrue(database.delete_from_outbox(0))
+        self.assertTrue(database.delete_from_outbox(2))
+        self.assertTrue(quota.store(database, "ford", make_relay_row("ford", 10, 3)))
+        self.assertEqual(quota.get_stats()["evicted"], 0)
+        self.assertEqual(len(database.get_outbox()), 2)
+        self.assertTrue(quota.store(database, "ford", make_relay_row("ford", 10, 4)))
+        self.assertEqual(quota.get_stats()["evicted"], 1)
+        self.assertIsNone(database.get_outbox_message(1), "oldest evicted")
+        system.stop()
+
+    def test_rows(self):
+        '''Check which rows count as relayed copies, and their sizes'''
+        self.database.add_relay_row("ford", 10, 1)
+        self.assertTrue(is_relay_row(self.database.outbox[0]))
+        self.assertEqual(get_row_size(self.database.outbox[0]), 10)
+        self.assertFalse(is_relay_row({"recipient":"abc", "msgType":"regular"}))
+        self.assertFalse(is_relay_row(None))
+
+    def test_origin_quota(self):
+        '''The oldest copies from the same origin should go first'''
+        quota = RelayQuota(max_origin_rows=2, max_origin_bytes=100)
+        self.database.add_relay_row("ford", 10, 3)
+        self.database.add_relay_row("ford", 10, 1)
+        self.database.add_relay_row("arthur", 10, 0)
+        self.database.outbox.append({"_id":3, "recipient":"ford", "msgType":"regular",
+                                     "message":"00" * 500, "timestamp":0})
+        self.assertTrue(quota.make_room(self.database, "arthur", 50))
+        self.assertEqual(len(self.database.get_outbox()), 4, "nothing evicted yet")
+        self.assertTrue(quota.make_room(self.database, "ford", 50))
+        self.assertIsNone(self.database.outbox[1], "oldest copy from ford evicted")
+        self.assertTrue(quota.make_room(self.database, "arthur", 95))
+        self.assertIsNone(self.database.outbox[2], "evicted for bytes")
+        self.assertEqual(self.database.get_origins(), ["ford", None])
+        self.assertFalse(quota.make_room(self.database, "arthur", 101), "too big")
+        stats = quota.get_stats()
+        self.assertEqual(stats["evicted"], 2)
+        self.assertEqual(stats["evictedbytes"], 20)
+        self.assertEqual(stats["rejected"], 1)
+        self.assertEqual(stats["byorigin"], {"ford":1, "arthur":1})
+
+    def test_oldest_first(self):
+        '''When the overall quota is full, the oldest copies should go first'''
+        quota = RelayQuota(max_rows=3, max_bytes=None, max_origin_rows=None,
+                           max_origin_bytes=None)
+        for index, origin in enumerate(["ford", "ford", "arthur", "zaphod"]):
+            self.database.add_relay_row(origin, 10, 10 - index)
+        self.assertTrue(quota.make_room(self.database, "trillian", 10))
+        self.assertEqual(self.database.get_origins(), ["ford", "ford"])
+        self.assertEqual(quota.get_stats()["rows"], 3)
+        self.assertEqual(quota.get_stats()["bytes"], 30)
+
+    def test_largest_origin_first(self):
+        '''With that policy, the copies from the origin using the most should go first'''
+        quota = RelayQuota(max_rows=None, max_bytes=100, max_origin_rows=None,
+                           max_origin_bytes=None, policy=EVICT_LARGEST_ORIGIN)
+        self.database.add_relay_row("arthur", 30, 0)
+        for timestamp in range(3):
+            self.database.add_relay_row("ford", 20, 5 - timestamp)
+        self.assertTrue(quota.make_room(self.database, "trillian", 30))
+        self.assertEqual(self.database.get_origins(), ["arthur", "ford", "ford"])
+        self.assertIsNone(self.database.outbox[3], "oldest from ford evicted")
+        self.assertTrue(quota.make_room(self.database, "trillian", 50))
+        self.assertEqual(self.database.get_origins(), ["arthur", "ford"])
+
+
+if __name__ == "__main__":
+    unittest.main()
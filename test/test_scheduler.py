@@ -0,0 +1,117 @@
+'''Module for testing the scheduler'''
+
+import unittest
+import threading
+import time
+from murmeli.scheduler import Scheduler, get_default_scheduler
+from murmeli.signals import Timer
+from murmeli.clock import VirtualClock
+
+
+class FakeClock:
+    '''Clock which only moves when told to'''
+    def __init__(self):
+        self.now = 50.0
+
+    def monotonic(self):
+        '''Get the current fake time'''
+        return self.now
+
+
+class SchedulerTest(unittest.TestCase):
+    '''Tests for the scheduler'''
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.calls = []
+
+    def make_target(self, name):
+        '''Make a target which records its calls'''
+        return lambda: self.calls.append((name, self.clock.now))
+
+    def test_order_and_cancel(self):
+        '''Calls should be run in order when they're due, unless cancelled'''
+        sched = Scheduler(clock=self.clock, threaded=False)
+        sched.call_later(5, self.make_target("b"))
+        sched.call_later(2, self.make_target("a"))
+        cancelled = sched.call_later(3, self.make_target("x"))
+        self.assertEqual(sched.get_next_time(), 52.0)
+        self.assertEqual(sched.run_pending(), 0, "nothing due yet")
+        cancelled.cancel()
+        self.assertEqual(sched.get_num_scheduled(), 2)
+        self.clock.now = 60.0
+        self.assertEqual(sched.run_pending(), 2)
+        self.assertEqual([name for name, _ in self.calls], ["a", "b"])
+        self.assertIsNone(sched.get_next_time())
+
+    def test_repeated(self):
+        '''Repeated calls should keep to their interval until cancelled'''
+        sched = Scheduler(clock=self.clock, threaded=False)
+        call = sched.call_repeatedly(10, self.make_target("r"), first_delay=1)
+        for now in [51, 55, 61, 71, 100]:
+            self.clock.now = now
+            sched.run_pending()
+        self.assertEqual(self.calls, [("r", 51), ("r", 61), ("r", 71), ("r", 100)])
+        self.assertEqual(sched.get_next_time(), 110, "falls back into step after being late")
+        call.cancel()
+        self.clock.now = 200
+        self.assertEqual(sched.run_pending(), 0)
+
+    def test_jitter_and_exceptions(self):
+        '''Jitter should spread the delays, and exceptions should be caught'''
+        sched = Scheduler(clock=self.clock, rand=lambda: 1.0, threaded=False)
+        self.assertEqual(sched.get_jittered(10, 0.2), 12.0)
+        sched.rand = lambda: 0.0
+        self.assertEqual(sched.get_jittered(10, 0.2), 8.0)
+        def bad_target():
+            raise ValueError("oops")
+        sched.call_later(1, bad_target, jitter=0.5)
+        self.assertEqual(sched.get_next_time(), 50.5)
+        self.clock.now = 51
+        sched.run_pending()
+        self.assertEqual(sched.get_stats(), {"scheduled":0, "run":1, "failed":1})
+
+    def test_run_for(self):
+        '''With a virtual clock, calls should be run at their times along the way'''
+        clock = VirtualClock(start_time=0.0)
+        sched = Scheduler(clock=clock, threaded=False)
+        times = []
+        sched.call_repeatedly(60, lambda: times.append(clock.time()))
+        timer = Timer(25, lambda: times.append(-clock.time()), repeated=False, scheduler=sched)
+        sched.run_for(3600)
+        self.assertEqual(clock.time(), 3600.0)
+        self.assertEqual(times[:3], [-25.0, 60.0, 120.0])
+        self.assertEqual(len(times), 61)
+        self.assertFalse(timer.running)
+
+    def test_thread(self):
+        '''With a thread, calls should be run with the real clock'''
+        sched = Scheduler()
+        sched.start()
+        called = threading.Event()
+        sched.call_later(0.1, called.set)
+        self.assertTrue(called.wait(timeout=2))
+        sched.stop()
+        self.assertFalse(sched.is_started())
+
+    def test_timers(self):
+        '''Timers should share the default scheduler and stop straight away'''
+        num_threads = threading.active_count()
+        called = []
+        timers = [Timer(0.05, lambda: called.append(1)) for _ in range(10)]
+        once = Timer(0.05, lambda: called.append(2), repeated=False)
+        time.sleep(0.3)
+        self.assertLessEqual(threading.active_count(), num_threads + 1)
+        for timer in timers:
+            timer.stop()
+        self.assertFalse(once.running, "only once")
+        self.assertEqual(called.count(2), 1)
+        self.assertGreater(called.count(1), 10)
+        num_called = len(called)
+        time.sleep(0.2)
+        self.assertEqual(len(called), num_called, "not called after stopping")
+        self.assertTrue(get_default_scheduler().is_started())
+
+
+if __name__ == "__main__":
+    unittest.main()
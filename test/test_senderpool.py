@@ -0,0 +1,101 @@
+'''Module for testing the pool of senders'''
+
+import unittest
+import threading
+import time
+from murmeli.senderpool import SenderPool
+from murmeli.clock import VirtualClock
+
+
+class SenderPoolTest(unittest.TestCase):
+    '''Tests for the sender pool'''
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.done = []
+        self.running_now = {}
+        self.max_running = {}
+
+    def make_job(self, recipient, index, duration=0.02):
+        '''Make a job which records when it runs'''
+        def job():
+            with self.lock:
+                self.running_now[recipient] = self.running_now.get(recipient, 0) + 1
+                self.max_running[recipient] = max(self.max_running.get(recipient, 0),
+                                                  self.running_now[recipient])
+            time.sleep(duration)
+            with self.lock:
+                self.running_now[recipient] -= 1
+                self.done.append((recipient, index))
+        return job
+
+    def test_order_per_recipient(self):
+        '''Jobs for each recipient should run in order, one at a time'''
+        pool = SenderPool(num_senders=4, send_gap=0)
+        pool.start()
+        for index in range(5):
+            for recipient in ["albert", "bertha", "cecil"]:
+                pool.submit(recipient, self.make_job(recipient, index))
+        self.assertTrue(pool.wait_until_idle(timeout=5))
+        self.assertEqual(len(self.done), 15)
+        for recipient in ["albert", "bertha", "cecil"]:
+            indexes = [index for recpt, index in self.done if recpt == recipient]
+            self.assertEqual(indexes, list(range(5)), "jobs run in order")
+            self.assertEqual(self.max_running[recipient], 1, "only one job at a time")
+        self.assertEqual(pool.get_stats()["jobs"], 15)
+        pool.stop()
+
+    def test_parallel_recipients(self):
+        '''Jobs for different recipients should run in parallel'''
+        pool = SenderPool(num_senders=8, send_gap=0)
+        pool.start()
+        start_time = time.monotonic()
+        for recipient in range(8):
+            pool.submit(recipient, self.make_job(recipient, 0, duration=0.3))
+        self.assertTrue(pool.wait_until_idle(timeout=5))
+        self.assertLess(time.monotonic() - start_time, 1.5, "jobs ran in parallel")
+        pool.stop()
+
+    def test_pacing(self):
+        '''Calls to pace should be spread out by the send gap'''
+        pool = SenderPool(num_senders=0, send_gap=0.1)
+        start_time = time.monotonic()
+        for _ in range(4):
+            pool.pace()
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.29)
+
+    def test_pacing_virtual_clock(self):
+        '''With a virtual clock, pacing moves the clock instead of waiting'''
+        clock = VirtualClock(start_time=100.0)
+        pool = SenderPool(num_senders=0, send_gap=3, clock=clock)
+        for _ in range(4):
+            pool.pace()
+        self.assertEqual(clock.time(), 109.0)
+
+    def test_inline(self):
+        '''With no senders, jobs run immediately'''
+        pool = SenderPool(num_senders=0)
+        pool.start()
+        pool.submit("dolly", self.make_job("dolly", 0, duration=0))
+        self.assertEqual(self.done, [("dolly", 0)])
+        self.assertTrue(pool.wait_until_idle(timeout=0))
+
+    def test_exception_and_stop(self):
+        '''Exceptions are counted, and after stopping no more jobs are taken'''
+        def bad_job():
+            raise ValueError("oops")
+        pool = SenderPool(num_senders=2, send_gap=0)
+        pool.start()
+        self.assertTrue(pool.submit("eric", bad_job))
+        self.assertTrue(pool.submit("eric", self.make_job("eric", 1)))
+        self.assertTrue(pool.wait_until_idle(timeout=5))
+        self.assertEqual(pool.get_stats()["failed"], 1)
+        self.assertEqual(self.done, [("eric", 1)])
+        pool.stop()
+        self.assertFalse(pool.submit("eric", self.make_job("eric", 2)), "not accepted")
+        self.assertTrue(pool.wait_until_idle(timeout=1))
+        self.assertEqual(len(self.done), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+'''Module for testing the simulation of a network of nodes'''
+
+import unittest
+from murmeli.simulator import NetworkSimulator, StandInCrypto, DeliveryTracker, get_percentile
+from murmeli.clock import VirtualClock, SystemClock, get_default_clock
+
+
+class StandInCryptoTest(unittest.TestCase):
+    '''Tests for the stand-in crypto'''
+
+    def test_encrypt(self):
+        '''Only the recipient can decrypt, and only known signers are recognised'''
+        alice = StandInCrypto(None, "AAAA")
+        bob = StandInCrypto(None, "BBBB")
+        carol = StandInCrypto(None, "CCCC")
+        encrypted = alice.encrypt_and_sign(b"Hi: there", "BBBB", "AAAA")
+        self.assertNotEqual(encrypted, alice.encrypt_and_sign(b"Hi: there", "BBBB", "AAAA"))
+        self.assertEqual(bob.decrypt_and_check_signature(encrypted), (b"Hi: there", None))
+        self.assertEqual(bob.import_public_key(alice.get_public_key("AAAA")), "AAAA")
+        self.assertEqual(bob.decrypt_and_check_signature(encrypted), (b"Hi: there", "AAAA"))
+        self.assertEqual(carol.decrypt_and_check_signature(encrypted), (None, None))
+        self.assertEqual(bob.decrypt_and_check_signature(b"rubbish"), (None, None))
+        self.assertIsNone(bob.get_public_key("CCCC"))
+        self.assertEqual(bob.get_keys(public_keys=True), [{"keyid":"AAAA"}, {"keyid":"BBBB"}])
+
+    def test_sign(self):
+        '''Signed data should only be verified with the signer's key'''
+        alice = StandInCrypto(None, "AAAA", overhead=100)
+        bob = StandInCrypto(None, "BBBB")
+        signed = alice.sign_data(b"relay me", "AAAA")
+        self.assertTrue(len(signed) > 100)
+        self.assertEqual(bob.verify_signed_data(signed), (None, None))
+        bob.import_public_key("standinkey:AAAA")
+        self.assertEqual(bob.verify_signed_data(signed), (b"relay me", "AAAA"))
+
+
+class DeliveryTrackerTest(unittest.TestCase):
+    '''Tests for the measuring of delivery latencies'''
+
+    def test_percentiles(self):
+        '''Check the nearest-rank percentiles'''
+        values = list(range(100, 0, -1))
+        self.assertEqual(get_percentile(values, 0.5), 50)
+        self.assertEqual(get_percentile(values, 0.99), 99)
+        self.assertEqual(get_percentile(values, 1.0), 100)
+        self.assertEqual(get_percentile([3], 0.1), 3)
+        self.assertIsNone(get_percentile([], 0.5))
+
+    def test_arrivals(self):
+        '''Each tagged message should be measured once for each recipient'''
+        clock = VirtualClock()
+        tracker = DeliveryTracker(clock)
+        body = tracker.make_body("regular", ["abc", "def"], "Hello")
+        clock.advance(5)
+        tracker.record_arrival("abc", {"messageBody":body})
+        tracker.record_arrival("abc", {"messageBody":body})
+        tracker.record_arrival("ghi", {"messageBody":"Not tagged"})
+        stats = tracker.get_stats()
+        self.assertEqual(stats["regular"]["sent"], 2)
+        self.assertEqual(stats["regular"]["delivered"], 1)
+        self.assertEqual(stats["regular"]["p50"], 5)
+        self.assertEqual(stats["unexpected"], 2)
+
+
+class NetworkSimulatorTest(unittest.TestCase):
+    '''Tests for running a small network'''
+
+    def setUp(self):
+        self.simulator = NetworkSimulator(8, num_friends=4, latency=1.0, jitter=0.0,
+                                          offline_fraction=0.0)
+        self.simulator.start()
+
+    def tearDown(self):
+        self.simulator.stop()
+        self.assertTrue(isinstance(get_default_clock(), SystemClock), "clock put back")
+
+    def test_traffic(self):
+        '''All the messages and referrals should arrive when all nodes are online'''
+        self.assertTrue(get_default_clock() is self.simulator.clock)
+        self.assertTrue(all(node.friends for node in self.simulator.nodes))
+        self.simulator.schedule_traffic(600, message_rate=30, referral_rate=6)
+        self.simulator.run(900)
+        report = self.simulator.get_report()
+        self.assertEqual(report["nodes"], 8)
+        for kind in ["regular", "referral"]:
+            stats = report["latency"][kind]
+            self.assertTrue(stats["sent"] > 0)
+            self.assertEqual(stats["delivered"], stats["sent"], kind)
+            self.assertTrue(1.0 <= stats["p50"] <= stats["max"] < 60)
+        self.assertEqual(report["latency"]["unexpected"], 0)
+        self.assertTrue(report["sentbytype"]["statusnotify"] > 0, "presence messages too")
+        self.assertTrue(report["amplification"] >= 1.0)
+        self.assertEqual(report["db"]["outboxrows"]["end"], 0, "outboxes emptied")
+        self.assertTrue(report["db"]["inboxrows"]["end"] > 0)
+        self.assertEqual(report["times"]["sim"], 900)
+
+    def test_offline_recipient(self):
+        '''A message for an offline node should arrive once it comes back'''
+        sender = self.simulator.nodes[0]
+        recipient = self.simulator.get_node(sorted(sender.friends)[0])
+        self.simulator.network.set_offline_schedule(recipient.tor_id, [(0, 600)])
+        self.simulator.send_message(sender)
+        self.simulator.run(3600)
+        stats = self.simulator.get_report()["latency"]["regular"]
+        self.assertEqual(stats["delivered"], 1)
+        self.assertTrue(stats["max"] >= 600)
+        self.assertTrue(self.simulator.network.get_stats()["offline"] > 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
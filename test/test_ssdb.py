@@ -218,6 +218,89 @@ class SsdbTest(unittest.TestCase):
         self.assertEqual(len(inbox), 1, "Inbox should now still have one message")
         self.assertEqual(len(ssdb.get_inbox()), 2, "Real Inbox should now have 2 message")
 
+    def test_delivery_states(self):
+        '''Test storing and updating the delivery states of recipients'''
+        ssdb = supersimpledb.MurmeliDb(None)
+        self.assertEqual(ssdb.get_delivery_states(), [], "No states at the start")
+        self.assertFalse(ssdb.update_delivery_state(None, {"failures":1}))
+        self.assertTrue(ssdb.update_delivery_state("abc", {"failures":1, "nextAttempt":5}))
+        self.assertTrue(ssdb.update_delivery_state("abc", {"failures":2, "nextAttempt":9}))
+        self.assertEqual(ssdb.get_delivery_states(),
+                         [{"torid":"abc", "failures":2, "nextAttempt":9}])
+
+    def test_reachability_states(self):
+        '''Test storing and updating the reachability statistics of contacts'''
+        ssdb = supersimpledb.MurmeliDb(None)
+        self.assertEqual(ssdb.get_reachability_states(), [], "No states at the start")
+        self.assertTrue(ssdb.update_reachability_state("abc", {"successes":1}))
+        self.assertTrue(ssdb.update_reachability_state("def", {"successes":0, "failures":1}))
+        self.assertTrue(ssdb.update_reachability_state("abc", {"successes":2, "latency":3.5}))
+        self.assertEqual(ssdb.get_reachability_states(),
+                         [{"torid":"abc", "successes":2, "latency":3.5},
+                          {"torid":"def", "successes":0, "failures":1}])
+        self.assertEqual(ssdb.get_delivery_states(), [], "Delivery table untouched")
+
+    def test_relay_seen_state(self):
+        '''Test storing and replacing the seen-set of relayed messages'''
+        ssdb = supersimpledb.MurmeliDb(None)
+        self.assertIsNone(ssdb.get_relay_seen_state(), "No state at the start")
+        ssdb.set_relay_seen_state({"current":"00ff", "count":1})
+        ssdb.set_relay_seen_state({"current":"01ff", "count":2})
+        state = ssdb.get_relay_seen_state()
+        self.assertEqual(state, {"current":"01ff", "count":2})
+        state["count"] = 3
+        self.assertEqual(ssdb.get_relay_seen_state()["count"], 2, "Only a copy was changed")
+
+    def test_coalescing_outbox(self):
+        '''Test that newer rows replace older ones with the same recipient and key'''
+        ssdb = supersimpledb.MurmeliDb(None)
+        ssdb.add_row_to_outbox({"recipient":"abc", "coalesceKey":"statusnotify", "ping":1})
+        ssdb.add_row_to_outbox({"recipient":"def", "coalesceKey":"statusnotify", "ping":1})
+        ssdb.add_row_to_outbox({"recipient":"abc", "coalesceKey":None, "text":"hello"})
+        ssdb.add_row_to_outbox({"recipient":"abc", "coalesceKey":None, "text":"hello"})
+        self.assertEqual(len(ssdb.get_outbox()), 4, "Nothing replaced yet")
+        ssdb.add_row_to_outbox({"recipient":"abc", "coalesceKey":"statusnotify", "ping":0})
+        self.assertEqual([row["_id"] for row in ssdb.get_outbox()], [1, 2, 3, 4])
+        self.assertEqual(ssdb.get_outbox_message(4)["ping"], 0)
+        # Row already deleted, so nothing else is replaced
+        self.assertTrue(ssdb.delete_from_outbox(4))
+        ssdb.add_row_to_outbox({"recipient":"abc", "coalesceKey":"statusnotify", "ping":1})
+        self.assertEqual([row["_id"] for row in ssdb.get_outbox()], [1, 2, 3, 5])
+
+    def test_outbox_checksums(self):
+        '''Test finding outbox rows by their checksums, also after loading'''
+        db_filename = "test_checksums.db"
+        self.assertFalse(os.path.exists(db_filename), "File %s shouldn't exist!" % db_filename)
+        ssdb = supersimpledb.MurmeliDb(None, db_filename)
+        ssdb.add_row_to_outbox({"recipient":"abc", "checksum":"1234"})
+        ssdb.add_row_to_outbox({"recipient":"abc", "coalesceKey":"statusnotify",
+                                "checksum":"5678"})
+        ssdb.add_row_to_outbox({"recipient":"def", "checksum":"1234"})
+        ssdb.add_row_to_outbox({"recipient":"abc", "text":"no checksum"})
+        self.assertEqual(ssdb.get_outbox_messages_with_checksums([]), [])
+        self.assertEqual(ssdb.get_outbox_messages_with_checksums(["9999"]), [])
+        rows = ssdb.get_outbox_messages_with_checksums(["1234", "5678"])
+        self.assertEqual([row["_id"] for row in rows], [0, 1, 2])
+        # Replaced and deleted rows aren't found any more
+        ssdb.add_row_to_outbox({"recipient":"abc", "coalesceKey":"statusnotify",
+                                "checksum":"9abc"})
+        self.assertTrue(ssdb.delete_from_outbox(0))
+        rows = ssdb.get_outbox_messages_with_checksums(["1234", "5678", "9abc"])
+        self.assertEqual([row["_id"] for row in rows], [2, 4])
+        ssdb.save_to_file()
+        loaded = supersimpledb.MurmeliDb(None, db_filename)
+        rows = loaded.get_outbox_messages_with_checksums(["1234", "5678", "9abc"])
+        self.assertEqual([(row["recipient"], row["checksum"]) for row in rows],
+                         [("def", "1234"), ("abc", "9abc")])
+        os.remove(db_filename)
+
+    def test_deadletters(self):
+        '''Test storing expired messages as dead letters'''
+        ssdb = supersimpledb.MurmeliDb(None)
+        self.assertEqual(ssdb.get_deadletters(), [], "No dead letters at the start")
+        ssdb.add_row_to_deadletters({"msgType":"regular", "recipient":"abc"})
+        self.assertEqual(ssdb.get_deadletters(), [{"msgType":"regular", "recipient":"abc"}])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -63,6 +63,30 @@ class SystemTest(unittest.TestCase):
         self.assertRaises(AttributeError, sys.invoke_call, "barney", "tomato")
         self.assertEqual(sys.invoke_call("barney", "count_fish"), 17, "Method invoked")
 
+    class StoringComponent(system.Component):
+        '''Component which stores something in another one before stopping'''
+        def __init__(self, parent, name, store_in):
+            system.Component.__init__(self, parent, name)
+            self.store_in = store_in
+            self.stored = []
+        def prepare_stop(self):
+            '''Store our state while the other component is running'''
+            if self.get_component(self.store_in).is_started():
+                self.stored.append(self.name)
+
+    def test_prepare_before_stop(self):
+        '''Test that all components are prepared before any of them stops'''
+        sys = system.System()
+        first = SystemTest.StoringComponent(sys, "first", "second")
+        sys.add_component(first)
+        second = SystemTest.StoringComponent(sys, "second", "first")
+        sys.add_component(second)
+        sys.stop()
+        self.assertEqual(first.stored, ["first"])
+        self.assertEqual(second.stored, ["second"])
+        self.assertFalse(first.started or second.started)
+        self.assertFalse(sys.components, "System empty")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,104 @@
+'''Module for testing the token buckets and the bandwidth limiter'''
+
+import threading
+import time
+import unittest
+from murmeli.tokenbucket import TokenBucket, BandwidthLimiter, get_traffic_class, \
+    CLASS_CONTACT, CLASS_BULK
+from murmeli.clock import VirtualClock
+
+
+class TokenBucketTest(unittest.TestCase):
+    '''Tests for the token bucket'''
+
+    def test_take_and_refill(self):
+        '''Tokens should be taken and refilled at the given rate'''
+        clock = VirtualClock()
+        bucket = TokenBucket(100, 200, clock=clock.monotonic)
+        self.assertTrue(bucket.take(150))
+        self.assertFalse(bucket.take(100))
+        self.assertAlmostEqual(bucket.get_wait(100), 0.5)
+        clock.advance(0.5)
+        self.assertTrue(bucket.take(100))
+        clock.advance(10)
+        self.assertEqual(bucket.get_wait(200), 0.0, "full but not beyond capacity")
+
+    def test_big_amounts(self):
+        '''Amounts bigger than the capacity should be allowed once the bucket is full'''
+        clock = VirtualClock()
+        bucket = TokenBucket(100, 200, clock=clock.monotonic)
+        self.assertTrue(bucket.take(500))
+        self.assertAlmostEqual(bucket.get_wait(1), 3.01)
+        clock.advance(5)
+        self.assertTrue(bucket.take(500))
+
+
+class BandwidthLimiterTest(unittest.TestCase):
+    '''Tests for the bandwidth limiter'''
+
+    def test_classes(self):
+        '''Message types should map to traffic classes'''
+        self.assertEqual(get_traffic_class("contactrequest"), CLASS_CONTACT)
+        self.assertEqual(get_traffic_class("relay"), CLASS_BULK)
+        self.assertEqual(get_traffic_class(None), get_traffic_class("regular"))
+
+    def test_no_limits(self):
+        '''Without limits there's no waiting, but the bytes are still counted'''
+        clock = VirtualClock()
+        limiter = BandwidthLimiter(clock=clock)
+        start_time = clock.monotonic()
+        for _ in range(10):
+            limiter.acquire("albert", 1000, "regular")
+        limiter.acquire("bertha", 50)
+        self.assertEqual(clock.monotonic(), start_time)
+        stats = limiter.get_stats()
+        self.assertEqual(stats["bytes"], 10050)
+        self.assertEqual(stats["bytesbytype"], {"regular":10000, "unknown":50})
+        self.assertEqual(stats["messagesbytype"], {"regular":10, "unknown":1})
+        self.assertEqual(stats["throttled"], 0)
+
+    def test_global_limit(self):
+        '''The global limit should slow down all the sending'''
+        clock = VirtualClock()
+        limiter = BandwidthLimiter(global_rate=1000, burst_secs=1.0, clock=clock)
+        start_time = clock.monotonic()
+        for peer in ["albert", "bertha", "charles", "doris"]:
+            limiter.acquire(peer, 1000, "regular")
+        self.assertAlmostEqual(clock.monotonic() - start_time, 3.0)
+        self.assertEqual(limiter.get_stats()["throttled"], 3)
+        self.assertAlmostEqual(limiter.get_stats()["throttledsecs"], 3.0)
+
+    def test_peer_limit(self):
+        '''The peer limit should only slow down sending to the same peer'''
+        clock = VirtualClock()
+        limiter = BandwidthLimiter(peer_rate=1000, burst_secs=1.0, clock=clock)
+        start_time = clock.monotonic()
+        for peer in ["albert", "bertha", "charles"]:
+            limiter.acquire(peer, 1000, "regular")
+        self.assertEqual(clock.monotonic(), start_time)
+        limiter.acquire("albert", 500, "regular")
+        self.assertAlmostEqual(clock.monotonic() - start_time, 0.5)
+        limiter.set_limits(None, None)
+        limiter.acquire("albert", 5000, "regular")
+        self.assertAlmostEqual(clock.monotonic() - start_time, 0.5)
+
+    def test_bulk_waits(self):
+        '''Bulk messages shouldn't go while a message of a higher class is waiting'''
+        limiter = BandwidthLimiter(global_rate=20000, burst_secs=0.05)
+        limiter.acquire("albert", 1000, "relay")
+        order = []
+        def send(peer, msg_type):
+            limiter.acquire(peer, 1000, msg_type)
+            order.append(msg_type)
+        regular = threading.Thread(target=send, args=("bertha", "regular"))
+        regular.start()
+        # Make sure the regular sender is already waiting before the relay arrives
+        while not order and not any(limiter._waiting.values()):
+            time.sleep(0.001)
+        send("charles", "relay")
+        regular.join()
+        self.assertEqual(order, ["regular", "relay"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,9 +2,13 @@
 
 import unittest
 import os
+import shutil
+import socket
+import sys as pysys
 import time
 import socks
 from murmeli import system
+from murmeli import guinotification
 from murmeli.torclient import TorClient
 from murmeli.message import ContactRequestMessage
 
@@ -21,6 +25,90 @@ class FakeMessageHandler(system.Component):
             self.messages.append(msg)
 
 
+class FakeNotifier(system.Component):
+    '''Gui notifier which remembers the notifications'''
+    def __init__(self, sys):
+        system.Component.__init__(self, sys, system.System.COMPNAME_GUI)
+        self.notifications = []
+
+    def notify_gui(self, notify_type):
+        '''Remember the notification'''
+        self.notifications.append(notify_type)
+
+
+class FakePostService(system.Component):
+    '''Post service which remembers when the transport was ready'''
+    def __init__(self, sys):
+        system.Component.__init__(self, sys, system.System.COMPNAME_POSTSERVICE)
+        self.ready_calls = []
+
+    def set_transport_ready(self, ready):
+        '''Remember the call'''
+        self.ready_calls.append(ready)
+
+
+def wait_for(condition, timeout=5.0):
+    '''Wait until the condition is true or the timeout runs out'''
+    end_time = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end_time:
+        time.sleep(0.05)
+    return condition()
+
+
+class FakeTorTest(unittest.TestCase):
+    '''Tests for the startup of the tor client, using a stand-in for tor'''
+
+    def setUp(self):
+        self.tordir = os.path.join("test", "outputdata", "faketor")
+        shutil.rmtree(self.tordir, ignore_errors=True)
+        os.makedirs(self.tordir)
+        os.environ["FAKE_TOR_DELAY"] = "1.0"
+        self.sys = system.System()
+        self.notifier = FakeNotifier(self.sys)
+        self.sys.add_component(self.notifier)
+        self.post = FakePostService(self.sys)
+        self.sys.add_component(self.post)
+        fake_tor = os.path.join(os.path.dirname(os.path.abspath(__file__)), "faketor.py")
+        self.tor_client = TorClient(self.sys, self.tordir, tor_exe=fake_tor)
+
+    def tearDown(self):
+        self.sys.stop()
+        os.environ.pop("FAKE_TOR_DELAY", None)
+
+    def test_startup(self):
+        '''The socket should be bound straight away, and readiness noticed from the log'''
+        start_time = time.monotonic()
+        self.sys.add_component(self.tor_client)
+        self.assertTrue(self.tor_client.started, "Tor started")
+        self.assertTrue(self.tor_client.socket_broker.listening.wait(1.0))
+        with socket.create_connection(("localhost", 11009), timeout=1.0):
+            self.assertLess(time.monotonic() - start_time, 1.0, "listening before bootstrap")
+        self.assertFalse(self.tor_client.is_ready())
+        self.assertFalse(self.post.ready_calls)
+        self.assertTrue(self.tor_client.get_own_torid().startswith("fakefake"))
+
+        self.assertTrue(self.tor_client.wait_until_ready(5.0), "bootstrap noticed")
+        ready_secs = time.monotonic() - start_time
+        self.assertTrue(1.0 <= ready_secs < 2.0, "noticed quickly: %.2f s" % ready_secs)
+        self.assertTrue(wait_for(lambda: self.post.ready_calls == [True]), "first flush kicked")
+        self.assertEqual(self.notifier.notifications.count(guinotification.NOTIFY_TOR_CONNECTED),
+                         1)
+        stats = self.tor_client.get_stats()["bootstrap"]
+        self.assertEqual(stats["progress"], 100)
+        self.assertTrue(stats["readysecs"] < 2.0)
+
+    def test_restart(self):
+        '''After a restart, the old log shouldn't make it look ready'''
+        self.sys.add_component(self.tor_client)
+        self.assertTrue(self.tor_client.wait_until_ready(5.0))
+        self.assertTrue(wait_for(lambda: self.post.ready_calls == [True]))
+        self.assertTrue(self.tor_client.start_tor(start_socket_broker=False))
+        self.assertFalse(self.tor_client.is_ready())
+        self.assertTrue(self.tor_client.wait_until_ready(5.0))
+        self.assertTrue(wait_for(lambda: self.post.ready_calls == [True, False, True]),
+                        "kicked again")
+
+
 class TorTest(unittest.TestCase):
     '''Tests for the tor communication'''
 